@@ -0,0 +1,160 @@
+"""
+Buffered user activity logging.
+
+``log_activity`` appends the event to an in-process buffer instead of
+inserting it. Once the buffer holds ``USER_ACTIVITY_MAX_PENDING`` events or
+``USER_ACTIVITY_FLUSH_INTERVAL`` seconds have passed, it is written with one
+``bulk_create`` after the current response has been sent (the
+``request_finished`` receiver in signals.py), and once more when the worker
+exits. Each event keeps the time it happened as ``created_at``, and the
+monthly partitions it belongs in are created before the insert if needed.
+
+Events still in memory when a worker is killed without a clean exit are
+lost. A flush that fails is retried with the next one.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import UserActivity
+from .partitions import create_partitions, is_partitioned, month_start
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 10
+DEFAULT_MAX_PENDING = 500
+BULK_BATCH_SIZE = 1000
+# Events kept across failing flushes before the oldest are dropped
+MAX_BUFFERED = 50000
+
+# Months known to have a partition (or all months when not partitioned)
+_partitioned = None
+_known_months = set()
+_partition_lock = threading.Lock()
+
+
+def ensure_activity_partitions(months):
+    """Create any missing monthly partitions among ``months``, once per process"""
+    global _partitioned
+    with _partition_lock:
+        if _partitioned is None:
+            _partitioned = is_partitioned()
+        if not _partitioned:
+            return []
+        missing = {month_start(month) for month in months} - _known_months
+        if not missing:
+            return []
+        created = create_partitions(missing)
+        _known_months.update(missing)
+        return created
+
+
+def write_activities(activities):
+    """Insert ``UserActivity`` instances in bulk; returns the number written"""
+    if not activities:
+        return 0
+    ensure_activity_partitions({activity.created_at for activity in activities})
+    with transaction.atomic():
+        UserActivity.objects.bulk_create(activities, batch_size=BULK_BATCH_SIZE)
+    return len(activities)
+
+
+class ActivityBuffer:
+    """Thread-safe per-process buffer of activities written in bulk"""
+
+    def __init__(self, flush_interval=None, max_pending=None):
+        self.flush_interval = flush_interval if flush_interval is not None else getattr(
+            settings, 'USER_ACTIVITY_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL
+        )
+        self.max_pending = max_pending if max_pending is not None else getattr(
+            settings, 'USER_ACTIVITY_MAX_PENDING', DEFAULT_MAX_PENDING
+        )
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._events = []
+        self._last_flush = time.monotonic()
+
+    def record(self, user_id, activity_type, ip_address=None, user_agent='', description='',
+               metadata=None, when=None):
+        activity = UserActivity(
+            user_id=user_id,
+            activity_type=activity_type,
+            ip_address=ip_address or None,
+            user_agent=user_agent or '',
+            description=description,
+            metadata=metadata or {},
+            created_at=when or timezone.now(),
+        )
+        with self._lock:
+            self._events.append(activity)
+            if len(self._events) > MAX_BUFFERED:
+                dropped = len(self._events) - MAX_BUFFERED
+                del self._events[:dropped]
+                logger.error('User activity buffer full; dropped %s oldest events', dropped)
+
+    @property
+    def due(self):
+        with self._lock:
+            if not self._events:
+                return False
+            return (
+                len(self._events) >= self.max_pending
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+
+    @property
+    def pending(self):
+        with self._lock:
+            return len(self._events)
+
+    def flush(self):
+        """Write buffered activities; returns the number written"""
+        if not self._flush_lock.acquire(blocking=False):
+            # Another thread is flushing; our events go out with the next batch
+            return 0
+        try:
+            with self._lock:
+                events, self._events = self._events, []
+                self._last_flush = time.monotonic()
+            try:
+                return write_activities(events)
+            except Exception:
+                logger.exception('User activity flush of %s events failed; will retry', len(events))
+                with self._lock:
+                    self._events[:0] = events
+                return 0
+        finally:
+            self._flush_lock.release()
+
+
+activity_buffer = ActivityBuffer()
+
+
+def log_activity(request, user, activity_type, **extra):
+    """Buffer an activity of ``user`` for the current request"""
+    activity_buffer.record(
+        user.pk,
+        activity_type,
+        ip_address=request.META.get('REMOTE_ADDR'),
+        user_agent=request.META.get('HTTP_USER_AGENT', ''),
+        **extra
+    )
+
+
+def flush_activities():
+    return activity_buffer.flush()
+
+
+def flush_activities_if_due():
+    if activity_buffer.due:
+        return activity_buffer.flush()
+    return 0
+
+
+atexit.register(flush_activities)
@@ -0,0 +1,60 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from accounts.models import UserActivity
+from accounts.partitions import (
+    add_months, create_partitions, drop_partitions, is_partitioned, month_start, months_between,
+)
+
+
+class Command(BaseCommand):
+    """Create upcoming user activity partitions and drop expired ones"""
+
+    help = (
+        'Create monthly UserActivity partitions USER_ACTIVITY_PARTITIONS_AHEAD months ahead and drop '
+        'months older than USER_ACTIVITY_RETENTION_MONTHS (run daily). Without partitioning '
+        '(non-PostgreSQL databases) expired rows are deleted in batches instead.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=None, help='Months of partitions to create ahead')
+        parser.add_argument('--retention', type=int, default=None, help='Months of activity to keep')
+        parser.add_argument('--batch-size', type=int, default=10000, help='Rows per DELETE when not partitioned')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be dropped')
+
+    def handle(self, *args, **options):
+        ahead = options['ahead'] if options['ahead'] is not None else getattr(
+            settings, 'USER_ACTIVITY_PARTITIONS_AHEAD', 2
+        )
+        retention = options['retention'] or getattr(settings, 'USER_ACTIVITY_RETENTION_MONTHS', 12)
+        now = timezone.now()
+        # Keep the current month plus `retention - 1` full months before it
+        cutoff = add_months(month_start(now), -(retention - 1))
+
+        if not is_partitioned():
+            self.handle_unpartitioned(cutoff, options)
+            return
+
+        if not options['dry_run']:
+            created = create_partitions(months_between(now, add_months(now, ahead)))
+            for name in created:
+                self.stdout.write(f'Created {name}')
+        dropped = drop_partitions(cutoff, dry_run=options['dry_run'])
+        for name in dropped:
+            self.stdout.write(f"{'Would drop' if options['dry_run'] else 'Dropped'} {name}")
+        self.stdout.write(self.style.SUCCESS(
+            f'{len(dropped)} partition(s) before {cutoff:%Y-%m} {"expired" if options["dry_run"] else "dropped"}'
+        ))
+
+    def handle_unpartitioned(self, cutoff, options):
+        expired = UserActivity.objects.filter(created_at__lt=cutoff)
+        if options['dry_run']:
+            self.stdout.write(f'Would delete {expired.count()} activities before {cutoff:%Y-%m}')
+            return
+        deleted = 0
+        while True:
+            ids = list(expired.values_list('pk', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            deleted += UserActivity.objects.filter(pk__in=ids).delete()[0]
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} activities before {cutoff:%Y-%m}'))
@@ -0,0 +1,107 @@
+# Generated by Django 5.2.5 on 2026-10-18 06:29
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+from accounts.partitions import (
+    ACTIVITY_TABLE, add_months, create_partitions, is_partitioned, months_between,
+)
+
+LEGACY_TABLE = f'{ACTIVITY_TABLE}_unpartitioned'
+
+
+def _table_definition(cursor, table):
+    """Secondary index and foreign key DDL of ``table``, to recreate after a rebuild"""
+    cursor.execute(
+        'SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s',
+        [table]
+    )
+    indexes = [definition for name, definition in cursor.fetchall() if name != f'{table}_pkey']
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+        [table]
+    )
+    foreign_keys = [
+        f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition}' for name, definition in cursor.fetchall()
+    ]
+    return indexes + foreign_keys
+
+
+def partition_activity_table(apps, schema_editor):
+    """Rebuild accounts_useractivity as a table partitioned by month of created_at"""
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql' or is_partitioned(ACTIVITY_TABLE, connection.alias):
+        return
+    with connection.cursor() as cursor:
+        definition = _table_definition(cursor, ACTIVITY_TABLE)
+        cursor.execute(f'SELECT MIN(created_at), MAX(id) FROM {ACTIVITY_TABLE}')
+        oldest, max_id = cursor.fetchone()
+        cursor.execute(
+            "SELECT attidentity <> '' FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'id'",
+            [ACTIVITY_TABLE]
+        )
+        identity = cursor.fetchone()[0]
+
+        cursor.execute(f'ALTER TABLE {ACTIVITY_TABLE} RENAME TO {LEGACY_TABLE}')
+        cursor.execute(
+            f'CREATE TABLE {ACTIVITY_TABLE} (LIKE {LEGACY_TABLE} INCLUDING DEFAULTS) '
+            f'PARTITION BY RANGE (created_at)'
+        )
+        now = timezone.now()
+        ahead = getattr(settings, 'USER_ACTIVITY_PARTITIONS_AHEAD', 2)
+        create_partitions(months_between(oldest or now, add_months(now, ahead)), using=connection.alias)
+        cursor.execute(f'INSERT INTO {ACTIVITY_TABLE} SELECT * FROM {LEGACY_TABLE}')
+
+        if identity:
+            # Identity columns aren't supported on partitioned tables before
+            # PostgreSQL 17, so ids come from an owned sequence instead
+            cursor.execute(f'DROP TABLE {LEGACY_TABLE}')
+            cursor.execute(f'CREATE SEQUENCE {ACTIVITY_TABLE}_id_seq OWNED BY {ACTIVITY_TABLE}.id')
+            cursor.execute(f"SELECT setval('{ACTIVITY_TABLE}_id_seq', %s)", [max(max_id or 0, 1)])
+            cursor.execute(
+                f"ALTER TABLE {ACTIVITY_TABLE} ALTER COLUMN id SET DEFAULT nextval('{ACTIVITY_TABLE}_id_seq')"
+            )
+        else:
+            # Serial column: the copied default already uses the old sequence
+            cursor.execute(f'ALTER SEQUENCE {ACTIVITY_TABLE}_id_seq OWNED BY {ACTIVITY_TABLE}.id')
+            cursor.execute(f'DROP TABLE {LEGACY_TABLE}')
+        # A partitioned table's primary key must include the partition key
+        cursor.execute(
+            f'ALTER TABLE {ACTIVITY_TABLE} ADD CONSTRAINT {ACTIVITY_TABLE}_pkey PRIMARY KEY (id, created_at)'
+        )
+        for statement in definition:
+            cursor.execute(statement)
+
+
+def unpartition_activity_table(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql' or not is_partitioned(ACTIVITY_TABLE, connection.alias):
+        return
+    with connection.cursor() as cursor:
+        definition = _table_definition(cursor, ACTIVITY_TABLE)
+        cursor.execute(f'ALTER TABLE {ACTIVITY_TABLE} RENAME TO {LEGACY_TABLE}')
+        cursor.execute(f'CREATE TABLE {ACTIVITY_TABLE} (LIKE {LEGACY_TABLE} INCLUDING DEFAULTS)')
+        cursor.execute(f'INSERT INTO {ACTIVITY_TABLE} SELECT * FROM {LEGACY_TABLE}')
+        cursor.execute(f'ALTER SEQUENCE {ACTIVITY_TABLE}_id_seq OWNED BY {ACTIVITY_TABLE}.id')
+        cursor.execute(f'DROP TABLE {LEGACY_TABLE}')
+        cursor.execute(f'ALTER TABLE {ACTIVITY_TABLE} ADD CONSTRAINT {ACTIVITY_TABLE}_pkey PRIMARY KEY (id)')
+        for statement in definition:
+            cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='useractivity',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(partition_activity_table, unpartition_activity_table),
+    ]
@@ -310,7 +310,9 @@ class UserActivity(models.Model):
     # Additional data (JSON)
     metadata = models.JSONField(default=dict, blank=True)
 
-    created_at = models.DateTimeField(auto_now_add=True)
+    # When the activity happened (set by the buffered writer, not at insert).
+    # Partition key on PostgreSQL, see partitions.py
+    created_at = models.DateTimeField(default=timezone.now)
 
     class Meta:
         app_label = 'accounts'
@@ -320,6 +322,7 @@ class UserActivity(models.Model):
         indexes = [
             models.Index(fields=['user', 'activity_type']),
             models.Index(fields=['created_at']),
+            models.Index(fields=['-created_at', '-id']),
         ]
 
     def __str__(self):
@@ -0,0 +1,120 @@
+"""
+Monthly range partitions for ``UserActivity`` (PostgreSQL).
+
+Migration 0003 turns ``accounts_useractivity`` into a table partitioned by
+``RANGE (created_at)`` with one child table per UTC calendar month, named
+``accounts_useractivity_pYYYY_MM``. Partitions are created ahead of time by
+``manage_activity_partitions`` and on demand by the activity writer, and
+months older than the retention period are dropped as whole tables instead
+of deleted row by row. Queries filtering on ``created_at`` only scan the
+partitions covering the range.
+
+On other databases the table is a plain table: the create functions are
+no-ops and retention falls back to batched deletes.
+"""
+
+import re
+from datetime import datetime, timezone as dt_timezone
+
+from django.db import connections
+
+ACTIVITY_TABLE = 'accounts_useractivity'
+
+_partition_suffix = re.compile(r'_p(\d{4})_(\d{2})$')
+
+
+def month_start(value):
+    """First instant (UTC) of the month containing ``value``"""
+    if value.tzinfo is not None:
+        value = value.astimezone(dt_timezone.utc)
+    return datetime(value.year, value.month, 1, tzinfo=dt_timezone.utc)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1, tzinfo=dt_timezone.utc)
+
+
+def months_between(start, end):
+    """Month starts from ``start``'s month through ``end``'s month"""
+    month, last = month_start(start), month_start(end)
+    months = []
+    while month <= last:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+def partition_name(month, table=ACTIVITY_TABLE):
+    return f'{table}_p{month:%Y_%m}'
+
+
+def is_partitioned(table=ACTIVITY_TABLE, using='default'):
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)', [table])
+        return cursor.fetchone() is not None
+
+
+def list_partitions(table=ACTIVITY_TABLE, using='default'):
+    """``[{'name', 'month', 'rows'}]`` oldest first; ``rows`` is the planner estimate"""
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT child.relname, child.reltuples FROM pg_inherits '
+            'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+            'WHERE pg_inherits.inhparent = to_regclass(%s)',
+            [table]
+        )
+        rows = cursor.fetchall()
+    partitions = []
+    for name, estimate in rows:
+        match = _partition_suffix.search(name)
+        if match:
+            partitions.append({
+                'name': name,
+                'month': datetime(int(match[1]), int(match[2]), 1, tzinfo=dt_timezone.utc),
+                'rows': max(int(estimate), 0),
+            })
+    return sorted(partitions, key=lambda partition: partition['month'])
+
+
+def create_partitions(months, table=ACTIVITY_TABLE, using='default'):
+    """Create the missing monthly partitions among ``months``; returns the names created"""
+    connection = connections[using]
+    if not is_partitioned(table, using):
+        return []
+    existing = {partition['month'] for partition in list_partitions(table, using)}
+    qn = connection.ops.quote_name
+    created = []
+    with connection.cursor() as cursor:
+        for month in sorted({month_start(month) for month in months} - existing):
+            name = partition_name(month, table)
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {qn(name)} PARTITION OF {qn(table)} '
+                f'FOR VALUES FROM (%s) TO (%s)',
+                [month, add_months(month, 1)]
+            )
+            created.append(name)
+    return created
+
+
+def drop_partitions(before, table=ACTIVITY_TABLE, using='default', dry_run=False):
+    """Drop partitions holding only rows older than ``before``'s month; returns their names"""
+    connection = connections[using]
+    cutoff = month_start(before)
+    expired = [
+        partition['name'] for partition in list_partitions(table, using)
+        if add_months(partition['month'], 1) <= cutoff
+    ]
+    if dry_run:
+        return expired
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        for name in expired:
+            cursor.execute(f'DROP TABLE IF EXISTS {qn(name)}')
+    return expired
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
 from django.utils.translation import gettext_lazy as _
+from shop_backend.compiled_serializers import CompiledListSerializer
 from .models import UserProfile, Address, UserActivity
 
 User = get_user_model()
@@ -60,6 +61,7 @@ class AddressSerializer(serializers.ModelSerializer):
 
 class UserActivitySerializer(serializers.ModelSerializer):
     """User activity serializer"""
+    timestamp = serializers.DateTimeField(source='created_at', read_only=True)
 
     class Meta:
         model = UserActivity
@@ -68,6 +70,7 @@ class UserActivitySerializer(serializers.ModelSerializer):
             'ip_address', 'user_agent', 'timestamp'
         ]
         read_only_fields = ['id', 'user', 'timestamp']
+        list_serializer_class = CompiledListSerializer
 
 
 class RegisterSerializer(serializers.ModelSerializer):
@@ -1,6 +1,8 @@
+from django.core.signals import request_finished
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.contrib.auth import get_user_model
+from .activity import flush_activities_if_due
 from .models import UserProfile
 
 User = get_user_model()
@@ -13,7 +15,7 @@ def create_user_profile(sender, instance, created, **kwargs):
         UserProfile.objects.create(user=instance)
 
 
-@receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
-    """Save user profile when user is saved"""
-    instance.profile.save()
+@receiver(request_finished, dispatch_uid='accounts.flush_user_activity')
+def flush_user_activity(sender, **kwargs):
+    """Write buffered user activities once enough are pending or the interval passed"""
+    flush_activities_if_due()
@@ -0,0 +1,33 @@
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.tokens import default_token_generator
+from django.core.mail import send_mail
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+from django.utils.translation import gettext as _
+from taskqueue.registry import task
+
+User = get_user_model()
+
+
+@task(queue='email')
+def send_password_reset_email(user_id):
+    """Email a password reset link"""
+    user = User.objects.filter(pk=user_id, is_active=True).first()
+    if user is None:
+        return
+    query = urlencode({
+        'uid': urlsafe_base64_encode(force_bytes(user.pk)),
+        'token': default_token_generator.make_token(user),
+    })
+    link = f'{settings.PASSWORD_RESET_URL}?{query}'
+    send_mail(
+        _('Reset your password'),
+        _('Use the link below to choose a new password:\n\n%(link)s\n\n'
+          'If you did not ask for a password reset you can ignore this email.') % {'link': link},
+        settings.DEFAULT_FROM_EMAIL,
+        [user.email],
+    )
+
@@ -1,3 +1,30 @@
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from rest_framework.test import APITestCase
 
-# Create your tests here.
+from .models import UserActivity
+
+User = get_user_model()
+
+
+class UserActivityListTests(APITestCase):
+    url = reverse('accounts:useractivity-list')
+
+    def setUp(self):
+        self.staff = User.objects.create_user(email='staff@example.com', password='secret', is_staff=True)
+        self.user = User.objects.create_user(email='user@example.com', password='secret')
+        UserActivity.objects.create(user=self.user, activity_type='login')
+        UserActivity.objects.create(user=self.staff, activity_type='login')
+        self.client.force_authenticate(self.staff)
+
+    def test_filter_by_user(self):
+        response = self.client.get(self.url, {'user': self.user.pk})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([activity['user'] for activity in response.data['results']], [self.user.pk])
+
+    def test_invalid_user_is_rejected(self):
+        response = self.client.get(self.url, {'user': 'abc'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('user', response.data)
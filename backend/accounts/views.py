@@ -1,14 +1,22 @@
 from rest_framework import viewsets, status, generics
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.exceptions import ValidationError
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, AllowAny
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate, get_user_model
-from django.utils.translation import gettext_lazy as _
-from django.core.mail import send_mail
 from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.translation import gettext_lazy as _
+from datetime import datetime, timedelta
+from shop_backend.exports import StreamingExportMixin
+from shop_backend.pagination import KeysetPagination
 from .models import UserProfile, Address, UserActivity
 from . import serializers
+from .activity import log_activity
+from .partitions import is_partitioned, list_partitions
+from .tasks import send_password_reset_email
 
 User = get_user_model()
 
@@ -67,16 +75,85 @@ class AddressViewSet(viewsets.ModelViewSet):
         serializer.save(user=self.request.user)
 
 
-class UserActivityViewSet(viewsets.ReadOnlyModelViewSet):
-    """User activity viewset (read-only)"""
+class UserActivityViewSet(StreamingExportMixin, viewsets.ReadOnlyModelViewSet):
+    """User activity viewset (read-only)
+
+    Listings are limited to ``?since=``/``?until=`` (ISO dates or datetimes;
+    a date ``until`` includes that day), by default the last
+    USER_ACTIVITY_DEFAULT_DAYS days and at most USER_ACTIVITY_MAX_RANGE_DAYS,
+    so only the monthly partitions in that range are scanned. Staff can also
+    filter by ``?user=`` and ``?activity_type=``.
+    """
     queryset = UserActivity.objects.all()
     serializer_class = serializers.UserActivitySerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
+    export_filename = 'activities'
+
+    def get_date_range(self):
+        params = self.request.query_params
+        now = timezone.now()
+        until = _parse_bound(params['until'], 'until', end_of_day=True) if params.get('until') else now
+        if params.get('since'):
+            since = _parse_bound(params['since'], 'since')
+        else:
+            since = until - timedelta(days=getattr(settings, 'USER_ACTIVITY_DEFAULT_DAYS', 30))
+        if since >= until:
+            raise ValidationError({'since': [_('Must be before until.')]})
+        max_days = getattr(settings, 'USER_ACTIVITY_MAX_RANGE_DAYS', 366)
+        if until - since > timedelta(days=max_days):
+            raise ValidationError({'since': [_('The range may span at most %(days)s days.') % {'days': max_days}]})
+        return since, until
 
     def get_queryset(self):
         if self.request.user.is_staff:
-            return UserActivity.objects.all()
-        return UserActivity.objects.filter(user=self.request.user)
+            queryset = UserActivity.objects.all()
+        else:
+            queryset = UserActivity.objects.filter(user=self.request.user)
+        if self.action != 'list':
+            return queryset
+
+        since, until = self.get_date_range()
+        queryset = queryset.filter(created_at__gte=since, created_at__lt=until)
+        if self.request.user.is_staff:
+            params = self.request.query_params
+            if params.get('user'):
+                try:
+                    user_id = int(params['user'])
+                except ValueError:
+                    raise ValidationError({'user': [_('Enter a user id.')]})
+                queryset = queryset.filter(user_id=user_id)
+            if params.get('activity_type'):
+                queryset = queryset.filter(activity_type=params['activity_type'])
+        return queryset
+
+    @action(detail=False, methods=['get'], permission_classes=[IsAdminUser])
+    def partitions(self, request):
+        """Monthly activity partitions with estimated row counts (staff only)"""
+        return Response({
+            'partitioned': is_partitioned(),
+            'retention_months': getattr(settings, 'USER_ACTIVITY_RETENTION_MONTHS', 12),
+            'partitions': [
+                {'name': partition['name'], 'month': partition['month'].date(), 'rows': partition['rows']}
+                for partition in list_partitions()
+            ],
+        })
+
+
+def _parse_bound(value, name, end_of_day=False):
+    """Aware datetime from an ISO date or datetime query parameter"""
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError(value)
+            parsed = datetime.combine(day + timedelta(days=1) if end_of_day else day, datetime.min.time())
+    except ValueError:
+        raise ValidationError({name: [_('Enter an ISO 8601 date or datetime.')]})
+    if timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
 
 
 class RegisterView(generics.CreateAPIView):
@@ -115,13 +192,7 @@ class LoginView(generics.GenericAPIView):
 
             if user:
                 refresh = RefreshToken.for_user(user)
-                # Log activity
-                UserActivity.objects.create(
-                    user=user,
-                    activity_type='login',
-                    ip_address=request.META.get('REMOTE_ADDR'),
-                    user_agent=request.META.get('HTTP_USER_AGENT')
-                )
+                log_activity(request, user, 'login')
                 return Response({
                     'user': serializers.UserSerializer(user).data,
                     'tokens': {
@@ -164,13 +235,7 @@ class ChangePasswordView(generics.UpdateAPIView):
                 )
             user.set_password(serializer.validated_data['new_password'])
             user.save()
-            # Log activity
-            UserActivity.objects.create(
-                user=user,
-                activity_type='password_change',
-                ip_address=request.META.get('REMOTE_ADDR'),
-                user_agent=request.META.get('HTTP_USER_AGENT')
-            )
+            log_activity(request, user, 'password_change')
             return Response({'message': _('Password changed successfully.')})
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -186,8 +251,9 @@ class ForgotPasswordView(generics.GenericAPIView):
             email = serializer.validated_data['email']
             try:
                 user = User.objects.get(email=email)
-                # Generate reset token (implement your logic)
-                # Send email with reset link
+                send_password_reset_email.enqueue(
+                    args=[user.pk], dedup_key=f'password-reset:{user.pk}'
+                )
                 return Response({'message': _('Password reset email sent.')})
             except User.DoesNotExist:
                 return Response(
@@ -1,4 +1,7 @@
 from django.contrib import admin
+from django.db import transaction
+from payments.models import Payment
+from payments.refunds import refund_payments
 from .models import Order, OrderItem, Cart, CartItem, Coupon, CouponUsage
 
 
@@ -18,6 +21,20 @@ class OrderAdmin(admin.ModelAdmin):
     ordering = ('-created_at',)
     readonly_fields = ('order_number', 'subtotal', 'tax_amount', 'shipping_cost', 'discount_amount', 'total_amount', 'created_at', 'updated_at')
     inlines = [OrderItemInline]
+    actions = ['cancel_and_refund']
+
+    @admin.action(description='Cancel selected orders and refund their payments')
+    def cancel_and_refund(self, request, queryset):
+        with transaction.atomic():
+            orders = list(queryset.filter(status__in=['pending', 'confirmed']).select_for_update())
+            for order in orders:
+                # save() so the stock reservations are released
+                order.status = 'cancelled'
+                order.save()
+            refunds = refund_payments(
+                Payment.objects.filter(order__in=orders), 'Order cancelled', processed_by=request.user
+            )
+        self.message_user(request, f'{len(orders)} order(s) cancelled, {len(refunds)} refund(s) queued')
 
 
 @admin.register(OrderItem)
@@ -0,0 +1,174 @@
+"""
+Checkout service.
+
+``place_order`` turns a cart into an order inside a single transaction
+holding the cart's row lock: the cart lines are loaded and priced once,
+stock is reserved in bulk, the order and all of its items are written
+with one ``INSERT`` each, the coupon (checked by ``orders.coupons``
+against the priced lines) is counted with a conditional ``UPDATE`` and
+the ordered lines leave the cart. Totals are computed from the priced
+lines exactly once; no ``OrderItem`` signals run. Passing an idempotency
+key makes client retries return the order created by the first attempt
+instead of a duplicate.
+"""
+
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from products.inventory import InsufficientStock, reserve_stock
+from .coupons import CartLine, check_coupon, claim_usage
+from .models import Cart, CartItem, CouponUsage, Order, OrderItem
+
+ZERO = Decimal('0.00')
+IDEMPOTENCY_KEY_MAX_LENGTH = Order._meta.get_field('idempotency_key').max_length
+
+
+class CheckoutError(Exception):
+    """Checkout could not be completed; carries an HTTP status for the view"""
+
+    def __init__(self, message, status_code=400, details=None):
+        self.message = message
+        self.status_code = status_code
+        self.details = details
+        super().__init__(message)
+
+
+class PricedLine:
+    """A cart line priced against the current catalog"""
+
+    __slots__ = ('item', 'unit_price', 'total_price')
+
+    def __init__(self, item):
+        self.item = item
+        self.unit_price = item.get_price()
+        self.total_price = self.unit_price * item.quantity
+
+    def as_cart_line(self):
+        return CartLine(self.item.product_id, self.item.product.category_id, self.total_price)
+
+    def as_order_item(self, order):
+        item = self.item
+        return OrderItem(
+            order=order,
+            product_id=item.product_id,
+            variant_id=item.variant_id,
+            product_name=item.product.name,
+            variant_name=item.variant.name if item.variant_id else '',
+            sku=item.variant.sku if item.variant_id else item.product.sku,
+            unit_price=self.unit_price,
+            quantity=item.quantity,
+            total_price=self.total_price,
+        )
+
+
+def load_cart_lines(cart):
+    """Cart items with product and variant, in one query"""
+    return list(
+        CartItem.objects.filter(cart=cart).select_related('product', 'variant').order_by('pk')
+    )
+
+
+def price_lines(items):
+    """Validate and price cart items; returns (lines, subtotal)"""
+    if not items:
+        raise CheckoutError(_('Cart is empty'))
+    unavailable = [
+        item.pk for item in items
+        if not item.product.is_active or (item.variant_id and not item.variant.is_active)
+    ]
+    if unavailable:
+        raise CheckoutError(_('Some items are no longer available'), details={'items': unavailable})
+    lines = [PricedLine(item) for item in items]
+    return lines, sum((line.total_price for line in lines), ZERO)
+
+
+def get_coupon(code, user, lines):
+    """Check a coupon against the user and the priced lines; returns its ``CouponResult``"""
+    result = check_coupon(code, user, [line.as_cart_line() for line in lines])
+    if result.error:
+        raise CheckoutError(result.error)
+    return result
+
+
+def claim_coupon(coupon_id):
+    """Atomically count one use of the coupon unless its limit is reached"""
+    if not claim_usage(coupon_id):
+        raise CheckoutError(_('Coupon usage limit exceeded'), status_code=409)
+
+
+def find_order(user, idempotency_key):
+    if not idempotency_key:
+        return None
+    return Order.objects.filter(user=user, idempotency_key=idempotency_key).first()
+
+
+def place_order(user, shipping_address, billing_address=None, notes='', coupon_code=None,
+                idempotency_key=None):
+    """Create an order from the user's cart
+
+    Returns ``(order, created)``; ``created`` is False when ``idempotency_key``
+    matches an order placed earlier. Raises ``CheckoutError``.
+    """
+    existing = find_order(user, idempotency_key)
+    if existing is not None:
+        return existing, False
+
+    try:
+        with transaction.atomic():
+            # The cart row lock serialises the user's checkouts and holds back
+            # cart total updates, so the lines and the coupon's per-user uses
+            # read below stay as they are until the order commits
+            cart = Cart.objects.select_for_update(of=('self',)).select_related('coupon').filter(user=user).first()
+            if cart is None:
+                raise CheckoutError(_('Cart is empty'))
+            existing = find_order(user, idempotency_key)
+            if existing is not None:
+                return existing, False
+            lines, subtotal = price_lines(load_cart_lines(cart))
+            if not coupon_code and cart.coupon_id:
+                coupon_code = cart.coupon.code
+            coupon = get_coupon(coupon_code, user, lines) if coupon_code else None
+            discount = coupon.discount if coupon else ZERO
+
+            order = Order.objects.create(
+                user=user,
+                shipping_address=shipping_address,
+                billing_address=billing_address,
+                subtotal=subtotal,
+                discount_amount=discount,
+                total_amount=subtotal - discount,
+                currency=cart.currency,
+                customer_notes=notes or '',
+                idempotency_key=idempotency_key or None,
+            )
+
+            try:
+                reserve_stock(
+                    ((line.item.product_id, line.item.variant_id, line.item.quantity) for line in lines),
+                    reference=order.order_number,
+                )
+            except InsufficientStock as exc:
+                raise CheckoutError(_('Insufficient stock'), status_code=409, details={'items': exc.shortages})
+
+            OrderItem.objects.bulk_create([line.as_order_item(order) for line in lines])
+
+            if coupon is not None:
+                claim_coupon(coupon.coupon_id)
+                CouponUsage.objects.create(
+                    coupon_id=coupon.coupon_id, user=user, order=order, discount_amount=discount
+                )
+
+            CartItem.objects.filter(pk__in=[line.item.pk for line in lines]).delete()
+            Cart.objects.filter(pk=cart.pk).update(
+                subtotal=ZERO, discount_amount=ZERO, total_amount=ZERO, coupon=None, updated_at=timezone.now()
+            )
+    except IntegrityError:
+        # A concurrent retry with the same key committed first
+        existing = find_order(user, idempotency_key)
+        if existing is None:
+            raise
+        return existing, False
+    return order, True
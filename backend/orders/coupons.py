@@ -0,0 +1,280 @@
+"""
+Coupon evaluation.
+
+A coupon's eligibility (validity window, usage and per-user limits, minimum
+amount, product/category scope) is compiled once into a ``CouponRule`` and
+kept in process memory. The cache key is the coupon's version
+(``updated_at``, which also moves when its scope changes, see
+``orders.signals``) plus the catalog's category version, because category
+scope covers subcategories; that version is shared by all processes (see
+``products.cache``). Category tree changes that send no signals are picked
+up once a rule is ``COUPON_RULE_CACHE_SECONDS`` old, when it is compiled
+again. The scope is stored as sets of product and category ids.
+
+Evaluating a cart costs one query for the coupons' versions and usage
+counts and one for the user's earlier uses, however many coupons are
+checked; the category version is read once per evaluation and passed
+along. ``best_coupon`` checks every active coupon against the same
+``CartLine`` list in one pass and returns the biggest discount. Usage
+counts are read at evaluation time; the binding usage limit check is the
+conditional ``UPDATE`` in ``claim_usage`` at checkout.
+"""
+
+import time
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from products.cache import get_versions
+from products.models import CategoryClosure
+from .models import CartItem, Coupon, CouponUsage
+
+ZERO = Decimal('0.00')
+# Compiled rules kept per process; the cache is emptied when it grows past this
+MAX_CACHED_RULES = 5000
+DEFAULT_RULE_CACHE_SECONDS = 300
+
+ROW_FIELDS = (
+    'id', 'code', 'coupon_type', 'value', 'usage_limit', 'usage_count', 'per_user_limit',
+    'valid_from', 'valid_until', 'minimum_amount', 'is_active', 'updated_at',
+)
+
+# One cart line as coupons see it: the product, its category and the line total
+CartLine = namedtuple('CartLine', 'product_id category_id total')
+# Outcome of one coupon against one cart; ``error`` is None when it applies
+CouponResult = namedtuple('CouponResult', 'coupon_id code discount error')
+
+# Above this many coupons, count all of the user's (few) uses rather than
+# sending every coupon id
+MAX_USAGE_FILTER_IDS = 100
+
+_rules = {}
+
+
+class CouponRule:
+    """A coupon's eligibility checks and discount, compiled"""
+
+    __slots__ = (
+        'coupon_id', 'code', 'version', 'compiled_at', 'coupon_type', 'value', 'usage_limit', 'per_user_limit',
+        'valid_from', 'valid_until', 'minimum_amount', 'is_active', 'product_ids', 'category_ids',
+    )
+
+    def __init__(self, row, version, product_ids=frozenset(), category_ids=frozenset()):
+        self.coupon_id = row['id']
+        self.code = row['code']
+        self.version = version
+        self.compiled_at = time.monotonic()
+        self.coupon_type = row['coupon_type']
+        self.value = row['value']
+        self.usage_limit = row['usage_limit']
+        self.per_user_limit = row['per_user_limit']
+        self.valid_from = row['valid_from']
+        self.valid_until = row['valid_until']
+        self.minimum_amount = row['minimum_amount']
+        self.is_active = row['is_active']
+        self.product_ids = product_ids
+        # Scope categories with all of their subcategories
+        self.category_ids = category_ids
+
+    @property
+    def scoped(self):
+        return bool(self.product_ids or self.category_ids)
+
+    def eligible_amount(self, lines, subtotal):
+        """Total of the cart lines the coupon applies to"""
+        if not self.scoped:
+            return subtotal
+        return sum(
+            (
+                line.total for line in lines
+                if line.product_id in self.product_ids or line.category_id in self.category_ids
+            ),
+            ZERO
+        )
+
+    def discount(self, amount):
+        """Discount on ``amount``, the eligible total"""
+        if self.coupon_type == 'percentage':
+            discount = amount * self.value / 100
+        elif self.coupon_type == 'fixed':
+            discount = self.value
+        else:
+            # free_shipping discounts the shipping cost, not the items
+            return ZERO
+        return min(discount, amount).quantize(Decimal('0.01'))
+
+    def rejection(self, now, usage_count, user_uses, subtotal, eligible):
+        """Why the coupon can't be used, or None"""
+        if not self.is_active or not self.valid_from <= now <= self.valid_until:
+            return _('Invalid coupon')
+        if self.usage_limit is not None and usage_count >= self.usage_limit:
+            return _('Coupon usage limit exceeded')
+        if self.per_user_limit and user_uses >= self.per_user_limit:
+            return _('Coupon per user limit exceeded')
+        if subtotal < self.minimum_amount:
+            return _('Order total is below the coupon minimum')
+        if self.scoped and eligible <= ZERO:
+            return _('Coupon does not apply to any item in the cart')
+        return None
+
+
+def current_category_version():
+    """Current category version of the catalog, part of every rule's cache key"""
+    return get_versions(['category'])['category']
+
+
+def _is_current(rule, version):
+    """Whether a cached rule was compiled for ``version`` recently enough"""
+    max_age = getattr(settings, 'COUPON_RULE_CACHE_SECONDS', DEFAULT_RULE_CACHE_SECONDS)
+    return rule is not None and rule.version == version and time.monotonic() - rule.compiled_at <= max_age
+
+
+def _compile(rows, category_version):
+    """Compile and cache the rules of coupon ``rows`` with three queries at most"""
+    ids = [row['id'] for row in rows]
+    products = defaultdict(set)
+    for coupon_id, product_id in Coupon.applicable_products.through.objects.filter(
+        coupon_id__in=ids
+    ).values_list('coupon_id', 'product_id'):
+        products[coupon_id].add(product_id)
+
+    links = list(
+        Coupon.applicable_categories.through.objects.filter(coupon_id__in=ids).values_list('coupon_id', 'category_id')
+    )
+    subtree = defaultdict(set)
+    if links:
+        for ancestor_id, descendant_id in CategoryClosure.objects.filter(
+            ancestor_id__in={category_id for _coupon_id, category_id in links}
+        ).values_list('ancestor_id', 'descendant_id'):
+            subtree[ancestor_id].add(descendant_id)
+    categories = defaultdict(set)
+    for coupon_id, category_id in links:
+        categories[coupon_id] |= subtree[category_id] | {category_id}
+
+    compiled = {
+        row['id']: CouponRule(
+            row,
+            (row['updated_at'], category_version),
+            frozenset(products[row['id']]),
+            frozenset(categories[row['id']]),
+        )
+        for row in rows
+    }
+    if len(_rules) + len(compiled) > MAX_CACHED_RULES:
+        _rules.clear()
+    _rules.update(compiled)
+    return compiled
+
+
+def load_rules(queryset, category_version=None):
+    """``(rule, usage_count)`` for every coupon of ``queryset``, compiling only changed coupons
+
+    Only id, version and usage count are read for coupons whose rule is
+    cached; full rows are fetched for the others. Pass ``category_version``
+    if it has already been read for this evaluation.
+    """
+    states = list(queryset.order_by().values_list('id', 'updated_at', 'usage_count'))
+    if not states:
+        return []
+    if category_version is None:
+        category_version = current_category_version()
+    rules = {}
+    stale = []
+    for coupon_id, updated_at, _count in states:
+        rule = _rules.get(coupon_id)
+        if _is_current(rule, (updated_at, category_version)):
+            rules[coupon_id] = rule
+        else:
+            stale.append(coupon_id)
+    if stale:
+        rules.update(_compile(list(Coupon.objects.filter(pk__in=stale).values(*ROW_FIELDS)), category_version))
+    # Coupons deleted since the first query have no rule
+    return [
+        (rules[coupon_id], usage_count) for coupon_id, _updated_at, usage_count in states if coupon_id in rules
+    ]
+
+
+def rule_for(coupon, category_version=None):
+    """Compiled rule of a loaded ``Coupon``"""
+    if category_version is None:
+        category_version = current_category_version()
+    rule = _rules.get(coupon.pk)
+    if not _is_current(rule, (coupon.updated_at, category_version)):
+        rule = _compile([{field: getattr(coupon, field) for field in ROW_FIELDS}], category_version)[coupon.pk]
+    return rule
+
+
+def reset():
+    """Drop every compiled rule"""
+    _rules.clear()
+
+
+def active_coupons(now=None):
+    """Coupons usable by anyone right now, before per-user and cart checks"""
+    now = now or timezone.now()
+    return Coupon.objects.filter(is_active=True, valid_from__lte=now, valid_until__gte=now).filter(
+        Q(usage_limit__isnull=True) | Q(usage_count__lt=F('usage_limit'))
+    )
+
+
+def user_usage_counts(user, coupon_ids):
+    """{coupon id: times ``user`` has used it} for ``coupon_ids``, in one query"""
+    if not coupon_ids or user is None or not user.is_authenticated:
+        return {}
+    usages = CouponUsage.objects.filter(user=user)
+    if len(coupon_ids) <= MAX_USAGE_FILTER_IDS:
+        usages = usages.filter(coupon_id__in=coupon_ids)
+    return dict(usages.order_by().values_list('coupon_id').annotate(uses=Count('id')))
+
+
+def cart_lines(cart):
+    """``CartLine`` of every item of ``cart`` at its stored total, in one query"""
+    return [
+        CartLine(*row)
+        for row in CartItem.objects.filter(cart=cart).values_list('product_id', 'product__category_id', 'total_price')
+    ]
+
+
+def evaluate(rules, user, lines, now=None):
+    """``CouponResult`` of each ``(rule, usage_count)`` against the same cart lines"""
+    now = now or timezone.now()
+    subtotal = sum((line.total for line in lines), ZERO)
+    uses = user_usage_counts(user, [rule.coupon_id for rule, _count in rules if rule.per_user_limit])
+    results = []
+    for rule, usage_count in rules:
+        eligible = rule.eligible_amount(lines, subtotal)
+        error = rule.rejection(now, usage_count, uses.get(rule.coupon_id, 0), subtotal, eligible)
+        results.append(CouponResult(rule.coupon_id, rule.code, ZERO if error else rule.discount(eligible), error))
+    return results
+
+
+def check_coupon(code, user, lines, category_version=None):
+    """``CouponResult`` of the coupon with ``code`` for this cart"""
+    results = evaluate(load_rules(Coupon.objects.filter(code=code), category_version), user, lines) if code else []
+    return results[0] if results else CouponResult(None, code, ZERO, _('Invalid coupon'))
+
+
+def best_coupon(user, lines):
+    """The applicable active coupon with the biggest discount on this cart, or None"""
+    now = timezone.now()
+    subtotal = sum((line.total for line in lines), ZERO)
+    candidates = active_coupons(now).filter(minimum_amount__lte=subtotal)
+    applicable = [
+        result for result in evaluate(load_rules(candidates), user, lines, now)
+        if result.error is None
+    ]
+    # Ties go to the oldest coupon
+    return max(applicable, key=lambda result: (result.discount, -result.coupon_id), default=None)
+
+
+def claim_usage(coupon_id):
+    """Atomically count one use of the coupon unless its usage limit is reached"""
+    return bool(
+        Coupon.objects.filter(pk=coupon_id).filter(
+            Q(usage_limit__isnull=True) | Q(usage_count__lt=F('usage_limit'))
+        ).update(usage_count=F('usage_count') + 1)
+    )
@@ -0,0 +1,77 @@
+import statistics
+import time
+import uuid
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from accounts.models import Address
+from orders.checkout import place_order
+from orders.models import Cart, CartItem
+from products.models import Category, Product
+from shop_backend.query_budget import QueryReport
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    """Time place_order for carts of different sizes"""
+
+    help = 'Benchmark the checkout service for 1/10/100-line carts (creates and removes its own data)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--lines',
+            type=int,
+            nargs='+',
+            default=[1, 10, 100],
+            help='Cart sizes to benchmark'
+        )
+        parser.add_argument('--runs', type=int, default=20, help='Checkouts per cart size')
+
+    def handle(self, *args, **options):
+        run_id = uuid.uuid4().hex[:8]
+        user = User.objects.create_user(
+            email=f'bench-{run_id}@example.com', password=uuid.uuid4().hex
+        )
+        address = Address.objects.create(
+            user=user, title='Benchmark', first_name='Bench', last_name='Mark',
+            address_line_1='-', city='-', state='-', postal_code='-',
+        )
+        category = Category.objects.create(name=f'Benchmark {run_id}', slug=f'benchmark-{run_id}')
+        max_lines = max(options['lines'])
+        products = Product.objects.bulk_create([
+            Product(
+                name=f'Benchmark {run_id} #{index}',
+                slug=f'benchmark-{run_id}-{index}',
+                sku=f'BENCH-{run_id}-{index}',
+                category=category,
+                price=1000 + index,
+                stock_quantity=options['runs'] * 10,
+            )
+            for index in range(max_lines)
+        ])
+        cart, _created = Cart.objects.get_or_create(user=user)
+
+        try:
+            for size in options['lines']:
+                timings, queries = [], []
+                for run in range(options['runs']):
+                    CartItem.objects.bulk_create([
+                        CartItem(cart=cart, product=product, quantity=1, unit_price=product.price,
+                                 total_price=product.price)
+                        for product in products[:size]
+                    ])
+                    report = QueryReport()
+                    started = time.perf_counter()
+                    with report.capture():
+                        place_order(user, address, idempotency_key=f'bench-{run_id}-{size}-{run}')
+                    timings.append(time.perf_counter() - started)
+                    queries.append(report.count)
+                self.stdout.write(
+                    f'{size:>4} lines: median {statistics.median(timings) * 1000:.1f}ms '
+                    f'max {max(timings) * 1000:.1f}ms, {max(queries)} queries'
+                )
+        finally:
+            user.delete()
+            Product.objects.filter(pk__in=[product.pk for product in products]).delete()
+            category.delete()
@@ -0,0 +1,184 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from django.test.utils import override_settings
+from django.utils import timezone
+from orders.models import Order
+from orders.serializers import OrderListSerializer
+from payments.models import Payment
+from products.models import Brand, Category, Product, ProductImage, Review
+from products.serializers import ProductListSerializer, ReviewSerializer
+
+User = get_user_model()
+
+SERIALIZERS = {
+    'products': ProductListSerializer,
+    'orders': OrderListSerializer,
+    'reviews': ReviewSerializer,
+}
+
+
+def _prefetch(instance, name, objects):
+    """Attach ``objects`` as the prefetched result of ``instance.<name>.all()``"""
+    queryset = getattr(instance, name).all()
+    queryset._result_cache = list(objects)
+    queryset._prefetch_done = True
+    instance._prefetched_objects_cache = {name: queryset}
+
+
+class Command(BaseCommand):
+    """Time compiled list serialization against DRF's
+
+    Output parity is covered by the CompiledSerializerTests in the products
+    and orders test suites.
+    """
+
+    help = 'Report serialization time per 1,000 rows for compiled list serializers and DRF'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000)
+        parser.add_argument('--runs', type=int, default=10, help='Timed renders per serializer and mode')
+        parser.add_argument(
+            '--source',
+            choices=['synthetic', 'db'],
+            default='synthetic',
+            help='In-memory rows (no database access) or the first --rows rows of each table'
+        )
+        parser.add_argument('--only', choices=sorted(SERIALIZERS), nargs='+')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        rows = options['rows']
+        loaders = {
+            'synthetic': {
+                'products': lambda: self.synthetic_products(rng, rows),
+                'orders': lambda: self.synthetic_orders(rng, rows),
+                'reviews': lambda: self.synthetic_reviews(rng, rows),
+            },
+            'db': {
+                'products': lambda: list(
+                    Product.objects.select_related('category', 'brand').prefetch_related('images')[:rows]
+                ),
+                'orders': lambda: list(
+                    Order.objects.select_related('payment').annotate(line_count=Count('items'))[:rows]
+                ),
+                'reviews': lambda: list(Review.objects.select_related('user', 'product')[:rows]),
+            },
+        }[options['source']]
+
+        for name in options['only'] or SERIALIZERS:
+            serializer_class = SERIALIZERS[name]
+            instances = loaders[name]()
+            if not instances:
+                self.stdout.write(f'{name:>8}: no rows')
+                continue
+
+            with override_settings(COMPILED_SERIALIZERS=False):
+                drf = self.time_render(serializer_class, instances, options['runs'])
+            compiled = self.time_render(serializer_class, instances, options['runs'])
+            per_thousand = 1000 / len(instances)
+            self.stdout.write(
+                f'{name:>8}: {len(instances)} rows, DRF {drf * per_thousand:.2f}ms/1k rows, '
+                f'compiled {compiled * per_thousand:.2f}ms/1k rows ({drf / compiled:.1f}x)'
+            )
+
+    def time_render(self, serializer_class, instances, runs):
+        """Median milliseconds to build and render the list serializer"""
+        timings = []
+        for _run in range(runs):
+            started = time.perf_counter()
+            serializer_class(instances, many=True).data
+            timings.append(time.perf_counter() - started)
+        return statistics.median(timings) * 1000
+
+    def synthetic_products(self, rng, rows):
+        now = timezone.now()
+        categories = [Category(id=index, name=f'Category {index}') for index in range(1, 51)]
+        brands = [Brand(id=index, name=f'Brand {index}') for index in range(1, 21)]
+        products = []
+        for index in range(1, rows + 1):
+            price = Decimal(rng.randint(100, 10000000)) / 100
+            product = Product(
+                id=index,
+                name=f'Product {index} – édition',
+                sku=f'SKU-{index:07d}',
+                price=price,
+                compare_price=price + 10 if index % 3 == 0 else None,
+                stock_quantity=rng.choice([0, 3, 50, 1200]),
+                category=rng.choice(categories),
+                # Some products have no brand, whose name is then omitted
+                brand=rng.choice(brands) if index % 7 else None,
+                rating_count=rng.randint(0, 500),
+                rating_avg=Decimal(rng.randint(100, 500)) / 100,
+                is_featured=index % 11 == 0,
+                is_active=True,
+                created_at=now - timedelta(seconds=rng.randint(0, 10 ** 7), microseconds=rng.randint(0, 999999)),
+            )
+            images = [
+                ProductImage(
+                    id=index * 10 + position, product_id=index, image=f'products/{index}-{position}.jpg',
+                    alt_text=f'Image {position}', display_order=position,
+                )
+                for position in range(index % 4)
+            ]
+            _prefetch(product, 'images', images)
+            products.append(product)
+        return products
+
+    def synthetic_orders(self, rng, rows):
+        now = timezone.now()
+        statuses = [value for value, _label in Order.ORDER_STATUS]
+        payment_statuses = [value for value, _label in Payment.STATUS_CHOICES]
+        orders = []
+        for index in range(1, rows + 1):
+            created_at = now - timedelta(seconds=rng.randint(0, 10 ** 7), microseconds=rng.randint(0, 999999))
+            order = Order(
+                id=index,
+                order_number=f'ORD-{index:08d}',
+                user_id=rng.randint(1, 1000),
+                status=rng.choice(statuses),
+                subtotal=Decimal(rng.randint(100, 10000000)) / 100,
+                total_amount=Decimal(rng.randint(100, 10000000)) / 100,
+                created_at=created_at,
+                updated_at=created_at + timedelta(minutes=rng.randint(0, 600)),
+            )
+            # Orders without a payment render a null payment status
+            payment = Payment(
+                id=index, order=order, status=rng.choice(payment_statuses), amount=order.total_amount,
+            ) if index % 4 else None
+            Order.payment.related.set_cached_value(order, payment)
+            order.line_count = rng.randint(1, 12)
+            orders.append(order)
+        return orders
+
+    def synthetic_reviews(self, rng, rows):
+        now = timezone.now()
+        users = [
+            User(id=index, email=f'user{index}@example.com', first_name=f'First{index}', last_name=f'Last{index}')
+            for index in range(1, 201)
+        ]
+        products = [Product(id=index, name=f'Product {index}') for index in range(1, 501)]
+        reviews = []
+        for index in range(1, rows + 1):
+            created_at = now - timedelta(seconds=rng.randint(0, 10 ** 7), microseconds=rng.randint(0, 999999))
+            reviews.append(Review(
+                id=index,
+                user=rng.choice(users),
+                product=rng.choice(products),
+                rating=rng.randint(1, 5),
+                title=f'Review {index}',
+                comment='Solid product. ' * rng.randint(1, 20),
+                is_active=index % 9 != 0,
+                is_featured=index % 13 == 0,
+                helpful_votes=rng.randint(0, 40),
+                created_at=created_at,
+                updated_at=created_at,
+            ))
+        return reviews
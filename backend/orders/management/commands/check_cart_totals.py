@@ -0,0 +1,64 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import DecimalField, F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from orders.models import Cart
+
+
+class Command(BaseCommand):
+    """Detect (and optionally repair) carts whose stored totals drifted from their items"""
+
+    help = 'Compare stored cart totals with the sum of their items; use --repair to fix them'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Write corrected totals')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of carts written per UPDATE batch'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        item_total = Coalesce(
+            Sum('items__total_price'),
+            Value(Decimal('0.00')),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        )
+        # One grouped query; the HAVING clause keeps only drifted carts
+        drifted = Cart.objects.annotate(item_total=item_total).filter(
+            ~Q(subtotal=F('item_total'))
+            | ~Q(total_amount=F('item_total') + F('tax_amount') - F('discount_amount'))
+        ).order_by('pk').values_list('pk', 'subtotal', 'item_total', 'tax_amount', 'discount_amount')
+
+        found = 0
+        batch = []
+        for pk, subtotal, expected, tax_amount, discount_amount in drifted.iterator(chunk_size=batch_size):
+            found += 1
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Cart {pk}: stored subtotal {subtotal}, items sum to {expected}')
+            batch.append(Cart(
+                pk=pk,
+                subtotal=expected,
+                total_amount=expected + tax_amount - discount_amount,
+            ))
+            if options['repair'] and len(batch) >= batch_size:
+                self._flush(batch)
+                batch = []
+        if options['repair']:
+            self._flush(batch)
+
+        if not found:
+            self.stdout.write(self.style.SUCCESS('All cart totals are consistent'))
+        elif options['repair']:
+            self.stdout.write(self.style.SUCCESS(f'Repaired {found} carts'))
+        else:
+            self.stdout.write(self.style.WARNING(f'{found} carts have drifted totals (run with --repair)'))
+
+    def _flush(self, batch):
+        if batch:
+            with transaction.atomic():
+                Cart.objects.bulk_update(batch, ['subtotal', 'total_amount'], batch_size=len(batch))
@@ -1,9 +1,16 @@
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _
 from django.core.validators import MinValueValidator
 from django.contrib.auth import get_user_model
 from accounts.models import Address
 from products.models import Product, ProductVariant
+from sequences.allocator import next_id
 
 User = get_user_model()
 
@@ -23,7 +30,7 @@ class Order(models.Model):
 
     # Order identification
     order_number = models.CharField(
-        max_length=20,
+        max_length=32,
         unique=True,
         verbose_name=_('Order Number')
     )
@@ -102,6 +109,14 @@ class Order(models.Model):
     customer_notes = models.TextField(blank=True, verbose_name=_('Customer Notes'))
     internal_notes = models.TextField(blank=True, verbose_name=_('Internal Notes'))
 
+    # Client-supplied key that makes checkout retries return the same order
+    idempotency_key = models.CharField(
+        max_length=64,
+        null=True,
+        blank=True,
+        verbose_name=_('Idempotency Key')
+    )
+
     # Tracking
     tracking_number = models.CharField(max_length=100, blank=True, verbose_name=_('Tracking Number'))
     carrier = models.CharField(max_length=50, blank=True, verbose_name=_('Carrier'))
@@ -122,24 +137,45 @@ class Order(models.Model):
             models.Index(fields=['status']),
             models.Index(fields=['created_at']),
             models.Index(fields=['order_number']),
+            models.Index(fields=['-created_at', '-id']),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'idempotency_key'],
+                condition=models.Q(idempotency_key__isnull=False),
+                name='unique_order_idempotency_key',
+            ),
         ]
 
     def __str__(self):
         return f"Order {self.order_number}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_status = instance.__dict__.get('status')
+        return instance
+
+    @property
+    def status_changed(self):
+        return getattr(self, '_loaded_status', None) != self.status
+
     def save(self, *args, **kwargs):
         if not self.order_number:
-            # Generate order number
-            import uuid
-            from datetime import datetime
-            now = datetime.now()
-            self.order_number = f"ORD-{now.strftime('%Y%m%d')}-{uuid.uuid4().hex[:6].upper()}"
+            self.order_number = next_id('ORD')
         super().save(*args, **kwargs)
 
     @property
     def item_count(self):
         return sum(item.quantity for item in self.items.all())
 
+    def calculate_totals(self):
+        """Recompute subtotal and total from the order items"""
+        subtotal = self.items.aggregate(total=models.Sum('total_price'))['total'] or 0
+        self.subtotal = subtotal
+        self.total_amount = subtotal + self.tax_amount + self.shipping_cost - self.discount_amount
+        Order.objects.filter(pk=self.pk).update(subtotal=self.subtotal, total_amount=self.total_amount)
+
     @property
     def can_cancel(self):
         return self.status in ['pending', 'confirmed']
@@ -262,6 +298,16 @@ class Cart(models.Model):
     # Currency
     currency = models.CharField(max_length=3, default='IRR', verbose_name=_('Currency'))
 
+    # Applied coupon
+    coupon = models.ForeignKey(
+        'Coupon',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='carts',
+        verbose_name=_('Coupon')
+    )
+
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -278,13 +324,70 @@ class Cart(models.Model):
     def item_count(self):
         return sum(item.quantity for item in self.items.all())
 
+    @classmethod
+    def apply_item_delta(cls, cart_id, delta):
+        """Shift the stored totals by an item total change in one UPDATE"""
+        if delta:
+            cls.objects.filter(pk=cart_id).update(
+                subtotal=F('subtotal') + delta,
+                total_amount=F('total_amount') + delta,
+                updated_at=timezone.now(),
+            )
+
+    @classmethod
+    def recalculate_totals(cls, cart_ids):
+        """Recompute the stored totals of the given carts from their items, in one UPDATE
+
+        For item deletes that skip ``CartItem.delete`` and so its delta, such
+        as the cascade of a product delete (see ``orders.signals``).
+        """
+        item_total = CartItem.objects.filter(cart=OuterRef('pk')).order_by().values('cart').annotate(
+            total=Sum('total_price')
+        ).values('total')
+        subtotal = Coalesce(
+            Subquery(item_total), Value(Decimal('0.00')), output_field=cls._meta.get_field('subtotal')
+        )
+        return cls.objects.filter(pk__in=cart_ids).update(
+            subtotal=subtotal,
+            total_amount=subtotal + F('tax_amount') - F('discount_amount'),
+            updated_at=timezone.now(),
+        )
+
     def update_totals(self):
-        """Update cart totals"""
-        items = self.items.all()
-        self.subtotal = sum(item.total_price for item in items)
-        # Add tax and discount calculations here
+        """Recompute the stored totals from the cart items"""
+        self.subtotal = self.items.aggregate(total=models.Sum('total_price'))['total'] or Decimal('0.00')
         self.total_amount = self.subtotal + self.tax_amount - self.discount_amount
-        self.save()
+        self.save(update_fields=['subtotal', 'total_amount', 'updated_at'])
+        self.__dict__.pop('pricing', None)
+
+    def clear(self):
+        """Remove every item and zero the totals"""
+        self.items.all().delete()
+        self.subtotal = self.discount_amount = self.total_amount = Decimal('0.00')
+        self.save(update_fields=['subtotal', 'discount_amount', 'total_amount', 'updated_at'])
+        self.__dict__.pop('pricing', None)
+
+    @cached_property
+    def pricing(self):
+        """Subtotal, discount and total from the stored totals, computed once"""
+        return self.price()
+
+    def price(self, category_version=None, lines=None):
+        """``pricing`` reusing the category version and ``CartLine`` list of a coupon check"""
+        subtotal = self.subtotal
+        discount = self.discount_amount
+        if self.coupon_id:
+            from .coupons import cart_lines, rule_for
+            rule = rule_for(self.coupon, category_version)
+            if rule.scoped and lines is None:
+                lines = cart_lines(self)
+            discount = rule.discount(rule.eligible_amount(lines if rule.scoped else (), subtotal))
+        return {
+            'subtotal': subtotal,
+            'discount': discount,
+            'tax': self.tax_amount,
+            'total': subtotal + self.tax_amount - discount,
+        }
 
 
 class CartItem(models.Model):
@@ -344,11 +447,39 @@ class CartItem(models.Model):
         variant_str = f" ({self.variant.name})" if self.variant else ""
         return f"{self.product.name}{variant_str} x{self.quantity}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_total_price = instance.__dict__.get('total_price')
+        return instance
+
     def save(self, *args, **kwargs):
         self.total_price = self.unit_price * self.quantity
+        previous = Decimal('0.00') if self._state.adding else getattr(self, '_loaded_total_price', None)
         super().save(*args, **kwargs)
         # Update cart totals
-        self.cart.update_totals()
+        if previous is None:
+            self.cart.update_totals()
+        else:
+            Cart.apply_item_delta(self.cart_id, self.total_price - previous)
+        self._loaded_total_price = self.total_price
+
+    def delete(self, *args, **kwargs):
+        # Queryset and cascade deletes skip this: checkout and Cart.clear zero
+        # the totals, product deletes recalculate them (orders.signals)
+        previous = getattr(self, '_loaded_total_price', None)
+        result = super().delete(*args, **kwargs)
+        Cart.apply_item_delta(self.cart_id, -(self.total_price if previous is None else previous))
+        return result
+
+    def get_price(self):
+        """Current catalog price of one unit"""
+        if self.variant_id:
+            return self.variant.final_price
+        return self.product.price
+
+    def get_total_price(self):
+        return self.get_price() * self.quantity
 
     @property
     def is_available(self):
@@ -452,20 +583,16 @@ class Coupon(models.Model):
             (self.usage_limit is None or self.usage_count < self.usage_limit)
         )
 
-    def can_use(self, user, order_total):
-        """Check if coupon can be used by user"""
-        if not self.is_valid:
-            return False
-
-        if order_total < self.minimum_amount:
-            return False
-
-        # Check per user limit
-        user_usage = self.coupon_usages.filter(user=user).count()
-        if user_usage >= self.per_user_limit:
-            return False
+    def calculate_discount(self, subtotal):
+        """Discount this coupon gives on ``subtotal`` of eligible items"""
+        from .coupons import rule_for
+        return rule_for(self).discount(subtotal)
 
-        return True
+    def can_use(self, user, order_total):
+        """Check if coupon can be used by user, regardless of product/category scope"""
+        from .coupons import rule_for, user_usage_counts
+        uses = user_usage_counts(user, [self.pk]).get(self.pk, 0)
+        return rule_for(self).rejection(timezone.now(), self.usage_count, uses, order_total, order_total) is None
 
 
 class CouponUsage(models.Model):
@@ -1,45 +1,46 @@
 from rest_framework import serializers
-from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
 from decimal import Decimal
 from .models import Order, OrderItem, Cart, CartItem, Coupon, CouponUsage
 from django.contrib.auth import get_user_model
 from accounts.models import Address
 from products.models import Product, ProductVariant
+from shop_backend.compiled_serializers import CompiledListSerializer
+from .checkout import IDEMPOTENCY_KEY_MAX_LENGTH
 
 User = get_user_model()
 
 
 class OrderItemSerializer(serializers.ModelSerializer):
     """Order item serializer"""
-    product_name = serializers.CharField(source='product.name', read_only=True)
-    variant_name = serializers.CharField(source='variant.name', read_only=True)
     product_image = serializers.SerializerMethodField()
-    total_price = serializers.SerializerMethodField()
 
     class Meta:
         model = OrderItem
         fields = [
-            'id', 'product', 'product_name', 'variant', 'variant_name',
-            'quantity', 'price', 'total_price', 'product_image',
+            'id', 'product', 'product_name', 'variant', 'variant_name', 'sku',
+            'quantity', 'unit_price', 'total_price', 'product_image',
             'created_at'
         ]
         read_only_fields = ['id', 'created_at']
 
     def get_product_image(self, obj):
-        primary_image = obj.product.images.filter(is_primary=True).first()
+        if obj.product_image:
+            return obj.product_image
+        # The product's first image, prefetched with the items
+        primary_image = obj.product.primary_image
         if primary_image:
             return primary_image.image.url
         return None
 
-    def get_total_price(self, obj):
-        return obj.quantity * obj.price
-
 
 class OrderListSerializer(serializers.ModelSerializer):
     """Order list serializer"""
     item_count = serializers.SerializerMethodField()
     status_display = serializers.CharField(source='get_status_display', read_only=True)
-    payment_status_display = serializers.CharField(source='get_payment_status_display', read_only=True)
+    # Orders without a payment yet show null
+    payment_status = serializers.CharField(source='payment.status', read_only=True)
+    payment_status_display = serializers.CharField(source='payment.get_status_display', read_only=True)
 
     class Meta:
         model = Order
@@ -48,8 +49,12 @@ class OrderListSerializer(serializers.ModelSerializer):
             'payment_status', 'payment_status_display', 'total_amount',
             'item_count', 'created_at', 'updated_at'
         ]
+        list_serializer_class = CompiledListSerializer
 
     def get_item_count(self, obj):
+        # Annotated by OrderViewSet.get_queryset to avoid a COUNT per row
+        if hasattr(obj, 'line_count'):
+            return obj.line_count
         return obj.items.count()
 
 
@@ -59,7 +64,11 @@ class OrderSerializer(serializers.ModelSerializer):
     shipping_address_details = serializers.SerializerMethodField()
     billing_address_details = serializers.SerializerMethodField()
     status_display = serializers.CharField(source='get_status_display', read_only=True)
-    payment_status_display = serializers.CharField(source='get_payment_status_display', read_only=True)
+    # Orders without a payment yet show null
+    payment_status = serializers.CharField(source='payment.status', read_only=True, allow_null=True)
+    payment_status_display = serializers.CharField(
+        source='payment.get_status_display', read_only=True, allow_null=True
+    )
     item_count = serializers.SerializerMethodField()
 
     class Meta:
@@ -67,10 +76,10 @@ class OrderSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'order_number', 'user', 'status', 'status_display',
             'payment_status', 'payment_status_display', 'subtotal',
-            'tax_amount', 'shipping_amount', 'discount_amount',
+            'tax_amount', 'shipping_cost', 'discount_amount',
             'total_amount', 'currency', 'shipping_address',
             'shipping_address_details', 'billing_address',
-            'billing_address_details', 'coupon', 'notes',
+            'billing_address_details', 'customer_notes',
             'items', 'item_count', 'created_at', 'updated_at'
         ]
         read_only_fields = [
@@ -110,7 +119,7 @@ class OrderSerializer(serializers.ModelSerializer):
         return None
 
     def get_item_count(self, obj):
-        return obj.items.count()
+        return len(obj.items.all())
 
 
 class CartItemSerializer(serializers.ModelSerializer):
@@ -132,7 +141,8 @@ class CartItemSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
     def get_product_image(self, obj):
-        primary_image = obj.product.images.filter(is_primary=True).first()
+        # The product's first image, prefetched with the cart items
+        primary_image = obj.product.primary_image
         if primary_image:
             return primary_image.image.url
         return None
@@ -169,50 +179,37 @@ class CartSerializer(serializers.ModelSerializer):
         return obj.items.count()
 
     def get_subtotal(self, obj):
-        return sum(item.get_total_price() for item in obj.items.all())
+        return obj.pricing['subtotal']
 
     def get_discount(self, obj):
-        if obj.coupon:
-            subtotal = self.get_subtotal(obj)
-            if obj.coupon.discount_type == 'percentage':
-                return subtotal * (obj.coupon.discount_value / 100)
-            else:
-                return min(obj.coupon.discount_value, subtotal)
-        return Decimal('0.00')
+        return obj.pricing['discount']
 
     def get_total(self, obj):
-        return self.get_subtotal(obj) - self.get_discount(obj)
+        return obj.pricing['total']
 
 
 class CouponSerializer(serializers.ModelSerializer):
     """Coupon serializer"""
     discount_display = serializers.SerializerMethodField()
-    is_valid = serializers.SerializerMethodField()
+    is_valid = serializers.BooleanField(read_only=True)
 
     class Meta:
         model = Coupon
         fields = [
-            'id', 'code', 'name', 'description', 'discount_type',
-            'discount_value', 'discount_display', 'minimum_amount',
-            'maximum_discount', 'usage_limit', 'per_user_limit',
-            'start_date', 'end_date', 'is_active', 'is_valid',
-            'times_used', 'created_at', 'updated_at'
+            'id', 'code', 'name', 'description', 'coupon_type',
+            'value', 'discount_display', 'minimum_amount',
+            'usage_limit', 'per_user_limit', 'valid_from', 'valid_until',
+            'applicable_products', 'applicable_categories', 'is_active', 'is_valid',
+            'usage_count', 'created_at', 'updated_at'
         ]
-        read_only_fields = ['id', 'times_used', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'usage_count', 'created_at', 'updated_at']
 
     def get_discount_display(self, obj):
-        if obj.discount_type == 'percentage':
-            return f'{obj.discount_value}%'
-        else:
-            return f'${obj.discount_value}'
-
-    def get_is_valid(self, obj):
-        now = timezone.now()
-        return (
-            obj.is_active and
-            obj.start_date <= now <= obj.end_date and
-            (not obj.usage_limit or obj.times_used < obj.usage_limit)
-        )
+        if obj.coupon_type == 'percentage':
+            return f'{obj.value}%'
+        if obj.coupon_type == 'free_shipping':
+            return _('Free shipping')
+        return f'{obj.value}'
 
 
 class CouponUsageSerializer(serializers.ModelSerializer):
@@ -231,6 +228,9 @@ class CheckoutSerializer(serializers.Serializer):
     shipping_address_id = serializers.IntegerField()
     billing_address_id = serializers.IntegerField(required=False)
     notes = serializers.CharField(required=False, allow_blank=True)
+    coupon_code = serializers.CharField(required=False, allow_blank=True)
+    # Also accepted as an Idempotency-Key header
+    idempotency_key = serializers.CharField(required=False, allow_blank=True, max_length=IDEMPOTENCY_KEY_MAX_LENGTH)
 
     def validate_shipping_address_id(self, value):
         try:
@@ -1,20 +1,74 @@
-from django.db.models.signals import post_save, pre_save
+import logging
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch import receiver
-from .models import Order, OrderItem
+from django.utils import timezone
+from products.inventory import commit_reservations, release_reservations, reservations_expired
+from products.models import Product
+from .models import Cart, CartItem, Coupon, Order, OrderItem
 
+logger = logging.getLogger(__name__)
 
-@receiver(pre_save, sender=Order)
-def generate_order_number(sender, instance, **kwargs):
-    """Generate order number if not provided"""
-    if not instance.order_number:
-        from django.utils import timezone
-        import uuid
-        timestamp = timezone.now().strftime('%Y%m%d')
-        unique_id = str(uuid.uuid4())[:8].upper()
-        instance.order_number = f"ORD-{timestamp}-{unique_id}"
+# Statuses that make an order's stock reservations permanent
+STOCK_COMMIT_STATUSES = ('confirmed', 'processing', 'shipped', 'delivered')
 
 
 @receiver(post_save, sender=OrderItem)
 def update_order_totals(sender, instance, **kwargs):
     """Update order totals when order item is saved"""
     instance.order.calculate_totals()
+
+
+@receiver(pre_delete, sender=Product)
+def remember_product_carts(sender, instance, **kwargs):
+    """Note the carts holding a product about to be deleted along with its cart items"""
+    instance._cart_ids = list(
+        CartItem.objects.filter(product=instance).values_list('cart_id', flat=True).distinct()
+    )
+
+
+@receiver(post_delete, sender=Product)
+def recalculate_product_carts(sender, instance, **kwargs):
+    """Recompute the totals of those carts; the cascade skips the item deltas"""
+    if getattr(instance, '_cart_ids', None):
+        Cart.recalculate_totals(instance._cart_ids)
+
+
+@receiver(post_save, sender=Order)
+def settle_stock_reservations(sender, instance, created, raw=False, **kwargs):
+    """Commit or release reserved stock when the order status changes"""
+    if raw or not instance.status_changed:
+        return
+    if not created:
+        if instance.status in STOCK_COMMIT_STATUSES:
+            if not commit_reservations(instance.order_number) and instance._loaded_status == 'pending':
+                logger.warning('Order %s confirmed without active stock reservations', instance.order_number)
+        elif instance.status == 'cancelled':
+            release_reservations(instance.order_number)
+    instance._loaded_status = instance.status
+
+
+@receiver(reservations_expired)
+def cancel_expired_orders(sender, references, **kwargs):
+    """Cancel pending orders whose stock went back, so no payment can confirm them"""
+    # The stock is already back: a plain UPDATE, without the post_save release
+    Order.objects.filter(order_number__in=references, status='pending').update(
+        status='cancelled', updated_at=timezone.now()
+    )
+
+
+@receiver(m2m_changed, sender=Coupon.applicable_products.through)
+@receiver(m2m_changed, sender=Coupon.applicable_categories.through)
+def bump_coupon_version(sender, instance, action, reverse, pk_set, **kwargs):
+    """Move updated_at of coupons whose scope changed so their compiled rules are rebuilt"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    now = timezone.now()
+    coupons = Coupon.objects.all()
+    if not reverse:
+        coupons = coupons.filter(pk=instance.pk)
+        instance.updated_at = now
+    elif pk_set is not None:
+        coupons = coupons.filter(pk__in=pk_set)
+    # A reverse clear (product.coupons.clear()) doesn't say which coupons lost it
+    coupons.update(updated_at=now)
@@ -1,3 +1,370 @@
-from django.test import TestCase
+import csv
+import io
+import json
+from datetime import timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from accounts.models import Address
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from payments.models import Payment, Refund
+from products.inventory import expire_reservations
+from products.models import CatalogVersion, Category, CategoryClosure, Product, ProductImage
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase
+from shop_backend.exports import serialized_chunks
+
+from . import coupons
+from .checkout import CheckoutError, place_order
+from .models import Cart, CartItem, Coupon, Order
+from .serializers import OrderListSerializer
+
+User = get_user_model()
+
+
+class CheckoutTestCase(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', password='secret')
+        self.address = Address.objects.create(
+            user=self.user, title='Home', first_name='Ada', last_name='Buyer', address_line_1='1 Main St',
+            city='Tehran', state='Tehran', postal_code='12345',
+        )
+        category = Category.objects.create(name='Books', slug='books')
+        self.product = Product.objects.create(
+            name='Book', slug='book', sku='BOOK-1', category=category, price=Decimal('20.00'), stock_quantity=10
+        )
+        ProductImage.objects.create(product=self.product, image='products/back.jpg', display_order=2)
+        ProductImage.objects.create(product=self.product, image='products/front.jpg', display_order=1)
+        self.cart, _created = Cart.objects.get_or_create(user=self.user)
+
+    def add_to_cart(self, quantity=2):
+        CartItem.objects.create(cart=self.cart, product=self.product, quantity=quantity, unit_price=self.product.price)
+
+
+class CheckoutViewTests(CheckoutTestCase):
+    url = reverse('orders:checkout')
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.add_to_cart()
+
+    def test_checkout_returns_order(self):
+        response = self.client.post(self.url, {'shipping_address_id': self.address.pk}, format='json')
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data['total_amount'], '40.00')
+        self.assertIsNone(response.data['payment_status'])
+        self.assertEqual(response.data['item_count'], 1)
+        self.assertEqual(response.data['items'][0]['sku'], 'BOOK-1')
+        self.assertTrue(response.data['items'][0]['product_image'].endswith('products/front.jpg'))
+        self.assertFalse(CartItem.objects.filter(cart=self.cart).exists())
+
+    def test_retry_with_idempotency_key_returns_first_order(self):
+        first = self.client.post(
+            self.url, {'shipping_address_id': self.address.pk}, format='json', HTTP_IDEMPOTENCY_KEY='checkout-1'
+        )
+        retry = self.client.post(
+            self.url, {'shipping_address_id': self.address.pk}, format='json', HTTP_IDEMPOTENCY_KEY='checkout-1'
+        )
+
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.data['id'], first.data['id'])
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 1)
+
+    def test_long_idempotency_key_is_rejected(self):
+        response = self.client.post(
+            self.url, {'shipping_address_id': self.address.pk}, format='json', HTTP_IDEMPOTENCY_KEY='k' * 65
+        )
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+
+class CartViewTests(CheckoutTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.add_to_cart()
+
+    def test_cart_shows_first_image(self):
+        response = self.client.get(reverse('orders:cart-detail', args=[self.cart.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['item_count'], 1)
+        self.assertTrue(response.data['items'][0]['product_image'].endswith('products/front.jpg'))
+
+    def test_apply_coupon(self):
+        now = timezone.now()
+        Coupon.objects.create(
+            code='FIVE', name='Five off', coupon_type='fixed', value=Decimal('5.00'),
+            valid_from=now - timedelta(days=1), valid_until=now + timedelta(days=1),
+        )
+
+        response = self.client.post(
+            reverse('orders:cart-apply-coupon', args=[self.cart.pk]), {'coupon_code': 'FIVE'}, format='json'
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['items'][0]['product_image'].endswith('products/front.jpg'))
+
+    def test_apply_coupon_reads_category_version_once(self):
+        now = timezone.now()
+        Coupon.objects.create(
+            code='FIVE', name='Five off', coupon_type='fixed', value=Decimal('5.00'),
+            valid_from=now - timedelta(days=1), valid_until=now + timedelta(days=1),
+        )
+        coupons.current_category_version()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                reverse('orders:cart-apply-coupon', args=[self.cart.pk]), {'coupon_code': 'FIVE'}, format='json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['discount'], Decimal('5.00'))
+        table = CatalogVersion._meta.db_table
+        self.assertEqual(sum(table in query['sql'] for query in queries.captured_queries), 1)
+
+
+class CartTotalsTests(CheckoutTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        self.lamp = Product.objects.create(
+            name='Lamp', slug='lamp', sku='LAMP-1', category=self.product.category, price=Decimal('15.00'),
+            stock_quantity=10,
+        )
+
+    def post(self, name, data):
+        response = self.client.post(reverse(f'orders:cart-{name}', args=[self.cart.pk]), data, format='json')
+        self.assertLess(response.status_code, 300)
+        self.cart.refresh_from_db()
+        return self.cart.subtotal, self.cart.total_amount
+
+    def totals(self):
+        self.cart.refresh_from_db()
+        return self.cart.subtotal, self.cart.total_amount
+
+    def test_add_update_and_remove_move_the_totals(self):
+        self.assertEqual(self.post('add-item', {'product_id': self.product.pk, 'quantity': 2}), (40, 40))
+        self.assertEqual(self.post('add-item', {'product_id': self.lamp.pk}), (55, 55))
+        self.assertEqual(self.post('add-item', {'product_id': self.lamp.pk}), (70, 70))
+
+        book = CartItem.objects.get(cart=self.cart, product=self.product)
+        self.assertEqual(self.post('update-item', {'item_id': book.pk, 'quantity': 1}), (50, 50))
+        self.assertEqual(self.post('remove-item', {'item_id': book.pk}), (30, 30))
+        lamp = CartItem.objects.get(cart=self.cart, product=self.lamp)
+        self.assertEqual(self.post('update-item', {'item_id': lamp.pk, 'quantity': 0}), (0, 0))
+
+    def test_clear(self):
+        self.add_to_cart()
+
+        self.assertEqual(self.post('clear', {}), (0, 0))
+
+    def test_product_delete_recalculates_the_carts_holding_it(self):
+        self.add_to_cart()
+        CartItem.objects.create(cart=self.cart, product=self.lamp, quantity=1, unit_price=self.lamp.price)
+        self.assertEqual(self.totals(), (55, 55))
+
+        self.product.delete()
+
+        self.assertEqual(self.totals(), (15, 15))
+
+    def test_recalculate_totals_of_an_empty_cart(self):
+        Cart.objects.filter(pk=self.cart.pk).update(subtotal=Decimal('9.00'), total_amount=Decimal('9.00'))
+
+        Cart.recalculate_totals([self.cart.pk])
+
+        self.assertEqual(self.totals(), (0, 0))
+
+
+class PlaceOrderTests(CheckoutTestCase):
+    def test_user_without_cart(self):
+        self.cart.delete()
+
+        with self.assertRaises(CheckoutError):
+            place_order(self.user, self.address)
+
+    def test_per_user_coupon_limit(self):
+        now = timezone.now()
+        Coupon.objects.create(
+            code='ONCE', name='Once', coupon_type='fixed', value=Decimal('5.00'), per_user_limit=1,
+            valid_from=now - timedelta(days=1), valid_until=now + timedelta(days=1),
+        )
+        self.add_to_cart()
+        order, created = place_order(self.user, self.address, coupon_code='ONCE')
+        self.assertTrue(created)
+        self.assertEqual(order.total_amount, Decimal('35.00'))
+
+        self.add_to_cart()
+        with self.assertRaises(CheckoutError):
+            place_order(self.user, self.address, coupon_code='ONCE')
+        self.assertEqual(CartItem.objects.filter(cart=self.cart).count(), 1)
+
+    def test_only_ordered_lines_leave_the_cart(self):
+        self.add_to_cart()
+
+        order, _created = place_order(self.user, self.address)
+
+        self.assertEqual(order.items.count(), 1)
+        self.cart.refresh_from_db()
+        self.assertEqual(self.cart.subtotal, Decimal('0.00'))
+        self.assertFalse(CartItem.objects.filter(cart=self.cart).exists())
+
+
+class CouponRuleCacheTests(CheckoutTestCase):
+    def setUp(self):
+        super().setUp()
+        coupons.reset()
+        self.addCleanup(coupons.reset)
+        now = timezone.now()
+        self.fiction = Category.objects.create(name='Fiction', slug='fiction')
+        self.coupon = Coupon.objects.create(
+            code='FICTION', name='Fiction', coupon_type='fixed', value=Decimal('5.00'),
+            valid_from=now - timedelta(days=1), valid_until=now + timedelta(days=1),
+        )
+        self.coupon.applicable_categories.add(self.fiction)
+        self.lines = [coupons.CartLine(self.product.pk, self.product.category_id, Decimal('20.00'))]
+
+    def move_books_under_fiction(self):
+        # The closure rows a tree move writes, without the signals of a save
+        CategoryClosure.objects.create(ancestor=self.fiction, descendant=self.product.category, depth=1)
+
+    def test_category_version_bumped_by_another_process_recompiles(self):
+        self.assertIsNotNone(coupons.check_coupon('FICTION', self.user, self.lines).error)
+        self.move_books_under_fiction()
+
+        CatalogVersion.objects.filter(family='category').update(version=1)
+
+        self.assertIsNone(coupons.check_coupon('FICTION', self.user, self.lines).error)
+
+    def test_rules_expire(self):
+        self.assertIsNotNone(coupons.check_coupon('FICTION', self.user, self.lines).error)
+        self.move_books_under_fiction()
+
+        self.assertIsNotNone(coupons.check_coupon('FICTION', self.user, self.lines).error)
+        with override_settings(COUPON_RULE_CACHE_SECONDS=0):
+            self.assertIsNone(coupons.check_coupon('FICTION', self.user, self.lines).error)
+
+
+class ExpiredReservationTests(CheckoutTestCase):
+    def setUp(self):
+        super().setUp()
+        self.add_to_cart()
+        self.order, _created = place_order(self.user, self.address)
+        self.payment = Payment.objects.create(
+            order=self.order, user=self.user, payment_method='credit_card', amount=self.order.total_amount,
+            currency='USD',
+        )
+
+    def expire(self):
+        expire_reservations(now=timezone.now() + timedelta(days=1))
+
+    def test_expiry_cancels_pending_order(self):
+        self.expire()
+
+        self.order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(self.order.status, 'cancelled')
+        self.assertEqual(self.product.stock_quantity, 10)
+
+    def test_late_payment_is_refunded_instead_of_confirming(self):
+        self.expire()
+        self.payment.status = 'completed'
+        self.payment.save()
+
+        self.order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(self.order.status, 'cancelled')
+        self.assertEqual(self.product.stock_quantity, 10)
+        refund = Refund.objects.get(payment=self.payment)
+        self.assertEqual(refund.amount, self.payment.amount)
+
+    def test_payment_before_expiry_keeps_the_stock(self):
+        self.payment.status = 'completed'
+        self.payment.save()
+        self.expire()
+
+        self.order.refresh_from_db()
+        self.product.refresh_from_db()
+        self.assertEqual(self.order.status, 'confirmed')
+        self.assertEqual(self.product.stock_quantity, 8)
+
+
+class CompiledSerializerTests(CheckoutTestCase):
+    def test_order_list_renders_like_drf(self):
+        self.add_to_cart()
+        paid, _created = place_order(self.user, self.address)
+        Payment.objects.create(
+            order=paid, user=self.user, payment_method='credit_card', amount=paid.total_amount, currency='USD'
+        )
+        self.add_to_cart(quantity=1)
+        place_order(self.user, self.address)
+
+        orders = list(Order.objects.select_related('payment').annotate(line_count=Count('items')))
+        with override_settings(COMPILED_SERIALIZERS=False):
+            expected = JSONRenderer().render(OrderListSerializer(orders, many=True).data)
+
+        self.assertEqual(JSONRenderer().render(OrderListSerializer(orders, many=True).data), expected)
+
+
+class OrderExportTests(CheckoutTestCase):
+    url = reverse('orders:order-list')
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.user)
+        for quantity in (1, 2, 3):
+            self.add_to_cart(quantity)
+            place_order(self.user, self.address)
+        Order.objects.filter(total_amount=Decimal('40.00')).update(status='confirmed')
+        stranger = User.objects.create_user(email='stranger@example.com', password=None)
+        Order.objects.create(
+            user=stranger, shipping_address=self.address, subtotal=Decimal('1.00'), total_amount=Decimal('1.00')
+        )
+
+    def listed(self, **params):
+        return self.client.get(self.url, params).json()['results']
+
+    def test_ndjson(self):
+        response = self.client.get(self.url, {'format': 'ndjson'})
+
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="orders.ndjson"')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(rows, self.listed())
+        self.assertEqual(len(rows), 3)
+
+    def test_csv_with_filters(self):
+        response = self.client.get(self.url, {'status': 'pending'}, HTTP_ACCEPT='text/csv')
+
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = list(csv.DictReader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual([row['order_number'] for row in rows], [
+            order['order_number'] for order in self.listed(status='pending')
+        ])
+        self.assertEqual([row['item_count'] for row in rows], ['1', '1'])
+        self.assertEqual(rows[0]['payment_status'], '')
+
+    def test_empty_csv_export(self):
+        response = self.client.get(self.url, {'format': 'csv', 'status': 'delivered'})
+
+        self.assertEqual(b''.join(response.streaming_content), b'')
+
+    @override_settings(EXPORT_CHUNK_SIZE=2)
+    def test_rows_are_serialized_a_chunk_at_a_time(self):
+        queryset = Order.objects.filter(user=self.user).annotate(line_count=Count('items')).order_by('pk')
+
+        chunks = list(serialized_chunks(queryset, OrderListSerializer))
+
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        self.assertEqual(
+            [row['id'] for chunk in chunks for row in chunk], list(queryset.values_list('pk', flat=True))
+        )
@@ -4,29 +4,52 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.filters import OrderingFilter
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Q, Sum, F
+from django.db.models import Count, Q, Sum, F, Prefetch, prefetch_related_objects
 from django.shortcuts import get_object_or_404
-from django.utils import timezone
+from shop_backend.exports import StreamingExportMixin
+from shop_backend.pagination import KeysetPagination
 from decimal import Decimal
-from .models import Order, OrderItem, Cart, CartItem, Coupon, CouponUsage
-from . import serializers
+from .models import Order, OrderItem, Cart, CartItem, Coupon
+from . import coupons, serializers
+from .checkout import IDEMPOTENCY_KEY_MAX_LENGTH, CheckoutError, place_order
 from products.models import Product, ProductVariant
 
 
-class OrderViewSet(viewsets.ModelViewSet):
+def with_order_details(queryset):
+    """Orders with what OrderSerializer reads, in three queries"""
+    return queryset.select_related('payment', 'shipping_address', 'billing_address').prefetch_related(
+        Prefetch('items', queryset=OrderItem.objects.select_related('product').prefetch_related('product__images'))
+    )
+
+
+def cart_items_prefetch():
+    """Cart items with what CartItemSerializer reads"""
+    return Prefetch(
+        'items', queryset=CartItem.objects.select_related('product', 'variant').prefetch_related('product__images')
+    )
+
+
+class OrderViewSet(StreamingExportMixin, viewsets.ModelViewSet):
     """Order management"""
     queryset = Order.objects.all()
     serializer_class = serializers.OrderSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend, OrderingFilter]
-    filterset_fields = ['status', 'payment_status']
+    filterset_fields = ['status', 'payment__status']
     ordering_fields = ['created_at', 'total_amount']
     ordering = ['-created_at']
+    pagination_class = KeysetPagination
+    export_filename = 'orders'
 
     def get_queryset(self):
-        if self.request.user.is_staff:
-            return Order.objects.all()
-        return Order.objects.filter(user=self.request.user)
+        queryset = Order.objects.all()
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(user=self.request.user)
+        if self.action == 'list':
+            queryset = queryset.select_related('payment').annotate(line_count=Count('items'))
+        else:
+            queryset = with_order_details(queryset)
+        return queryset
 
     def get_serializer_class(self):
         if self.action == 'list':
@@ -90,12 +113,18 @@ class CartViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return Cart.objects.filter(user=self.request.user)
+        return Cart.objects.filter(user=self.request.user).prefetch_related(cart_items_prefetch())
 
     def get_object(self):
         cart, created = Cart.objects.get_or_create(user=self.request.user)
         return cart
 
+    def retrieve(self, request, *args, **kwargs):
+        cart = self.get_object()
+        prefetch_related_objects([cart], cart_items_prefetch())
+        serializer = self.get_serializer(cart)
+        return Response(serializer.data)
+
     @action(detail=True, methods=['post'])
     def add_item(self, request, pk=None):
         """Add item to cart"""
@@ -126,7 +155,7 @@ class CartViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_404_NOT_FOUND
                 )
 
-        # Check stock
+        # Advisory check; stock is reserved atomically at checkout
         available_stock = variant.stock_quantity if variant else product.stock_quantity
         if quantity > available_stock:
             return Response(
@@ -139,7 +168,10 @@ class CartViewSet(viewsets.ModelViewSet):
             cart=cart,
             product=product,
             variant=variant,
-            defaults={'quantity': quantity}
+            defaults={
+                'quantity': quantity,
+                'unit_price': variant.final_price if variant else product.price,
+            }
         )
 
         if not created:
@@ -168,7 +200,7 @@ class CartViewSet(viewsets.ModelViewSet):
             item.delete()
             return Response({'message': 'Item removed from cart'})
 
-        # Check stock
+        # Advisory check; stock is reserved atomically at checkout
         available_stock = (
             item.variant.stock_quantity if item.variant
             else item.product.stock_quantity
@@ -205,53 +237,43 @@ class CartViewSet(viewsets.ModelViewSet):
     def clear(self, request, pk=None):
         """Clear cart"""
         cart = self.get_object()
-        cart.items.all().delete()
+        cart.clear()
         return Response({'message': 'Cart cleared'})
 
     @action(detail=True, methods=['post'])
     def apply_coupon(self, request, pk=None):
         """Apply coupon to cart"""
         cart = self.get_object()
-        coupon_code = request.data.get('coupon_code')
-
-        try:
-            coupon = Coupon.objects.get(
-                code=coupon_code,
-                is_active=True,
-                start_date__lte=timezone.now(),
-                end_date__gte=timezone.now()
-            )
-        except Coupon.DoesNotExist:
+        category_version = coupons.current_category_version()
+        lines = coupons.cart_lines(cart)
+        result = coupons.check_coupon(request.data.get('coupon_code'), request.user, lines, category_version)
+        if result.error:
             return Response(
-                {'error': 'Invalid coupon'},
+                {'error': result.error},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Check usage limit
-        if coupon.usage_limit and coupon.times_used >= coupon.usage_limit:
-            return Response(
-                {'error': 'Coupon usage limit exceeded'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-        # Check user usage
-        if coupon.per_user_limit:
-            user_usage = CouponUsage.objects.filter(
-                coupon=coupon,
-                user=request.user
-            ).count()
-            if user_usage >= coupon.per_user_limit:
-                return Response(
-                    {'error': 'Coupon per user limit exceeded'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-
-        cart.coupon = coupon
-        cart.save()
+        cart.coupon_id = result.coupon_id
+        cart.save(update_fields=['coupon', 'updated_at'])
+        cart.__dict__['pricing'] = cart.price(category_version, lines)
 
+        prefetch_related_objects([cart], cart_items_prefetch())
         serializer = self.get_serializer(cart)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['get'])
+    def best_coupon(self, request, pk=None):
+        """Active coupon with the biggest discount on the cart"""
+        cart = self.get_object()
+        result = coupons.best_coupon(request.user, coupons.cart_lines(cart))
+        if result is None:
+            return Response({'coupon': None, 'discount': None})
+        coupon = Coupon.objects.get(pk=result.coupon_id)
+        return Response({
+            'coupon': serializers.CouponSerializer(coupon, context=self.get_serializer_context()).data,
+            'discount': result.discount,
+        })
+
 
 class CartItemViewSet(viewsets.ModelViewSet):
     """Cart item management"""
@@ -270,9 +292,10 @@ class CouponViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
+        queryset = Coupon.objects.prefetch_related('applicable_products', 'applicable_categories')
         if self.request.user.is_staff:
-            return Coupon.objects.all()
-        return Coupon.objects.filter(is_active=True)
+            return queryset
+        return queryset.filter(is_active=True)
 
 
 class CheckoutView(generics.GenericAPIView):
@@ -281,52 +304,35 @@ class CheckoutView(generics.GenericAPIView):
     permission_classes = [IsAuthenticated]
 
     def post(self, request, *args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key and len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+            return Response(
+                {'error': f'Idempotency-Key is longer than {IDEMPOTENCY_KEY_MAX_LENGTH} characters'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            cart = Cart.objects.get(user=request.user)
-            if not cart.items.exists():
-                return Response(
-                    {'error': 'Cart is empty'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-
-            # Create order
-            order = Order.objects.create(
-                user=request.user,
-                shipping_address=serializer.validated_data['shipping_address'],
-                billing_address=serializer.validated_data.get('billing_address'),
-                coupon=cart.coupon
-            )
-
-            # Create order items
-            for cart_item in cart.items.all():
-                OrderItem.objects.create(
-                    order=order,
-                    product=cart_item.product,
-                    variant=cart_item.variant,
-                    quantity=cart_item.quantity,
-                    price=cart_item.get_price()
-                )
-
-            # Update coupon usage
-            if cart.coupon:
-                CouponUsage.objects.create(
-                    coupon=cart.coupon,
-                    user=request.user,
-                    order=order
+            data = serializer.validated_data
+            try:
+                order, created = place_order(
+                    request.user,
+                    shipping_address=data['shipping_address_id'],
+                    billing_address=data.get('billing_address_id'),
+                    notes=data.get('notes', ''),
+                    coupon_code=data.get('coupon_code'),
+                    idempotency_key=idempotency_key or data.get('idempotency_key'),
                 )
-                cart.coupon.times_used += 1
-                cart.coupon.save()
-
-            # Clear cart
-            cart.items.all().delete()
-            cart.coupon = None
-            cart.save()
-
-            # Calculate totals
-            order.calculate_totals()
+            except CheckoutError as exc:
+                payload = {'error': exc.message}
+                if exc.details:
+                    payload.update(exc.details)
+                return Response(payload, status=exc.status_code)
 
+            order = with_order_details(Order.objects.filter(pk=order.pk)).get()
             serializer = serializers.OrderSerializer(order)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            return Response(
+                serializer.data,
+                status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+            )
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Payment, PaymentGateway, Refund
+from .models import Payment, PaymentGateway, Refund, WebhookEvent
 
 
 @admin.register(Payment)
@@ -29,3 +29,19 @@ class RefundAdmin(admin.ModelAdmin):
     search_fields = ('payment__order__order_number', 'refund_id', 'reason')
     readonly_fields = ('refund_id', 'gateway_response', 'processed_at', 'created_at', 'updated_at')
     ordering = ('-created_at',)
+
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    """Webhook event admin; events are stored as received"""
+    list_display = ('gateway', 'event_id', 'event_type', 'reference', 'status', 'attempts', 'received_at')
+    list_filter = ('gateway', 'status', 'received_at')
+    search_fields = ('event_id', 'reference')
+    readonly_fields = (
+        'gateway', 'payment_gateway', 'event_id', 'event_type', 'reference', 'payload',
+        'status', 'attempts', 'last_error', 'received_at', 'processed_at',
+    )
+    ordering = ('-received_at',)
+
+    def has_add_permission(self, request):
+        return False
@@ -0,0 +1,801 @@
+"""
+Payment gateway API clients.
+
+``get_client(gateway)`` returns the client of a ``PaymentGateway``
+configuration, chosen by its gateway type (``CLIENT_CLASSES``). Clients map
+payments and refunds onto one gateway's API: ``create_payment``,
+``verify_payment`` and ``refund`` return plain dicts and raise
+``GatewayError``.
+
+Each configuration has one ``GatewayState`` per process, shared by all
+threads:
+
+- a ``requests.Session`` whose pool keeps connections to the gateway alive
+  between calls, so most calls skip the TCP and TLS handshakes;
+- a ``CircuitBreaker``. Once at least ``PAYMENT_GATEWAY_BREAKER_THRESHOLD``
+  of the recent calls failed, calls fail fast with ``GatewayUnavailable``.
+  After ``PAYMENT_GATEWAY_BREAKER_COOLDOWN`` seconds one trial call decides
+  whether the circuit closes again. ``payments.routing`` ranks gateways
+  with an open circuit last;
+- a ``RetryBudget``: retries are limited to ``PAYMENT_GATEWAY_RETRY_RATIO``
+  of the calls, so a gateway that is already struggling isn't hit with
+  several times its normal traffic;
+- a ``LatencyHistogram`` of call durations, plus call counters. Both are
+  reported by ``gateway_stats``;
+- a ``RollingWindow`` of the success rate and mean latency of the last
+  ``PAYMENT_GATEWAY_STATS_WINDOW`` seconds, which ``payments.routing``
+  ranks gateways by.
+
+A call has a deadline, ``PAYMENT_GATEWAY_DEADLINE`` seconds by default,
+that covers all of its attempts. Each attempt's read timeout is the time
+left. Only calls that are safe to repeat are retried: reads,
+verifications, and writes sent with an idempotency key. Connection errors,
+timeouts, 429 and 5xx answers count as gateway failures. Other 4xx answers
+are the caller's error and are never retried.
+
+A gateway's ``settings['base_url']`` points its client at another host,
+e.g. ``payments.fake_gateway.FakeGatewayServer`` in development.
+"""
+
+import bisect
+import os
+import random
+import threading
+import time
+from collections import deque
+from decimal import Decimal
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .models import PaymentGateway
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_DEADLINE = 15
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_RATIO = 0.2
+DEFAULT_BREAKER_WINDOW = 50
+DEFAULT_BREAKER_MIN_CALLS = 20
+DEFAULT_BREAKER_THRESHOLD = 0.5
+DEFAULT_BREAKER_COOLDOWN = 30
+DEFAULT_STATS_WINDOW = 300
+STATS_BUCKETS = 30
+RETRY_BACKOFF = 0.1
+# Retries allowed before any call made deposits
+RETRY_RESERVE = 10
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# Currencies Stripe takes in whole units rather than cents
+ZERO_DECIMAL_CURRENCIES = frozenset({
+    'BIF', 'CLP', 'DJF', 'GNF', 'JPY', 'KMF', 'KRW', 'MGA', 'PYG', 'RWF', 'UGX', 'VND', 'VUV', 'XAF', 'XOF',
+    'XPF',
+})
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+class GatewayError(Exception):
+    """A gateway call failed; ``retryable`` when repeating it may succeed"""
+
+    def __init__(self, message, status_code=None, response=None, retryable=False):
+        self.message = message
+        self.status_code = status_code
+        self.response = response
+        self.retryable = retryable
+        super().__init__(message)
+
+
+class GatewayUnavailable(GatewayError):
+    """The gateway was not called: its circuit is open or the deadline has passed"""
+
+    def __init__(self, message):
+        super().__init__(message, retryable=True)
+
+
+class Deadline:
+    """A point in time by which a call and all of its retries must be done"""
+
+    __slots__ = ('expires',)
+
+    def __init__(self, seconds=None):
+        self.expires = time.monotonic() + (seconds if seconds is not None else _setting(
+            'PAYMENT_GATEWAY_DEADLINE', DEFAULT_DEADLINE
+        ))
+
+    def remaining(self):
+        return max(self.expires - time.monotonic(), 0.0)
+
+
+class CircuitBreaker:
+    """Fails calls fast while most of a gateway's recent calls fail"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window=DEFAULT_BREAKER_WINDOW, min_calls=DEFAULT_BREAKER_MIN_CALLS,
+                 threshold=DEFAULT_BREAKER_THRESHOLD, cooldown=DEFAULT_BREAKER_COOLDOWN, clock=time.monotonic):
+        self.min_calls = min_calls
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.opened = 0
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._open_since = None
+        self._probing = False
+
+    def _state(self):
+        if self._open_since is None:
+            return self.CLOSED
+        if self.clock() - self._open_since >= self.cooldown:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def allow(self):
+        """Whether a call may go out now; in half-open state only one trial call may"""
+        with self._lock:
+            state = self._state()
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record(self, success):
+        """Count the outcome of a call ``allow`` let through"""
+        with self._lock:
+            if self._open_since is not None:
+                # Only the trial call decides; calls started before the circuit opened don't
+                if self._probing:
+                    self._probing = False
+                    if success:
+                        self._open_since = None
+                        self._outcomes.clear()
+                    else:
+                        self._open_since = self.clock()
+                return
+            self._outcomes.append(success)
+            failures = len(self._outcomes) - sum(self._outcomes)
+            if len(self._outcomes) >= self.min_calls and failures >= self.threshold * len(self._outcomes):
+                self._open_since = self.clock()
+                self.opened += 1
+
+    def failure_rate(self):
+        with self._lock:
+            if not self._outcomes:
+                return 0.0
+            return 1 - sum(self._outcomes) / len(self._outcomes)
+
+
+class RetryBudget:
+    """Allows retries for up to ``ratio`` of the calls made"""
+
+    def __init__(self, ratio=DEFAULT_RETRY_RATIO, reserve=RETRY_RESERVE):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._tokens = float(reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self._tokens + self.ratio, self.reserve)
+
+    def withdraw(self):
+        """Take one retry from the budget; False when it is spent"""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RollingWindow:
+    """Calls, failures and latency of the last ``seconds``, kept in time buckets"""
+
+    def __init__(self, seconds=DEFAULT_STATS_WINDOW, buckets=STATS_BUCKETS, clock=time.monotonic):
+        self.width = seconds / buckets
+        self.clock = clock
+        self._lock = threading.Lock()
+        # [slot, calls, failures, total seconds]; a bucket is reused once its slot is past the window
+        self._buckets = [[-1, 0, 0, 0.0] for _ in range(buckets)]
+
+    def record(self, success, seconds):
+        slot = int(self.clock() // self.width)
+        with self._lock:
+            bucket = self._buckets[slot % len(self._buckets)]
+            if bucket[0] != slot:
+                bucket[:] = [slot, 0, 0, 0.0]
+            bucket[1] += 1
+            bucket[2] += not success
+            bucket[3] += seconds
+
+    def totals(self):
+        """``(calls, failures, total seconds)`` within the window"""
+        oldest = int(self.clock() // self.width) - len(self._buckets)
+        calls = failures = 0
+        total = 0.0
+        with self._lock:
+            for slot, bucket_calls, bucket_failures, bucket_total in self._buckets:
+                if slot > oldest:
+                    calls += bucket_calls
+                    failures += bucket_failures
+                    total += bucket_total
+        return calls, failures, total
+
+    def snapshot(self):
+        calls, failures, total = self.totals()
+        return {
+            'calls': calls,
+            'success_rate': round(1 - failures / calls, 4) if calls else None,
+            'mean_ms': round(total * 1000 / calls, 3) if calls else None,
+        }
+
+
+class LatencyHistogram:
+    """Call durations counted in fixed buckets"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = [0] * (len(self.buckets) + 1)
+            self._count = 0
+            self._total = 0.0
+            self._max = 0.0
+
+    def observe(self, seconds):
+        milliseconds = seconds * 1000
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, milliseconds)] += 1
+            self._count += 1
+            self._total += milliseconds
+            self._max = max(self._max, milliseconds)
+
+    def _percentile(self, fraction):
+        """Upper bound of the bucket holding the ``fraction`` percentile"""
+        rank = fraction * self._count
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else round(self._max, 3)
+        return 0.0
+
+    def snapshot(self):
+        with self._lock:
+            labels = [f'<={bound}ms' for bound in self.buckets] + [f'>{self.buckets[-1]}ms']
+            return {
+                'count': self._count,
+                'mean_ms': round(self._total / self._count, 3) if self._count else 0.0,
+                'max_ms': round(self._max, 3),
+                'p50_ms': self._percentile(0.50),
+                'p95_ms': self._percentile(0.95),
+                'p99_ms': self._percentile(0.99),
+                'buckets': {label: count for label, count in zip(labels, self._counts) if count},
+            }
+
+
+class GatewayState:
+    """Connections, circuit breaker, retry budget and metrics of one gateway configuration"""
+
+    def __init__(self, name):
+        self.name = name
+        self.pid = os.getpid()
+        self.session = requests.Session()
+        pool_size = _setting('PAYMENT_GATEWAY_POOL_SIZE', DEFAULT_POOL_SIZE)
+        # Retries are ours, with deadlines and a budget; urllib3 must not add its own
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.breaker = CircuitBreaker(
+            window=_setting('PAYMENT_GATEWAY_BREAKER_WINDOW', DEFAULT_BREAKER_WINDOW),
+            min_calls=_setting('PAYMENT_GATEWAY_BREAKER_MIN_CALLS', DEFAULT_BREAKER_MIN_CALLS),
+            threshold=_setting('PAYMENT_GATEWAY_BREAKER_THRESHOLD', DEFAULT_BREAKER_THRESHOLD),
+            cooldown=_setting('PAYMENT_GATEWAY_BREAKER_COOLDOWN', DEFAULT_BREAKER_COOLDOWN),
+        )
+        self.budget = RetryBudget(_setting('PAYMENT_GATEWAY_RETRY_RATIO', DEFAULT_RETRY_RATIO))
+        self.latency = LatencyHistogram()
+        self.recent = RollingWindow(_setting('PAYMENT_GATEWAY_STATS_WINDOW', DEFAULT_STATS_WINDOW))
+        # Gateway-specific values kept between calls, e.g. OAuth tokens
+        self.cache = {}
+        self._lock = threading.Lock()
+        self._counts = {'calls': 0, 'succeeded': 0, 'failed': 0, 'retried': 0, 'rejected': 0}
+
+    def count(self, outcome):
+        with self._lock:
+            self._counts[outcome] += 1
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self._counts)
+        return {
+            'name': self.name,
+            'circuit': self.breaker.state,
+            'circuit_opened': self.breaker.opened,
+            'failure_rate': round(self.breaker.failure_rate(), 4),
+            **counts,
+            'latency': self.latency.snapshot(),
+            'recent': self.recent.snapshot(),
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_states = {}
+_states_lock = threading.Lock()
+
+
+def gateway_state(gateway):
+    """The process's ``GatewayState`` of a configuration; a forked child gets new ones"""
+    with _states_lock:
+        state = _states.get(gateway.pk)
+        if state is None or state.pid != os.getpid():
+            state = _states[gateway.pk] = GatewayState(gateway.name)
+        state.name = gateway.name
+        return state
+
+
+def gateway_stats():
+    """{gateway id: circuit state, call counts and latency percentiles} for this process"""
+    with _states_lock:
+        states = dict(_states)
+    return {pk: state.snapshot() for pk, state in states.items()}
+
+
+def reset():
+    """Close every pooled connection and forget circuit and latency state"""
+    with _states_lock:
+        states = list(_states.values())
+        _states.clear()
+    for state in states:
+        state.close()
+
+
+def is_available(gateway):
+    """False while the gateway's circuit is open"""
+    with _states_lock:
+        state = _states.get(gateway.pk)
+    return state is None or state.breaker.state != CircuitBreaker.OPEN
+
+
+def recent_stats(gateway):
+    """``(calls, success rate, mean seconds)`` of the gateway's recent calls in this process"""
+    with _states_lock:
+        state = _states.get(gateway.pk)
+    if state is None:
+        return 0, None, None
+    calls, failures, total = state.recent.totals()
+    if not calls:
+        return 0, None, None
+    return calls, 1 - failures / calls, total / calls
+
+
+def gateway_for_payment(payment):
+    """The configuration a payment is made through, or None for payments outside a gateway
+
+    ``Payment.gateway_name`` holds the configuration's name, or only the
+    gateway type for payments first seen through a webhook.
+    """
+    if not payment.gateway_name:
+        return None
+    gateway = PaymentGateway.objects.filter(name=payment.gateway_name).first()
+    if gateway is None:
+        gateway = PaymentGateway.objects.filter(gateway_type=payment.gateway_name, is_active=True).order_by(
+            'id'
+        ).first()
+    return gateway
+
+
+class GatewayClient:
+    """Calls to one gateway configuration's API"""
+
+    # Default API hosts by PaymentGateway.is_sandbox
+    base_urls = {}
+    # Header the gateway deduplicates requests by; writes carrying it can be retried
+    idempotency_header = None
+
+    def __init__(self, gateway):
+        self.gateway = gateway
+        self.state = gateway_state(gateway)
+
+    @property
+    def base_url(self):
+        return ((self.gateway.settings or {}).get('base_url') or self.base_urls[self.gateway.is_sandbox]).rstrip('/')
+
+    def headers(self):
+        """Headers authenticating a call"""
+        return {}
+
+    def request(self, method, path, deadline=None, idempotency_key=None, retry=None, authenticate=True, **kwargs):
+        """Decoded JSON answer of an API call, retried within its deadline and the retry budget"""
+        deadline = deadline or Deadline()
+        if retry is None:
+            retry = method == 'GET' or bool(idempotency_key and self.idempotency_header)
+        headers = {**(self.headers() if authenticate else {}), **kwargs.pop('headers', {})}
+        if idempotency_key and self.idempotency_header:
+            headers[self.idempotency_header] = idempotency_key
+        connect_timeout = _setting('PAYMENT_GATEWAY_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)
+        max_attempts = _setting('PAYMENT_GATEWAY_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+        state = self.state
+        state.count('calls')
+        state.budget.deposit()
+
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = deadline.remaining()
+            if not remaining:
+                raise GatewayUnavailable(f'{self.gateway.name}: deadline exceeded')
+            if not state.breaker.allow():
+                state.count('rejected')
+                raise GatewayUnavailable(f'{self.gateway.name}: circuit open')
+
+            started = time.perf_counter()
+            try:
+                response = state.session.request(
+                    method, self.base_url + path, headers=headers,
+                    timeout=(min(connect_timeout, remaining), remaining), **kwargs
+                )
+                error = self.error_for(response)
+            except requests.RequestException as exc:
+                error = GatewayError(f'{self.gateway.name}: {exc}', retryable=True)
+            except Exception:
+                # Never leave a trial call of a half-open circuit unrecorded
+                state.breaker.record(False)
+                raise
+            elapsed = time.perf_counter() - started
+            # A rejected request is the caller's fault, not the gateway failing
+            healthy = error is None or not error.retryable
+            state.latency.observe(elapsed)
+            state.recent.record(healthy, elapsed)
+            state.breaker.record(healthy)
+            if error is None:
+                state.count('succeeded')
+                return self.decode(response)
+
+            state.count('failed')
+            if not (retry and error.retryable and attempt < max_attempts):
+                raise error
+            backoff = RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+            if backoff >= deadline.remaining() or not state.budget.withdraw():
+                raise error
+            state.count('retried')
+            time.sleep(backoff)
+
+    def error_for(self, response):
+        """``GatewayError`` for an unsuccessful answer, None for a successful one"""
+        if response.status_code < 400:
+            return None
+        try:
+            body = response.json()
+        except ValueError:
+            body = response.text[:500]
+        return GatewayError(
+            f'{self.gateway.name}: HTTP {response.status_code}',
+            status_code=response.status_code,
+            response=body,
+            retryable=response.status_code == 429 or response.status_code >= 500,
+        )
+
+    def decode(self, response):
+        try:
+            return response.json()
+        except ValueError:
+            raise GatewayError(f'{self.gateway.name}: invalid response', status_code=response.status_code)
+
+    def create_payment(self, payment, callback_url=None, deadline=None):
+        """Start a payment; ``{'intent_id', 'client_secret', 'redirect_url', 'raw'}``"""
+        raise NotImplementedError
+
+    def verify_payment(self, payment, deadline=None):
+        """Ask the gateway about a started payment; ``{'status', 'transaction_id', 'raw'}``
+
+        ``status`` is a ``Payment`` status: completed, pending, processing or failed.
+        """
+        raise NotImplementedError
+
+    def refund(self, refund, deadline=None):
+        """Refund (part of) a payment; ``{'refund_id', 'status', 'raw'}``, status completed or processing"""
+        raise GatewayError(f'{self.gateway.name}: refunds are not supported through the API')
+
+    def callback_url(self, callback_url):
+        return callback_url or (self.gateway.settings or {}).get('callback_url') or ''
+
+
+class StripeClient(GatewayClient):
+    """Stripe PaymentIntents"""
+
+    base_urls = {True: 'https://api.stripe.com', False: 'https://api.stripe.com'}
+    idempotency_header = 'Idempotency-Key'
+    STATUSES = {
+        'succeeded': 'completed',
+        'processing': 'processing',
+        'canceled': 'cancelled',
+    }
+
+    def headers(self):
+        return {'Authorization': f'Bearer {self.gateway.api_secret or self.gateway.api_key}'}
+
+    @staticmethod
+    def minor_units(amount, currency):
+        if currency.upper() in ZERO_DECIMAL_CURRENCIES:
+            return int(amount)
+        return int((Decimal(amount) * 100).to_integral_value())
+
+    def create_payment(self, payment, callback_url=None, deadline=None):
+        data = self.request(
+            'POST', '/v1/payment_intents', deadline=deadline,
+            idempotency_key=f'intent-{payment.payment_id}-{payment.amount}',
+            data={
+                'amount': self.minor_units(payment.amount, payment.currency),
+                'currency': payment.currency.lower(),
+                'metadata[payment_id]': payment.payment_id,
+            },
+        )
+        return {'intent_id': data['id'], 'client_secret': data.get('client_secret'), 'redirect_url': None, 'raw': data}
+
+    def verify_payment(self, payment, deadline=None):
+        data = self.request('GET', f'/v1/payment_intents/{payment.gateway_transaction_id}', deadline=deadline)
+        return {
+            'status': self.STATUSES.get(data.get('status'), 'pending'),
+            'transaction_id': data.get('latest_charge') or data.get('id'),
+            'raw': data,
+        }
+
+    def refund(self, refund, deadline=None):
+        payment = refund.payment
+        data = self.request(
+            'POST', '/v1/refunds', deadline=deadline, idempotency_key=f'refund-{refund.refund_id}',
+            data={
+                'payment_intent': payment.gateway_transaction_id,
+                'amount': self.minor_units(refund.amount, payment.currency),
+            },
+        )
+        return {
+            'refund_id': data['id'],
+            'status': 'completed' if data.get('status') == 'succeeded' else 'processing',
+            'raw': data,
+        }
+
+
+class PayPalClient(GatewayClient):
+    """PayPal Orders v2, captured on verification"""
+
+    base_urls = {True: 'https://api-m.sandbox.paypal.com', False: 'https://api-m.paypal.com'}
+    idempotency_header = 'PayPal-Request-Id'
+
+    def headers(self):
+        return {'Authorization': f'Bearer {self.access_token()}'}
+
+    def access_token(self):
+        """OAuth token of the configuration, cached until shortly before it expires"""
+        key = ('token', self.gateway.api_key)
+        token, expires = self.state.cache.get(key, (None, 0))
+        if token and expires > time.monotonic():
+            return token
+        data = self.request(
+            'POST', '/v1/oauth2/token', retry=True, authenticate=False,
+            data={'grant_type': 'client_credentials'},
+            auth=(self.gateway.api_key, self.gateway.api_secret or ''),
+        )
+        self.state.cache[key] = (data['access_token'], time.monotonic() + data.get('expires_in', 0) - 60)
+        return data['access_token']
+
+    def create_payment(self, payment, callback_url=None, deadline=None):
+        callback_url = self.callback_url(callback_url)
+        body = {
+            'intent': 'CAPTURE',
+            'purchase_units': [{
+                'reference_id': payment.payment_id,
+                'amount': {'currency_code': payment.currency, 'value': f'{payment.amount:.2f}'},
+            }],
+        }
+        if callback_url:
+            body['application_context'] = {'return_url': callback_url, 'cancel_url': callback_url}
+        data = self.request(
+            'POST', '/v2/checkout/orders', deadline=deadline,
+            idempotency_key=f'order-{payment.payment_id}-{payment.amount}', json=body,
+        )
+        approve = next((link['href'] for link in data.get('links', []) if link.get('rel') == 'approve'), None)
+        return {'intent_id': data['id'], 'client_secret': None, 'redirect_url': approve, 'raw': data}
+
+    def verify_payment(self, payment, deadline=None):
+        data = self.request(
+            'POST', f'/v2/checkout/orders/{payment.gateway_transaction_id}/capture', deadline=deadline,
+            idempotency_key=f'capture-{payment.payment_id}', json={},
+        )
+        captures = [
+            capture
+            for unit in data.get('purchase_units', [])
+            for capture in (unit.get('payments') or {}).get('captures', [])
+        ]
+        status = {'COMPLETED': 'completed', 'DECLINED': 'failed'}.get(data.get('status'), 'processing')
+        return {'status': status, 'transaction_id': captures[0]['id'] if captures else None, 'raw': data}
+
+    def refund(self, refund, deadline=None):
+        payment = refund.payment
+        data = self.request(
+            'POST', f'/v2/payments/captures/{payment.transaction_id}/refund', deadline=deadline,
+            idempotency_key=f'refund-{refund.refund_id}',
+            json={'amount': {'currency_code': payment.currency, 'value': f'{refund.amount:.2f}'}},
+        )
+        return {
+            'refund_id': data['id'],
+            'status': 'completed' if data.get('status') == 'COMPLETED' else 'processing',
+            'raw': data,
+        }
+
+    def verify_webhook(self, transmission, webhook_id, event, deadline=None):
+        """Whether PayPal confirms it sent ``event`` to the webhook ``webhook_id``"""
+        data = self.request(
+            'POST', '/v1/notifications/verify-webhook-signature', deadline=deadline, retry=True,
+            json={**transmission, 'webhook_id': webhook_id, 'webhook_event': event},
+        )
+        return data.get('verification_status') == 'SUCCESS'
+
+
+class ZarinPalClient(GatewayClient):
+    """ZarinPal payment gateway v4; amounts in rials"""
+
+    base_urls = {True: 'https://sandbox.zarinpal.com', False: 'https://api.zarinpal.com'}
+    start_urls = {True: 'https://sandbox.zarinpal.com', False: 'https://www.zarinpal.com'}
+    # Verifying an already verified payment answers 101
+    PAID_CODES = (100, 101)
+
+    @property
+    def start_url(self):
+        return ((self.gateway.settings or {}).get('base_url') or self.start_urls[self.gateway.is_sandbox]).rstrip('/')
+
+    def create_payment(self, payment, callback_url=None, deadline=None):
+        data = self.request(
+            'POST', '/pg/v4/payment/request.json', deadline=deadline,
+            json={
+                'merchant_id': self.gateway.merchant_id or self.gateway.api_key,
+                'amount': int(payment.amount),
+                'description': f'Payment {payment.payment_id}',
+                'callback_url': self.callback_url(callback_url),
+            },
+        )
+        result = data.get('data') or {}
+        if result.get('code') != 100:
+            raise GatewayError(f'{self.gateway.name}: payment request rejected', response=data)
+        authority = result['authority']
+        return {
+            'intent_id': authority,
+            'client_secret': None,
+            'redirect_url': f'{self.start_url}/pg/StartPay/{authority}',
+            'raw': data,
+        }
+
+    def verify_payment(self, payment, deadline=None):
+        try:
+            data = self.request(
+                'POST', '/pg/v4/payment/verify.json', deadline=deadline, retry=True,
+                json={
+                    'merchant_id': self.gateway.merchant_id or self.gateway.api_key,
+                    'amount': int(payment.amount),
+                    'authority': payment.gateway_transaction_id,
+                },
+            )
+        except GatewayError as exc:
+            if exc.retryable:
+                raise
+            # Unpaid, cancelled or mismatched payments are answered with an error code
+            return {'status': 'failed', 'transaction_id': None, 'raw': exc.response}
+        result = data.get('data') or {}
+        paid = result.get('code') in self.PAID_CODES
+        return {
+            'status': 'completed' if paid else 'failed',
+            'transaction_id': str(result['ref_id']) if paid and result.get('ref_id') else None,
+            'raw': data,
+        }
+
+
+class PayPingClient(GatewayClient):
+    """PayPing v2"""
+
+    base_urls = {True: 'https://api.payping.ir', False: 'https://api.payping.ir'}
+
+    def headers(self):
+        return {'Authorization': f'Bearer {self.gateway.api_key}'}
+
+    def create_payment(self, payment, callback_url=None, deadline=None):
+        data = self.request(
+            'POST', '/v2/pay', deadline=deadline,
+            json={
+                'amount': int(payment.amount),
+                'returnUrl': self.callback_url(callback_url),
+                'clientRefId': payment.payment_id,
+            },
+        )
+        return {
+            'intent_id': data['code'],
+            'client_secret': None,
+            'redirect_url': f'{self.base_url}/v2/pay/gotoipg/{data["code"]}',
+            'raw': data,
+        }
+
+    def verify_payment(self, payment, deadline=None):
+        try:
+            data = self.request(
+                'POST', '/v2/pay/verify', deadline=deadline, retry=True,
+                json={'refId': payment.transaction_id or payment.gateway_transaction_id, 'amount': int(payment.amount)},
+            )
+        except GatewayError as exc:
+            if exc.retryable:
+                raise
+            return {'status': 'failed', 'transaction_id': None, 'raw': exc.response}
+        return {'status': 'completed', 'transaction_id': payment.transaction_id, 'raw': data}
+
+
+class IDPayClient(GatewayClient):
+    """IDPay v1.1; the sandbox is selected by a header"""
+
+    base_urls = {True: 'https://api.idpay.ir', False: 'https://api.idpay.ir'}
+    # 100: verified now, 101: verified before
+    PAID_STATUSES = (100, 101)
+
+    def headers(self):
+        return {'X-API-KEY': self.gateway.api_key, 'X-SANDBOX': '1' if self.gateway.is_sandbox else '0'}
+
+    def create_payment(self, payment, callback_url=None, deadline=None):
+        data = self.request(
+            'POST', '/v1.1/payment', deadline=deadline,
+            json={
+                'order_id': payment.payment_id,
+                'amount': int(payment.amount),
+                'callback': self.callback_url(callback_url),
+            },
+        )
+        return {'intent_id': data['id'], 'client_secret': None, 'redirect_url': data.get('link'), 'raw': data}
+
+    def verify_payment(self, payment, deadline=None):
+        try:
+            data = self.request(
+                'POST', '/v1.1/payment/verify', deadline=deadline, retry=True,
+                json={'id': payment.gateway_transaction_id, 'order_id': payment.payment_id},
+            )
+        except GatewayError as exc:
+            if exc.retryable:
+                raise
+            return {'status': 'failed', 'transaction_id': None, 'raw': exc.response}
+        paid = int(data.get('status', 0)) in self.PAID_STATUSES
+        return {
+            'status': 'completed' if paid else 'failed',
+            'transaction_id': str(data['track_id']) if paid and data.get('track_id') else None,
+            'raw': data,
+        }
+
+
+CLIENT_CLASSES = {
+    'stripe': StripeClient,
+    'paypal': PayPalClient,
+    'zarinpal': ZarinPalClient,
+    'payping': PayPingClient,
+    'idpay': IDPayClient,
+}
+
+
+def get_client(gateway):
+    """API client of a ``PaymentGateway`` configuration"""
+    try:
+        return CLIENT_CLASSES[gateway.gateway_type](gateway)
+    except KeyError:
+        raise GatewayError(f'No API client for gateway type {gateway.gateway_type!r}')
@@ -0,0 +1,247 @@
+"""
+Local stand-ins for payment gateways.
+
+``FakeStripeGateway`` builds payment intent events and signs them the way
+Stripe does, so deliveries go through the real verification, storage and
+processing path without a Stripe account. The ``benchmark_webhooks``
+command uses it; a ``PaymentGateway`` whose ``settings['webhook_secret']``
+is the fake's ``secret`` verifies its deliveries.
+
+``FakeGatewayServer`` is an HTTP server on localhost that answers the API
+calls of ``payments.clients`` for every gateway type, with configurable
+latency and failure rate. Point a gateway at it with
+``settings['base_url']``; ``benchmark_gateways`` uses it to exercise
+connection pooling, retries and circuit breakers.
+"""
+
+import json
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .webhooks import stripe_signature
+
+# A payment's life as Stripe reports it, in the order Stripe sends the events
+PAYMENT_EVENTS = ('payment_intent.processing', 'payment_intent.succeeded')
+
+
+class FakeStripeGateway:
+    """Signed Stripe webhook deliveries for made-up payment intents"""
+
+    def __init__(self, secret=None):
+        self.secret = secret or f'whsec_{uuid.uuid4().hex}'
+
+    def event(self, reference, event_type, event_id=None):
+        """A Stripe event about the payment intent ``reference``"""
+        return {
+            'id': event_id or f'evt_{uuid.uuid4().hex[:24]}',
+            'object': 'event',
+            'type': event_type,
+            'created': int(time.time()),
+            'data': {'object': {'id': reference, 'object': 'payment_intent'}},
+        }
+
+    def delivery(self, event, timestamp=None):
+        """``(body, headers)`` of one delivery of ``event``, headers as WSGI environ keys"""
+        body = json.dumps(event).encode()
+        timestamp = timestamp or int(time.time())
+        header = f't={timestamp},v1={stripe_signature(self.secret, timestamp, body)}'
+        return body, {'HTTP_STRIPE_SIGNATURE': header}
+
+    def deliveries(self, references, event_types=PAYMENT_EVENTS, duplicate_rate=0.0, seed=None):
+        """Deliveries of ``event_types`` for every reference, payments interleaved
+
+        Each payment's events keep their order; a ``duplicate_rate`` share of
+        them is delivered a second time later on, as Stripe does when an
+        acknowledgement is lost.
+        """
+        rng = random.Random(seed)
+        queues = [[self.event(reference, event_type) for event_type in event_types] for reference in references]
+        deliveries = []
+        duplicates = []
+        while queues:
+            queue = rng.choice(queues)
+            event = queue.pop(0)
+            deliveries.append(self.delivery(event))
+            if rng.random() < duplicate_rate:
+                duplicates.append((len(deliveries), self.delivery(event)))
+            if not queue:
+                queues.remove(queue)
+        # Latest first, so earlier positions stay valid
+        for position, delivery in reversed(duplicates):
+            deliveries.insert(rng.randint(position, len(deliveries)), delivery)
+        return deliveries
+
+
+class _FakeGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out as separate writes; don't let Nagle hold the body back
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server.fake.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_call(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length') or 0)
+        # Read the body so the connection can carry the next request
+        self.rfile.read(length)
+        fake.count('requests')
+        status, data = fake.answer(self.command, self.path)
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        try:
+            self.wfile.write(payload)
+        except ConnectionError:
+            # The client stopped waiting, e.g. its deadline passed during ``latency``
+            self.close_connection = True
+
+    do_GET = handle_call
+    do_POST = handle_call
+
+
+class FakeGatewayServer:
+    """Answers gateway API calls on localhost; use as a context manager
+
+    Every payment it is asked to verify has been paid, and PayPal webhook
+    verifications are answered with ``webhook_verification``. ``latency``
+    seconds are added to each answer and a ``failure_rate`` share of the
+    calls is answered with 503; all three can be changed while the server
+    runs.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, failure_rate=0.0, seed=None,
+                 webhook_verification='SUCCESS'):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.webhook_verification = webhook_verification
+        self.counts = {'connections': 0, 'requests': 0, 'failures': 0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _FakeGatewayHandler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        self._thread = None
+        self._routes = [
+            ('POST', r'/v1/payment_intents', self.stripe_create),
+            ('GET', r'/v1/payment_intents/(?P<id>[^/]+)', self.stripe_retrieve),
+            ('POST', r'/v1/refunds', self.stripe_refund),
+            ('POST', r'/v1/oauth2/token', self.paypal_token),
+            ('POST', r'/v2/checkout/orders', self.paypal_create),
+            ('POST', r'/v2/checkout/orders/(?P<id>[^/]+)/capture', self.paypal_capture),
+            ('POST', r'/v2/payments/captures/(?P<id>[^/]+)/refund', self.paypal_refund),
+            ('POST', r'/v1/notifications/verify-webhook-signature', self.paypal_verify_webhook),
+            ('POST', r'/pg/v4/payment/request\.json', self.zarinpal_request),
+            ('POST', r'/pg/v4/payment/verify\.json', self.zarinpal_verify),
+            ('POST', r'/v2/pay', self.payping_create),
+            ('POST', r'/v2/pay/verify', self.payping_verify),
+            ('POST', r'/v1\.1/payment', self.idpay_create),
+            ('POST', r'/v1\.1/payment/verify', self.idpay_verify),
+        ]
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def answer(self, method, path):
+        """``(status, JSON data)`` of one call"""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            failing = self._rng.random() < self.failure_rate
+        if failing:
+            self.count('failures')
+            return 503, {'error': 'Service unavailable'}
+        path = path.split('?', 1)[0]
+        for route_method, pattern, handler in self._routes:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                return 200, handler(*match.groups())
+        return 404, {'error': f'No route for {method} {path}'}
+
+    @staticmethod
+    def token(prefix):
+        return f'{prefix}{uuid.uuid4().hex[:24]}'
+
+    def stripe_create(self):
+        intent = self.token('pi_')
+        return {'id': intent, 'object': 'payment_intent', 'client_secret': f'{intent}_secret_{uuid.uuid4().hex[:8]}',
+                'status': 'requires_payment_method'}
+
+    def stripe_retrieve(self, intent):
+        return {'id': intent, 'object': 'payment_intent', 'status': 'succeeded', 'latest_charge': self.token('ch_')}
+
+    def stripe_refund(self):
+        return {'id': self.token('re_'), 'object': 'refund', 'status': 'succeeded'}
+
+    def paypal_token(self):
+        return {'access_token': self.token('A21'), 'token_type': 'Bearer', 'expires_in': 32400}
+
+    def paypal_create(self):
+        order = self.token('').upper()[:17]
+        return {'id': order, 'status': 'CREATED', 'links': [
+            {'rel': 'approve', 'href': f'{self.url}/checkoutnow?token={order}'},
+        ]}
+
+    def paypal_capture(self, order):
+        capture = self.token('').upper()[:17]
+        return {'id': order, 'status': 'COMPLETED', 'purchase_units': [
+            {'payments': {'captures': [{'id': capture, 'status': 'COMPLETED'}]}},
+        ]}
+
+    def paypal_refund(self, capture):
+        return {'id': self.token('').upper()[:17], 'status': 'COMPLETED'}
+
+    def paypal_verify_webhook(self):
+        return {'verification_status': self.webhook_verification}
+
+    def zarinpal_request(self):
+        return {'data': {'code': 100, 'message': 'Success', 'authority': f'A{uuid.uuid4().int % 10 ** 35:035d}'},
+                'errors': []}
+
+    def zarinpal_verify(self):
+        return {'data': {'code': 100, 'message': 'Verified', 'ref_id': uuid.uuid4().int % 10 ** 9}, 'errors': []}
+
+    def payping_create(self):
+        return {'code': self.token('')}
+
+    def payping_verify(self):
+        return {'amount': 0, 'cardNumber': '6037****1234'}
+
+    def idpay_create(self):
+        payment = self.token('')
+        return {'id': payment, 'link': f'{self.url}/p/ws-sandbox/{payment}'}
+
+    def idpay_verify(self):
+        return {'status': 100, 'track_id': uuid.uuid4().int % 10 ** 9}
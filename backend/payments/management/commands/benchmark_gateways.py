@@ -0,0 +1,190 @@
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from payments import clients
+from payments.fake_gateway import FakeGatewayServer
+from payments.models import Payment, PaymentGateway
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    """Exercise the gateway clients against a local fake gateway"""
+
+    help = (
+        'Run gateway API calls against a local fake gateway server: pooled client calls compared with a new '
+        'connection per call, then retries under a failure rate and the circuit breaker opening and '
+        'closing during an outage (creates and removes its own gateway configurations)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=500, help='Calls per measurement')
+        parser.add_argument('--concurrency', type=int, default=8, help='Concurrent callers')
+        parser.add_argument('--latency', type=float, default=0.002, help='Seconds the fake gateway takes per call')
+        parser.add_argument('--failure-rate', type=float, default=0.2, help='Share of failing calls in the retry run')
+        parser.add_argument('--cooldown', type=float, default=1.0, help='Circuit breaker cooldown for the outage run')
+
+    def handle(self, *args, **options):
+        if options['calls'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--calls and --concurrency must be at least 1')
+        run_id = uuid.uuid4().hex[:8]
+        with FakeGatewayServer(latency=options['latency'], seed=1) as server, override_settings(
+            PAYMENT_GATEWAY_BREAKER_COOLDOWN=options['cooldown']
+        ):
+            gateways = [
+                PaymentGateway.objects.create(
+                    name=f'Benchmark {run_id} {gateway_type}', gateway_type=gateway_type, api_key='bench',
+                    api_secret='bench', merchant_id='bench', settings={'base_url': server.url},
+                    supported_currencies=['IRR', 'USD'],
+                )
+                for gateway_type in clients.CLIENT_CLASSES
+            ]
+            clients.reset()
+            try:
+                self.compare_pooling(server, gateways, options)
+                stripe = next(gateway for gateway in gateways if gateway.gateway_type == 'stripe')
+                self.retries(server, stripe, options)
+                self.outage(server, stripe, options)
+                self.stdout.write('per gateway:')
+                stats = clients.gateway_stats()
+                for gateway in gateways:
+                    snapshot = stats.get(gateway.pk)
+                    if snapshot:
+                        latency = snapshot['latency']
+                        self.stdout.write(
+                            f'  {gateway.gateway_type:<9} calls {snapshot["calls"]:>5} ok {snapshot["succeeded"]:>5} '
+                            f'failed {snapshot["failed"]:>4} retried {snapshot["retried"]:>4} '
+                            f'rejected {snapshot["rejected"]:>4} circuit {snapshot["circuit"]:<9} '
+                            f'p50 <={latency["p50_ms"]}ms p99 <={latency["p99_ms"]}ms'
+                        )
+            finally:
+                clients.reset()
+                PaymentGateway.objects.filter(pk__in=[gateway.pk for gateway in gateways]).delete()
+
+    def payment(self, index):
+        # Unsaved: the clients only read these fields
+        return Payment(
+            payment_id=f'PAY-BENCH-{index}', amount=Decimal('150000.00'), currency='IRR',
+            gateway_transaction_id=f'ref_{index}', transaction_id=f'ref_{index}',
+        )
+
+    def run(self, calls, concurrency, call):
+        """Run ``call(index)`` ``calls`` times from ``concurrency`` threads; (latencies, errors, seconds)"""
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def worker(indexes):
+            local, failed = [], []
+            for index in indexes:
+                started = time.perf_counter()
+                try:
+                    call(index)
+                except Exception as exc:
+                    failed.append(exc)
+                else:
+                    local.append(time.perf_counter() - started)
+            with lock:
+                latencies.extend(local)
+                errors.extend(failed)
+
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=worker, args=(range(offset, calls, concurrency),)) for offset in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        latencies.sort()
+        return latencies, errors, time.perf_counter() - started
+
+    def report(self, label, result, server, connections_before):
+        latencies, errors, elapsed = result
+        self.stdout.write(
+            f'{label:<22} {len(latencies) / elapsed:>7.0f} calls/s  p50 {percentile(latencies, 0.5) * 1000:6.2f}ms  '
+            f'p99 {percentile(latencies, 0.99) * 1000:6.2f}ms  errors {len(errors):>4}  '
+            f'new connections {server.counts["connections"] - connections_before}'
+        )
+
+    def compare_pooling(self, server, gateways, options):
+        calls, concurrency = options['calls'], options['concurrency']
+        stripe = next(gateway for gateway in gateways if gateway.gateway_type == 'stripe')
+        url = f'{server.url}/v1/payment_intents/'
+
+        before = server.counts['connections']
+        result = self.run(calls, concurrency, lambda index: requests.get(f'{url}ref_{index}', timeout=5).json())
+        self.report('new connection/call', result, server, before)
+
+        client = clients.get_client(stripe)
+        before = server.counts['connections']
+        result = self.run(calls, concurrency, lambda index: client.verify_payment(self.payment(index)))
+        self.report('pooled client', result, server, before)
+
+        for gateway in gateways:
+            client = clients.get_client(gateway)
+            before = server.counts['connections']
+
+            def create_and_verify(index, client=client):
+                payment = self.payment(index)
+                payment.gateway_transaction_id = client.create_payment(payment, 'https://shop.test/callback')[
+                    'intent_id'
+                ]
+                return client.verify_payment(payment)
+
+            result = self.run(calls // 5 or 1, concurrency, create_and_verify)
+            self.report(f'{gateway.gateway_type} create+verify', result, server, before)
+
+    def retries(self, server, gateway, options):
+        server.failure_rate = options['failure_rate']
+        client = clients.get_client(gateway)
+        state = client.state
+        before = state.snapshot()
+        requests_before = server.counts['requests']
+        connections_before = server.counts['connections']
+        result = self.run(options['calls'], options['concurrency'], lambda index: client.verify_payment(
+            self.payment(index)
+        ))
+        after = state.snapshot()
+        server.failure_rate = 0.0
+        self.report(f'{options["failure_rate"]:.0%} failing', result, server, connections_before)
+        self.stdout.write(
+            f'  {server.counts["requests"] - requests_before} gateway requests for {options["calls"]} calls, '
+            f'{after["retried"] - before["retried"]} retries, circuit {after["circuit"]}'
+        )
+
+    def outage(self, server, gateway, options):
+        clients.reset()
+        client = clients.get_client(gateway)
+        server.failure_rate = 1.0
+        requests_before = server.counts['requests']
+        latencies, errors, elapsed = self.run(
+            options['calls'], options['concurrency'], lambda index: client.verify_payment(self.payment(index))
+        )
+        rejected = sum(isinstance(error, clients.GatewayUnavailable) for error in errors)
+        self.stdout.write(
+            f'outage: {options["calls"]} calls failed in {elapsed:.2f}s, '
+            f'{server.counts["requests"] - requests_before} reached the gateway, {rejected} failed fast; '
+            f'circuit {client.state.breaker.state}'
+        )
+
+        server.failure_rate = 0.0
+        time.sleep(options['cooldown'])
+        connections_before = server.counts['connections']
+        self.stdout.write(f'after {options["cooldown"]}s: circuit {client.state.breaker.state}')
+        # One trial call decides; concurrent calls fail fast until it is back
+        client.verify_payment(self.payment(0))
+        self.stdout.write(f'after a trial call: circuit {client.state.breaker.state}')
+        result = self.run(options['calls'], options['concurrency'], lambda index: client.verify_payment(
+            self.payment(index)
+        ))
+        self.report('recovered', result, server, connections_before)
@@ -0,0 +1,187 @@
+import csv
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from orders.models import Order
+from payments import reconciliation
+from payments.models import Payment
+from sequences.allocator import next_ids
+
+User = get_user_model()
+
+# Differences written into the settlement file, each for --mismatch-rate of the payments
+KINDS = ('amount', 'status', 'missing_settlement', 'duplicate', 'unknown_reference')
+
+
+class Command(BaseCommand):
+    """Time settlement reconciliation of a large generated settlement file"""
+
+    help = (
+        'Create payments, write a settlement file for them with amount differences, unsettled payments, '
+        'missing, duplicate and unknown records, then reconcile and correct it and check every difference '
+        'was found (creates and removes its own data)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=100000, help='Payments settled on the day')
+        parser.add_argument('--mismatch-rate', type=float, default=0.01, help='Share of payments per kind of difference')
+        parser.add_argument('--format', choices=['csv', 'json', 'jsonl'], default='csv', help='Settlement file format')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per insert and correction batch')
+        parser.add_argument('--trace-memory', action='store_true', help='Measure peak Python memory (slower)')
+        parser.add_argument('--seed', type=int, default=1, help='Seed for the injected differences')
+
+    def handle(self, *args, **options):
+        count, batch_size = options['payments'], options['batch_size']
+        if count < 1 or batch_size < 1:
+            raise CommandError('--payments and --batch-size must be at least 1')
+        run_id = uuid.uuid4().hex[:8]
+        gateway_name = f'Benchmark {run_id}'
+        user = User.objects.create_user(email=f'bench-{run_id}@example.com', password=uuid.uuid4().hex)
+        directory = tempfile.mkdtemp(prefix='settlement-')
+        path = os.path.join(directory, f'settlement.{options["format"]}')
+        try:
+            started = time.perf_counter()
+            kinds = self.create_payments(user, gateway_name, run_id, count, batch_size, options)
+            self.stdout.write(f'setup:     {count} payments in {time.perf_counter() - started:.1f}s')
+
+            started = time.perf_counter()
+            expected = self.write_settlement(path, options['format'], run_id, count, kinds)
+            self.stdout.write(
+                f'file:      {expected["records"]} records, {os.path.getsize(path) / 1e6:.1f} MB '
+                f'in {time.perf_counter() - started:.1f}s'
+            )
+
+            if options['trace_memory']:
+                tracemalloc.start()
+            started = time.perf_counter()
+            index = reconciliation.PaymentIndex(timezone.localdate(), gateway_name)
+            indexed = time.perf_counter() - started
+            found = {}
+
+            def report(mismatch):
+                found[mismatch.kind] = found.get(mismatch.kind, 0) + 1
+
+            started = time.perf_counter()
+            counts = reconciliation.reconcile(
+                reconciliation.read_settlement(path), index, report, apply=True, batch_size=batch_size
+            )
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f'index:     {len(index)} payments in {indexed:.2f}s ({len(index) / indexed:.0f}/s)'
+            )
+            self.stdout.write(
+                f'reconcile: {counts["records"]} records in {elapsed:.2f}s ({counts["records"] / elapsed:.0f}/s), '
+                f'{counts["corrected"]} corrected; '
+                + ', '.join(f'{kind} {total}' for kind, total in sorted(found.items()))
+            )
+            if options['trace_memory']:
+                _current, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self.stdout.write(
+                    f'memory:    peak {peak / 1e6:.1f} MB ({peak / max(len(index), 1):.0f} bytes per payment)'
+                )
+
+            completed = Payment.objects.filter(gateway_name=gateway_name, status='completed').count()
+            ok = (
+                all(found.get(kind, 0) == expected[kind] for kind in KINDS)
+                and counts['corrected'] == expected['status']
+                and completed == count
+            )
+            self.stdout.write((self.style.SUCCESS if ok else self.style.ERROR)(
+                'check:     expected ' + ', '.join(f'{kind} {expected[kind]}' for kind in KINDS)
+                + f', corrected {expected["status"]}; {completed}/{count} payments completed'
+            ))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+            os.rmdir(directory)
+            # The user's orders cascade to their payments
+            for start in range(0, count, batch_size):
+                ids = list(Order.objects.filter(user=user).values_list('pk', flat=True)[:batch_size])
+                if not ids:
+                    break
+                Payment.objects.filter(order__in=ids).delete()
+                Order.objects.filter(pk__in=ids).delete()
+            user.delete()
+
+    def create_payments(self, user, gateway_name, run_id, count, batch_size, options):
+        """Create the payments; returns the injected difference of each, or None"""
+        rng = random.Random(options['seed'])
+        rate = options['mismatch_rate']
+        kinds = []
+        for index in range(count):
+            draw = rng.random()
+            kinds.append(KINDS[int(draw / rate)] if draw < rate * len(KINDS) else None)
+        for start in range(0, count, batch_size):
+            size = min(batch_size, count - start)
+            with transaction.atomic():
+                orders = Order.objects.bulk_create([
+                    Order(order_number=number, user=user, subtotal=self.amount(start + offset),
+                          total_amount=self.amount(start + offset), status='confirmed')
+                    for offset, number in enumerate(next_ids('ORD', size))
+                ])
+                Payment.objects.bulk_create([
+                    Payment(
+                        payment_id=payment_id, order=order, user=user, payment_method='credit_card',
+                        amount=order.total_amount, currency='USD', gateway_name=gateway_name,
+                        status='processing' if kinds[start + offset] == 'status' else 'completed',
+                        gateway_transaction_id=f'pi_{run_id}_{start + offset}',
+                        transaction_id=f'ch_{run_id}_{start + offset}',
+                    )
+                    for offset, (payment_id, order) in enumerate(zip(next_ids('PAY', size), orders))
+                ])
+        return kinds
+
+    @staticmethod
+    def amount(index):
+        return Decimal(1000 + index % 9000) / 100
+
+    def write_settlement(self, path, file_format, run_id, count, kinds):
+        """Write the settlement file; returns the expected count of each difference"""
+        expected = dict.fromkeys(KINDS, 0)
+        expected['records'] = 0
+
+        def records():
+            for index, kind in enumerate(kinds):
+                if kind:
+                    expected[kind] += 1
+                if kind == 'missing_settlement':
+                    continue
+                # Half the records carry the charge id, half the intent id
+                reference = f'{"ch" if index % 2 else "pi"}_{run_id}_{index}'
+                amount = self.amount(index) + (1 if kind == 'amount' else 0)
+                record = {'reference': reference, 'amount': str(amount), 'currency': 'USD', 'status': 'settled'}
+                yield record
+                if kind == 'duplicate':
+                    yield record
+                if kind == 'unknown_reference':
+                    yield {**record, 'reference': f'unknown_{run_id}_{index}'}
+
+        with open(path, 'w', newline='', encoding='utf-8') as stream:
+            if file_format == 'csv':
+                writer = csv.DictWriter(stream, ['reference', 'amount', 'currency', 'status'])
+                writer.writeheader()
+                for record in records():
+                    writer.writerow(record)
+                    expected['records'] += 1
+            elif file_format == 'jsonl':
+                for record in records():
+                    stream.write(json.dumps(record) + '\n')
+                    expected['records'] += 1
+            else:
+                stream.write('[\n')
+                for record in records():
+                    stream.write((',\n' if expected['records'] else '') + json.dumps(record))
+                    expected['records'] += 1
+                stream.write('\n]\n')
+        return expected
@@ -0,0 +1,139 @@
+import statistics
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from orders.models import Order
+from payments.fake_gateway import FakeStripeGateway
+from payments.models import Payment, PaymentGateway, WebhookEvent
+from payments.views import PaymentWebhookView
+from rest_framework.test import APIRequestFactory
+from sequences.allocator import next_ids
+from taskqueue.worker import Worker
+
+User = get_user_model()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class Command(BaseCommand):
+    """Time webhook ingestion and processing with deliveries from a fake gateway"""
+
+    help = (
+        'Benchmark webhook ingestion (signature check, storage, acknowledgement) and processing: a fake '
+        'Stripe gateway sends processing and succeeded events for new payments, with retried duplicates, '
+        'then a worker drains the payments queue (creates and removes its own data)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=500, help='Payments to send events for')
+        parser.add_argument('--duplicate-rate', type=float, default=0.1, help='Share of deliveries sent twice')
+        parser.add_argument('--concurrency', type=int, default=4, help='Concurrent senders')
+        parser.add_argument('--seed', type=int, default=None, help='Seed for delivery order and duplicates')
+
+    def handle(self, *args, **options):
+        if options['payments'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--payments and --concurrency must be at least 1')
+        run_id = uuid.uuid4().hex[:8]
+        fake = FakeStripeGateway()
+        gateway = PaymentGateway.objects.create(
+            name=f'Benchmark {run_id}', gateway_type='stripe', api_key='-',
+            settings={'webhook_secret': fake.secret},
+        )
+        user = User.objects.create_user(email=f'bench-{run_id}@example.com', password=uuid.uuid4().hex)
+        count = options['payments']
+        references = [f'pi_bench_{run_id}_{index}' for index in range(count)]
+        try:
+            orders = Order.objects.bulk_create([
+                Order(order_number=number, user=user, subtotal=Decimal('100.00'), total_amount=Decimal('100.00'))
+                for number in next_ids('ORD', count)
+            ])
+            Payment.objects.bulk_create([
+                Payment(
+                    payment_id=payment_id, order=order, user=user, payment_method='credit_card',
+                    amount=order.total_amount, gateway_name='stripe', gateway_transaction_id=reference,
+                )
+                for payment_id, order, reference in zip(next_ids('PAY', count), orders, references)
+            ])
+            deliveries = fake.deliveries(references, duplicate_rate=options['duplicate_rate'], seed=options['seed'])
+
+            latencies, outcomes, elapsed = self.ingest(deliveries, options['concurrency'])
+            latencies.sort()
+            self.stdout.write(
+                f'ingest:  {len(deliveries)} deliveries in {elapsed:.2f}s ({len(deliveries) / elapsed:.0f}/s), '
+                f'ack p50 {percentile(latencies, 0.50) * 1000:.1f}ms p99 {percentile(latencies, 0.99) * 1000:.1f}ms '
+                f'mean {statistics.fmean(latencies) * 1000:.1f}ms; '
+                + ', '.join(f'{outcome} {total}' for outcome, total in sorted(outcomes.items()))
+            )
+
+            started = time.perf_counter()
+            tasks = Worker(queues=['payments']).drain()
+            elapsed = time.perf_counter() - started
+            events = WebhookEvent.objects.filter(payment_gateway=gateway)
+            processed = events.filter(status='processed').count()
+            self.stdout.write(
+                f'process: {processed} events of {count} payments in {tasks} tasks, {elapsed:.2f}s '
+                f'({processed / elapsed if elapsed else 0:.0f} events/s)'
+            )
+
+            completed = Payment.objects.filter(gateway_transaction_id__in=references, status='completed').count()
+            statuses = dict(events.order_by().values_list('status').annotate(total=Count('id')))
+            expected = count * 2
+            # Concurrent senders can store a payment's events out of order; the
+            # earlier status is then ignored, never applied after the later one
+            ok = completed == count and sum(statuses.values()) == expected and not statuses.get('pending')
+            self.stdout.write((self.style.SUCCESS if ok else self.style.ERROR)(
+                f'check:   {completed}/{count} payments completed, {sum(statuses.values())}/{expected} events '
+                f'stored, ' + ', '.join(f'{status} {total}' for status, total in sorted(statuses.items()))
+            ))
+        finally:
+            WebhookEvent.objects.filter(payment_gateway=gateway).delete()
+            user.delete()
+            gateway.delete()
+
+    def ingest(self, deliveries, concurrency):
+        """Post ``deliveries`` to the webhook view from ``concurrency`` threads"""
+        view = PaymentWebhookView.as_view()
+        factory = APIRequestFactory()
+        latencies = []
+        outcomes = {}
+        lock = threading.Lock()
+
+        def sender(batch):
+            local, counts = [], {}
+            try:
+                for body, headers in batch:
+                    request = factory.post(
+                        '/api/v1/payments/webhooks/stripe/', data=body, content_type='application/json', **headers
+                    )
+                    started = time.perf_counter()
+                    response = view(request, gateway_name='stripe')
+                    local.append(time.perf_counter() - started)
+                    outcome = response.data.get('status') or f'error {response.status_code}'
+                    counts[outcome] = counts.get(outcome, 0) + 1
+            finally:
+                connection.close()
+            with lock:
+                latencies.extend(local)
+                for outcome, total in counts.items():
+                    outcomes[outcome] = outcomes.get(outcome, 0) + total
+
+        started = time.perf_counter()
+        threads = [
+            threading.Thread(target=sender, args=(deliveries[index::concurrency],)) for index in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return latencies, outcomes, time.perf_counter() - started
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q
+from payments.models import Payment
+from payments.refunds import counted_totals, recalculate
+
+
+class Command(BaseCommand):
+    """Detect (and optionally repair) payments whose refund_amount drifted from their refunds"""
+
+    help = (
+        'Compare Payment.refund_amount with the sum of its pending, processing and completed refunds; '
+        'use --repair to fix them. Payments whose refunds exceed their amount are only reported.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='Write corrected totals')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of payments written per UPDATE batch'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        # One grouped query; the HAVING clause keeps only drifted payments
+        drifted = counted_totals(Payment.objects.all()).filter(
+            ~Q(refund_amount=F('counted_total'))
+        ).order_by('pk').values_list('pk', 'payment_id', 'amount', 'refund_amount', 'counted_total')
+
+        found = over = 0
+        batch = []
+        for pk, payment_id, amount, stored, expected in drifted.iterator(chunk_size=batch_size):
+            found += 1
+            if expected > amount:
+                # payment_refund_within_amount rejects the total; needs a person
+                over += 1
+                self.stdout.write(self.style.ERROR(
+                    f'Payment {payment_id}: refunds total {expected}, more than its amount {amount}'
+                ))
+                continue
+            if options['verbosity'] > 1:
+                self.stdout.write(f'Payment {payment_id}: stored refund_amount {stored}, refunds sum to {expected}')
+            batch.append(pk)
+            if options['repair'] and len(batch) >= batch_size:
+                self._flush(batch)
+                batch = []
+        if options['repair']:
+            self._flush(batch)
+
+        if not found:
+            self.stdout.write(self.style.SUCCESS('All payment refund totals are consistent'))
+        elif options['repair']:
+            self.stdout.write(self.style.SUCCESS(f'Repaired {found - over} payments'))
+        else:
+            self.stdout.write(self.style.WARNING(
+                f'{found - over} payments have drifted refund totals (run with --repair)'
+            ))
+
+    def _flush(self, batch):
+        # Summed again inside the UPDATE, so refunds saved since the check aren't lost
+        if batch:
+            with transaction.atomic():
+                recalculate(batch)
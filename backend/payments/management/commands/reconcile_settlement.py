@@ -0,0 +1,102 @@
+import csv
+import datetime
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from payments import reconciliation
+
+
+class Command(BaseCommand):
+    """Match a gateway settlement file against the payments of its day"""
+
+    help = (
+        'Stream a settlement file (CSV, JSON Lines or a JSON array) and match its records with the day\'s '
+        'payments by gateway_transaction_id / transaction_id. Reports unknown references, duplicates, amount, '
+        'currency and status differences and settled payments missing from the file; --apply moves pending '
+        'and processing payments the gateway settled or failed to completed / failed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Settlement file')
+        parser.add_argument('--date', type=datetime.date.fromisoformat, help='Settlement day (default: yesterday)')
+        parser.add_argument('--gateway', help='Only payments of this gateway (PaymentGateway name)')
+        parser.add_argument('--format', choices=['csv', 'json', 'jsonl'], help='File format (default: extension)')
+        parser.add_argument(
+            '--lookback',
+            type=int,
+            default=reconciliation.DEFAULT_LOOKBACK_DAYS,
+            help='Days before the settlement day whose payments may be in the file'
+        )
+        parser.add_argument(
+            '--reference-field',
+            action='append',
+            help='Record field holding the payment reference (repeatable, tried in order)'
+        )
+        parser.add_argument('--amount-field', default='amount', help='Record field holding the amount')
+        parser.add_argument('--currency-field', default='currency', help='Record field holding the currency')
+        parser.add_argument('--status-field', default='status', help='Record field holding the status')
+        parser.add_argument('--minor-units', action='store_true', help='Amounts are in minor units (e.g. cents)')
+        parser.add_argument('--report', help='Write every mismatch to this CSV file ("-" for stdout)')
+        parser.add_argument('--apply', action='store_true', help='Correct the status of open payments')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=reconciliation.DEFAULT_BATCH_SIZE,
+            help='Payments corrected per UPDATE batch'
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        day = options['date'] or timezone.localdate() - datetime.timedelta(days=1)
+        fields = {
+            'amount': options['amount_field'],
+            'currency': options['currency_field'],
+            'status': options['status_field'],
+        }
+        if options['reference_field']:
+            fields['reference'] = tuple(options['reference_field'])
+
+        started = time.perf_counter()
+        index = reconciliation.PaymentIndex(day, options['gateway'], options['lookback'])
+        self.stdout.write(f'Indexed {len(index)} payments in {time.perf_counter() - started:.2f}s')
+
+        report_file = None
+        if options['report'] == '-':
+            writer = csv.writer(sys.stdout)
+        elif options['report']:
+            report_file = open(options['report'], 'w', newline='', encoding='utf-8')
+            writer = csv.writer(report_file)
+        else:
+            writer = None
+        if writer:
+            writer.writerow(reconciliation.Mismatch._fields)
+
+        started = time.perf_counter()
+        try:
+            counts = reconciliation.reconcile(
+                reconciliation.read_settlement(options['path'], options['format']),
+                index,
+                writer.writerow if writer else lambda mismatch: None,
+                fields=fields,
+                amounts_in_minor_units=options['minor_units'],
+                apply=options['apply'],
+                batch_size=options['batch_size'],
+            )
+        except (OSError, ValueError) as exc:
+            raise CommandError(f'Could not read {options["path"]}: {exc}')
+        finally:
+            if report_file:
+                report_file.close()
+        elapsed = time.perf_counter() - started
+
+        mismatches = {kind: total for kind, total in counts.items() if kind not in ('records', 'matched', 'corrected')}
+        summary = (
+            f'{counts["records"]} records in {elapsed:.2f}s, {counts["matched"]} matched'
+            + ''.join(f', {kind} {total}' for kind, total in sorted(mismatches.items()))
+        )
+        if 'corrected' in counts:
+            summary += f'; corrected {counts["corrected"]} payments'
+        self.stdout.write((self.style.WARNING if mismatches else self.style.SUCCESS)(summary))
@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from payments.models import WebhookEvent
+from payments.tasks import WEBHOOK_GATEWAYS
+from payments.webhooks import enqueue_processing
+
+
+class Command(BaseCommand):
+    """Queue stored webhook events for processing again"""
+
+    help = (
+        'Put stored webhook events back in the payments queue, e.g. after their task failed for good or a '
+        'payment was corrected by hand. Pending events are replayed by default; --status also takes ignored '
+        'and processed ones, which are applied again only if they still move their payment forward.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--gateway', choices=WEBHOOK_GATEWAYS, help='Only events of this gateway')
+        parser.add_argument('--hours', type=int, help='Only events received in the last N hours')
+        parser.add_argument('--event', action='append', default=[], help='Event ID to replay (repeatable)')
+        parser.add_argument('--reference', action='append', default=[], help='Payment reference (repeatable)')
+        parser.add_argument(
+            '--status',
+            action='append',
+            choices=[value for value, _label in WebhookEvent.STATUS_CHOICES],
+            help='Event statuses to replay (repeatable, default: pending)'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='Payments queued per transaction')
+        parser.add_argument('--dry-run', action='store_true', help='Only report what would be replayed')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+        events = WebhookEvent.objects.filter(status__in=options['status'] or ['pending']).exclude(reference='')
+        if options['gateway']:
+            events = events.filter(gateway=options['gateway'])
+        if options['hours']:
+            events = events.filter(received_at__gte=timezone.now() - timedelta(hours=options['hours']))
+        if options['event']:
+            events = events.filter(event_id__in=options['event'])
+        if options['reference']:
+            events = events.filter(reference__in=options['reference'])
+
+        payments = list(events.order_by().values_list('gateway', 'reference').distinct())
+        if options['dry_run']:
+            self.stdout.write(f'Would replay {events.count()} events of {len(payments)} payments')
+            return
+
+        replayed = 0
+        for start in range(0, len(payments), options['batch_size']):
+            batch = payments[start:start + options['batch_size']]
+            with transaction.atomic():
+                for gateway, reference in batch:
+                    replayed += events.filter(gateway=gateway, reference=reference).update(
+                        status='pending', processed_at=None
+                    )
+                    enqueue_processing(gateway, reference)
+        self.stdout.write(self.style.SUCCESS(f'Replayed {replayed} events of {len(payments)} payments'))
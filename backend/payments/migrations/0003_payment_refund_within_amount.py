@@ -0,0 +1,20 @@
+# Generated by Django 5.2.5 on 2026-10-18 07:16
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0005_order_number_length'),
+        ('payments', '0002_webhook_event'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='payment',
+            constraint=models.CheckConstraint(condition=models.Q(('refund_amount__lte', models.F('amount'))), name='payment_refund_within_amount'),
+        ),
+    ]
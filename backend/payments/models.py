@@ -1,8 +1,10 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.core.validators import MinValueValidator
 from django.contrib.auth import get_user_model
 from orders.models import Order
+from sequences.allocator import next_id
 
 User = get_user_model()
 
@@ -182,15 +184,19 @@ class Payment(models.Model):
             models.Index(fields=['payment_method']),
             models.Index(fields=['created_at']),
         ]
+        constraints = [
+            models.CheckConstraint(
+                condition=models.Q(refund_amount__lte=models.F('amount')),
+                name='payment_refund_within_amount',
+            ),
+        ]
 
     def __str__(self):
         return f"Payment {self.payment_id} - {self.amount} {self.currency}"
 
     def save(self, *args, **kwargs):
         if not self.payment_id:
-            # Generate payment ID
-            import uuid
-            self.payment_id = f"PAY-{uuid.uuid4().hex[:8].upper()}"
+            self.payment_id = next_id('PAY')
         super().save(*args, **kwargs)
 
     @property
@@ -205,6 +211,38 @@ class Payment(models.Model):
     def remaining_amount(self):
         return self.amount - self.refund_amount
 
+    @classmethod
+    def apply_refund_delta(cls, payment_id, delta, completed=False):
+        """Shift one payment's refund_amount by ``delta`` in a single UPDATE
+
+        An increase only applies while refund_amount stays within the
+        amount; the UPDATE then matches no row and 0 is returned.
+        ``completed`` is for a refund that just completed: the payment
+        becomes refunded, or partially refunded while some of it is left.
+        """
+        new_total = models.F('refund_amount') + delta
+        updates = {'refund_amount': new_total, 'updated_at': timezone.now()}
+        payments = cls.objects.filter(pk=payment_id)
+        if delta > 0:
+            payments = payments.filter(refund_amount__lte=models.F('amount') - delta)
+        if completed:
+            updates['refunded_at'] = updates['updated_at']
+            updates['status'] = models.Case(
+                models.When(amount__lte=new_total, then=models.Value('refunded')),
+                default=models.Value('partially_refunded'),
+            )
+        elif delta < 0:
+            # A refund taken back: the payment is refundable again
+            updates['status'] = models.Case(
+                models.When(
+                    status__in=['refunded', 'partially_refunded'], refund_amount__lte=-delta,
+                    then=models.Value('completed'),
+                ),
+                models.When(status='refunded', then=models.Value('partially_refunded')),
+                default=models.F('status'),
+            )
+        return payments.update(**updates)
+
 
 class PaymentGateway(models.Model):
     """Payment gateway configuration"""
@@ -327,6 +365,9 @@ class Refund(models.Model):
         ('cancelled', _('Cancelled')),
     ]
 
+    # Statuses whose amount is counted in Payment.refund_amount
+    COUNTED_STATUSES = ('pending', 'processing', 'completed')
+
     refund_id = models.CharField(
         max_length=100,
         unique=True,
@@ -419,13 +460,98 @@ class Refund(models.Model):
     def __str__(self):
         return f"Refund {self.refund_id} - {self.amount}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_refund_state()
+        return instance
+
+    def remember_refund_state(self):
+        """Snapshot the fields that feed Payment.refund_amount"""
+        if self.get_deferred_fields() & {'payment_id', 'amount', 'status'}:
+            self._refund_state = None
+        else:
+            self._refund_state = (self.payment_id, self.amount, self.status)
+
+    @property
+    def refund_state(self):
+        return getattr(self, '_refund_state', None)
+
+    @property
+    def counted_amount(self):
+        return self.amount if self.status in self.COUNTED_STATUSES else 0
+
     def save(self, *args, **kwargs):
         if not self.refund_id:
-            # Generate refund ID
-            import uuid
-            self.refund_id = f"REF-{uuid.uuid4().hex[:8].upper()}"
-        super().save(*args, **kwargs)
+            self.refund_id = next_id('REF')
+        # The post_save signal moves Payment.refund_amount; a refund that
+        # doesn't fit in the payment is rolled back with the error it raises
+        with transaction.atomic():
+            super().save(*args, **kwargs)
 
     @property
     def is_successful(self):
         return self.status == 'completed'
+
+
+class WebhookEvent(models.Model):
+    """A gateway webhook delivery, stored as received
+
+    Rows are only ever inserted; the payload columns never change, only the
+    processing state does. (gateway, event_id) is unique, so a delivery the
+    gateway retries is stored and applied once.
+    """
+
+    STATUS_CHOICES = [
+        ('pending', _('Pending')),
+        ('processed', _('Processed')),
+        ('ignored', _('Ignored')),
+    ]
+
+    gateway = models.CharField(max_length=20, verbose_name=_('Gateway'))
+    # The configuration whose secret verified the delivery
+    payment_gateway = models.ForeignKey(
+        PaymentGateway,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='webhook_events',
+        verbose_name=_('Payment Gateway')
+    )
+    event_id = models.CharField(max_length=255, verbose_name=_('Event ID'))
+    event_type = models.CharField(max_length=100, blank=True, verbose_name=_('Event Type'))
+    # Gateway transaction id of the payment the event is about
+    reference = models.CharField(max_length=255, blank=True, verbose_name=_('Reference'))
+    payload = models.JSONField(verbose_name=_('Payload'))
+
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='pending',
+        verbose_name=_('Status')
+    )
+    attempts = models.PositiveIntegerField(default=0, verbose_name=_('Attempts'))
+    last_error = models.TextField(blank=True, verbose_name=_('Last Error'))
+
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        app_label = 'payments'
+        verbose_name = _('Webhook Event')
+        verbose_name_plural = _('Webhook Events')
+        ordering = ['-received_at']
+        constraints = [
+            models.UniqueConstraint(fields=['gateway', 'event_id'], name='unique_webhook_event'),
+        ]
+        indexes = [
+            # Workers read a payment's pending events in arrival order
+            models.Index(
+                fields=['gateway', 'reference', 'id'], condition=models.Q(status='pending'),
+                name='webhook_event_pending_idx'
+            ),
+            models.Index(fields=['received_at']),
+        ]
+
+    def __str__(self):
+        return f'{self.gateway} {self.event_id} ({self.status})'
@@ -0,0 +1,333 @@
+"""
+Settlement reconciliation.
+
+A gateway's settlement report lists the payments it settled on a day.
+``reconcile`` matches one against the payments of that day:
+
+1. ``PaymentIndex`` loads the day's payments (plus ``lookback`` days
+   before, for payments captured after the day they were created) with one
+   ``values_list`` query read through a server-side cursor. A dict maps
+   both gateway_transaction_id and transaction_id to a row number; amounts
+   in minor units, statuses and flags are kept in compact arrays indexed by
+   that number, under 300 bytes per payment in all (``manage.py
+   benchmark_reconciliation --trace-memory`` measures it).
+2. ``read_settlement`` streams the records of a CSV, JSON Lines or JSON
+   array file; only the current record is held.
+3. Each record is compared with its payment. Unknown references,
+   duplicates, amount and currency differences and status drift are
+   passed to ``report`` as ``Mismatch`` tuples as they are found, followed
+   by the day's completed payments the file doesn't list.
+4. With ``apply=True`` pending or processing payments the gateway settled
+   or failed, for the payment's amount and currency, are corrected in
+   batches of ``batch_size``: one conditional UPDATE per target status, and
+   for completed payments their orders and stock reservations (or a refund
+   when the order was cancelled meanwhile), as the ``Payment`` post_save
+   signal would. Amount differences and any other drift are only
+   reported.
+
+Memory therefore grows with the day's payments, not with the file or the
+number of mismatches and corrections.
+"""
+
+import csv
+import datetime
+import json
+from array import array
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.utils import timezone
+from orders.models import Order
+from products.inventory import commit_many_reservations, hold_reservations
+
+from .clients import ZERO_DECIMAL_CURRENCIES
+from .models import Payment
+from .refunds import LATE_PAYMENT_REASON, refund_payments
+
+DEFAULT_FIELDS = {
+    # Tried in order; the first one present in a record is used
+    'reference': ('reference', 'transaction_id', 'gateway_transaction_id', 'id'),
+    'amount': 'amount',
+    'currency': 'currency',
+    'status': 'status',
+}
+# Settlement status -> payment status
+SETTLEMENT_STATUSES = {
+    'settled': 'completed',
+    'succeeded': 'completed',
+    'success': 'completed',
+    'completed': 'completed',
+    'paid': 'completed',
+    'available': 'completed',
+    'pending': 'processing',
+    'processing': 'processing',
+    'failed': 'failed',
+    'declined': 'failed',
+    'refunded': 'refunded',
+    'partially_refunded': 'partially_refunded',
+}
+# Payment statuses that agree with a settlement status
+COMPATIBLE_STATUSES = {
+    # A settled charge may have been refunded since
+    'completed': ('completed', 'partially_refunded', 'refunded'),
+}
+# Payments reconciliation may move forward, and where to
+CORRECTABLE_STATUSES = ('pending', 'processing')
+CORRECTIONS = ('completed', 'failed')
+DEFAULT_LOOKBACK_DAYS = 2
+DEFAULT_BATCH_SIZE = 1000
+CHUNK_SIZE = 5000
+
+STATUS_CODES = [value for value, _label in Payment.STATUS_CHOICES]
+
+# One difference between the file and the payments. ``payment`` is the
+# Payment pk (None for unknown references), ``expected`` the file's value
+# and ``actual`` the payment's.
+Mismatch = namedtuple('Mismatch', 'kind reference payment expected actual')
+
+
+def minor_units(amount, currency, is_minor=False):
+    """Integer amount in the currency's minor unit"""
+    if is_minor or currency.upper() in ZERO_DECIMAL_CURRENCIES:
+        return int(Decimal(amount))
+    return int((Decimal(amount) * 100).to_integral_value())
+
+
+def day_bounds(day):
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+    return start, start + datetime.timedelta(days=1)
+
+
+class PaymentIndex:
+    """The payments of a day, by gateway reference"""
+
+    def __init__(self, day, gateway_name=None, lookback=DEFAULT_LOOKBACK_DAYS):
+        self.start, self.end = day_bounds(day)
+        self.rows = {}
+        self.pks = array('q')
+        self.amounts = array('q')
+        self.statuses = bytearray()
+        self.currencies = []
+        self.currency_codes = bytearray()
+        # Completed payments of the day itself, which the file should list
+        self.due = bytearray()
+        # 1 once the file listed the payment, 2 once reported as missing
+        self.seen = bytearray()
+        payments = Payment.objects.filter(
+            created_at__gte=self.start - datetime.timedelta(days=lookback), created_at__lt=self.end
+        )
+        if gateway_name:
+            payments = payments.filter(gateway_name=gateway_name)
+        columns = payments.order_by().values_list(
+            'pk', 'gateway_transaction_id', 'transaction_id', 'amount', 'currency', 'status', 'created_at'
+        )
+        for pk, gateway_reference, reference, amount, currency, status, created_at in columns.iterator(
+            chunk_size=CHUNK_SIZE
+        ):
+            if not gateway_reference and not reference:
+                continue
+            row = len(self.pks)
+            self.pks.append(pk)
+            self.amounts.append(minor_units(amount, currency))
+            self.statuses.append(STATUS_CODES.index(status))
+            self.currency_codes.append(self._currency_code(currency))
+            self.due.append(status in COMPATIBLE_STATUSES['completed'] and created_at >= self.start)
+            self.seen.append(0)
+            for key in (gateway_reference, reference):
+                if key:
+                    self.rows[key] = row
+
+    def __len__(self):
+        return len(self.pks)
+
+    def _currency_code(self, currency):
+        if currency not in self.currencies:
+            self.currencies.append(currency)
+        return self.currencies.index(currency)
+
+    def status(self, row):
+        return STATUS_CODES[self.statuses[row]]
+
+    def currency(self, row):
+        return self.currencies[self.currency_codes[row]]
+
+    def unseen(self):
+        """(reference, row) of every payment the file should have listed but didn't"""
+        for reference, row in self.rows.items():
+            if self.due[row] and not self.seen[row]:
+                # Listed under one reference only
+                self.seen[row] = 2
+                yield reference, row
+
+
+def iter_json_array(stream, chunk_size=1 << 16):
+    """Objects of a top-level JSON array, decoded one at a time"""
+    decoder = json.JSONDecoder()
+    buffer, started, eof = '', False, False
+    while True:
+        index = 0
+        while True:
+            while index < len(buffer) and buffer[index] in ' \t\r\n,':
+                index += 1
+            if index == len(buffer):
+                break
+            if not started:
+                if buffer[index] != '[':
+                    raise ValueError('Expected a JSON array of records')
+                started = True
+                index += 1
+                continue
+            if buffer[index] == ']':
+                return
+            try:
+                record, index = decoder.raw_decode(buffer, index)
+            except json.JSONDecodeError:
+                # A record cut by the chunk boundary, unless the file ended
+                if eof:
+                    raise
+                break
+            yield record
+        buffer = buffer[index:]
+        if eof:
+            raise ValueError('Unterminated JSON array')
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+
+
+def read_settlement(path, file_format=None):
+    """Stream the records of a settlement file as dicts
+
+    ``file_format`` is csv, jsonl or json, by default taken from the file
+    name; a .json file holding records one per line is read as JSON Lines.
+    """
+    file_format = file_format or path.rsplit('.', 1)[-1].lower()
+    if file_format == 'csv':
+        with open(path, newline='', encoding='utf-8-sig') as stream:
+            yield from csv.DictReader(stream)
+        return
+    if file_format not in ('json', 'jsonl', 'ndjson'):
+        raise ValueError(f'Unknown settlement file format {file_format!r}')
+    with open(path, encoding='utf-8') as stream:
+        first = stream.read(1)
+        while first and first.isspace():
+            first = stream.read(1)
+        stream.seek(0)
+        if first == '[':
+            yield from iter_json_array(stream)
+            return
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+class Corrections:
+    """Status corrections, applied a batch at a time"""
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.pending = {status: [] for status in CORRECTIONS}
+        self.applied = 0
+
+    def add(self, pk, status):
+        batch = self.pending[status]
+        batch.append(pk)
+        if len(batch) >= self.batch_size:
+            self.flush(status)
+
+    def flush(self, status=None):
+        for target in [status] if status else CORRECTIONS:
+            pks, self.pending[target] = self.pending[target], []
+            if pks:
+                self.applied += apply_corrections(pks, target)
+
+
+def apply_corrections(pks, status):
+    """Move the open payments among ``pks`` to ``status``; returns how many moved"""
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(
+            Payment.objects.select_for_update(of=('self',)).filter(pk__in=pks, status__in=CORRECTABLE_STATUSES)
+            .values_list('pk', 'order_id', 'order__order_number')
+        )
+        if not rows:
+            return 0
+        Payment.objects.filter(pk__in=[row[0] for row in rows]).update(
+            status=status, processed_at=now, updated_at=now
+        )
+        if status == 'completed':
+            # What the Payment and Order post_save signals do for one payment
+            hold_reservations([row[2] for row in rows])
+            Order.objects.filter(pk__in=[row[1] for row in rows], status='pending').update(
+                status='confirmed', updated_at=now
+            )
+            commit_many_reservations([row[2] for row in rows])
+            refund_payments(
+                Payment.objects.filter(pk__in=[row[0] for row in rows], order__status='cancelled'),
+                LATE_PAYMENT_REASON,
+            )
+    return len(rows)
+
+
+def reconcile(records, index, report, fields=None, amounts_in_minor_units=False, apply=False,
+              batch_size=DEFAULT_BATCH_SIZE):
+    """Match settlement ``records`` against ``index``; returns counts by outcome
+
+    ``report`` is called with every ``Mismatch``.
+    """
+    fields = {**DEFAULT_FIELDS, **(fields or {})}
+    corrections = Corrections(batch_size) if apply else None
+    counts = {'records': 0, 'matched': 0}
+
+    def mismatch(kind, reference, row=None, expected=None, actual=None):
+        counts[kind] = counts.get(kind, 0) + 1
+        report(Mismatch(kind, reference, None if row is None else index.pks[row], expected, actual))
+
+    for record in records:
+        counts['records'] += 1
+        reference = next((record[name] for name in fields['reference'] if record.get(name)), None)
+        if reference is None:
+            mismatch('invalid', None, expected='no reference')
+            continue
+        reference = str(reference)
+        row = index.rows.get(reference)
+        if row is None:
+            mismatch('unknown_reference', reference)
+            continue
+        if index.seen[row]:
+            mismatch('duplicate', reference, row)
+            continue
+        index.seen[row] = 1
+        matched = True
+
+        currency = str(record.get(fields['currency']) or index.currency(row))
+        if currency.upper() != index.currency(row).upper():
+            mismatch('currency', reference, row, currency, index.currency(row))
+            matched = False
+        else:
+            try:
+                amount = minor_units(record.get(fields['amount']), currency, amounts_in_minor_units)
+            except (InvalidOperation, TypeError, ValueError):
+                mismatch('invalid', reference, row, expected=f'amount {record.get(fields["amount"])!r}')
+                continue
+            if amount != index.amounts[row]:
+                mismatch('amount', reference, row, amount, index.amounts[row])
+                matched = False
+
+        settled = SETTLEMENT_STATUSES.get(str(record.get(fields['status']) or '').lower())
+        current = index.status(row)
+        if settled and current not in COMPATIBLE_STATUSES.get(settled, (settled,)):
+            mismatch('status', reference, row, settled, current)
+            # Only a record whose amount and currency agree may move the payment
+            if matched and corrections is not None and current in CORRECTABLE_STATUSES and settled in CORRECTIONS:
+                corrections.add(index.pks[row], settled)
+            matched = False
+        counts['matched'] += matched
+
+    for reference, row in index.unseen():
+        mismatch('missing_settlement', reference, row, actual=index.status(row))
+    if corrections is not None:
+        corrections.flush()
+        counts['corrected'] = corrections.applied
+    return counts
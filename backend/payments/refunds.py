@@ -0,0 +1,148 @@
+"""
+Refund bookkeeping.
+
+``Payment.refund_amount`` is the total of the payment's refunds that are
+pending, processing or completed, i.e. the part of the payment that is
+refunded or on its way back. A refund claims its amount when it is saved
+(``Refund`` post_save, ``apply_change``) with a conditional UPDATE:
+
+    UPDATE payment SET refund_amount = refund_amount + <amount>
+    WHERE id = <payment> AND refund_amount <= amount - <amount>
+
+Concurrent refunds of one payment are serialised by the row lock of that
+UPDATE, and one that no longer fits matches no row and is rolled back with
+``RefundError``. The payment_refund_within_amount check constraint backs
+this up for writes that bypass it. A refund that fails or is cancelled
+gives its amount back; one that completes moves the payment to refunded or
+partially_refunded in the same UPDATE. No refund rows are summed.
+
+``refund_payments`` refunds what is left of many payments at once, e.g.
+for bulk cancellations, and ``process_refunds`` tasks send those refunds
+to the gateways. The ``check_refund_totals`` command compares the stored
+totals with the refund rows.
+"""
+
+from django.db import transaction
+from django.db.models import DecimalField, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from sequences.allocator import next_ids
+
+from .clients import GatewayError, gateway_for_payment, get_client
+from .models import Payment, Refund
+from .tasks import process_refunds
+
+# Payments that can still be refunded
+REFUNDABLE_STATUSES = ('completed', 'partially_refunded')
+# Refunds sent to the gateways per process_refunds task
+REFUND_BATCH_SIZE = 100
+# Reason of the refunds of payments completed for cancelled orders
+LATE_PAYMENT_REASON = 'Order cancelled before the payment completed'
+AMOUNT_FIELD = DecimalField(max_digits=12, decimal_places=2)
+
+
+class RefundError(Exception):
+    """A refund doesn't fit in its payment; carries an HTTP status for the view"""
+
+    def __init__(self, message, status_code=400):
+        self.message = message
+        self.status_code = status_code
+        super().__init__(message)
+
+
+def apply_change(previous, refund):
+    """Apply a refund's change from ``previous`` (its refund_state, None when new) to its payment"""
+    old_payment_id, old_amount, old_status = previous or (refund.payment_id, 0, None)
+    old = old_amount if old_status in Refund.COUNTED_STATUSES else 0
+    new = refund.counted_amount
+    if old_payment_id != refund.payment_id:
+        if old:
+            Payment.apply_refund_delta(old_payment_id, -old)
+        old = 0
+    completed = refund.status == 'completed' and old_status != 'completed'
+    if (new != old or completed) and not Payment.apply_refund_delta(refund.payment_id, new - old, completed):
+        raise RefundError('Refund amount exceeds the refundable amount')
+
+
+def counted_totals(payments):
+    """``payments`` annotated with ``counted_total``, the sum of their counted refunds"""
+    return payments.annotate(counted_total=Coalesce(
+        Sum('refunds__amount', filter=Q(refunds__status__in=Refund.COUNTED_STATUSES)),
+        Value(0),
+        output_field=AMOUNT_FIELD,
+    ))
+
+
+def recalculate(payment_ids):
+    """Set refund_amount of the given payments from their refund rows, in one UPDATE"""
+    refund_total = Refund.objects.filter(
+        payment=OuterRef('pk'), status__in=Refund.COUNTED_STATUSES
+    ).order_by().values('payment').annotate(total=Sum('amount')).values('total')
+    return Payment.objects.filter(pk__in=payment_ids).update(
+        refund_amount=Coalesce(Subquery(refund_total), Value(0), output_field=AMOUNT_FIELD),
+        updated_at=timezone.now(),
+    )
+
+
+def send_refund(refund):
+    """Send a pending refund to its gateway and save the outcome; returns its status
+
+    A gateway that rejects the refund marks it failed. When the gateway
+    can't be reached the refund stays pending and can be sent again: the
+    clients send an idempotency key derived from ``refund_id``. Both raise
+    the ``GatewayError``.
+    """
+    gateway = gateway_for_payment(refund.payment)
+    if gateway is None:
+        # Payments outside a gateway (e.g. cash on delivery) are refunded by hand
+        result = {'status': 'completed', 'raw': None}
+    else:
+        try:
+            result = get_client(gateway).refund(refund)
+        except GatewayError as exc:
+            if not exc.retryable:
+                refund.status = 'failed'
+                refund.gateway_response = {'error': exc.message, 'response': exc.response}
+                refund.save()
+            raise
+    refund.status = result['status']
+    refund.gateway_response = result['raw']
+    if refund.status == 'completed':
+        refund.processed_at = timezone.now()
+    refund.save()
+    return refund.status
+
+
+def refund_payments(payments, reason, processed_by=None):
+    """Refund what is left of each of ``payments``; returns the new refunds
+
+    The payments are locked and their refunds inserted in one statement
+    each, then the refunds are sent by ``process_refunds`` tasks queued in
+    the same transaction. Payments that aren't refundable are skipped.
+    """
+    with transaction.atomic():
+        rows = list(
+            payments.filter(status__in=REFUNDABLE_STATUSES, refund_amount__lt=F('amount'))
+            .select_for_update().order_by('pk')
+            .values_list('pk', 'order_id', 'user_id', 'amount', 'refund_amount')
+        )
+        if not rows:
+            return []
+        refunds = Refund.objects.bulk_create([
+            Refund(
+                refund_id=refund_id, payment_id=payment_id, order_id=order_id, user_id=user_id,
+                amount=amount - refunded, reason=reason, processed_by=processed_by,
+            )
+            for refund_id, (payment_id, order_id, user_id, amount, refunded) in zip(next_ids('REF', len(rows)), rows)
+        ])
+        # bulk_create skips post_save: claim the rest of every locked payment in one UPDATE
+        Payment.objects.filter(pk__in=[row[0] for row in rows]).update(
+            refund_amount=F('amount'), updated_at=timezone.now()
+        )
+        for refund in refunds:
+            refund.remember_refund_state()
+        ids = [refund.pk for refund in refunds]
+        for start in range(0, len(ids), REFUND_BATCH_SIZE):
+            process_refunds.delay(ids[start:start + REFUND_BATCH_SIZE])
+    return refunds
@@ -0,0 +1,134 @@
+"""
+Payment gateway routing.
+
+``rank_gateways(amount, currency)`` orders the gateways that can take a
+payment (active, supporting the currency, amount within their limits)
+from best to worst. A gateway's score is what taking the payment through
+it is expected to cost, in the payment's currency:
+
+    fixed fee + amount * (fee % / 100
+                          + PAYMENT_ROUTING_FAILURE_COST * failure rate
+                          + PAYMENT_ROUTING_LATENCY_COST * mean seconds)
+
+The failure rate and latency come from this process's recent calls to the
+gateway (``payments.clients.RollingWindow``). A gateway with fewer than
+``PAYMENT_ROUTING_MIN_CALLS`` recent calls is scored on its fees alone. A
+gateway whose circuit is open is ranked after all the others.
+
+Gateway configurations are read once per process and kept in memory.
+``PaymentGateway`` saves and deletes bump a version shared by all processes
+(``products.cache`` versions, held in the database unless the catalog cache
+is shared; see ``payments.signals``), and every process reloads on its next
+routing call after that. Changes that send no signals (``update()``, raw
+SQL) are picked up after ``PAYMENT_GATEWAY_CACHE_SECONDS`` at most.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from products.cache import get_versions, invalidate_on_commit
+
+from . import clients
+from .models import PaymentGateway
+
+VERSION_FAMILY = 'payment_gateway'
+DEFAULT_FAILURE_COST = 0.05
+DEFAULT_LATENCY_COST = 0.001
+DEFAULT_MIN_CALLS = 20
+DEFAULT_CACHE_SECONDS = 60
+
+# One eligible gateway for a payment: its expected cost and what it is made of
+Route = namedtuple('Route', 'gateway fee score success_rate latency available')
+
+_lock = threading.Lock()
+# (version, monotonic load time, gateways)
+_cached = (None, 0.0, ())
+
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+
+def invalidate():
+    """Make every process reload the gateway configurations once this transaction commits"""
+    invalidate_on_commit(VERSION_FAMILY)
+
+
+def active_gateways():
+    """Active ``PaymentGateway`` configurations, from memory unless one changed
+
+    The instances are shared between threads and must not be modified.
+    """
+    global _cached
+    version = get_versions([VERSION_FAMILY])[VERSION_FAMILY]
+    cached_version, loaded_at, gateways = _cached
+    now = time.monotonic()
+    expired = now - loaded_at > _setting('PAYMENT_GATEWAY_CACHE_SECONDS', DEFAULT_CACHE_SECONDS)
+    if cached_version != version or expired:
+        gateways = tuple(PaymentGateway.objects.filter(is_active=True).order_by('id'))
+        with _lock:
+            _cached = (version, now, gateways)
+    return gateways
+
+
+def get_gateway(gateway_id):
+    """The active configuration with this id, or None"""
+    return next((gateway for gateway in active_gateways() if gateway.pk == gateway_id), None)
+
+
+def reset():
+    """Forget the cached configurations"""
+    global _cached
+    with _lock:
+        _cached = (None, 0.0, ())
+
+
+def fee(gateway, amount):
+    """Fees the gateway charges on ``amount``"""
+    return (gateway.fixed_fee + amount * gateway.transaction_fee / 100).quantize(Decimal('0.01'))
+
+
+def accepts(gateway, amount, currency):
+    """Whether the gateway can take a payment of ``amount`` in ``currency``"""
+    # An empty currency list means the gateway takes any currency
+    if gateway.supported_currencies and currency not in gateway.supported_currencies:
+        return False
+    return gateway.min_amount <= amount <= gateway.max_amount
+
+
+def route(gateway, amount):
+    """``Route`` of a payment of ``amount`` through ``gateway``"""
+    gateway_fee = fee(gateway, amount)
+    calls, success_rate, latency = clients.recent_stats(gateway)
+    score = gateway_fee
+    if calls >= _setting('PAYMENT_ROUTING_MIN_CALLS', DEFAULT_MIN_CALLS):
+        penalty = (
+            _setting('PAYMENT_ROUTING_FAILURE_COST', DEFAULT_FAILURE_COST) * (1 - success_rate)
+            + _setting('PAYMENT_ROUTING_LATENCY_COST', DEFAULT_LATENCY_COST) * latency
+        )
+        score += amount * Decimal(str(round(penalty, 6)))
+    return Route(
+        gateway=gateway,
+        fee=gateway_fee,
+        score=score.quantize(Decimal('0.01')),
+        success_rate=success_rate,
+        latency=latency,
+        available=clients.is_available(gateway),
+    )
+
+
+def rank_gateways(amount, currency):
+    """``Route`` of every gateway that can take the payment, best first"""
+    amount = Decimal(amount)
+    routes = [route(gateway, amount) for gateway in active_gateways() if accepts(gateway, amount, currency)]
+    # Ties go to the oldest configuration
+    return sorted(routes, key=lambda item: (not item.available, item.score, item.gateway.pk))
+
+
+def choose_gateway(amount, currency):
+    """The best gateway for a payment, or None when no gateway can take it"""
+    routes = rank_gateways(amount, currency)
+    return routes[0].gateway if routes else None
@@ -1,34 +1,31 @@
 from rest_framework import serializers
-from django.db import models
+from shop_backend.compiled_serializers import CompiledListSerializer
 from .models import Payment, PaymentGateway, Refund
 
 
 class PaymentSerializer(serializers.ModelSerializer):
     """Payment serializer"""
     order_number = serializers.CharField(source='order.order_number', read_only=True)
-    gateway_name = serializers.CharField(source='gateway.name', read_only=True)
     status_display = serializers.CharField(source='get_status_display', read_only=True)
     refundable_amount = serializers.SerializerMethodField()
 
     class Meta:
         model = Payment
         fields = [
-            'id', 'order', 'order_number', 'gateway', 'gateway_name',
+            'id', 'order', 'order_number', 'gateway_name',
             'amount', 'currency', 'status', 'status_display',
             'transaction_id', 'gateway_response', 'processed_at',
-            'refundable_amount', 'created_at', 'updated_at'
+            'refund_amount', 'refundable_amount', 'created_at', 'updated_at'
         ]
         read_only_fields = [
-            'id', 'transaction_id', 'gateway_response',
-            'processed_at', 'created_at', 'updated_at'
+            'id', 'gateway_name', 'transaction_id', 'gateway_response', 'processed_at',
+            'refund_amount', 'created_at', 'updated_at'
         ]
+        list_serializer_class = CompiledListSerializer
 
     def get_refundable_amount(self, obj):
-        if obj.status == 'completed':
-            refunded_amount = obj.refunds.filter(
-                status='completed'
-            ).aggregate(total=models.Sum('amount'))['total'] or 0
-            return obj.amount - refunded_amount
+        if obj.status in ('completed', 'partially_refunded'):
+            return obj.remaining_amount
         return 0
 
 
@@ -39,17 +36,40 @@ class PaymentGatewaySerializer(serializers.ModelSerializer):
     class Meta:
         model = PaymentGateway
         fields = [
-            'id', 'name', 'display_name', 'description', 'logo',
+            'id', 'name', 'gateway_type', 'api_key', 'api_secret',
+            'merchant_id', 'is_active', 'is_sandbox', 'settings',
             'supported_currencies', 'supported_currencies_display',
-            'is_active', 'test_mode', 'config', 'fee_percentage',
-            'fee_fixed', 'processing_time', 'created_at', 'updated_at'
+            'transaction_fee', 'fixed_fee', 'min_amount', 'max_amount',
+            'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
+        # Credentials and webhook secrets are never sent back
+        extra_kwargs = {
+            'api_key': {'write_only': True},
+            'api_secret': {'write_only': True},
+            'settings': {'write_only': True},
+        }
 
     def get_supported_currencies_display(self, obj):
         return obj.supported_currencies
 
 
+class PaymentMethodSerializer(serializers.Serializer):
+    """A gateway offered for a payment, from a ``routing.Route``"""
+    id = serializers.IntegerField(source='gateway.id')
+    name = serializers.CharField(source='gateway.name')
+    gateway_type = serializers.CharField(source='gateway.gateway_type')
+    is_sandbox = serializers.BooleanField(source='gateway.is_sandbox')
+    supported_currencies = serializers.ListField(source='gateway.supported_currencies')
+    transaction_fee = serializers.DecimalField(source='gateway.transaction_fee', max_digits=5, decimal_places=2)
+    fixed_fee = serializers.DecimalField(source='gateway.fixed_fee', max_digits=8, decimal_places=2)
+    min_amount = serializers.DecimalField(source='gateway.min_amount', max_digits=12, decimal_places=2)
+    max_amount = serializers.DecimalField(source='gateway.max_amount', max_digits=12, decimal_places=2)
+    # Only known for a given amount
+    fee = serializers.DecimalField(max_digits=12, decimal_places=2, allow_null=True)
+    available = serializers.BooleanField()
+
+
 class RefundSerializer(serializers.ModelSerializer):
     """Refund serializer"""
     payment_amount = serializers.DecimalField(
@@ -85,7 +105,8 @@ class RefundSerializer(serializers.ModelSerializer):
 class PaymentIntentSerializer(serializers.Serializer):
     """Payment intent serializer"""
     order_id = serializers.IntegerField()
-    gateway_id = serializers.IntegerField()
+    # Chosen by payments.routing when omitted
+    gateway_id = serializers.IntegerField(required=False)
     return_url = serializers.URLField(required=False)
 
 
@@ -1,29 +1,57 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import Payment, Refund
+from products.inventory import hold_reservations
+from .models import Payment, PaymentGateway, Refund
+from . import refunds, routing
 
 
 @receiver(post_save, sender=Payment)
 def update_order_payment_status(sender, instance, **kwargs):
     """Update order payment status when payment is saved"""
     if instance.status == 'completed':
-        instance.order.payment_status = 'paid'
-        instance.order.status = 'confirmed'
-        instance.order.save()
+        with transaction.atomic():
+            order = instance.order
+            hold_reservations([order.order_number])
+            # Read after the hold: expiry may have cancelled the order meanwhile
+            order.refresh_from_db(fields=['status'])
+            order._loaded_status = order.status
+            if order.status == 'pending':
+                order.status = 'confirmed'
+                order.save()
+            elif order.status == 'cancelled':
+                # Paid after the order was cancelled, e.g. once its stock hold
+                # expired: the stock may be gone, so the money goes back
+                refunds.refund_payments(Payment.objects.filter(pk=instance.pk), refunds.LATE_PAYMENT_REASON)
     elif instance.status == 'failed':
         instance.order.payment_status = 'failed'
         instance.order.save()
 
 
 @receiver(post_save, sender=Refund)
-def update_payment_status_on_refund(sender, instance, **kwargs):
-    """Update payment status when refund is processed"""
-    if instance.status == 'completed':
-        payment = instance.payment
-        total_refunded = payment.refunds.filter(
-            status='completed'
-        ).aggregate(total=models.Sum('amount'))['total'] or 0
-
-        if total_refunded >= payment.amount:
-            payment.status = 'refunded'
-            payment.save()
+def update_payment_refund_amount(sender, instance, created, raw=False, **kwargs):
+    """Apply the refund's change to Payment.refund_amount"""
+    if raw:
+        return
+    previous = None if created else instance.refund_state
+    if previous is None and not created:
+        # Unknown prior state (e.g. deferred fields), recompute from scratch
+        refunds.recalculate([instance.payment_id])
+    else:
+        refunds.apply_change(previous, instance)
+    instance.remember_refund_state()
+
+
+@receiver(post_delete, sender=Refund)
+def remove_payment_refund_amount(sender, instance, **kwargs):
+    """Give a deleted refund's amount back to its payment"""
+    payment_id, amount, status = instance.refund_state or (instance.payment_id, instance.amount, instance.status)
+    if status in Refund.COUNTED_STATUSES:
+        Payment.apply_refund_delta(payment_id, -amount)
+
+
+@receiver(post_save, sender=PaymentGateway)
+@receiver(post_delete, sender=PaymentGateway)
+def invalidate_gateway_configs(sender, **kwargs):
+    """Reload the gateway configurations routing keeps in memory"""
+    routing.invalidate()
@@ -0,0 +1,159 @@
+import logging
+
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from taskqueue.registry import task
+
+from .clients import GatewayError
+from .models import Payment, Refund, WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+# Gateway event type -> payment status
+STRIPE_EVENT_STATUSES = {
+    'payment_intent.processing': 'processing',
+    'payment_intent.succeeded': 'completed',
+    'charge.succeeded': 'completed',
+    'payment_intent.payment_failed': 'failed',
+    'charge.failed': 'failed',
+    'payment_intent.canceled': 'cancelled',
+}
+PAYPAL_EVENT_STATUSES = {
+    'PAYMENT.CAPTURE.PENDING': 'processing',
+    'PAYMENT.CAPTURE.COMPLETED': 'completed',
+    'PAYMENT.CAPTURE.DENIED': 'failed',
+    'PAYMENT.CAPTURE.DECLINED': 'failed',
+}
+WEBHOOK_GATEWAYS = ('stripe', 'paypal')
+
+# Webhooks may only move a payment forward from these states
+OPEN_STATUSES = ('pending', 'processing')
+
+
+def event_status(gateway_name, event_type):
+    """Payment status a gateway event type moves a payment to, or None"""
+    if gateway_name == 'stripe':
+        return STRIPE_EVENT_STATUSES.get(event_type)
+    if gateway_name == 'paypal':
+        return PAYPAL_EVENT_STATUSES.get(event_type)
+    raise ValueError(f'Unknown gateway {gateway_name!r}')
+
+
+def parse_webhook(gateway_name, payload):
+    """(event id, gateway transaction id, event type, new status or None) for a webhook payload"""
+    if gateway_name == 'stripe':
+        obj = (payload.get('data') or {}).get('object') or {}
+        reference = obj.get('payment_intent') or obj.get('id')
+        event_type = payload.get('type')
+    elif gateway_name == 'paypal':
+        reference = (payload.get('resource') or {}).get('id')
+        event_type = payload.get('event_type')
+    else:
+        raise ValueError(f'Unknown gateway {gateway_name!r}')
+    return payload.get('id'), reference, event_type, event_status(gateway_name, event_type)
+
+
+def apply_status(payment, gateway_name, new_status, payload):
+    """Move a locked payment to ``new_status``; False when it may not move there"""
+    if payment.status not in OPEN_STATUSES or payment.status == new_status:
+        return False
+    payment.status = new_status
+    payment.gateway_name = payment.gateway_name or gateway_name
+    payment.gateway_response = {**(payment.gateway_response or {}), 'webhook': payload}
+    if new_status in ('completed', 'failed'):
+        payment.processed_at = timezone.now()
+    return True
+
+
+def locked_payment(reference):
+    return Payment.objects.select_for_update().filter(
+        Q(gateway_transaction_id=reference) | Q(transaction_id=reference)
+    ).first()
+
+
+@task(queue='payments', max_attempts=8)
+def process_webhook_events(gateway_name, reference):
+    """Apply the pending webhook events of one payment, oldest first
+
+    The payment row lock orders workers handling the same payment, and
+    events already applied are marked processed in the same transaction, so
+    a retry or a replay never applies an event twice.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        payment = locked_payment(reference)
+        if payment is not None:
+            events = list(
+                WebhookEvent.objects.select_for_update().filter(
+                    gateway=gateway_name, reference=reference, status='pending'
+                ).order_by('id')
+            )
+            changed = False
+            applied, ignored = [], []
+            for event in events:
+                new_status = event_status(gateway_name, event.event_type)
+                if new_status and apply_status(payment, gateway_name, new_status, event.payload):
+                    changed = True
+                    applied.append(event.pk)
+                else:
+                    ignored.append(event.pk)
+            if changed:
+                # save() so the post_save signal updates the order
+                payment.save()
+            for status, ids in (('processed', applied), ('ignored', ignored)):
+                if ids:
+                    WebhookEvent.objects.filter(pk__in=ids).update(
+                        status=status, processed_at=now, attempts=F('attempts') + 1, last_error=''
+                    )
+            return
+    # The webhook can beat the request that stores the gateway reference;
+    # recorded outside the transaction above, then retried by the worker
+    error = f'No payment for {gateway_name} reference {reference}'
+    WebhookEvent.objects.filter(gateway=gateway_name, reference=reference, status='pending').update(
+        attempts=F('attempts') + 1, last_error=error
+    )
+    raise Payment.DoesNotExist(error)
+
+
+@task(queue='payments', max_attempts=8)
+def process_payment_webhook(gateway_name, payload):
+    """Apply a gateway webhook to its payment
+
+    Superseded by ``process_webhook_events``; kept so tasks queued before
+    webhook events were stored still run.
+    """
+    event_id, reference, _event_type, new_status = parse_webhook(gateway_name, payload)
+    if new_status is None or not reference:
+        logger.info('Ignoring %s webhook %s', gateway_name, event_id)
+        return
+    with transaction.atomic():
+        payment = locked_payment(reference)
+        if payment is None:
+            raise Payment.DoesNotExist(f'No payment for {gateway_name} reference {reference}')
+        if apply_status(payment, gateway_name, new_status, payload):
+            payment.save()
+
+
+@task(queue='payments', max_attempts=8)
+def process_refunds(refund_ids):
+    """Send pending refunds to their gateways
+
+    Refunds that are no longer pending are skipped, so a retry only sends
+    the ones whose gateway couldn't be reached. Refunds a gateway rejects
+    are marked failed, which gives their amount back to the payment.
+    """
+    from .refunds import send_refund
+
+    unsent = 0
+    refunds = Refund.objects.select_related('payment').filter(pk__in=refund_ids, status='pending').order_by('pk')
+    for refund in refunds:
+        try:
+            send_refund(refund)
+        except GatewayError as exc:
+            if exc.retryable:
+                unsent += 1
+            else:
+                logger.warning('Refund %s rejected by the gateway: %s', refund.refund_id, exc.message)
+    if unsent:
+        raise GatewayError(f'{unsent} of {len(refund_ids)} refunds could not be sent', retryable=True)
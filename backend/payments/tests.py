@@ -1,3 +1,488 @@
-from django.test import TestCase
+import json
+import time
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from orders.models import Order
+from rest_framework.test import APITestCase
+
+from products.models import CatalogVersion
+
+from . import clients, reconciliation, routing, webhooks
+from .fake_gateway import FakeGatewayServer, FakeStripeGateway
+from .models import Payment, PaymentGateway, Refund, WebhookEvent
+from .refunds import RefundError
+from .tasks import process_webhook_events
+
+User = get_user_model()
+
+
+class ReconcileTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', password='secret')
+        order = Order.objects.create(user=self.user, subtotal=Decimal('47.70'), total_amount=Decimal('47.70'))
+        self.payment = Payment.objects.create(
+            order=order, user=self.user, payment_method='credit_card', amount=Decimal('47.70'),
+            currency='USD', status='processing', gateway_transaction_id='pi_1', transaction_id='ch_1',
+        )
+
+    def reconcile(self, record):
+        found = []
+        counts = reconciliation.reconcile(
+            [record], reconciliation.PaymentIndex(timezone.localdate()), found.append, apply=True
+        )
+        self.payment.refresh_from_db()
+        return counts, found
+
+    def test_settled_record_completes_payment(self):
+        counts, found = self.reconcile({'reference': 'pi_1', 'amount': '47.70', 'currency': 'USD', 'status': 'settled'})
+
+        self.assertEqual(counts['corrected'], 1)
+        self.assertEqual([mismatch.kind for mismatch in found], ['status'])
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertEqual(self.payment.order.status, 'confirmed')
+
+    def test_amount_mismatch_is_not_corrected(self):
+        counts, found = self.reconcile({'reference': 'pi_1', 'amount': '1.00', 'currency': 'USD', 'status': 'settled'})
+
+        self.assertEqual(counts['corrected'], 0)
+        self.assertEqual([mismatch.kind for mismatch in found], ['amount', 'status'])
+        self.assertEqual(self.payment.status, 'processing')
+
+    def test_currency_mismatch_is_not_corrected(self):
+        counts, _found = self.reconcile({'reference': 'ch_1', 'amount': '47.70', 'currency': 'EUR', 'status': 'settled'})
+
+        self.assertEqual(counts['corrected'], 0)
+        self.assertEqual(self.payment.status, 'processing')
+
+
+class ProcessPaymentTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='buyer@example.com', password='secret')
+        self.order = Order.objects.create(user=self.user, subtotal=Decimal('47.70'), total_amount=Decimal('47.70'))
+        self.payment = Payment.objects.create(
+            order=self.order, user=self.user, payment_method='credit_card', amount=Decimal('47.70'),
+            currency='USD', gateway_name='stripe-main',
+        )
+        self.client.force_authenticate(self.user)
+
+    def process(self):
+        response = self.client.post(reverse('payments:payment-process', args=[self.payment.pk]))
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        return response
+
+    def test_owner_cannot_change_gateway(self):
+        response = self.client.patch(
+            reverse('payments:payment-detail', args=[self.payment.pk]), {'gateway_name': 'nonexistent'}
+        )
+
+        self.assertEqual(response.status_code, 403)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.gateway_name, 'stripe-main')
+
+    def test_payment_without_gateway_is_not_confirmed(self):
+        response = self.process()
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.payment.status, 'pending')
+        self.assertEqual(self.order.status, 'pending')
+
+    def test_cash_on_delivery_is_confirmed_by_staff_only(self):
+        Payment.objects.filter(pk=self.payment.pk).update(payment_method='cash_on_delivery', gateway_name='')
+
+        self.assertEqual(self.process().status_code, 403)
+        self.assertEqual(self.payment.status, 'pending')
+
+        staff = User.objects.create_user(email='staff@example.com', password='secret', is_staff=True)
+        self.client.force_authenticate(staff)
+        self.assertEqual(self.process().status_code, 200)
+        self.assertEqual(self.payment.status, 'completed')
+        self.assertEqual(self.order.status, 'confirmed')
+
+    def test_owner_cannot_refund(self):
+        Payment.objects.filter(pk=self.payment.pk).update(status='completed')
+
+        response = self.client.post(reverse('payments:payment-refund', args=[self.payment.pk]))
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(self.payment.refunds.exists())
+
+
+class ActiveGatewaysTests(TestCase):
+    def setUp(self):
+        routing.reset()
+        self.addCleanup(routing.reset)
+        self.gateway = PaymentGateway.objects.create(name='Card', gateway_type='paypal', api_key='key')
+
+    def test_version_bumped_by_another_process_reloads(self):
+        self.assertEqual(routing.active_gateways(), (self.gateway,))
+        PaymentGateway.objects.filter(pk=self.gateway.pk).update(is_active=False)
+
+        CatalogVersion.objects.filter(family=routing.VERSION_FAMILY).update(version=1)
+
+        self.assertEqual(routing.active_gateways(), ())
+
+    def test_changes_without_signals_expire(self):
+        self.assertEqual(routing.active_gateways(), (self.gateway,))
+        PaymentGateway.objects.filter(pk=self.gateway.pk).update(is_active=False)
+
+        self.assertEqual(routing.active_gateways(), (self.gateway,))
+        with override_settings(PAYMENT_GATEWAY_CACHE_SECONDS=0):
+            self.assertEqual(routing.active_gateways(), ())
+
+
+class WebhookTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='buyer@example.com', password='secret')
+        cls.order = Order.objects.create(user=cls.user, subtotal=Decimal('47.70'), total_amount=Decimal('47.70'))
+        cls.payment = Payment.objects.create(
+            order=cls.order, user=cls.user, payment_method='credit_card', amount=Decimal('47.70'),
+            currency='USD', gateway_transaction_id='pi_1',
+        )
+        cls.stripe = FakeStripeGateway()
+        cls.gateway = PaymentGateway.objects.create(
+            name='Stripe', gateway_type='stripe', api_key='key', settings={'webhook_secret': cls.stripe.secret}
+        )
+
+    def record(self, event_type, event_id=None):
+        return webhooks.record_event('stripe', self.stripe.event('pi_1', event_type, event_id), self.gateway)
+
+
+class StripeWebhookTests(WebhookTestCase):
+    def test_valid_signature(self):
+        event = self.stripe.event('pi_1', 'payment_intent.succeeded')
+        body, headers = self.stripe.delivery(event)
+
+        gateway, payload = webhooks.verify('stripe', body, headers)
+
+        self.assertEqual(gateway, self.gateway)
+        self.assertEqual(payload, event)
+
+    def test_tampered_body(self):
+        body, headers = self.stripe.delivery(self.stripe.event('pi_1', 'payment_intent.canceled'))
+        body = body.replace(b'canceled', b'succeeded')
+
+        with self.assertRaisesMessage(webhooks.WebhookError, 'Invalid webhook signature'):
+            webhooks.verify('stripe', body, headers)
+
+    def test_signature_of_another_secret(self):
+        body, headers = FakeStripeGateway().delivery(self.stripe.event('pi_1', 'payment_intent.succeeded'))
+
+        with self.assertRaisesMessage(webhooks.WebhookError, 'Invalid webhook signature'):
+            webhooks.verify('stripe', body, headers)
+
+    def test_expired_timestamp(self):
+        sent = int(time.time()) - webhooks.signature_tolerance() - 1
+        body, headers = self.stripe.delivery(self.stripe.event('pi_1', 'payment_intent.succeeded'), timestamp=sent)
+
+        with self.assertRaisesMessage(webhooks.WebhookError, 'outside the tolerance'):
+            webhooks.verify('stripe', body, headers)
+
+    def test_duplicate_delivery(self):
+        body, headers = self.stripe.delivery(self.stripe.event('pi_1', 'payment_intent.succeeded', 'evt_1'))
+        url = reverse('payments:payment-webhook', args=['stripe'])
+
+        first = self.client.post(url, body, content_type='application/json', **headers)
+        again = self.client.post(url, body, content_type='application/json', **headers)
+
+        self.assertEqual((first.json()['status'], again.json()['status']), ('ok', 'duplicate'))
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+    def test_duplicate_event_id_is_not_recorded_again(self):
+        event, created = self.record('payment_intent.succeeded', 'evt_1')
+        duplicate, created_again = self.record('payment_intent.canceled', 'evt_1')
+
+        self.assertTrue(created)
+        self.assertFalse(created_again)
+        self.assertEqual(duplicate.pk, event.pk)
+        self.assertEqual(duplicate.event_type, 'payment_intent.succeeded')
+
+
+class PayPalWebhookTests(WebhookTestCase):
+    headers = {header: 'value' for header in webhooks.PAYPAL_HEADERS.values()}
+
+    def setUp(self):
+        super().setUp()
+        clients.reset()
+        self.addCleanup(clients.reset)
+        self.server = FakeGatewayServer().start()
+        self.addCleanup(self.server.stop)
+        self.paypal = PaymentGateway.objects.create(
+            name='PayPal', gateway_type='paypal', api_key='key', api_secret='secret',
+            settings={'base_url': self.server.url, 'webhook_id': 'WH-1'},
+        )
+        self.body = json.dumps({'id': 'WH-EVENT-1', 'event_type': 'PAYMENT.CAPTURE.COMPLETED'}).encode()
+
+    def test_verified_by_paypal(self):
+        gateway, payload = webhooks.verify('paypal', self.body, self.headers)
+
+        self.assertEqual(gateway, self.paypal)
+        self.assertEqual(payload['id'], 'WH-EVENT-1')
+
+    def test_rejected_by_paypal(self):
+        self.server.webhook_verification = 'FAILURE'
+
+        with self.assertRaisesMessage(webhooks.WebhookError, 'Invalid webhook signature'):
+            webhooks.verify('paypal', self.body, self.headers)
+
+    def test_missing_transmission_headers(self):
+        with self.assertRaisesMessage(webhooks.WebhookError, 'Missing PayPal transmission headers'):
+            webhooks.verify('paypal', self.body, {})
+
+    def test_paypal_unavailable(self):
+        self.server.failure_rate = 1.0
+
+        with self.assertRaises(webhooks.WebhookError) as raised:
+            webhooks.verify('paypal', self.body, self.headers)
+
+        self.assertEqual(raised.exception.status_code, 503)
+
+
+class ProcessWebhookEventsTests(WebhookTestCase):
+    def process(self):
+        process_webhook_events('stripe', 'pi_1')
+        self.payment.refresh_from_db()
+        return dict(WebhookEvent.objects.values_list('event_id', 'status'))
+
+    def test_events_are_applied_in_arrival_order(self):
+        self.record('payment_intent.processing', 'evt_1')
+        self.record('payment_intent.succeeded', 'evt_2')
+
+        statuses = self.process()
+
+        self.assertEqual(statuses, {'evt_1': 'processed', 'evt_2': 'processed'})
+        self.assertEqual(self.payment.status, 'completed')
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'confirmed')
+
+    def test_terminal_status_is_kept(self):
+        self.record('payment_intent.succeeded', 'evt_1')
+        self.record('payment_intent.processing', 'evt_2')
+        self.record('payment_intent.canceled', 'evt_3')
+
+        statuses = self.process()
+
+        self.assertEqual(statuses, {'evt_1': 'processed', 'evt_2': 'ignored', 'evt_3': 'ignored'})
+        self.assertEqual(self.payment.status, 'completed')
+
+    def test_processed_events_are_not_applied_again(self):
+        self.record('payment_intent.succeeded', 'evt_1')
+        self.process()
+        Payment.objects.filter(pk=self.payment.pk).update(status='processing')
+
+        self.process()
+
+        self.assertEqual(self.payment.status, 'processing')
+
+    def test_unknown_payment_is_retried(self):
+        Payment.objects.filter(pk=self.payment.pk).update(gateway_transaction_id='pi_2')
+        event, _created = self.record('payment_intent.succeeded', 'evt_1')
+
+        with self.assertRaises(Payment.DoesNotExist):
+            process_webhook_events('stripe', 'pi_1')
+
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), ('pending', 1))
+
+
+class RefundBookkeepingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(email='buyer@example.com', password='secret')
+        cls.order = Order.objects.create(user=cls.user, subtotal=Decimal('100.00'), total_amount=Decimal('100.00'))
+
+    def setUp(self):
+        self.payment = Payment.objects.create(
+            order=self.order, user=self.user, payment_method='cash_on_delivery', amount=Decimal('100.00'),
+            currency='USD', status='completed',
+        )
+
+    def refund(self, amount):
+        return Refund.objects.create(
+            payment=self.payment, order=self.order, user=self.user, amount=Decimal(amount), reason='Returned'
+        )
+
+    def refresh(self):
+        self.payment.refresh_from_db()
+        return self.payment.refund_amount, self.payment.status
+
+    def test_pending_refund_claims_its_amount(self):
+        self.refund('30.00')
+
+        self.assertEqual(self.refresh(), (Decimal('30.00'), 'completed'))
+
+    def test_refund_beyond_the_remaining_amount(self):
+        self.refund('70.00')
+
+        with self.assertRaises(RefundError):
+            self.refund('40.00')
+
+        self.assertEqual(self.payment.refunds.count(), 1)
+        self.assertEqual(self.refresh(), (Decimal('70.00'), 'completed'))
+
+    def test_failed_or_cancelled_refund_gives_its_amount_back(self):
+        for status in ('failed', 'cancelled'):
+            with self.subTest(status):
+                refund = self.refund('60.00')
+
+                refund.status = status
+                refund.save()
+
+                self.assertEqual(self.refresh(), (Decimal('0.00'), 'completed'))
+
+    def test_completion_of_part_of_the_payment(self):
+        refund = self.refund('40.00')
+
+        refund.status = 'completed'
+        refund.save()
+
+        self.assertEqual(self.refresh(), (Decimal('40.00'), 'partially_refunded'))
+        self.assertIsNotNone(self.payment.refunded_at)
+
+    def test_completion_of_the_whole_payment(self):
+        first = self.refund('40.00')
+        second = self.refund('60.00')
+        for refund in (first, second):
+            refund.status = 'completed'
+            refund.save()
+
+        self.assertEqual(self.refresh(), (Decimal('100.00'), 'refunded'))
+
+        second.status = 'cancelled'
+        second.save()
+
+        self.assertEqual(self.refresh(), (Decimal('40.00'), 'partially_refunded'))
+
+    def test_delta_beyond_the_amount_matches_no_row(self):
+        self.assertEqual(Payment.apply_refund_delta(self.payment.pk, Decimal('100.01')), 0)
+        self.assertEqual(Payment.apply_refund_delta(self.payment.pk, Decimal('100.00')), 1)
+        self.assertEqual(self.refresh(), (Decimal('100.00'), 'completed'))
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.breaker = clients.CircuitBreaker(
+            window=4, min_calls=4, threshold=0.5, cooldown=30, clock=lambda: self.now
+        )
+
+    def fail(self, calls):
+        for _ in range(calls):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(False)
+
+    def test_opens_once_enough_recent_calls_failed(self):
+        self.breaker.record(True)
+        self.fail(2)
+        self.assertEqual(self.breaker.state, clients.CircuitBreaker.CLOSED)
+
+        self.fail(1)
+
+        self.assertEqual(self.breaker.state, clients.CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.opened, 1)
+
+    def test_old_outcomes_leave_the_window(self):
+        self.fail(1)
+        for _ in range(4):
+            self.breaker.record(True)
+
+        self.fail(1)
+
+        self.assertEqual(self.breaker.state, clients.CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.failure_rate(), 0.25)
+
+    def test_one_trial_call_after_the_cooldown(self):
+        self.fail(4)
+        self.now += 30
+
+        self.assertEqual(self.breaker.state, clients.CircuitBreaker.HALF_OPEN)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        # A call that started before the circuit opened doesn't decide
+        self.breaker.record(True)
+
+        self.breaker.record(True)
+        self.assertEqual(self.breaker.state, clients.CircuitBreaker.CLOSED)
+        self.assertEqual(self.breaker.failure_rate(), 0.0)
+
+    def test_failed_trial_call_restarts_the_cooldown(self):
+        self.fail(4)
+        self.now += 30
+        self.fail(1)
+
+        self.assertEqual(self.breaker.state, clients.CircuitBreaker.OPEN)
+        self.now += 29
+        self.assertFalse(self.breaker.allow())
+        self.now += 1
+        self.assertTrue(self.breaker.allow())
+
+
+@override_settings(PAYMENT_GATEWAY_BREAKER_WINDOW=4, PAYMENT_GATEWAY_BREAKER_MIN_CALLS=4)
+class GatewayClientTests(TestCase):
+    def setUp(self):
+        clients.reset()
+        self.addCleanup(clients.reset)
+        self.server = FakeGatewayServer(seed=1).start()
+        self.addCleanup(self.server.stop)
+        self.gateway = PaymentGateway.objects.create(
+            name='Stripe', gateway_type='stripe', api_key='pk', api_secret='sk',
+            settings={'base_url': self.server.url},
+        )
+        self.client = clients.get_client(self.gateway)
+
+    def retrieve(self, deadline=None):
+        return self.client.request('GET', '/v1/payment_intents/pi_1', deadline=deadline)
+
+    def test_connections_are_reused(self):
+        for _ in range(3):
+            self.assertEqual(self.retrieve()['status'], 'succeeded')
+
+        self.assertEqual(self.server.counts['connections'], 1)
+        self.assertEqual(clients.gateway_stats()[self.gateway.pk]['succeeded'], 3)
+
+    def test_failed_reads_are_retried(self):
+        self.server.failure_rate = 1.0
+
+        with self.assertRaises(clients.GatewayError) as raised:
+            self.retrieve()
+
+        self.assertEqual((raised.exception.status_code, raised.exception.retryable), (503, True))
+        self.assertEqual(self.server.counts['requests'], clients.DEFAULT_MAX_ATTEMPTS)
+
+    @override_settings(PAYMENT_GATEWAY_MAX_ATTEMPTS=1)
+    def test_open_circuit_fails_fast(self):
+        self.server.failure_rate = 1.0
+        for _ in range(4):
+            with self.assertRaises(clients.GatewayError):
+                self.retrieve()
+
+        with self.assertRaisesMessage(clients.GatewayUnavailable, 'circuit open'):
+            self.retrieve()
+
+        self.assertEqual(self.server.counts['requests'], 4)
+        self.assertFalse(clients.is_available(self.gateway))
+        stats = clients.gateway_stats()[self.gateway.pk]
+        self.assertEqual((stats['circuit'], stats['rejected']), ('open', 1))
+
+    def test_deadline_caps_the_wait(self):
+        self.server.latency = 0.5
+
+        started = time.monotonic()
+        with self.assertRaises(clients.GatewayError) as raised:
+            self.retrieve(clients.Deadline(0.2))
+
+        self.assertLess(time.monotonic() - started, 0.45)
+        self.assertTrue(raised.exception.retryable)
+        self.assertEqual(self.server.counts['requests'], 1)
+
+    def test_expired_deadline_makes_no_call(self):
+        with self.assertRaisesMessage(clients.GatewayUnavailable, 'deadline exceeded'):
+            self.retrieve(clients.Deadline(0))
+
+        self.assertEqual(self.server.counts['requests'], 0)
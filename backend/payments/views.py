@@ -1,32 +1,52 @@
 from rest_framework import viewsets, status, generics
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser, SAFE_METHODS
 from rest_framework.filters import OrderingFilter
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Q
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+from shop_backend.exports import StreamingExportMixin
 from .models import Payment, PaymentGateway, Refund
-from . import serializers
+from . import clients, refunds, routing, serializers, tasks, webhooks
 from orders.models import Order
 
+# Payments a new intent may restart
+REOPENABLE_STATUSES = ('pending', 'failed', 'cancelled')
 
-class PaymentViewSet(viewsets.ModelViewSet):
+
+def gateway_error_response(exc):
+    """503 when the gateway could not be called, 502 when it answered with an error"""
+    if isinstance(exc, clients.GatewayUnavailable) or exc.retryable:
+        return Response({'error': 'Payment gateway unavailable'}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    return Response({'error': 'Payment gateway error', 'detail': exc.message}, status=status.HTTP_502_BAD_GATEWAY)
+
+
+class PaymentViewSet(StreamingExportMixin, viewsets.ModelViewSet):
     """Payment management"""
     queryset = Payment.objects.all()
     serializer_class = serializers.PaymentSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend, OrderingFilter]
-    filterset_fields = ['status', 'gateway', 'currency']
+    filterset_fields = ['status', 'gateway_name', 'currency']
     ordering_fields = ['created_at', 'amount']
     ordering = ['-created_at']
+    export_filename = 'payments'
+
+    def get_permissions(self):
+        # Customers see and process their own payments; only staff edit them
+        if self.request.method not in SAFE_METHODS and self.action != 'process':
+            return [IsAdminUser()]
+        return super().get_permissions()
 
     def get_queryset(self):
-        if self.request.user.is_staff:
-            return Payment.objects.all()
-        return Payment.objects.filter(order__user=self.request.user)
+        queryset = Payment.objects.all()
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(order__user=self.request.user)
+        if self.action == 'list':
+            queryset = queryset.select_related('order')
+        return queryset
 
     @action(detail=True, methods=['post'])
     def process(self, request, pk=None):
@@ -38,90 +58,106 @@ class PaymentViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Here you would integrate with actual payment gateway
-        # For now, we'll simulate payment processing
-        success = self._process_payment_gateway(payment)
+        gateway = clients.gateway_for_payment(payment)
+        if gateway is None:
+            # Only staff confirm payments outside a gateway, once the cash is in
+            if payment.payment_method != 'cash_on_delivery':
+                return Response(
+                    {'error': 'No payment gateway for this payment'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            if not request.user.is_staff:
+                return Response(
+                    {'error': 'Permission denied'},
+                    status=status.HTTP_403_FORBIDDEN
+                )
+            result = 'completed'
+        else:
+            try:
+                result = self._process_payment_gateway(payment, gateway)
+            except clients.GatewayError as exc:
+                return gateway_error_response(exc)
 
-        if success:
+        if result == 'completed':
             payment.status = 'completed'
             payment.processed_at = timezone.now()
+            # The post_save signal confirms the order, or refunds a cancelled one
             payment.save()
-
-            # Update order status
-            payment.order.status = 'confirmed'
-            payment.order.payment_status = 'paid'
-            payment.order.save()
+            if payment.order.status == 'cancelled':
+                return Response(
+                    {'error': 'Order was cancelled; the payment is being refunded'},
+                    status=status.HTTP_409_CONFLICT
+                )
 
             return Response({'message': 'Payment processed successfully'})
-        else:
+        elif result == 'failed':
             payment.status = 'failed'
             payment.save()
             return Response(
                 {'error': 'Payment processing failed'},
                 status=status.HTTP_400_BAD_REQUEST
             )
+        payment.save(update_fields=['gateway_response', 'transaction_id', 'updated_at'])
+        return Response(
+            {'error': 'Payment not completed yet', 'status': result},
+            status=status.HTTP_409_CONFLICT
+        )
 
-    @action(detail=True, methods=['post'])
+    @action(detail=True, methods=['post'], permission_classes=[IsAdminUser])
     def refund(self, request, pk=None):
         """Process refund"""
         payment = self.get_object()
-        if payment.status != 'completed':
+        if payment.status not in refunds.REFUNDABLE_STATUSES:
             return Response(
                 {'error': 'Can only refund completed payments'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        amount = request.data.get('amount')
-        if not amount:
-            amount = payment.amount
-
-        if Decimal(amount) > payment.amount:
+        try:
+            amount = Decimal(request.data.get('amount') or payment.remaining_amount)
+        except InvalidOperation:
+            amount = None
+        if amount is None or amount <= 0:
             return Response(
-                {'error': 'Refund amount cannot exceed payment amount'},
+                {'error': 'Invalid refund amount'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Create refund record
-        refund = Refund.objects.create(
-            payment=payment,
-            amount=Decimal(amount),
-            reason=request.data.get('reason', ''),
-            processed_by=request.user
-        )
+        # Create refund record; it claims its amount from the payment
+        try:
+            refund = Refund.objects.create(
+                payment=payment,
+                order=payment.order,
+                user=payment.user,
+                amount=amount,
+                reason=request.data.get('reason', ''),
+                processed_by=request.user
+            )
+        except refunds.RefundError as exc:
+            return Response({'error': exc.message}, status=exc.status_code)
 
         # Process refund through gateway
-        success = self._process_refund_gateway(refund)
-
-        if success:
-            refund.status = 'completed'
-            refund.processed_at = timezone.now()
-            refund.save()
-
-            # Update payment status if full refund
-            if refund.amount == payment.amount:
-                payment.status = 'refunded'
-                payment.save()
-
-            return Response({'message': 'Refund processed successfully'})
-        else:
-            refund.status = 'failed'
-            refund.save()
+        try:
+            result = refunds.send_refund(refund)
+        except clients.GatewayError as exc:
+            if not exc.retryable:
+                return gateway_error_response(exc)
+            # Still pending; sent again in the background
+            tasks.process_refunds.delay([refund.pk])
             return Response(
-                {'error': 'Refund processing failed'},
-                status=status.HTTP_400_BAD_REQUEST
+                {'message': 'Refund queued', 'status': refund.status},
+                status=status.HTTP_202_ACCEPTED
             )
 
-    def _process_payment_gateway(self, payment):
-        """Simulate payment gateway processing"""
-        # In real implementation, integrate with payment gateway API
-        # For demo purposes, we'll assume success
-        return True
+        return Response({'message': 'Refund processed successfully', 'status': result})
 
-    def _process_refund_gateway(self, refund):
-        """Simulate refund processing"""
-        # In real implementation, integrate with payment gateway API
-        # For demo purposes, we'll assume success
-        return True
+    def _process_payment_gateway(self, payment, gateway):
+        """Payment status the gateway reports: completed, failed, or pending/processing"""
+        result = clients.get_client(gateway).verify_payment(payment)
+        payment.gateway_response = {**(payment.gateway_response or {}), 'verify': result['raw']}
+        if result['transaction_id']:
+            payment.transaction_id = result['transaction_id']
+        return result['status']
 
 
 class PaymentGatewayViewSet(viewsets.ModelViewSet):
@@ -130,6 +166,12 @@ class PaymentGatewayViewSet(viewsets.ModelViewSet):
     serializer_class = serializers.PaymentGatewaySerializer
     permission_classes = [IsAuthenticated]
 
+    def get_permissions(self):
+        # Customers may see the active gateways; only staff configure them
+        if self.request.method not in SAFE_METHODS:
+            return [IsAdminUser()]
+        return super().get_permissions()
+
     def get_queryset(self):
         if self.request.user.is_staff:
             return PaymentGateway.objects.all()
@@ -150,6 +192,16 @@ class PaymentGatewayViewSet(viewsets.ModelViewSet):
             'message': f'Gateway {"activated" if gateway.is_active else "deactivated"}'
         })
 
+    @action(detail=False, methods=['get'])
+    def stats(self, request):
+        """Circuit state, call counts and latency of each gateway, as seen by this process"""
+        if not request.user.is_staff:
+            return Response(
+                {'error': 'Permission denied'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        return Response(clients.gateway_stats())
+
 
 class RefundViewSet(viewsets.ModelViewSet):
     """Refund management"""
@@ -176,7 +228,7 @@ class PaymentIntentView(generics.GenericAPIView):
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
             order_id = serializer.validated_data['order_id']
-            gateway_id = serializer.validated_data['gateway_id']
+            gateway_id = serializer.validated_data.get('gateway_id')
 
             try:
                 order = Order.objects.get(id=order_id, user=request.user)
@@ -186,34 +238,68 @@ class PaymentIntentView(generics.GenericAPIView):
                     status=status.HTTP_404_NOT_FOUND
                 )
 
-            if order.payment_status == 'paid':
+            if order.status != 'pending':
+                # Cancelled orders, e.g. once their stock hold expired, can't be paid
                 return Response(
-                    {'error': 'Order already paid'},
+                    {'error': 'Order is not awaiting payment'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
 
-            try:
-                gateway = PaymentGateway.objects.get(id=gateway_id, is_active=True)
-            except PaymentGateway.DoesNotExist:
+            payment = Payment.objects.filter(order=order).first()
+            if payment is not None and payment.status not in REOPENABLE_STATUSES:
                 return Response(
-                    {'error': 'Payment gateway not found'},
-                    status=status.HTTP_404_NOT_FOUND
+                    {'error': 'Order already paid'},
+                    status=status.HTTP_400_BAD_REQUEST
                 )
 
-            # Create payment record
-            payment = Payment.objects.create(
-                order=order,
-                gateway=gateway,
-                amount=order.total_amount,
-                currency=order.currency,
-                status='pending'
-            )
+            routes = routing.rank_gateways(order.total_amount, order.currency)
+            if gateway_id is None:
+                if not routes:
+                    return Response(
+                        {'error': 'No payment gateway accepts this order'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                gateway = routes[0].gateway
+            else:
+                gateway = routing.get_gateway(gateway_id)
+                if gateway is None:
+                    return Response(
+                        {'error': 'Payment gateway not found'},
+                        status=status.HTTP_404_NOT_FOUND
+                    )
+                if not routing.accepts(gateway, order.total_amount, order.currency):
+                    return Response(
+                        {'error': 'Payment gateway does not accept this order'},
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+
+            # Create payment record, or restart the order's unfinished one
+            if payment is None:
+                payment = Payment(order=order, user=request.user)
+            payment.gateway_name = gateway.name
+            payment.payment_method = 'paypal' if gateway.gateway_type == 'paypal' else 'credit_card'
+            payment.amount = order.total_amount
+            payment.currency = order.currency
+            payment.status = 'pending'
+            payment.save()
 
             # Create payment intent with gateway
-            intent_data = self._create_payment_intent(payment, gateway)
+            try:
+                intent_data = self._create_payment_intent(
+                    payment, gateway, serializer.validated_data.get('return_url')
+                )
+            except clients.GatewayError as exc:
+                response = gateway_error_response(exc)
+                if isinstance(exc, clients.GatewayUnavailable):
+                    # Offer the other gateways that take the order, best first
+                    response.data['alternatives'] = [
+                        route.gateway.id for route in routes if route.gateway.pk != gateway.pk
+                    ]
+                return response
 
             return Response({
                 'payment_id': payment.id,
+                'gateway_id': gateway.id,
                 'client_secret': intent_data.get('client_secret'),
                 'intent_id': intent_data.get('intent_id'),
                 'gateway_data': intent_data
@@ -221,13 +307,17 @@ class PaymentIntentView(generics.GenericAPIView):
 
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-    def _create_payment_intent(self, payment, gateway):
+    def _create_payment_intent(self, payment, gateway, return_url=None):
         """Create payment intent with gateway"""
-        # In real implementation, call gateway API
-        # For demo purposes, return mock data
+        result = clients.get_client(gateway).create_payment(payment, callback_url=return_url)
+        # Webhooks and verification find the payment by the gateway's id
+        payment.gateway_transaction_id = result['intent_id']
+        payment.gateway_response = {'intent': result['raw']}
+        payment.save(update_fields=['gateway_transaction_id', 'gateway_response', 'updated_at'])
         return {
-            'client_secret': f'pi_mock_{payment.id}',
-            'intent_id': f'intent_{payment.id}',
+            'client_secret': result['client_secret'],
+            'intent_id': result['intent_id'],
+            'redirect_url': result['redirect_url'],
             'amount': str(payment.amount),
             'currency': payment.currency
         }
@@ -235,38 +325,50 @@ class PaymentIntentView(generics.GenericAPIView):
 
 class PaymentWebhookView(generics.GenericAPIView):
     """Handle payment webhooks"""
-    permission_classes = []  # Allow unauthenticated access for webhooks
+    # Gateways authenticate with signatures, checked in webhooks.verify
+    authentication_classes = []
+    permission_classes = []
 
     def post(self, request, gateway_name, *args, **kwargs):
-        # Verify webhook signature (implementation depends on gateway)
-        payload = request.data
-
-        # Process webhook based on gateway
-        if gateway_name == 'stripe':
-            return self._handle_stripe_webhook(payload)
-        elif gateway_name == 'paypal':
-            return self._handle_paypal_webhook(payload)
-        else:
-            return Response(
-                {'error': 'Unknown gateway'},
-                status=status.HTTP_400_BAD_REQUEST
-            )
-
-    def _handle_stripe_webhook(self, payload):
-        """Handle Stripe webhook"""
-        # Implement Stripe webhook handling
-        return Response({'status': 'ok'})
-
-    def _handle_paypal_webhook(self, payload):
-        """Handle PayPal webhook"""
-        # Implement PayPal webhook handling
-        return Response({'status': 'ok'})
-
-
-class PaymentMethodsView(generics.ListAPIView):
-    """List available payment methods"""
-    serializer_class = serializers.PaymentGatewaySerializer
+        try:
+            payment_gateway, payload = webhooks.verify(gateway_name, request.body, request.META)
+            _event, created = webhooks.record_event(gateway_name, payload, payment_gateway)
+        except webhooks.WebhookError as exc:
+            return Response({'error': exc.message}, status=exc.status_code)
+        # Acknowledge right away; the payment and order are updated by a worker
+        return Response({'status': 'ok' if created else 'duplicate'})
+
+
+class PaymentMethodsView(generics.GenericAPIView):
+    """List available payment methods
+
+    With ``order_id``, or ``amount`` and ``currency``, only the gateways
+    that accept the payment are listed, best first (see payments.routing).
+    """
+    serializer_class = serializers.PaymentMethodSerializer
     permission_classes = [IsAuthenticated]
 
-    def get_queryset(self):
-        return PaymentGateway.objects.filter(is_active=True)
+    def get(self, request, *args, **kwargs):
+        order_id = request.query_params.get('order_id')
+        amount = request.query_params.get('amount')
+        currency = request.query_params.get('currency', 'IRR')
+        if order_id:
+            order = get_object_or_404(Order, pk=order_id, user=request.user)
+            amount, currency = order.total_amount, order.currency
+        elif amount:
+            try:
+                amount = Decimal(amount)
+            except InvalidOperation:
+                return Response(
+                    {'error': 'Invalid amount'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+        if not amount:
+            methods = [
+                routing.Route(gateway, None, None, None, None, clients.is_available(gateway))
+                for gateway in routing.active_gateways()
+            ]
+        else:
+            methods = routing.rank_gateways(amount, currency)
+        return Response(self.get_serializer(methods, many=True).data)
@@ -0,0 +1,175 @@
+"""
+Payment gateway webhooks.
+
+A delivery goes through three steps:
+
+1. ``verify`` checks its signature with the active ``PaymentGateway``
+   configurations of the gateway type in the URL. Stripe deliveries carry an
+   HMAC-SHA256 of ``"<timestamp>.<body>"`` keyed with the endpoint secret
+   (``settings['webhook_secret']`` of the gateway), checked locally along
+   with the timestamp's age. PayPal deliveries are checked by PayPal's
+   verify-webhook-signature API for the configured ``settings['webhook_id']``,
+   through the gateway's API client (``payments.clients``).
+2. ``record_event`` inserts the raw payload into ``WebhookEvent``. The
+   table is append-only and unique on (gateway, event ID), so a retried
+   delivery is recognised as a duplicate and never processed twice. In the
+   same transaction a ``process_webhook_events`` task is queued for the
+   payment the event refers to. The view acknowledges as soon as that
+   transaction commits.
+3. ``payments.tasks.process_webhook_events`` locks the payment and applies
+   its pending events in arrival order, retrying with backoff when the
+   payment is not there yet. The ``replay_webhooks`` command puts stored
+   events back in the queue.
+"""
+
+import hashlib
+import hmac
+import json
+import logging
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from .clients import GatewayError, get_client
+from .models import PaymentGateway, WebhookEvent
+from .tasks import parse_webhook, process_webhook_events
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIGNATURE_TOLERANCE = 300
+PAYPAL_HEADERS = {
+    'auth_algo': 'HTTP_PAYPAL_AUTH_ALGO',
+    'cert_url': 'HTTP_PAYPAL_CERT_URL',
+    'transmission_id': 'HTTP_PAYPAL_TRANSMISSION_ID',
+    'transmission_sig': 'HTTP_PAYPAL_TRANSMISSION_SIG',
+    'transmission_time': 'HTTP_PAYPAL_TRANSMISSION_TIME',
+}
+
+
+class WebhookError(Exception):
+    """A delivery was rejected; carries an HTTP status for the view"""
+
+    def __init__(self, message, status_code=400):
+        self.message = message
+        self.status_code = status_code
+        super().__init__(message)
+
+
+def signature_tolerance():
+    return getattr(settings, 'WEBHOOK_SIGNATURE_TOLERANCE', DEFAULT_SIGNATURE_TOLERANCE)
+
+
+def gateway_configs(gateway_name):
+    """Active configurations of a gateway type, the ones webhooks are verified with"""
+    return list(PaymentGateway.objects.filter(gateway_type=gateway_name, is_active=True).order_by('id'))
+
+
+def stripe_signature(secret, timestamp, body):
+    """Hex HMAC-SHA256 Stripe signs ``body`` sent at ``timestamp`` with"""
+    return hmac.new(secret.encode(), f'{timestamp}.'.encode() + body, hashlib.sha256).hexdigest()
+
+
+def verify_stripe(gateways, body, headers, now=None):
+    """The gateway whose endpoint secret signed ``body``"""
+    timestamp = None
+    signatures = []
+    for item in headers.get('HTTP_STRIPE_SIGNATURE', '').split(','):
+        key, _sep, value = item.strip().partition('=')
+        if key == 't':
+            timestamp = value
+        elif key == 'v1':
+            signatures.append(value)
+    if not timestamp or not timestamp.isdigit() or not signatures:
+        raise WebhookError('Missing or malformed Stripe-Signature header')
+    if abs((now or time.time()) - int(timestamp)) > signature_tolerance():
+        raise WebhookError('Webhook timestamp outside the tolerance')
+
+    for gateway in gateways:
+        secret = (gateway.settings or {}).get('webhook_secret')
+        if not secret:
+            continue
+        expected = stripe_signature(secret, timestamp, body)
+        if any(hmac.compare_digest(expected, signature) for signature in signatures):
+            return gateway
+    raise WebhookError('Invalid webhook signature')
+
+
+def verify_paypal(gateways, body, headers):
+    """The gateway whose webhook PayPal confirms sent ``body``"""
+    transmission = {field: headers.get(header) for field, header in PAYPAL_HEADERS.items()}
+    if not all(transmission.values()):
+        raise WebhookError('Missing PayPal transmission headers')
+    event = json.loads(body)
+    for gateway in gateways:
+        webhook_id = (gateway.settings or {}).get('webhook_id')
+        if not webhook_id:
+            continue
+        try:
+            verified = get_client(gateway).verify_webhook(transmission, webhook_id, event)
+        except GatewayError as exc:
+            logger.warning('PayPal webhook verification failed for %s: %s', gateway.name, exc)
+            if not exc.retryable:
+                continue
+            # Not the sender's fault: a 5xx makes PayPal deliver again later
+            raise WebhookError('Webhook verification unavailable', status_code=503) from exc
+        if verified:
+            return gateway
+    raise WebhookError('Invalid webhook signature')
+
+
+VERIFIERS = {
+    'stripe': verify_stripe,
+    'paypal': verify_paypal,
+}
+
+
+def verify(gateway_name, body, headers):
+    """``(payment gateway, payload)`` of a signed delivery; raises ``WebhookError``"""
+    if gateway_name not in VERIFIERS:
+        raise WebhookError('Unknown gateway')
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise WebhookError('Malformed webhook payload')
+    if not isinstance(payload, dict):
+        raise WebhookError('Malformed webhook payload')
+    gateways = gateway_configs(gateway_name)
+    if not gateways:
+        raise WebhookError('Gateway is not configured', status_code=404)
+    return VERIFIERS[gateway_name](gateways, body, headers), payload
+
+
+def enqueue_processing(gateway_name, reference):
+    """Queue processing of a payment's pending events, once while queued"""
+    return process_webhook_events.enqueue(
+        args=[gateway_name, reference], dedup_key=f'webhook:{gateway_name}:{reference}'
+    )
+
+
+def record_event(gateway_name, payload, payment_gateway=None):
+    """Store a delivery and queue it; returns ``(event, created)``
+
+    ``created`` is False for a delivery already stored, which is left alone.
+    Events that can't change a payment are stored as ``ignored``.
+    """
+    event_id, reference, event_type, new_status = parse_webhook(gateway_name, payload)
+    if not event_id:
+        raise WebhookError('Webhook payload has no event id')
+    with transaction.atomic():
+        try:
+            with transaction.atomic():
+                event = WebhookEvent.objects.create(
+                    gateway=gateway_name,
+                    payment_gateway=payment_gateway,
+                    event_id=event_id,
+                    event_type=event_type or '',
+                    reference=reference or '',
+                    payload=payload,
+                    status='pending' if new_status and reference else 'ignored',
+                )
+        except IntegrityError:
+            return WebhookEvent.objects.get(gateway=gateway_name, event_id=event_id), False
+        if event.status == 'pending':
+            enqueue_processing(gateway_name, event.reference)
+    return event, True
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Category, Brand, Product, Review, ProductVariant, ProductImage
+from .models import Category, Brand, Product, Review, ProductVariant, ProductImage, StockReservation
 
 
 @admin.register(Category)
@@ -42,7 +42,10 @@ class ProductAdmin(admin.ModelAdmin):
     ordering = ('-created_at',)
     prepopulated_fields = {'slug': ('name',)}
     inlines = [ProductImageInline, VariantInline]
-    readonly_fields = ('review_count', 'created_at', 'updated_at')
+    readonly_fields = (
+        'review_count', 'rating_avg', 'rating_count', 'rating_1_count', 'rating_2_count',
+        'rating_3_count', 'rating_4_count', 'rating_5_count', 'created_at', 'updated_at'
+    )
 
 
 @admin.register(Review)
@@ -63,3 +66,14 @@ class VariantAdmin(admin.ModelAdmin):
     search_fields = ('product__name', 'name', 'sku')
     ordering = ('product', 'name')
     readonly_fields = ('created_at', 'updated_at')
+
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    """Stock reservation admin"""
+    list_display = ('reference', 'product', 'variant', 'quantity', 'status', 'expires_at')
+    list_filter = ('status', 'created_at')
+    search_fields = ('reference', 'product__name', 'product__sku')
+    ordering = ('-created_at',)
+    raw_id_fields = ('product', 'variant')
+    readonly_fields = ('created_at', 'updated_at')
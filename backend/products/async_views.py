@@ -0,0 +1,255 @@
+"""
+Async read path for the catalog, served by the ASGI application.
+
+Plain Django ``async def`` views (DRF views are synchronous) for the
+read-heavy catalog endpoints: product list/detail/featured/search and the
+category and brand lists. They use the async ORM, so a slow database round
+trip suspends the request instead of holding a worker thread, and
+independent queries of a request (page rows and totals, facets) are
+awaited together with ``asyncio.gather``.
+
+Django 5.2 still runs async ORM calls through ``sync_to_async`` on the
+request's thread, so gathered queries of one request share its connection
+and reach the database one after another; the win is that the event loop
+keeps serving other requests meanwhile, and the views need no change when
+the ORM gains native async drivers.
+
+Rows are loaded with the prefetches of the matching sync views, then
+rendered by the same DRF serializers (``sync_to_async``) and encoded with
+``shop_backend.renderers.dumps``, so both paths return the same bytes; the
+featured, category and brand lists share their catalog cache entries with
+the sync views. Responses are read-only and anonymous: no session or user
+is loaded, and their queries go to a read replica when one is configured.
+"""
+
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.db.models import Count, Prefetch
+from django.http import HttpResponse
+from django.views.decorators.http import require_GET
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+from shop_backend.pagination import KeysetPagination
+from shop_backend.renderers import dumps
+from shop_backend.replicas import replica_read
+from .models import Brand, Category, Product
+from . import cache as catalog_cache
+from . import serializers
+from .views import PRODUCT_FILTERS, BrandViewSet, CategoryViewSet, product_filters
+from .search import asearch_facets, get_search_backend
+from .tracking import record_view
+
+# Families whose changes alter a product listing (names are denormalized in)
+PRODUCT_LIST_FAMILIES = ('product', 'category', 'brand')
+
+PRODUCT_LIST_FIELDS = (
+    'id', 'name', 'sku', 'price', 'compare_price', 'stock_quantity',
+    'is_featured', 'is_active', 'rating_avg', 'rating_count', 'created_at',
+    'category__id', 'category__name', 'brand__id', 'brand__name',
+)
+PRODUCT_ORDERING_FIELDS = ('name', 'price', 'created_at', 'rating_avg', 'rating_count')
+SEARCH_ORDERING_FIELDS = ('name', 'price', 'created_at', 'rating_avg')
+# The sync views filter category and brand through DjangoFilterBackend
+ID_FILTERS = {'category': ('category_id', int), 'brand': ('brand_id', int)}
+
+
+async def alist(queryset):
+    """Evaluate a queryset with the async ORM"""
+    return [obj async for obj in queryset]
+
+
+def json_response(data, status=200):
+    """``data`` encoded as FastJSONRenderer encodes the sync views' responses"""
+    return HttpResponse(dumps(data), status=status, content_type='application/json')
+
+
+async def serialize(serializer_class, instance, request=None, many=False):
+    """``serializer_class(instance).data``, rendered on a worker thread
+
+    Pass ``request`` where the sync view's serializer gets it in its context
+    (it makes file URLs absolute).
+    """
+    context = {'request': Request(request)} if request is not None else {}
+    return await sync_to_async(lambda: serializer_class(instance, many=many, context=context).data)()
+
+
+def get_page_number_params(request):
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    try:
+        size = min(max(int(request.GET.get('page_size', api_settings.PAGE_SIZE)), 1), 100)
+    except ValueError:
+        size = api_settings.PAGE_SIZE
+    return page, size
+
+
+async def apage_number(request, queryset):
+    """``(rows, envelope)`` for page-number pagination; rows and count are fetched together"""
+    page, size = get_page_number_params(request)
+    offset = (page - 1) * size
+    count, rows = await asyncio.gather(queryset.acount(), alist(queryset[offset:offset + size]))
+    url = request.build_absolute_uri()
+    envelope = {
+        'count': count,
+        'next': replace_query_param(url, 'page', page + 1) if offset + size < count else None,
+        'previous': (
+            None if page == 1 else
+            remove_query_param(url, 'page') if page == 2 else replace_query_param(url, 'page', page - 1)
+        ),
+    }
+    return rows, envelope
+
+
+def product_list_queryset(params):
+    """Active products filtered like ``ProductViewSet.get_queryset``; ``ParseError`` for malformed filters"""
+    queryset = Product.objects.select_related('category', 'brand').only(*PRODUCT_LIST_FIELDS).prefetch_related(
+        'images'
+    ).filter(is_active=True)
+    queryset = queryset.filter(**product_filters(params, {**PRODUCT_FILTERS, **ID_FILTERS}))
+    if params.get('is_featured') in ('true', 'True', '1'):
+        queryset = queryset.filter(is_featured=True)
+    return queryset
+
+
+def filter_like(viewset_class, request, queryset):
+    """``queryset`` through the search and ordering filters of the sync ``viewset_class``
+
+    The category and brand lists share their cache entries, keyed on the
+    query string, with the sync viewsets, so they must filter alike.
+    """
+    drf_request = Request(request)
+    for backend in viewset_class.filter_backends:
+        queryset = backend().filter_queryset(drf_request, queryset, viewset_class)
+    return queryset
+
+
+def apply_ordering(queryset, params, allowed, default):
+    ordering = params.get('ordering')
+    if ordering and ordering.lstrip('-') in allowed:
+        return queryset.order_by(ordering)
+    return queryset.order_by(*default) if default else queryset
+
+
+@replica_read
+@require_GET
+async def product_list(request):
+    """Active products with keyset pagination (async)"""
+    drf_request = Request(request)
+    paginator = KeysetPagination()
+    try:
+        queryset = apply_ordering(
+            product_list_queryset(request.GET), request.GET, PRODUCT_ORDERING_FIELDS, ('-created_at',)
+        )
+        products = await paginator.apaginate_queryset(queryset, drf_request)
+    except (NotFound, ParseError) as exc:
+        return json_response({'error': str(exc)}, status=exc.status_code)
+    data = await serialize(serializers.ProductListSerializer, products, request, many=True)
+    return json_response(paginator.get_paginated_data(data))
+
+
+@replica_read
+@require_GET
+async def product_detail(request, pk):
+    """Product with category, brand, images, variants and reviews (async)"""
+    try:
+        product = await Product.objects.select_related('category', 'brand').prefetch_related(
+            'images', 'variants'
+        ).aget(pk=pk, is_active=True)
+    except Product.DoesNotExist:
+        return json_response({'error': 'Product not found'}, status=404)
+    record_view(product.pk)
+    return json_response(await serialize(serializers.ProductSerializer, product, request))
+
+
+@replica_read
+@require_GET
+async def featured_products(request):
+    """Featured products, from the catalog cache (async)"""
+    async def compute():
+        products = await alist(
+            Product.objects.select_related('category', 'brand').prefetch_related('images').filter(
+                is_featured=True, is_active=True
+            )
+        )
+        return await serialize(serializers.ProductListSerializer, products, many=True)
+
+    # The entry ProductViewSet.featured reads and fills too
+    return json_response(await catalog_cache.aget_or_compute('product.featured', compute, PRODUCT_LIST_FAMILIES))
+
+
+@replica_read
+@require_GET
+async def product_search(request):
+    """Ranked product search with highlights and facets (async)"""
+    query = request.GET.get('q', '').strip()
+    queryset = Product.objects.select_related('category', 'brand').prefetch_related(
+        'images', 'variants'
+    ).filter(is_active=True)
+    try:
+        queryset = queryset.filter(**product_filters(request.GET, ID_FILTERS))
+    except ParseError as exc:
+        return json_response({'error': str(exc)}, status=exc.status_code)
+
+    backend = get_search_backend()
+    if query:
+        # The in-memory backend may (re)build its index with sync queries
+        queryset = await sync_to_async(backend.search)(queryset, query)
+        default_ordering = ('-search_rank', '-rating_avg', '-created_at')
+    else:
+        default_ordering = ('-rating_avg', '-created_at')
+    queryset = apply_ordering(queryset, request.GET, SEARCH_ORDERING_FIELDS, default_ordering)
+
+    (products, envelope), facets = await asyncio.gather(
+        apage_number(request, queryset),
+        asearch_facets(queryset),
+    )
+    data = await serialize(serializers.ProductListSerializer, products, request, many=True)
+    if query:
+        highlights = await sync_to_async(backend.highlight)(products, query)
+        for item, product in zip(data, products):
+            item['search_rank'] = round(float(product.search_rank), 6)
+            item['highlight'] = highlights.get(product.pk, {})
+    return json_response(dict(envelope, results=data, query=query, facets=facets))
+
+
+@replica_read
+@require_GET
+async def category_list(request):
+    """Categories with product counts and direct subcategories (async)"""
+    async def compute():
+        queryset = filter_like(CategoryViewSet, request, Category.objects.annotate(
+            product_count=Count('products')
+        ).prefetch_related(
+            Prefetch('children', queryset=Category.objects.annotate(product_count=Count('products')))
+        ))
+        categories, envelope = await apage_number(request, queryset)
+        data = await serialize(serializers.CategorySerializer, categories, request, many=True)
+        return dict(envelope, results=data)
+
+    # The entry CategoryViewSet.list reads and fills too
+    return json_response(await catalog_cache.aget_or_compute(
+        'category.list', compute, ('category', 'product'),
+        params=catalog_cache.request_params(Request(request)),
+    ))
+
+
+@replica_read
+@require_GET
+async def brand_list(request):
+    """Brands with product counts (async)"""
+    async def compute():
+        queryset = filter_like(BrandViewSet, request, Brand.objects.annotate(product_count=Count('products')))
+        brands, envelope = await apage_number(request, queryset)
+        data = await serialize(serializers.BrandSerializer, brands, request, many=True)
+        return dict(envelope, results=data)
+
+    # The entry BrandViewSet.list reads and fills too
+    return json_response(await catalog_cache.aget_or_compute(
+        'brand.list', compute, ('brand', 'product'),
+        params=catalog_cache.request_params(Request(request)),
+    ))
@@ -0,0 +1,335 @@
+"""
+Read-through cache for hot catalog endpoints.
+
+Entries live in the ``catalog`` cache alias (``CACHES`` in settings): an
+in-process LRU (``LocMemCache`` bounded by ``MAX_ENTRIES`` and ``TIMEOUT``)
+by default, or Redis when ``CATALOG_CACHE_URL`` is set. Keys embed a version
+number per model family (product, category, brand); the model signals bump
+the version on save/delete, which orphans every dependent entry at once
+instead of deleting keys one by one. A shared cache holds the versions
+itself; with a process-local one they are ``CatalogVersion`` rows, read from
+the primary in one query per lookup, so a bump made by one worker reaches
+the entries cached by every other worker. Concurrent misses for the same key are
+collapsed so only one caller recomputes (single flight), always against the
+primary database rather than a read replica, and hits, misses
+and latencies are counted per key family in ``metrics``. Async views use
+``aget_or_compute``, which collapses concurrent misses within one event loop.
+
+Stock levels change through conditional ``UPDATE`` statements that send no
+signals, so cached listings may show stock up to ``TIMEOUT`` seconds old;
+checkout always reserves against the database.
+"""
+
+import asyncio
+import hashlib
+import threading
+import time
+import weakref
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models import F
+from rest_framework.utils.serializer_helpers import ReturnDict, ReturnList
+from shop_backend.replicas import primary_reads
+from .models import CatalogVersion
+
+FAMILIES = ('product', 'category', 'brand')
+DEFAULT_ALIAS = 'catalog'
+DEFAULT_LOCK_TIMEOUT = 10
+
+_MISSING = object()
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', DEFAULT_ALIAS)]
+
+
+class CacheMetrics:
+    """Thread-safe hit/miss/latency counters per key family"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = defaultdict(lambda: {
+                'hits': 0, 'misses': 0, 'waits': 0,
+                'lookup_time': 0.0, 'compute_time': 0.0, 'max_compute_time': 0.0,
+            })
+
+    def record(self, family, outcome, lookup_time=0.0, compute_time=None):
+        with self._lock:
+            stats = self._stats[family]
+            stats[outcome] += 1
+            stats['lookup_time'] += lookup_time
+            if compute_time is not None:
+                stats['compute_time'] += compute_time
+                stats['max_compute_time'] = max(stats['max_compute_time'], compute_time)
+
+    def snapshot(self):
+        """{family: {'hits', 'misses', 'waits', 'hit_ratio', 'avg_lookup_ms', 'avg_compute_ms', ...}}"""
+        with self._lock:
+            result = {}
+            for family, stats in self._stats.items():
+                lookups = stats['hits'] + stats['misses'] + stats['waits']
+                result[family] = {
+                    'hits': stats['hits'],
+                    'misses': stats['misses'],
+                    'waits': stats['waits'],
+                    'hit_ratio': round(stats['hits'] / lookups, 4) if lookups else 0.0,
+                    'avg_lookup_ms': round(stats['lookup_time'] * 1000 / lookups, 3) if lookups else 0.0,
+                    'avg_compute_ms': (
+                        round(stats['compute_time'] * 1000 / stats['misses'], 3) if stats['misses'] else 0.0
+                    ),
+                    'max_compute_ms': round(stats['max_compute_time'] * 1000, 3),
+                }
+            return result
+
+
+metrics = CacheMetrics()
+
+
+def _version_key(family):
+    return f'catalog:version:{family}'
+
+
+def _initial_version():
+    # Time based so a version key evicted from the LRU never restarts at a
+    # number whose entries may still be cached
+    return time.time_ns() // 1000
+
+
+def versions_in_database():
+    """Whether versions are kept in ``CatalogVersion`` because the cache is per process"""
+    return isinstance(get_cache(), LocMemCache)
+
+
+def _database_versions(families):
+    with primary_reads():
+        versions = dict(CatalogVersion.objects.filter(family__in=families).values_list('family', 'version'))
+        # Rows are created by migration; this only runs on a database flushed since
+        missing = [family for family in families if family not in versions]
+        if missing:
+            CatalogVersion.objects.bulk_create(
+                [CatalogVersion(family=family, version=_initial_version()) for family in missing],
+                ignore_conflicts=True,
+            )
+            versions.update(CatalogVersion.objects.filter(family__in=missing).values_list('family', 'version'))
+    return versions
+
+
+def get_versions(families):
+    """Current version of each family, fetched in one round trip"""
+    if versions_in_database():
+        return _database_versions(families)
+    cache = get_cache()
+    keys = {family: _version_key(family) for family in families}
+    found = cache.get_many(list(keys.values()))
+    versions = {}
+    for family, key in keys.items():
+        version = found.get(key)
+        if version is None:
+            cache.add(key, _initial_version(), timeout=None)
+            version = cache.get(key)
+        versions[family] = version
+    return versions
+
+
+async def aget_versions(families):
+    """``get_versions`` for async callers"""
+    if versions_in_database():
+        return await sync_to_async(_database_versions)(families)
+    cache = get_cache()
+    keys = {family: _version_key(family) for family in families}
+    found = await cache.aget_many(list(keys.values()))
+    versions = {}
+    for family, key in keys.items():
+        version = found.get(key)
+        if version is None:
+            await cache.aadd(key, _initial_version(), timeout=None)
+            version = await cache.aget(key)
+        versions[family] = version
+    return versions
+
+
+def bump_version(*families):
+    """Invalidate every entry that depends on ``families``"""
+    if versions_in_database():
+        # A family without a row has no entries yet
+        CatalogVersion.objects.filter(family__in=families).update(version=F('version') + 1)
+        return
+    cache = get_cache()
+    for family in families:
+        key = _version_key(family)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _initial_version(), timeout=None)
+
+
+def invalidate_on_commit(*families):
+    """Bump versions once the current transaction commits"""
+    transaction.on_commit(lambda: bump_version(*families))
+
+
+def make_key(name, versions, params=None):
+    version = '.'.join(str(versions[family]) for family in sorted(versions))
+    digest = ''
+    if params:
+        encoded = '&'.join(f'{key}={value}' for key, value in sorted(params))
+        digest = hashlib.md5(encoded.encode('utf-8')).hexdigest()
+    return f'catalog:{name}:{version}:{digest}'
+
+
+class SingleFlight:
+    """Collapse concurrent recomputes of the same key
+
+    Threads of one process wait on an in-process event; other processes are
+    held off by a short-lived ``cache.add`` lock and poll for the value.
+    """
+
+    poll_interval = 0.05
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def run(self, key, compute, timeout, lock_timeout=DEFAULT_LOCK_TIMEOUT):
+        """Return ``(value, computed)`` for ``key``"""
+        with self._lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+
+        cache = get_cache()
+        if not leader:
+            event.wait(lock_timeout)
+            value = cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value, False
+            return self._compute_and_store(cache, key, compute, timeout), True
+
+        lock_key = f'{key}:lock'
+        locked = False
+        try:
+            locked = cache.add(lock_key, 1, timeout=lock_timeout)
+            if not locked:
+                # Another process is computing; wait for its result
+                deadline = time.monotonic() + lock_timeout
+                while time.monotonic() < deadline:
+                    time.sleep(self.poll_interval)
+                    value = cache.get(key, _MISSING)
+                    if value is not _MISSING:
+                        return value, False
+            return self._compute_and_store(cache, key, compute, timeout), True
+        finally:
+            if locked:
+                cache.delete(lock_key)
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def _compute_and_store(self, cache, key, compute, timeout):
+        value = compute()
+        cache.set(key, value, timeout=timeout)
+        return value
+
+
+single_flight = SingleFlight()
+
+
+def detach(data):
+    """Copy serializer output into plain containers that pickle cheaply"""
+    if isinstance(data, (ReturnList, list)):
+        return [detach(item) for item in data]
+    if isinstance(data, (ReturnDict, dict)):
+        return {key: detach(value) for key, value in data.items()}
+    return data
+
+
+def request_params(request):
+    """Cache key parameters for a GET request: query string and host"""
+    return [('_host', request.get_host())] + list(request.query_params.lists())
+
+
+def _compute_on_primary(compute):
+    # A replica lagging behind the write that bumped the version would get
+    # stale data cached under the new version
+    with primary_reads():
+        return detach(compute())
+
+
+def get_or_compute(name, compute, depends_on, params=None, timeout=DEFAULT_TIMEOUT):
+    """Cached value of ``compute()`` keyed on ``name``, ``params`` and family versions
+
+    ``name`` is the metrics family, e.g. 'product.featured'.
+    """
+    started = time.perf_counter()
+    cache = get_cache()
+    key = make_key(name, get_versions(depends_on), params)
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        metrics.record(name, 'hits', lookup_time=time.perf_counter() - started)
+        return value
+
+    lookup_time = time.perf_counter() - started
+    value, computed = single_flight.run(key, lambda: _compute_on_primary(compute), timeout)
+    if computed:
+        metrics.record(
+            name, 'misses', lookup_time=lookup_time,
+            compute_time=time.perf_counter() - started - lookup_time,
+        )
+    else:
+        metrics.record(name, 'waits', lookup_time=time.perf_counter() - started)
+    return value
+
+
+# {event loop: {key: asyncio.Future}} of async recomputes in flight
+_async_inflight = weakref.WeakKeyDictionary()
+
+
+async def aget_or_compute(name, compute, depends_on, params=None, timeout=DEFAULT_TIMEOUT):
+    """``get_or_compute`` for async views; ``compute`` is a coroutine function"""
+    started = time.perf_counter()
+    cache = get_cache()
+    key = make_key(name, await aget_versions(depends_on), params)
+    value = await cache.aget(key, _MISSING)
+    if value is not _MISSING:
+        metrics.record(name, 'hits', lookup_time=time.perf_counter() - started)
+        return value
+
+    loop = asyncio.get_running_loop()
+    inflight = _async_inflight.setdefault(loop, {})
+    future = inflight.get(key)
+    if future is not None:
+        value = await asyncio.shield(future)
+        metrics.record(name, 'waits', lookup_time=time.perf_counter() - started)
+        return value
+
+    lookup_time = time.perf_counter() - started
+    future = inflight[key] = loop.create_future()
+    try:
+        # On the primary, as in _compute_on_primary
+        with primary_reads():
+            value = detach(await compute())
+        await cache.aset(key, value, timeout=timeout)
+        future.set_result(value)
+    except BaseException as exc:
+        future.set_exception(exc)
+        # Waiters re-raise it; don't warn about an unobserved exception
+        future.exception()
+        raise
+    finally:
+        inflight.pop(key, None)
+    metrics.record(
+        name, 'misses', lookup_time=lookup_time,
+        compute_time=time.perf_counter() - started - lookup_time,
+    )
+    return value
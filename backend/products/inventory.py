@@ -0,0 +1,221 @@
+"""
+Stock reservation engine.
+
+Stock is taken with conditional updates of the form
+``UPDATE ... SET stock_quantity = stock_quantity - n WHERE stock_quantity >= n``
+so concurrent checkouts can never oversell and no row is read-then-written.
+A multi-line reservation issues one such statement per table (products and
+variants), with the per-row quantities folded into a ``CASE`` expression.
+Every reservation is recorded as ``StockReservation`` rows that are either
+committed with the order, released, or returned to stock once they expire.
+Expiry sends ``reservations_expired`` with the references whose stock went
+back, in the same transaction, so the orders holding them can be cancelled
+before a late payment confirms them without stock.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.dispatch import Signal
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+from .models import Product, ProductVariant, StockReservation
+
+DEFAULT_RESERVATION_TTL = 15 * 60
+
+# Sent with sender=StockReservation and the set of references that expired
+reservations_expired = Signal()
+
+
+class InsufficientStock(Exception):
+    """Raised when one or more lines cannot be reserved"""
+
+    def __init__(self, shortages):
+        # [{'product_id', 'variant_id', 'requested', 'available'}]
+        self.shortages = shortages
+        super().__init__(_('Insufficient stock'))
+
+
+class _Shortfall(Exception):
+    pass
+
+
+def _group_lines(lines):
+    """Sum quantities per product and per variant
+
+    ``lines`` is an iterable of ``(product_id, variant_id, quantity)``;
+    variant lines draw from the variant's stock, others from the product's.
+    """
+    products, variants = {}, {}
+    for product_id, variant_id, quantity in lines:
+        quantity = int(quantity)
+        if quantity <= 0:
+            raise ValueError('Reservation quantities must be positive')
+        if variant_id:
+            variants[variant_id] = variants.get(variant_id, 0) + quantity
+        else:
+            products[product_id] = products.get(product_id, 0) + quantity
+    return products, variants
+
+
+def _quantity_case(quantities):
+    return Case(
+        *[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+        output_field=IntegerField(),
+    )
+
+
+def take_stock(model, quantities):
+    """Decrement stock for every row in one statement; return rows updated"""
+    if not quantities:
+        return 0
+    amount = _quantity_case(quantities)
+    return model.objects.filter(
+        pk__in=list(quantities),
+        stock_quantity__gte=amount,
+    ).update(stock_quantity=F('stock_quantity') - amount, updated_at=timezone.now())
+
+
+def return_stock(model, quantities):
+    """Increment stock for every row in one statement"""
+    if not quantities:
+        return 0
+    return model.objects.filter(pk__in=list(quantities)).update(
+        stock_quantity=F('stock_quantity') + _quantity_case(quantities),
+        updated_at=timezone.now(),
+    )
+
+
+def _shortages(products, variants):
+    shortages = []
+    for model, quantities, key in ((Product, products, 'product_id'), (ProductVariant, variants, 'variant_id')):
+        if not quantities:
+            continue
+        available = dict(model.objects.filter(pk__in=list(quantities)).values_list('pk', 'stock_quantity'))
+        for pk, requested in quantities.items():
+            if available.get(pk, 0) < requested:
+                shortage = {'product_id': None, 'variant_id': None}
+                shortage[key] = pk
+                shortage.update(requested=requested, available=available.get(pk, 0))
+                shortages.append(shortage)
+    return shortages
+
+
+def reserve_stock(lines, reference, ttl=None):
+    """Atomically reserve every line or none of them
+
+    Returns the created ``StockReservation`` rows; raises ``InsufficientStock``
+    listing the lines that could not be satisfied.
+    """
+    lines = list(lines)
+    products, variants = _group_lines(lines)
+    ttl = ttl if ttl is not None else getattr(settings, 'STOCK_RESERVATION_TTL', DEFAULT_RESERVATION_TTL)
+    expires_at = timezone.now() + timedelta(seconds=ttl)
+
+    variant_products = {}
+    if variants:
+        variant_products = {
+            variant_id: product_id for product_id, variant_id, _quantity in lines if variant_id
+        }
+
+    try:
+        with transaction.atomic():
+            if take_stock(Product, products) != len(products):
+                raise _Shortfall
+            if take_stock(ProductVariant, variants) != len(variants):
+                raise _Shortfall
+            reservations = [
+                StockReservation(
+                    product_id=product_id,
+                    quantity=quantity,
+                    reference=reference,
+                    expires_at=expires_at,
+                )
+                for product_id, quantity in products.items()
+            ] + [
+                StockReservation(
+                    product_id=variant_products[variant_id],
+                    variant_id=variant_id,
+                    quantity=quantity,
+                    reference=reference,
+                    expires_at=expires_at,
+                )
+                for variant_id, quantity in variants.items()
+            ]
+            return StockReservation.objects.bulk_create(reservations)
+    except _Shortfall:
+        # The transaction rolled back; report against fresh stock levels
+        raise InsufficientStock(_shortages(products, variants))
+
+
+def _release(queryset, status):
+    """Return stock held by the active reservations in ``queryset``; returns their references"""
+    with transaction.atomic():
+        rows = list(
+            queryset.filter(status='active').select_for_update(skip_locked=True).values_list(
+                'pk', 'product_id', 'variant_id', 'quantity', 'reference'
+            )
+        )
+        if not rows:
+            return []
+        products, variants = _group_lines(
+            (product_id, variant_id, quantity) for _pk, product_id, variant_id, quantity, _reference in rows
+        )
+        return_stock(Product, products)
+        return_stock(ProductVariant, variants)
+        StockReservation.objects.filter(pk__in=[row[0] for row in rows]).update(
+            status=status, updated_at=timezone.now()
+        )
+        return [row[4] for row in rows]
+
+
+def release_reservations(reference):
+    """Give back the stock of a checkout that will not complete"""
+    return len(_release(StockReservation.objects.filter(reference=reference), 'released'))
+
+
+def hold_reservations(references):
+    """Lock the active reservations of checkouts until the transaction ends; returns how many
+
+    ``expire_reservations`` skips locked rows, and one already expiring them
+    is waited for, so an order read after this can't lose its stock to
+    expiry before its reservations are committed.
+    """
+    return len(
+        StockReservation.objects.filter(reference__in=references, status='active')
+        .select_for_update().values_list('pk', flat=True)
+    )
+
+
+def commit_reservations(reference):
+    """Make a checkout's reservations permanent; returns the number committed"""
+    return StockReservation.objects.filter(reference=reference, status='active').update(
+        status='committed', updated_at=timezone.now()
+    )
+
+
+def commit_many_reservations(references):
+    """``commit_reservations`` for many checkouts in one UPDATE"""
+    return StockReservation.objects.filter(reference__in=references, status='active').update(
+        status='committed', updated_at=timezone.now()
+    )
+
+
+def expire_reservations(now=None, batch_size=500):
+    """Return stock of reservations past their expiry time"""
+    now = now or timezone.now()
+    total = 0
+    while True:
+        batch = StockReservation.objects.filter(
+            status='active', expires_at__lte=now
+        ).order_by('expires_at').values_list('pk', flat=True)[:batch_size]
+        with transaction.atomic():
+            references = _release(StockReservation.objects.filter(pk__in=list(batch)), 'expired')
+            if references:
+                reservations_expired.send(sender=StockReservation, references=set(references))
+        total += len(references)
+        if len(references) < batch_size:
+            return total
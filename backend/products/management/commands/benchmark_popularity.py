@@ -0,0 +1,70 @@
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from products.ranking import get_scorer, popular_products, rank_rows
+
+
+class Command(BaseCommand):
+    """Rank a synthetic catalog and time the popular read path"""
+
+    help = (
+        'Benchmark popularity scoring on a synthetic catalog (default 1M products) in memory, '
+        'then time one popular products read against the current rankings table'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=1000000)
+        parser.add_argument('--categories', type=int, default=500)
+        parser.add_argument('--depth', type=int, default=3, help='Ancestors per category')
+        parser.add_argument('--top', type=int, default=50)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        now = timezone.now()
+        categories = options['categories']
+        # Synthetic tree: category n descends from n // 10, n // 100, ...
+        ancestors = {}
+        for category_id in range(1, categories + 1):
+            chain, node = [category_id], category_id
+            for _level in range(options['depth'] - 1):
+                node //= 10
+                if not node:
+                    break
+                chain.append(node)
+            ancestors[category_id] = chain
+
+        def rows():
+            for product_id in range(1, options['products'] + 1):
+                rating_count = int(rng.paretovariate(1.5)) - 1
+                yield (
+                    product_id,
+                    rng.randint(1, categories),
+                    int(rng.paretovariate(1.2)) - 1,
+                    int(rng.paretovariate(1.1) * 10) - 10,
+                    Decimal(rng.randint(100, 500)) / 100 if rating_count else Decimal('0'),
+                    rating_count,
+                    now - timedelta(days=rng.random() * 720),
+                )
+
+        scorer = get_scorer(now=now)
+        started = time.perf_counter()
+        rankings = rank_rows(rows(), scorer, options['top'], ancestors)
+        elapsed = time.perf_counter() - started
+        stored = sum(len(entries) for entries in rankings.values())
+        self.stdout.write(
+            f"Ranked {options['products']} products into {len(rankings)} lists "
+            f'({stored} rows) in {elapsed:.2f}s ({options["products"] / elapsed:,.0f} products/s)'
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            list(popular_products(limit=20))
+            read = time.perf_counter() - started
+        self.stdout.write(f'popular read: {len(queries)} query, {read * 1000:.2f}ms against the current table')
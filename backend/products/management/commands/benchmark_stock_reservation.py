@@ -0,0 +1,110 @@
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Sum
+from products.inventory import InsufficientStock, reserve_stock
+from products.models import Category, Product, StockReservation
+
+
+class Command(BaseCommand):
+    """Hammer one SKU from many threads and verify nothing is oversold"""
+
+    help = 'Concurrency benchmark for the stock reservation engine (use a PostgreSQL database)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=32, help='Concurrent buyers')
+        parser.add_argument('--stock', type=int, default=1000, help='Units of the hot SKU')
+        parser.add_argument('--quantity', type=int, default=1, help='Units per reservation')
+        parser.add_argument(
+            '--attempts',
+            type=int,
+            default=100,
+            help='Reservations attempted by each thread'
+        )
+        parser.add_argument('--keep', action='store_true', help='Keep the benchmark product')
+
+    def handle(self, *args, **options):
+        if connection.vendor == 'sqlite':
+            self.stderr.write('SQLite serializes writers; results will not reflect PostgreSQL behaviour')
+
+        run_id = uuid.uuid4().hex[:8]
+        category = Category.objects.create(name=f'Benchmark {run_id}', slug=f'benchmark-{run_id}')
+        product = Product.objects.create(
+            name=f'Benchmark SKU {run_id}',
+            slug=f'benchmark-sku-{run_id}',
+            sku=f'BENCH-{run_id}',
+            category=category,
+            price=1,
+            stock_quantity=options['stock'],
+        )
+
+        results = {'reserved': 0, 'rejected': 0, 'errors': 0}
+        latencies = []
+        lock = threading.Lock()
+        start_barrier = threading.Barrier(options['threads'])
+
+        def buyer(index):
+            local = {'reserved': 0, 'rejected': 0, 'errors': 0}
+            timings = []
+            try:
+                start_barrier.wait()
+                for attempt in range(options['attempts']):
+                    started = time.perf_counter()
+                    try:
+                        reserve_stock(
+                            [(product.pk, None, options['quantity'])],
+                            reference=f'bench-{run_id}-{index}-{attempt}',
+                        )
+                        local['reserved'] += 1
+                    except InsufficientStock:
+                        local['rejected'] += 1
+                    except Exception:
+                        local['errors'] += 1
+                    timings.append(time.perf_counter() - started)
+            finally:
+                connections.close_all()
+                with lock:
+                    for key, value in local.items():
+                        results[key] += value
+                    latencies.extend(timings)
+
+        threads = [threading.Thread(target=buyer, args=(index,)) for index in range(options['threads'])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        product.refresh_from_db(fields=['stock_quantity'])
+        reserved_units = StockReservation.objects.filter(
+            reference__startswith=f'bench-{run_id}-'
+        ).aggregate(total=Sum('quantity'))['total'] or 0
+        oversold = reserved_units + product.stock_quantity - options['stock']
+
+        latencies.sort()
+        attempts = len(latencies)
+        self.stdout.write(
+            f"threads={options['threads']} attempts={attempts} "
+            f"reserved={results['reserved']} rejected={results['rejected']} errors={results['errors']}"
+        )
+        self.stdout.write(
+            f'{attempts / elapsed:.0f} reservations/s, '
+            f'p50={latencies[attempts // 2] * 1000:.2f}ms '
+            f'p99={latencies[min(attempts - 1, int(attempts * 0.99))] * 1000:.2f}ms'
+        )
+        self.stdout.write(
+            f"stock start={options['stock']} end={product.stock_quantity} "
+            f'reserved units={reserved_units} oversold={oversold}'
+        )
+
+        if not options['keep']:
+            product.delete()
+            category.delete()
+
+        if oversold != 0 or product.stock_quantity < 0:
+            raise CommandError('Stock accounting mismatch: reservations oversold the SKU')
+        self.stdout.write(self.style.SUCCESS('No oversell'))
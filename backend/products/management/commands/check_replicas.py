@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from shop_backend.replicas import ReplicaPool
+
+
+class Command(BaseCommand):
+    """Probe the read replicas the catalog is served from"""
+
+    help = 'Report reachability and replication lag of each REPLICA_DATABASES alias; exits 1 if none is usable'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-lag', type=float, default=None, help='Lag limit in seconds (default REPLICA_MAX_LAG_SECONDS)')
+
+    def handle(self, *args, **options):
+        aliases = getattr(settings, 'REPLICA_DATABASES', [])
+        if not aliases:
+            self.stdout.write('No replicas configured (set DATABASE_REPLICA_HOSTS); all reads use the primary')
+            return
+        pool = ReplicaPool(aliases=aliases, max_lag=options['max_lag'])
+        pool.check_all()
+        for alias, state in pool.status().items():
+            if state['error']:
+                detail = f"error: {state['error'].strip()}"
+            else:
+                detail = f"lag {state['lag']:.2f}s"
+            label = 'ok' if state['healthy'] else 'ejected'
+            self.stdout.write(f"{alias:<16}{label:<10}{detail}")
+        if not pool.healthy():
+            raise CommandError('No replica is usable; reads fall back to the primary')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from products.inventory import expire_reservations
+
+
+class Command(BaseCommand):
+    """Return stock held by expired reservations"""
+
+    help = 'Release stock reservations past their expiry time (run from cron every minute)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of reservations released per transaction'
+        )
+
+    def handle(self, *args, **options):
+        released = expire_reservations(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired reservations'))
@@ -0,0 +1,146 @@
+import statistics
+import threading
+import time
+from urllib.parse import quote
+
+import requests
+from django.core.management.base import BaseCommand, CommandError
+from products.models import Product
+
+# (name, WSGI path, ASGI path); {product} and {query} are filled in
+ENDPOINTS = [
+    ('product-list', '/api/v1/products/products/', '/api/v1/products/async/products/'),
+    ('product-detail', '/api/v1/products/products/{product}/', '/api/v1/products/async/products/{product}/'),
+    ('featured', '/api/v1/products/products/featured/', '/api/v1/products/async/products/featured/'),
+    ('search', '/api/v1/products/search/?q={query}', '/api/v1/products/async/search/?q={query}'),
+    ('categories', '/api/v1/products/categories/', '/api/v1/products/async/categories/'),
+    ('brands', '/api/v1/products/brands/', '/api/v1/products/async/brands/'),
+]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_load(url, concurrency, duration, timeout):
+    """Hit ``url`` from ``concurrency`` keep-alive clients for ``duration`` seconds"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        local, failed = [], 0
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                response = session.get(url, timeout=timeout)
+                response.content
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            if ok:
+                local.append(elapsed)
+            else:
+                failed += 1
+        session.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'mean': statistics.fmean(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+class Command(BaseCommand):
+    """Compare the WSGI (DRF) and ASGI (async) catalog endpoints under load"""
+
+    help = (
+        'Load test the catalog endpoints on a WSGI and an ASGI server and report '
+        'requests/sec and p50/p99 latency. Start both servers first, e.g. '
+        '`gunicorn shop_backend.wsgi -w 4 -b 127.0.0.1:8000` and '
+        '`uvicorn shop_backend.asgi:application --workers 4 --port 8001`.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--wsgi-url', default='http://127.0.0.1:8000', help='Base URL of the WSGI server')
+        parser.add_argument('--asgi-url', default='http://127.0.0.1:8001', help='Base URL of the ASGI server')
+        parser.add_argument(
+            '--endpoints',
+            nargs='+',
+            choices=[name for name, _wsgi, _asgi in ENDPOINTS],
+            help='Endpoints to test (default: all)'
+        )
+        parser.add_argument('--concurrency', type=int, default=32, help='Concurrent keep-alive clients')
+        parser.add_argument('--duration', type=float, default=10.0, help='Seconds per endpoint and server')
+        parser.add_argument('--warmup', type=float, default=2.0, help='Unmeasured seconds before each run')
+        parser.add_argument('--timeout', type=float, default=10.0, help='Per-request timeout in seconds')
+        parser.add_argument('--product', type=int, help='Product id for the detail endpoint')
+        parser.add_argument('--query', help='Search query (default: first word of the product name)')
+        parser.add_argument(
+            '--only',
+            choices=['wsgi', 'asgi'],
+            help='Test a single server instead of both'
+        )
+
+    def handle(self, *args, **options):
+        product = Product.objects.filter(is_active=True).order_by('pk').only('pk', 'name')
+        if options['product']:
+            product = product.filter(pk=options['product'])
+        product = product.first()
+        if product is None:
+            raise CommandError('No active product to test against; load some catalog data first')
+        query = options['query'] or product.name.split()[0]
+
+        servers = [('wsgi', options['wsgi_url'].rstrip('/')), ('asgi', options['asgi_url'].rstrip('/'))]
+        if options['only']:
+            servers = [server for server in servers if server[0] == options['only']]
+        selected = options['endpoints'] or [name for name, _wsgi, _asgi in ENDPOINTS]
+
+        self.stdout.write(
+            f"{options['concurrency']} clients, {options['duration']:.0f}s per run, "
+            f"product {product.pk}, query {query!r}"
+        )
+        self.stdout.write(
+            f"{'endpoint':<16}{'server':<8}{'requests':>10}{'errors':>8}"
+            f"{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}"
+        )
+        for name, wsgi_path, asgi_path in ENDPOINTS:
+            if name not in selected:
+                continue
+            for server, base_url in servers:
+                path = (wsgi_path if server == 'wsgi' else asgi_path).format(
+                    product=product.pk, query=quote(query)
+                )
+                url = base_url + path
+                try:
+                    requests.get(url, timeout=options['timeout'])
+                except requests.RequestException as exc:
+                    raise CommandError(f'{server} server not reachable at {base_url}: {exc}')
+                if options['warmup'] > 0:
+                    run_load(url, options['concurrency'], options['warmup'], options['timeout'])
+                stats = run_load(url, options['concurrency'], options['duration'], options['timeout'])
+                self.stdout.write(
+                    f"{name:<16}{server:<8}{stats['requests']:>10}{stats['errors']:>8}"
+                    f"{stats['rps']:>10.1f}{stats['p50']:>10.1f}{stats['p99']:>10.1f}"
+                )
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from products.tracking import prune_view_stats
+
+
+class Command(BaseCommand):
+    """Remove hourly product view stats past their retention period"""
+
+    help = 'Delete hourly product view stats and flush markers older than VIEW_STATS_RETENTION_DAYS (run daily)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=None,
+            help='Retention in days (defaults to VIEW_STATS_RETENTION_DAYS)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=10000,
+            help='Rows deleted per statement'
+        )
+
+    def handle(self, *args, **options):
+        days = options['days'] or getattr(settings, 'VIEW_STATS_RETENTION_DAYS', 90)
+        before = timezone.now() - timedelta(days=days)
+        deleted = prune_view_stats(before, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} view stat rows older than {days} days'))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from products.models import CategoryClosure
+
+
+class Command(BaseCommand):
+    """Rebuild the category closure table from Category.parent"""
+
+    help = 'Regenerate products_categoryclosure from the category parent links'
+
+    def handle(self, *args, **options):
+        count = CategoryClosure.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt category tree with {count} closure rows'))
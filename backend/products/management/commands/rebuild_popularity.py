@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+from products.ranking import rebuild_rankings
+
+
+class Command(BaseCommand):
+    """Recompute the precomputed popular product lists"""
+
+    help = 'Score the active catalog and store the top-N popular products globally and per category'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, help='Products kept per list (default POPULARITY_TOP_N)')
+        parser.add_argument('--scorer', help='Dotted path of a PopularityScorer (default POPULARITY_SCORER)')
+
+    def handle(self, *args, **options):
+        scorer = import_string(options['scorer'])() if options['scorer'] else None
+        started = time.perf_counter()
+        written = rebuild_rankings(top_n=options['top'], scorer=scorer)
+        self.stdout.write(self.style.SUCCESS(
+            f'Stored {written} ranking rows in {time.perf_counter() - started:.1f}s'
+        ))
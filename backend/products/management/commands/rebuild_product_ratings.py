@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+from products.models import Product, Review
+
+
+class Command(BaseCommand):
+    """Rebuild denormalized product rating aggregates from reviews"""
+
+    help = 'Recompute rating_avg, rating_count and the rating histogram for products'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of products written per UPDATE batch'
+        )
+        parser.add_argument(
+            '--product',
+            type=int,
+            action='append',
+            dest='product_ids',
+            help='Only rebuild the given product id (can be repeated)'
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        products = Product.objects.order_by('pk')
+        reviews = Review.objects.filter(is_active=True)
+        if options['product_ids']:
+            products = products.filter(pk__in=options['product_ids'])
+            reviews = reviews.filter(product_id__in=options['product_ids'])
+
+        # One grouped query for every (product, rating) bucket
+        histograms = {}
+        buckets = reviews.values_list('product_id', 'rating').annotate(
+            count=Count('id')
+        ).order_by()
+        for product_id, rating, count in buckets:
+            histograms.setdefault(product_id, {})[rating] = count
+
+        fields = list(Product.RATING_FIELDS)
+        updated = changed = 0
+        batch = []
+        for product in products.only('pk', *fields).iterator(chunk_size=batch_size):
+            values = Product.rating_values_from_histogram(histograms.get(product.pk, {}))
+            if any(getattr(product, field) != value for field, value in values.items()):
+                for field, value in values.items():
+                    setattr(product, field, value)
+                batch.append(product)
+                changed += 1
+            updated += 1
+            if len(batch) >= batch_size:
+                self._flush(batch, fields)
+                batch = []
+        self._flush(batch, fields)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {updated} products, rebuilt ratings for {changed}'
+        ))
+
+    def _flush(self, batch, fields):
+        if batch:
+            with transaction.atomic():
+                Product.objects.bulk_update(batch, fields, batch_size=len(batch))
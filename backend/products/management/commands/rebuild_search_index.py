@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from products.models import Product
+from products.search import get_search_backend
+
+
+class Command(BaseCommand):
+    """Rebuild stored product search documents and vectors"""
+
+    help = 'Recompute search_document and search_vector for every product'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of products loaded per batch'
+        )
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        products = Product.objects.select_related('category', 'brand').order_by('pk')
+        count = 0
+        for product in products.iterator(chunk_size=options['batch_size']):
+            backend.refresh([product])
+            count += 1
+        self.stdout.write(self.style.SUCCESS(f'Re-indexed {count} products'))
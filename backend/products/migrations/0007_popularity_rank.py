@@ -0,0 +1,31 @@
+# Generated by Django 5.2.5 on 2026-10-18 06:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0006_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PopularityRank',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveSmallIntegerField(verbose_name='Position')),
+                ('score', models.FloatField(verbose_name='Score')),
+                ('computed_at', models.DateTimeField(verbose_name='Computed At')),
+                ('category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='popularity_ranks', to='products.category')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='popularity_ranks', to='products.product')),
+            ],
+            options={
+                'verbose_name': 'Popularity Rank',
+                'verbose_name_plural': 'Popularity Ranks',
+                'ordering': ['category', 'position'],
+                'constraints': [models.UniqueConstraint(fields=('category', 'position'), name='unique_category_popularity_position'), models.UniqueConstraint(condition=models.Q(('category__isnull', True)), fields=('position',), name='unique_global_popularity_position')],
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.5 on 2026-10-18 06:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0007_popularity_rank'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ViewFlushBatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch_id', models.UUIDField(unique=True, verbose_name='Batch ID')),
+                ('views', models.PositiveIntegerField(default=0, verbose_name='Views')),
+                ('flushed_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+            options={
+                'verbose_name': 'View Flush Batch',
+                'verbose_name_plural': 'View Flush Batches',
+            },
+        ),
+        migrations.CreateModel(
+            name='ProductViewStat',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField(verbose_name='Hour')),
+                ('views', models.PositiveIntegerField(default=0, verbose_name='Views')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='view_stats', to='products.product')),
+            ],
+            options={
+                'verbose_name': 'Product View Stat',
+                'verbose_name_plural': 'Product View Stats',
+                'ordering': ['product', 'hour'],
+                'indexes': [models.Index(fields=['hour'], name='products_pr_hour_5c6f97_idx')],
+                'constraints': [models.UniqueConstraint(fields=('product', 'hour'), name='unique_product_view_hour')],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.5 on 2026-10-18 11:20
+
+import time
+
+from django.db import migrations
+
+
+def seed_catalog_versions(apps, schema_editor):
+    """Create the version row of every family so lookups never have to"""
+    CatalogVersion = apps.get_model('products', 'CatalogVersion')
+    version = time.time_ns() // 1000
+    CatalogVersion.objects.using(schema_editor.connection.alias).bulk_create(
+        [CatalogVersion(family=family, version=version) for family in ('product', 'category', 'brand')],
+        ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0010_productimage_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(seed_catalog_versions, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,16 @@
-from django.db import models
+from decimal import Decimal
+
+from django.contrib.postgres.search import SearchVectorField
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models.functions import Cast
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.urls import reverse
 from django.utils.text import slugify
 from django.contrib.auth import get_user_model
+from sequences.allocator import next_id
 
 User = get_user_model()
 
@@ -57,16 +64,152 @@ class Category(models.Model):
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
+        if self.parent_changed:
+            self.validate_parent()
         super().save(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_parent_id = instance.__dict__.get('parent_id')
+        instance._loaded_name = instance.__dict__.get('name')
+        return instance
+
+    def clean(self):
+        super().clean()
+        self.validate_parent()
+
+    def validate_parent(self):
+        """Reject parents that would create a cycle in the tree"""
+        if self.pk and self.parent_id and CategoryClosure.objects.filter(
+            ancestor_id=self.pk, descendant_id=self.parent_id
+        ).exists():
+            raise ValidationError({'parent': _('A category cannot be moved under itself or its subcategories.')})
+
     @property
     def is_parent(self):
         return self.parent is None
 
+    @property
+    def parent_changed(self):
+        return getattr(self, '_loaded_parent_id', self.parent_id) != self.parent_id
+
+    def get_ancestors(self, include_self=False):
+        """Ancestors from the root down, in one query"""
+        min_depth = 0 if include_self else 1
+        return Category.objects.filter(
+            descendant_links__descendant=self,
+            descendant_links__depth__gte=min_depth
+        ).order_by('-descendant_links__depth')
+
+    def get_descendants(self, include_self=False):
+        """Every category below this one at any depth, in one query"""
+        min_depth = 0 if include_self else 1
+        return Category.objects.filter(
+            ancestor_links__ancestor=self,
+            ancestor_links__depth__gte=min_depth
+        )
+
     def get_absolute_url(self):
         return reverse('products:category_detail', kwargs={'slug': self.slug})
 
 
+class CategoryClosure(models.Model):
+    """Closure table of Category.parent: one row per (ancestor, descendant) pair
+
+    Every category has a depth 0 row pointing at itself, so subtree queries
+    are a single indexed join regardless of tree depth.
+    """
+
+    ancestor = models.ForeignKey(
+        Category,
+        on_delete=models.CASCADE,
+        related_name='descendant_links'
+    )
+    descendant = models.ForeignKey(
+        Category,
+        on_delete=models.CASCADE,
+        related_name='ancestor_links'
+    )
+    depth = models.PositiveIntegerField(default=0, verbose_name=_('Depth'))
+
+    class Meta:
+        app_label = 'products'
+        verbose_name = _('Category Closure')
+        verbose_name_plural = _('Category Closures')
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_category_closure'),
+        ]
+        indexes = [
+            models.Index(fields=['descendant', 'depth']),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} -> {self.descendant_id} ({self.depth})"
+
+    @classmethod
+    def insert_node(cls, category):
+        """Add closure rows for a newly created category"""
+        rows = [cls(ancestor_id=category.pk, descendant_id=category.pk, depth=0)]
+        if category.parent_id:
+            rows += [
+                cls(ancestor_id=ancestor_id, descendant_id=category.pk, depth=depth + 1)
+                for ancestor_id, depth in cls.objects.filter(
+                    descendant_id=category.parent_id
+                ).values_list('ancestor_id', 'depth')
+            ]
+        cls.objects.bulk_create(rows)
+
+    @classmethod
+    def move_subtree(cls, category):
+        """Re-link the subtree rooted at ``category`` under its current parent"""
+        with transaction.atomic():
+            subtree = list(
+                cls.objects.filter(ancestor_id=category.pk).values_list('descendant_id', 'depth')
+            )
+            if not subtree:
+                return cls.insert_node(category)
+            subtree_ids = [descendant_id for descendant_id, _depth in subtree]
+            if category.parent_id in subtree_ids:
+                raise ValidationError(_('A category cannot be moved under itself or its subcategories.'))
+
+            # Detach the subtree from its old ancestors
+            cls.objects.filter(descendant_id__in=subtree_ids).exclude(
+                ancestor_id__in=subtree_ids
+            ).delete()
+
+            # Attach it below every ancestor of the new parent
+            if category.parent_id:
+                new_ancestors = cls.objects.filter(
+                    descendant_id=category.parent_id
+                ).values_list('ancestor_id', 'depth')
+                cls.objects.bulk_create([
+                    cls(
+                        ancestor_id=ancestor_id,
+                        descendant_id=descendant_id,
+                        depth=ancestor_depth + depth + 1
+                    )
+                    for ancestor_id, ancestor_depth in new_ancestors
+                    for descendant_id, depth in subtree
+                ])
+
+    @classmethod
+    def rebuild(cls):
+        """Regenerate the whole table from Category.parent"""
+        parents = dict(Category.objects.values_list('pk', 'parent_id'))
+        rows = []
+        for category_id in parents:
+            ancestor_id, depth, seen = category_id, 0, set()
+            while ancestor_id is not None and ancestor_id not in seen:
+                seen.add(ancestor_id)
+                rows.append(cls(ancestor_id=ancestor_id, descendant_id=category_id, depth=depth))
+                ancestor_id, depth = parents.get(ancestor_id), depth + 1
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(rows, batch_size=1000)
+        return len(rows)
+
+
 class Brand(models.Model):
     """Product brand/manufacturer model"""
 
@@ -112,6 +255,12 @@ class Brand(models.Model):
             self.slug = slugify(self.name)
         super().save(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_name = instance.__dict__.get('name')
+        return instance
+
     def get_absolute_url(self):
         return reverse('products:brand_detail', kwargs={'slug': self.slug})
 
@@ -202,10 +351,38 @@ class Product(models.Model):
     total_sales = models.PositiveIntegerField(default=0, verbose_name=_('Total Sales'))
     view_count = models.PositiveIntegerField(default=0, verbose_name=_('View Count'))
 
+    # Rating aggregates (maintained incrementally from active reviews)
+    rating_avg = models.DecimalField(
+        max_digits=3,
+        decimal_places=2,
+        default=0,
+        verbose_name=_('Average Rating')
+    )
+    rating_count = models.PositiveIntegerField(default=0, verbose_name=_('Rating Count'))
+    rating_1_count = models.PositiveIntegerField(default=0, verbose_name=_('1 Star Ratings'))
+    rating_2_count = models.PositiveIntegerField(default=0, verbose_name=_('2 Star Ratings'))
+    rating_3_count = models.PositiveIntegerField(default=0, verbose_name=_('3 Star Ratings'))
+    rating_4_count = models.PositiveIntegerField(default=0, verbose_name=_('4 Star Ratings'))
+    rating_5_count = models.PositiveIntegerField(default=0, verbose_name=_('5 Star Ratings'))
+
+    # Search (maintained by products.search on save)
+    search_document = models.TextField(blank=True, default='', editable=False)
+    search_vector = SearchVectorField(null=True, blank=True, editable=False)
+
     # Timestamps
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    RATING_BUCKET_FIELDS = {
+        1: 'rating_1_count',
+        2: 'rating_2_count',
+        3: 'rating_3_count',
+        4: 'rating_4_count',
+        5: 'rating_5_count',
+    }
+    RATING_FIELDS = ('rating_avg', 'rating_count', *RATING_BUCKET_FIELDS.values())
+    DERIVED_FIELDS = (*RATING_FIELDS, 'search_document', 'search_vector')
+
     class Meta:
         app_label = 'products'
         verbose_name = _('Product')
@@ -216,6 +393,9 @@ class Product(models.Model):
             models.Index(fields=['brand']),
             models.Index(fields=['is_active', 'is_featured']),
             models.Index(fields=['price']),
+            models.Index(fields=['is_active', 'rating_avg']),
+            models.Index(fields=['is_active', '-rating_count', '-rating_avg']),
+            models.Index(fields=['-created_at', '-id']),
         ]
 
     def __str__(self):
@@ -225,9 +405,13 @@ class Product(models.Model):
         if not self.slug:
             self.slug = slugify(self.name)
         if not self.sku:
-            # Generate SKU
-            import uuid
-            self.sku = f"PRD-{uuid.uuid4().hex[:8].upper()}"
+            self.sku = next_id('PRD')
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            # Rating and search columns are owned by signals; never write back a stale copy
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.DERIVED_FIELDS
+            ]
         super().save(*args, **kwargs)
 
     def get_absolute_url(self):
@@ -247,16 +431,100 @@ class Product(models.Model):
             return round(((self.compare_price - self.price) / self.compare_price) * 100, 2)
         return 0
 
+    @property
+    def primary_image(self):
+        """The first image by display order, taken from prefetched images when there are any"""
+        images = self.images.all()
+        if not images:
+            return None
+        return min(images, key=lambda image: (image.display_order, image.pk))
+
     @property
     def average_rating(self):
-        reviews = self.reviews.filter(is_active=True)
-        if reviews.exists():
-            return round(reviews.aggregate(models.Avg('rating'))['rating__avg'], 1)
-        return 0
+        return round(self.rating_avg, 1)
 
     @property
     def review_count(self):
-        return self.reviews.filter(is_active=True).count()
+        return self.rating_count
+
+    @property
+    def rating_histogram(self):
+        return {
+            rating: getattr(self, field)
+            for rating, field in self.RATING_BUCKET_FIELDS.items()
+        }
+
+    @classmethod
+    def rating_values_from_histogram(cls, histogram):
+        """Build rating column values from a {rating: count} histogram"""
+        values = {
+            field: histogram.get(rating, 0)
+            for rating, field in cls.RATING_BUCKET_FIELDS.items()
+        }
+        count = sum(values.values())
+        total = sum(rating * histogram.get(rating, 0) for rating in cls.RATING_BUCKET_FIELDS)
+        values['rating_count'] = count
+        values['rating_avg'] = (
+            (Decimal(total) / count).quantize(Decimal('0.01')) if count else Decimal('0')
+        )
+        return values
+
+    @classmethod
+    def apply_rating_delta(cls, product_id, added=None, removed=None):
+        """Shift one product's rating aggregates by a single UPDATE
+
+        ``added``/``removed`` are star ratings (1-5) entering or leaving the
+        set of active reviews. The average is derived from the pre-update
+        histogram plus the delta, so no review rows are read.
+        """
+        deltas = {}
+        if added is not None:
+            deltas[added] = deltas.get(added, 0) + 1
+        if removed is not None:
+            deltas[removed] = deltas.get(removed, 0) - 1
+        deltas = {rating: delta for rating, delta in deltas.items() if delta}
+        if not deltas:
+            return 0
+
+        count_delta = sum(deltas.values())
+        new_count = models.F('rating_count') + count_delta
+        new_total = sum(
+            (
+                (models.F(field) + deltas.get(rating, 0)) * rating
+                for rating, field in cls.RATING_BUCKET_FIELDS.items()
+            ),
+            models.Value(0),
+        )
+        updates = {
+            cls.RATING_BUCKET_FIELDS[rating]: models.F(cls.RATING_BUCKET_FIELDS[rating]) + delta
+            for rating, delta in deltas.items()
+        }
+        updates['rating_count'] = new_count
+        updates['updated_at'] = timezone.now()
+        updates['rating_avg'] = models.Case(
+            models.When(
+                models.Q(rating_count__lte=-count_delta),
+                then=models.Value(Decimal('0')),
+            ),
+            default=Cast(
+                Cast(new_total, models.FloatField()) / new_count,
+                models.DecimalField(max_digits=3, decimal_places=2),
+            ),
+            output_field=models.DecimalField(max_digits=3, decimal_places=2),
+        )
+        return cls.objects.filter(pk=product_id).update(**updates)
+
+    def update_rating(self):
+        """Recompute rating aggregates for this product from its reviews"""
+        histogram = dict(
+            self.reviews.filter(is_active=True).values_list('rating').annotate(
+                count=models.Count('id')
+            ).order_by()
+        )
+        values = self.rating_values_from_histogram(histogram)
+        for field, value in values.items():
+            setattr(self, field, value)
+        Product.objects.filter(pk=self.pk).update(**values)
 
 
 class ProductImage(models.Model):
@@ -272,6 +540,8 @@ class ProductImage(models.Model):
     display_order = models.PositiveIntegerField(default=0, verbose_name=_('Display Order'))
 
     created_at = models.DateTimeField(auto_now_add=True)
+    # Feeds the product validators (see shop_backend/conditional.py)
+    updated_at = models.DateTimeField(auto_now=True)
 
     class Meta:
         app_label = 'products'
@@ -343,9 +613,7 @@ class ProductVariant(models.Model):
 
     def save(self, *args, **kwargs):
         if not self.sku:
-            # Generate variant SKU
-            import uuid
-            self.sku = f"VAR-{uuid.uuid4().hex[:8].upper()}"
+            self.sku = next_id('VAR')
         super().save(*args, **kwargs)
 
     @property
@@ -357,6 +625,155 @@ class ProductVariant(models.Model):
         return self.stock_quantity > 0
 
 
+class StockReservation(models.Model):
+    """Stock held for a checkout until it is committed, released or expires"""
+
+    STATUS_CHOICES = [
+        ('active', _('Active')),
+        ('committed', _('Committed')),
+        ('released', _('Released')),
+        ('expired', _('Expired')),
+    ]
+
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='stock_reservations'
+    )
+    variant = models.ForeignKey(
+        ProductVariant,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='stock_reservations'
+    )
+    quantity = models.PositiveIntegerField(verbose_name=_('Quantity'))
+
+    # Checkout/order key the reservation belongs to
+    reference = models.CharField(max_length=100, verbose_name=_('Reference'))
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='active',
+        verbose_name=_('Status')
+    )
+    expires_at = models.DateTimeField(verbose_name=_('Expires At'))
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'products'
+        verbose_name = _('Stock Reservation')
+        verbose_name_plural = _('Stock Reservations')
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['reference', 'status']),
+            models.Index(fields=['status', 'expires_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.reference}: {self.product_id}/{self.variant_id or '-'} x{self.quantity} ({self.status})"
+
+
+class PopularityRank(models.Model):
+    """Precomputed top-N popular products, globally (category null) and per category subtree"""
+
+    category = models.ForeignKey(
+        Category,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='popularity_ranks'
+    )
+    position = models.PositiveSmallIntegerField(verbose_name=_('Position'))
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='popularity_ranks'
+    )
+    score = models.FloatField(verbose_name=_('Score'))
+    computed_at = models.DateTimeField(verbose_name=_('Computed At'))
+
+    class Meta:
+        app_label = 'products'
+        verbose_name = _('Popularity Rank')
+        verbose_name_plural = _('Popularity Ranks')
+        ordering = ['category', 'position']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['category', 'position'],
+                name='unique_category_popularity_position',
+            ),
+            models.UniqueConstraint(
+                fields=['position'],
+                condition=models.Q(category__isnull=True),
+                name='unique_global_popularity_position',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.category_id or 'global'} #{self.position}: {self.product_id}"
+
+
+class ProductViewStat(models.Model):
+    """Product detail views per hour, written by the view count flusher"""
+
+    product = models.ForeignKey(
+        Product,
+        on_delete=models.CASCADE,
+        related_name='view_stats'
+    )
+    hour = models.DateTimeField(verbose_name=_('Hour'))
+    views = models.PositiveIntegerField(default=0, verbose_name=_('Views'))
+
+    class Meta:
+        app_label = 'products'
+        verbose_name = _('Product View Stat')
+        verbose_name_plural = _('Product View Stats')
+        ordering = ['product', 'hour']
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'hour'], name='unique_product_view_hour'),
+        ]
+        indexes = [
+            models.Index(fields=['hour']),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} @ {self.hour:%Y-%m-%d %H}:00: {self.views}"
+
+
+class ViewFlushBatch(models.Model):
+    """Marker of an applied view count flush; makes retried flushes no-ops"""
+
+    batch_id = models.UUIDField(unique=True, verbose_name=_('Batch ID'))
+    views = models.PositiveIntegerField(default=0, verbose_name=_('Views'))
+    flushed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        app_label = 'products'
+        verbose_name = _('View Flush Batch')
+        verbose_name_plural = _('View Flush Batches')
+
+    def __str__(self):
+        return str(self.batch_id)
+
+
+class CatalogVersion(models.Model):
+    """Catalog cache version of a key family, shared by processes whose cache is not (see products/cache.py)"""
+
+    family = models.CharField(max_length=50, primary_key=True, verbose_name=_('Family'))
+    version = models.BigIntegerField(verbose_name=_('Version'))
+
+    class Meta:
+        app_label = 'products'
+        verbose_name = _('Catalog Version')
+        verbose_name_plural = _('Catalog Versions')
+
+    def __str__(self):
+        return f"{self.family}: {self.version}"
+
+
 class ProductAttribute(models.Model):
     """Product attributes (color, size, material, etc.)"""
 
@@ -478,3 +895,21 @@ class Review(models.Model):
 
     def __str__(self):
         return f"{self.user.email} - {self.product.name} - {self.rating}★"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.remember_rating_state()
+        return instance
+
+    def remember_rating_state(self):
+        """Snapshot the fields that feed the product rating aggregates"""
+        deferred = self.get_deferred_fields()
+        if deferred & {'product_id', 'rating', 'is_active'}:
+            self._rating_state = None
+        else:
+            self._rating_state = (self.product_id, self.rating, self.is_active)
+
+    @property
+    def rating_state(self):
+        return getattr(self, '_rating_state', None)
@@ -0,0 +1,153 @@
+"""
+Popular products ranking.
+
+``rebuild_rankings`` streams the active catalog once, scores every product
+with the configured ``PopularityScorer`` and keeps bounded heaps of the top
+N products globally and for every category subtree (a product counts
+towards all of its category's ancestors via the closure table). The result
+replaces the contents of ``PopularityRank`` in one transaction, so
+``ProductViewSet.popular`` is a single indexed read of at most N rows.
+
+Scorers are pluggable through ``POPULARITY_SCORER`` (a dotted path) and
+receive the rows described by their ``fields``.
+"""
+
+import heapq
+import math
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .cache import invalidate_on_commit
+from .models import CategoryClosure, PopularityRank, Product
+
+DEFAULT_TOP_N = 50
+
+DEFAULT_WEIGHTS = {
+    'sales': 3.0,
+    'views': 1.0,
+    'reviews': 2.0,
+    # Boost for new products, halving every ``half_life_days``
+    'recency': 0.5,
+    'half_life_days': 30.0,
+    # Bayesian prior for the rating average
+    'prior_rating': 3.5,
+    'prior_count': 5,
+}
+
+
+class PopularityScorer:
+    """Interface for popularity scores; higher is more popular"""
+
+    # Product columns passed to ``score`` in this order
+    fields = ()
+
+    def __init__(self, now=None):
+        self.now = now or timezone.now()
+
+    def score(self, row):
+        raise NotImplementedError
+
+
+class WeightedPopularityScorer(PopularityScorer):
+    """Log-scaled sales, views and review quality with a recency boost
+
+    ``(w_s*log(1+sales) + w_v*log(1+views) + w_r*bayes_rating*log(1+reviews))
+    * (1 + w_n * 0.5 ** (age_days / half_life_days))``
+    """
+
+    fields = ('total_sales', 'view_count', 'rating_avg', 'rating_count', 'created_at')
+
+    def __init__(self, now=None, weights=None):
+        super().__init__(now)
+        self.weights = dict(DEFAULT_WEIGHTS, **(weights or getattr(settings, 'POPULARITY_WEIGHTS', {})))
+
+    def score(self, row):
+        total_sales, view_count, rating_avg, rating_count, created_at = row
+        w = self.weights
+        rating = (
+            (float(rating_avg) * rating_count + w['prior_rating'] * w['prior_count'])
+            / (rating_count + w['prior_count'])
+        )
+        base = (
+            w['sales'] * math.log1p(total_sales)
+            + w['views'] * math.log1p(view_count)
+            + w['reviews'] * rating / 5 * math.log1p(rating_count)
+        )
+        age_days = max((self.now - created_at).total_seconds(), 0) / 86400
+        return base * (1 + w['recency'] * 0.5 ** (age_days / w['half_life_days']))
+
+
+def get_scorer(now=None):
+    path = getattr(settings, 'POPULARITY_SCORER', 'products.ranking.WeightedPopularityScorer')
+    return import_string(path)(now=now)
+
+
+def category_ancestors():
+    """{category_id: [ancestor ids including itself]} from the closure table"""
+    ancestors = {}
+    for ancestor_id, descendant_id in CategoryClosure.objects.values_list('ancestor_id', 'descendant_id'):
+        ancestors.setdefault(descendant_id, []).append(ancestor_id)
+    return ancestors
+
+
+def rank_rows(rows, scorer, top_n, ancestors):
+    """Top ``top_n`` (score, product_id) per scope from ``(product_id, category_id, *fields)`` rows
+
+    Returns {None: [...], category_id: [...]} sorted best first. Memory is
+    bounded by ``top_n`` per category, not by the catalog size.
+    """
+    heaps = {None: []}
+    score = scorer.score
+    push, replace = heapq.heappush, heapq.heapreplace
+    for row in rows:
+        product_id, category_id = row[0], row[1]
+        entry = (score(row[2:]), product_id)
+        for scope in [None] + ancestors.get(category_id, [category_id]):
+            heap = heaps.get(scope)
+            if heap is None:
+                heap = heaps[scope] = []
+            if len(heap) < top_n:
+                push(heap, entry)
+            elif entry > heap[0]:
+                replace(heap, entry)
+    return {scope: sorted(heap, reverse=True) for scope, heap in heaps.items()}
+
+
+def rebuild_rankings(top_n=None, scorer=None, chunk_size=10000):
+    """Recompute and store the popularity tables; returns the number of rows written"""
+    top_n = top_n or getattr(settings, 'POPULARITY_TOP_N', DEFAULT_TOP_N)
+    now = timezone.now()
+    scorer = scorer or get_scorer(now=now)
+    rows = Product.objects.filter(is_active=True).order_by().values_list(
+        'pk', 'category_id', *scorer.fields
+    ).iterator(chunk_size=chunk_size)
+    rankings = rank_rows(rows, scorer, top_n, category_ancestors())
+
+    ranks = [
+        PopularityRank(
+            category_id=scope,
+            position=position,
+            product_id=product_id,
+            score=score,
+            computed_at=now,
+        )
+        for scope, entries in rankings.items()
+        for position, (score, product_id) in enumerate(entries, start=1)
+    ]
+    with transaction.atomic():
+        PopularityRank.objects.all().delete()
+        PopularityRank.objects.bulk_create(ranks, batch_size=5000)
+        invalidate_on_commit('product')
+    return len(ranks)
+
+
+def popular_products(category_id=None, limit=20):
+    """Popular active products from the precomputed table, one query"""
+    return Product.objects.select_related('category', 'brand').filter(
+        popularity_ranks__category_id=category_id,
+        popularity_ranks__position__lte=limit,
+        is_active=True,
+    ).order_by('popularity_ranks__position')
@@ -0,0 +1,388 @@
+"""
+Product search backends.
+
+``PostgresSearchBackend`` ranks products with a weighted ``tsvector``
+(``Product.search_vector``) and falls back to pg_trgm similarity on
+``Product.search_document`` for typo tolerance. ``InMemorySearchBackend`` is
+a pure-Python inverted index over the same normalized documents, used on
+databases without full-text search (SQLite test runs).
+"""
+
+import bisect
+import difflib
+import html
+import math
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, CharField, Count, F, FloatField, IntegerField, Max, Q, Value, When
+from django.utils.functional import cached_property
+
+# Arabic code points commonly typed in place of their Persian forms
+_CHARACTER_MAP = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی',  # Yeh
+    'ك': 'ک',  # Kaf
+    'ة': 'ه', 'ۀ': 'ه',  # Heh
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',  # Alef
+    'ؤ': 'و',  # Waw
+    '\u200c': ' ', '\u200d': '',  # ZWNJ / ZWJ
+    **{chr(0x06F0 + digit): str(digit) for digit in range(10)},
+    **{chr(0x0660 + digit): str(digit) for digit in range(10)},
+})
+_DIACRITICS = re.compile('[\u064b-\u065f\u0670\u0640]')  # harakat, superscript alef, tatweel
+_TOKEN = re.compile(r'\w+')
+
+DEFAULT_PRICE_BUCKETS = [0, 1000000, 5000000, 20000000, 50000000, 100000000]
+
+# Field weights, matching the setweight() labels of the tsvector
+WEIGHTS = {'A': 1.0, 'B': 0.4, 'C': 0.2, 'D': 0.1}
+
+
+def normalize_text(text):
+    """Normalize Persian/English text for indexing and querying"""
+    if not text:
+        return ''
+    text = unicodedata.normalize('NFKC', str(text)).translate(_CHARACTER_MAP)
+    text = _DIACRITICS.sub('', text).casefold()
+    return ' '.join(_TOKEN.findall(text))
+
+
+def tokenize(text):
+    return normalize_text(text).split()
+
+
+def build_search_fields(product):
+    """Normalized text per tsvector weight for one product"""
+    return {
+        'A': normalize_text(product.name),
+        'B': normalize_text(' '.join(filter(None, [
+            product.sku,
+            product.brand.name if product.brand_id else '',
+            product.category.name if product.category_id else '',
+        ]))),
+        'C': normalize_text(product.short_description),
+        'D': normalize_text(product.description),
+    }
+
+
+def build_search_document(product):
+    """Compact normalized text used for trigram matching"""
+    fields = build_search_fields(product)
+    return ' '.join(filter(None, [fields['A'], fields['B']]))
+
+
+def highlight_text(text, terms, max_words=None):
+    """Wrap words of ``text`` that start with any of ``terms`` in <mark>"""
+    if not text:
+        return ''
+    words = str(text).split()
+    marked, first_hit = [], None
+    for index, word in enumerate(words):
+        normalized = normalize_text(word)
+        if normalized and any(normalized.startswith(term) for term in terms):
+            marked.append(f'<mark>{html.escape(word)}</mark>')
+            if first_hit is None:
+                first_hit = index
+        else:
+            marked.append(html.escape(word))
+    if max_words and len(marked) > max_words:
+        start = max(0, (first_hit or 0) - max_words // 3)
+        marked = marked[start:start + max_words]
+    return ' '.join(marked)
+
+
+def price_ranges(buckets=None):
+    """``[(low, high)]`` for the configured price buckets; the last is open ended"""
+    bounds = buckets or getattr(settings, 'SEARCH_PRICE_BUCKETS', DEFAULT_PRICE_BUCKETS)
+    return [(low, high) for low, high in zip(bounds, bounds[1:] + [None])]
+
+
+def facet_queryset(queryset, ranges):
+    """Category, brand and price bucket counts of ``queryset`` in one ``UNION ALL`` query
+
+    Rows are ``{'facet', 'key', 'label', 'count'}``; a price row's key is its
+    index in ``ranges``.
+    """
+    queryset = queryset.order_by()
+    bucket = Case(
+        *[
+            When(Q(price__gte=low) if high is None else Q(price__gte=low, price__lt=high), then=Value(index))
+            for index, (low, high) in enumerate(ranges)
+        ],
+        default=None,
+        output_field=IntegerField(),
+    )
+    categories = queryset.values(
+        facet=Value('category'), key=F('category_id'), label=F('category__name')
+    ).annotate(count=Count('id'))
+    brands = queryset.exclude(brand=None).values(
+        facet=Value('brand'), key=F('brand_id'), label=F('brand__name')
+    ).annotate(count=Count('id'))
+    prices = queryset.values(
+        facet=Value('price'), key=bucket, label=Value('', output_field=CharField())
+    ).annotate(count=Count('id'))
+    return categories.union(brands, prices, all=True).order_by('-count')
+
+
+def build_facets(rows, ranges):
+    """The facets response section from ``facet_queryset`` rows"""
+    facets = {'categories': [], 'brands': []}
+    bucket_counts = {}
+    for row in rows:
+        if row['facet'] == 'category':
+            facets['categories'].append(
+                {'category_id': row['key'], 'category__name': row['label'], 'count': row['count']}
+            )
+        elif row['facet'] == 'brand':
+            facets['brands'].append({'brand_id': row['key'], 'brand__name': row['label'], 'count': row['count']})
+        elif row['key'] is not None:
+            bucket_counts[row['key']] = row['count']
+    facets['price'] = [
+        {'min': low, 'max': high, 'count': bucket_counts.get(index, 0)}
+        for index, (low, high) in enumerate(ranges)
+    ]
+    return facets
+
+
+def search_facets(queryset):
+    """Category, brand and price bucket counts for a result queryset, in one query"""
+    ranges = price_ranges()
+    return build_facets(facet_queryset(queryset, ranges), ranges)
+
+
+async def asearch_facets(queryset):
+    """``search_facets`` for async views"""
+    ranges = price_ranges()
+    return build_facets([row async for row in facet_queryset(queryset, ranges)], ranges)
+
+
+class SearchBackend:
+    """Interface shared by the search backends"""
+
+    def no_results(self, queryset):
+        return queryset.annotate(search_rank=Value(0.0, output_field=FloatField())).none()
+
+    def search(self, queryset, query):
+        """Filter ``queryset`` to matches of ``query`` annotated with ``search_rank``"""
+        raise NotImplementedError
+
+    def highlight(self, products, query):
+        """Return {product_id: {'name': ..., 'snippet': ...}} with <mark> tags"""
+        terms = tokenize(query)
+        return {
+            product.pk: {
+                'name': highlight_text(product.name, terms),
+                'snippet': highlight_text(product.short_description or product.description, terms, max_words=30),
+            }
+            for product in products
+        }
+
+    def refresh(self, products):
+        """Bring stored search data up to date for the given products
+
+        Products should have ``category`` and ``brand`` loaded.
+        """
+
+
+class PostgresSearchBackend(SearchBackend):
+    """tsvector ranking with pg_trgm similarity fallback"""
+
+    config = 'simple'
+    trigram_threshold = 0.3
+
+    @cached_property
+    def has_trigram(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            return cursor.fetchone() is not None
+
+    def build_query(self, query):
+        from django.contrib.postgres.search import SearchQuery
+
+        terms = tokenize(query)
+        if not terms:
+            return None
+        # Prefix match every term so partially typed words still hit
+        raw = ' & '.join(f"'{term}':*" for term in terms)
+        return SearchQuery(raw, config=self.config, search_type='raw')
+
+    def search(self, queryset, query):
+        from django.contrib.postgres.search import SearchRank, TrigramSimilarity
+
+        search_query = self.build_query(query)
+        if search_query is None:
+            return self.no_results(queryset)
+
+        rank = SearchRank(F('search_vector'), search_query)
+        condition = Q(search_vector=search_query)
+        if self.has_trigram:
+            normalized = normalize_text(query)
+            queryset = queryset.annotate(similarity=TrigramSimilarity('search_document', normalized))
+            condition |= Q(search_document__trigram_similar=normalized)
+            rank = rank + F('similarity') * self.trigram_threshold
+        return queryset.annotate(search_rank=rank).filter(condition)
+
+    def highlight(self, products, query):
+        from django.contrib.postgres.search import SearchHeadline
+
+        search_query = self.build_query(query)
+        if search_query is None or not products:
+            return {}
+        model = type(products[0])
+        headline_options = {
+            'config': self.config,
+            'start_sel': '<mark>',
+            'stop_sel': '</mark>',
+        }
+        rows = model.objects.filter(pk__in=[product.pk for product in products]).annotate(
+            name_headline=SearchHeadline('name', search_query, highlight_all=True, **headline_options),
+            snippet_headline=SearchHeadline(
+                'short_description', search_query, max_words=30, min_words=10, **headline_options
+            ),
+        ).values_list('pk', 'name_headline', 'snippet_headline')
+        highlights = super().highlight(products, query)
+        for pk, name, snippet in rows:
+            # ts_headline misses Persian spelling variants; keep the Python marks then
+            if '<mark>' in (name or ''):
+                highlights[pk]['name'] = name
+            if '<mark>' in (snippet or ''):
+                highlights[pk]['snippet'] = snippet
+        return highlights
+
+    def refresh(self, products):
+        from django.contrib.postgres.search import SearchVector
+        from .models import Product
+
+        for product in products:
+            fields = build_search_fields(product)
+            vector = None
+            for weight, text in fields.items():
+                part = SearchVector(Value(text), config=self.config, weight=weight)
+                vector = part if vector is None else vector + part
+            Product.objects.filter(pk=product.pk).update(
+                search_vector=vector,
+                search_document=build_search_document(product),
+            )
+
+
+class InMemoryIndex:
+    """Inverted index of token -> {product_id: weighted term frequency}"""
+
+    def __init__(self, documents):
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        for product_id, fields in documents:
+            length = 0
+            for weight, text in fields.items():
+                for token in text.split():
+                    postings = self.postings[token]
+                    postings[product_id] = postings.get(product_id, 0) + WEIGHTS[weight]
+                    length += 1
+            self.lengths[product_id] = length or 1
+        self.vocabulary = sorted(self.postings)
+        self.size = len(self.lengths)
+
+    def expand(self, term):
+        """Tokens matching ``term`` as a prefix, or close spellings of it"""
+        start = bisect.bisect_left(self.vocabulary, term)
+        matches = []
+        for token in self.vocabulary[start:]:
+            if not token.startswith(term):
+                break
+            matches.append(token)
+        if not matches and len(term) > 2:
+            matches = difflib.get_close_matches(term, self.vocabulary, n=3, cutoff=0.75)
+        return matches
+
+    def search(self, terms, limit=None):
+        """Return [(product_id, score)] for documents matching every term"""
+        scores = None
+        for term in terms:
+            term_scores = defaultdict(float)
+            for token in self.expand(term):
+                postings = self.postings[token]
+                idf = math.log(1 + self.size / len(postings))
+                # Exact tokens outrank prefix/fuzzy expansions
+                boost = 1.0 if token == term else 0.5
+                for product_id, frequency in postings.items():
+                    term_scores[product_id] += boost * idf * frequency / math.sqrt(self.lengths[product_id])
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {
+                    product_id: score + term_scores[product_id]
+                    for product_id, score in scores.items() if product_id in term_scores
+                }
+            if not scores:
+                return []
+        ranked = sorted((scores or {}).items(), key=lambda item: (-item[1], item[0]))
+        return ranked[:limit] if limit else ranked
+
+
+class InMemorySearchBackend(SearchBackend):
+    """Pure-Python fallback for databases without full-text search"""
+
+    max_results = 1000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index = None
+        self._version = None
+
+    def get_index(self):
+        from .models import Product
+
+        # Rebuild only when the catalog changed since the last build
+        version = Product.objects.aggregate(count=Count('id'), updated=Max('updated_at'))
+        version = (version['count'], version['updated'])
+        with self._lock:
+            if self._index is None or self._version != version:
+                products = Product.objects.select_related('category', 'brand').only(
+                    'name', 'sku', 'short_description', 'description', 'category__name', 'brand__name'
+                )
+                self._index = InMemoryIndex(
+                    (product.pk, build_search_fields(product)) for product in products.iterator()
+                )
+                self._version = version
+            return self._index
+
+    def search(self, queryset, query):
+        terms = tokenize(query)
+        if not terms:
+            return self.no_results(queryset)
+        ranked = self.get_index().search(terms, limit=self.max_results)
+        if not ranked:
+            return self.no_results(queryset)
+        return queryset.filter(pk__in=[product_id for product_id, _score in ranked]).annotate(
+            search_rank=Case(
+                *[When(pk=product_id, then=Value(score)) for product_id, score in ranked],
+                default=Value(0.0),
+                output_field=FloatField(),
+            )
+        )
+
+    def refresh(self, products):
+        from .models import Product
+
+        for product in products:
+            Product.objects.filter(pk=product.pk).update(search_document=build_search_document(product))
+        with self._lock:
+            self._index = None
+
+
+_backends = {}
+
+
+def get_search_backend():
+    """Search backend for the default database"""
+    vendor = connection.vendor
+    if vendor not in _backends:
+        if vendor == 'postgresql':
+            _backends[vendor] = PostgresSearchBackend()
+        else:
+            _backends[vendor] = InMemorySearchBackend()
+    return _backends[vendor]
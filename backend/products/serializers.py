@@ -1,5 +1,5 @@
 from rest_framework import serializers
-from django.db.models import Avg
+from shop_backend.compiled_serializers import CompiledListSerializer
 from .models import Category, Brand, Product, Review, ProductVariant
 
 
@@ -12,16 +12,20 @@ class CategorySerializer(serializers.ModelSerializer):
         model = Category
         fields = [
             'id', 'name', 'description', 'image', 'parent',
-            'order', 'is_active', 'product_count', 'subcategories',
+            'display_order', 'is_active', 'product_count', 'subcategories',
             'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
 
     def get_product_count(self, obj):
+        # Annotated by CategoryViewSet.get_queryset to avoid a COUNT per row
+        if hasattr(obj, 'product_count'):
+            return obj.product_count
         return obj.products.count()
 
     def get_subcategories(self, obj):
-        if obj.parent is None:
+        # parent_id: listing child categories must not load their parents
+        if obj.parent_id is None:
             return CategorySerializer(obj.children.all(), many=True).data
         return []
 
@@ -39,6 +43,9 @@ class BrandSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at', 'updated_at']
 
     def get_product_count(self, obj):
+        # Annotated by BrandViewSet.get_queryset to avoid a COUNT per row
+        if hasattr(obj, 'product_count'):
+            return obj.product_count
         return obj.products.count()
 
 
@@ -47,8 +54,10 @@ class ProductImageSerializer(serializers.Serializer):
     id = serializers.IntegerField()
     image = serializers.ImageField()
     alt_text = serializers.CharField()
-    is_primary = serializers.BooleanField()
-    order = serializers.IntegerField()
+    order = serializers.IntegerField(source='display_order')
+
+    class Meta:
+        list_serializer_class = CompiledListSerializer
 
 
 class ProductListSerializer(serializers.ModelSerializer):
@@ -56,31 +65,33 @@ class ProductListSerializer(serializers.ModelSerializer):
     category_name = serializers.CharField(source='category.name', read_only=True)
     brand_name = serializers.CharField(source='brand.name', read_only=True)
     primary_image = serializers.SerializerMethodField()
-    review_count = serializers.SerializerMethodField()
-    average_rating = serializers.SerializerMethodField()
+    review_count = serializers.IntegerField(source='rating_count', read_only=True)
+    average_rating = serializers.DecimalField(
+        source='rating_avg',
+        max_digits=3,
+        decimal_places=2,
+        read_only=True
+    )
 
     class Meta:
         model = Product
         fields = [
-            'id', 'name', 'sku', 'price', 'sale_price', 'currency',
+            'id', 'name', 'sku', 'price', 'compare_price',
             'stock_quantity', 'is_in_stock', 'category_name', 'brand_name',
-            'primary_image', 'rating', 'review_count', 'average_rating',
+            'primary_image', 'review_count', 'average_rating',
             'is_featured', 'is_active', 'created_at'
         ]
+        list_serializer_class = CompiledListSerializer
 
     def get_primary_image(self, obj):
-        primary_image = obj.images.filter(is_primary=True).first()
-        if primary_image:
-            return ProductImageSerializer(primary_image).data
-        return None
-
-    def get_review_count(self, obj):
-        return obj.reviews.filter(is_approved=True).count()
-
-    def get_average_rating(self, obj):
-        return obj.reviews.filter(is_approved=True).aggregate(
-            Avg('rating')
-        )['rating__avg'] or 0
+        # The first image by display order, from the prefetched images
+        primary_image = obj.primary_image
+        if primary_image is None:
+            return None
+        if not hasattr(self, '_image_serializer'):
+            # Bound once per list instead of once per row
+            self._image_serializer = ProductImageSerializer(many=True)
+        return self._image_serializer.to_representation([primary_image])[0]
 
 
 class ProductSerializer(serializers.ModelSerializer):
@@ -90,18 +101,24 @@ class ProductSerializer(serializers.ModelSerializer):
     images = ProductImageSerializer(many=True, read_only=True)
     variants = serializers.SerializerMethodField()
     reviews = serializers.SerializerMethodField()
-    review_count = serializers.SerializerMethodField()
-    average_rating = serializers.SerializerMethodField()
+    review_count = serializers.IntegerField(source='rating_count', read_only=True)
+    average_rating = serializers.DecimalField(
+        source='rating_avg',
+        max_digits=3,
+        decimal_places=2,
+        read_only=True
+    )
+    rating_histogram = serializers.DictField(child=serializers.IntegerField(), read_only=True)
 
     class Meta:
         model = Product
         fields = [
-            'id', 'name', 'description', 'sku', 'price', 'sale_price',
-            'currency', 'stock_quantity', 'low_stock_threshold',
-            'is_in_stock', 'is_featured', 'is_active', 'weight',
+            'id', 'name', 'slug', 'short_description', 'description', 'sku',
+            'price', 'compare_price', 'stock_quantity', 'low_stock_threshold',
+            'is_in_stock', 'is_featured', 'is_active', 'is_digital', 'weight',
             'dimensions', 'category', 'brand', 'images', 'variants',
-            'reviews', 'review_count', 'average_rating', 'tags',
-            'seo_title', 'seo_description', 'created_at', 'updated_at'
+            'reviews', 'review_count', 'average_rating', 'rating_histogram',
+            'meta_title', 'meta_description', 'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
 
@@ -109,15 +126,7 @@ class ProductSerializer(serializers.ModelSerializer):
         return VariantSerializer(obj.variants.all(), many=True).data
 
     def get_reviews(self, obj):
-        return ReviewSerializer(obj.reviews.filter(is_approved=True), many=True).data
-
-    def get_review_count(self, obj):
-        return obj.reviews.filter(is_approved=True).count()
-
-    def get_average_rating(self, obj):
-        return obj.reviews.filter(is_approved=True).aggregate(
-            Avg('rating')
-        )['rating__avg'] or 0
+        return ReviewSerializer(obj.reviews.filter(is_active=True).select_related('user', 'product'), many=True).data
 
 
 class ReviewSerializer(serializers.ModelSerializer):
@@ -129,22 +138,23 @@ class ReviewSerializer(serializers.ModelSerializer):
         model = Review
         fields = [
             'id', 'user', 'user_name', 'product', 'product_name',
-            'rating', 'title', 'comment', 'is_approved', 'is_featured',
+            'rating', 'title', 'comment', 'is_active', 'is_featured',
             'helpful_votes', 'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'user', 'created_at', 'updated_at']
+        list_serializer_class = CompiledListSerializer
 
 
 class VariantSerializer(serializers.ModelSerializer):
     """Product variant serializer"""
     product_name = serializers.CharField(source='product.name', read_only=True)
+    final_price = serializers.DecimalField(max_digits=12, decimal_places=2, read_only=True)
 
     class Meta:
         model = ProductVariant
         fields = [
             'id', 'product', 'product_name', 'sku', 'name',
-            'size', 'color', 'material', 'price', 'sale_price',
-            'stock_quantity', 'low_stock_threshold', 'is_active',
-            'weight', 'dimensions', 'created_at', 'updated_at'
+            'price', 'compare_price', 'final_price', 'stock_quantity',
+            'is_in_stock', 'image', 'is_active', 'created_at', 'updated_at'
         ]
         read_only_fields = ['id', 'created_at', 'updated_at']
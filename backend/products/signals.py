@@ -1,22 +1,100 @@
-from django.db.models.signals import post_save, pre_save
+from django.core.signals import request_finished
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import Product, Review
+from .cache import invalidate_on_commit
+from .models import Brand, Category, CategoryClosure, Product, ProductImage, ProductVariant, Review
+from .search import get_search_backend
+from .tracking import flush_views_if_due
+
+# Cache family whose entries depend on each model
+CACHE_FAMILIES = {
+    Product: 'product',
+    ProductVariant: 'product',
+    ProductImage: 'product',
+    Review: 'product',
+    Category: 'category',
+    Brand: 'brand',
+}
+
+
+@receiver(post_save, sender=Category)
+def maintain_category_closure(sender, instance, created, raw=False, **kwargs):
+    """Keep the category closure table in sync with Category.parent"""
+    if raw:
+        return
+    if created:
+        CategoryClosure.insert_node(instance)
+    elif instance.parent_changed:
+        CategoryClosure.move_subtree(instance)
+    instance._loaded_parent_id = instance.parent_id
 
 
 @receiver(post_save, sender=Review)
-def update_product_rating(sender, instance, **kwargs):
-    """Update product rating when review is saved"""
-    if instance.is_approved:
+def update_product_rating(sender, instance, created, **kwargs):
+    """Apply the review's rating change to the product aggregates"""
+    previous = None if created else instance.rating_state
+    current = (instance.product_id, instance.rating, instance.is_active)
+
+    if previous is None and not created:
+        # Unknown prior state (e.g. deferred fields), recompute from scratch
         instance.product.update_rating()
+    elif previous != current:
+        old_product_id, old_rating, old_active = previous or (None, None, False)
+        removed = old_rating if old_active else None
+        added = instance.rating if instance.is_active else None
+        if old_product_id == instance.product_id:
+            Product.apply_rating_delta(instance.product_id, added=added, removed=removed)
+        else:
+            if removed is not None:
+                Product.apply_rating_delta(old_product_id, removed=removed)
+            if added is not None:
+                Product.apply_rating_delta(instance.product_id, added=added)
 
+    instance.remember_rating_state()
 
-@receiver(pre_save, sender=Product)
-def generate_sku(sender, instance, **kwargs):
-    """Generate SKU if not provided"""
-    if not instance.sku:
-        # Generate SKU based on category and product ID
-        if instance.category:
-            prefix = instance.category.name[:3].upper()
-        else:
-            prefix = 'PRD'
-        instance.sku = f"{prefix}-{instance.id or 'NEW'}"
+
+@receiver(post_delete, sender=Review)
+def remove_product_rating(sender, instance, **kwargs):
+    """Remove a deleted review from the product aggregates"""
+    product_id, rating, is_active = instance.rating_state or (
+        instance.product_id, instance.rating, instance.is_active
+    )
+    if is_active:
+        Product.apply_rating_delta(product_id, removed=rating)
+
+
+@receiver(post_save, sender=Product)
+def update_product_search(sender, instance, raw=False, **kwargs):
+    """Refresh the product's search document and vector"""
+    if not raw:
+        get_search_backend().refresh([instance])
+
+
+@receiver(post_save, sender=Brand)
+@receiver(post_save, sender=Category)
+def update_related_product_search(sender, instance, created, raw=False, **kwargs):
+    """Re-index products whose brand or category was renamed"""
+    if created or raw or instance.name == getattr(instance, '_loaded_name', instance.name):
+        return
+    products = instance.products.select_related('category', 'brand')
+    get_search_backend().refresh(products.iterator())
+    instance._loaded_name = instance.name
+
+
+def invalidate_catalog_cache(sender, raw=False, **kwargs):
+    """Bump the catalog cache version of the changed model's family"""
+    if not raw:
+        invalidate_on_commit(CACHE_FAMILIES[sender])
+
+
+# Connected per sender: a sender-less delete receiver would disable fast
+# (single statement) queryset deletes for every model
+for _model in CACHE_FAMILIES:
+    post_save.connect(invalidate_catalog_cache, sender=_model, dispatch_uid=f'catalog_cache_save_{_model.__name__}')
+    post_delete.connect(invalidate_catalog_cache, sender=_model, dispatch_uid=f'catalog_cache_delete_{_model.__name__}')
+
+
+@receiver(request_finished, dispatch_uid='products.flush_view_counts')
+def flush_view_counts(sender, **kwargs):
+    """Write buffered product views once the response is out, if a flush is due"""
+    flush_views_if_due()
@@ -1,3 +1,626 @@
-from django.test import TestCase
+from datetime import timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from unittest import mock, skipUnless
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.exceptions import ParseError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+from shop_backend.pagination import KeysetPagination
+from shop_backend.query_budget import QueryBudgetTestMixin
+
+from . import tracking
+from .cache import FAMILIES, bump_version, get_cache, get_or_compute, get_versions
+from .models import (
+    Brand, CatalogVersion, Category, CategoryClosure, Product, ProductImage, ProductVariant, ProductViewStat,
+    Review, ViewFlushBatch,
+)
+from .ranking import rebuild_rankings
+from .search import InMemorySearchBackend, PostgresSearchBackend, search_facets
+from .serializers import ProductListSerializer, ReviewSerializer
+
+User = get_user_model()
+
+
+class CatalogTestCase(APITestCase):
+    """A small catalog; the catalog cache is emptied for every test"""
+
+    def setUp(self):
+        get_cache().clear()
+        self.category = Category.objects.create(name='Books', slug='books')
+        self.brand = Brand.objects.create(name='Press', slug='press')
+        self.product = self.create_product('Book', category=self.category, brand=self.brand)
+        ProductImage.objects.create(product=self.product, image='products/back.jpg', display_order=2)
+        ProductImage.objects.create(product=self.product, image='products/front.jpg', display_order=1)
+
+    def create_product(self, name, **fields):
+        fields.setdefault('category', self.category)
+        fields.setdefault('price', Decimal('20.00'))
+        fields.setdefault('stock_quantity', 10)
+        return Product.objects.create(
+            name=name, slug=name.lower().replace(' ', '-'), sku=name.upper().replace(' ', '-'), **fields
+        )
+
+
+class ProductDetailTests(CatalogTestCase):
+    def test_detail(self):
+        ProductVariant.objects.create(product=self.product, name='Hardcover', sku='BOOK-HC', price=Decimal('30.00'))
+
+        response = self.client.get(reverse('products:product-detail', args=[self.product.pk]))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['slug'], 'book')
+        self.assertEqual(response.data['category']['name'], 'Books')
+        self.assertEqual(response.data['brand']['name'], 'Press')
+        self.assertEqual([image['order'] for image in response.data['images']], [1, 2])
+        self.assertEqual(response.data['variants'][0]['final_price'], '30.00')
+
+
+class SearchTestCase(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other_brand = Brand.objects.create(name='Atlas', slug='atlas')
+        self.create_product('Book Stand', brand=self.other_brand, price=Decimal('3000000.00'))
+        self.create_product('Lamp', category=Category.objects.create(name='Lighting', slug='lighting'))
+
+    def search(self, query):
+        return self.client.get(reverse('products:product-search'), {'q': query})
+
+
+class SearchViewTests(SearchTestCase):
+    def test_ranked_results_with_facets(self):
+        response = self.search('book')
+
+        self.assertEqual(response.status_code, 200)
+        highlights = {product['name']: product['highlight']['name'] for product in response.data['results']}
+        self.assertEqual(highlights, {'Book': '<mark>Book</mark>', 'Book Stand': '<mark>Book</mark> Stand'})
+        facets = response.data['facets']
+        self.assertEqual(
+            facets['categories'], [{'category_id': self.category.pk, 'category__name': 'Books', 'count': 2}]
+        )
+        self.assertEqual(
+            sorted((brand['brand__name'], brand['count']) for brand in facets['brands']), [('Atlas', 1), ('Press', 1)]
+        )
+        self.assertEqual([bucket['count'] for bucket in facets['price']], [1, 1, 0, 0, 0, 0])
+
+    def test_facets_take_one_query(self):
+        with self.assertNumQueries(1):
+            facets = search_facets(Product.objects.filter(is_active=True))
+
+        self.assertEqual([(category['category__name'], category['count']) for category in facets['categories']], [
+            ('Books', 2), ('Lighting', 1)
+        ])
+        self.assertEqual(len(facets['brands']), 2)
+        self.assertEqual(sum(bucket['count'] for bucket in facets['price']), 3)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'full-text search needs PostgreSQL')
+class PostgresSearchTests(SearchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = PostgresSearchBackend()
+
+    def names(self, query):
+        return [product.name for product in self.backend.search(Product.objects.all(), query).order_by('-search_rank')]
+
+    def test_prefix_match(self):
+        self.assertEqual(set(self.names('boo')), {'Book', 'Book Stand'})
+
+    def test_typo_falls_back_to_trigrams(self):
+        if not self.backend.has_trigram:
+            self.skipTest('pg_trgm is not installed')
+        self.assertEqual(self.names('lampp'), ['Lamp'])
+
+
+@skipUnless(connection.vendor == 'sqlite', 'the in-memory backend is the SQLite fallback')
+class InMemorySearchTests(SearchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.backend = InMemorySearchBackend()
+
+    def names(self, query):
+        return [product.name for product in self.backend.search(Product.objects.all(), query).order_by('-search_rank')]
+
+    def test_exact_match_outranks_prefix(self):
+        self.assertEqual(self.names('book'), ['Book', 'Book Stand'])
+
+    def test_typo(self):
+        self.assertEqual(self.names('lampp'), ['Lamp'])
+
+    def test_index_follows_catalog_changes(self):
+        self.assertEqual(self.names('desk'), [])
+        self.create_product('Desk')
+
+        self.assertEqual(self.names('desk'), ['Desk'])
+
+
+class ConditionalGetTests(CatalogTestCase):
+    def test_list_deletion_is_not_hidden_by_if_modified_since(self):
+        older = self.create_product('Older')
+        url = reverse('products:product-list')
+        first = self.client.get(url)
+        self.assertNotIn('Last-Modified', first)
+        older.delete()
+
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], first['ETag'])
+
+    def test_image_change_moves_the_etag(self):
+        url = reverse('products:product-detail', args=[self.product.pk])
+        etag = self.client.get(url)['ETag']
+        image = self.product.images.get(display_order=2)
+        image.alt_text = 'Back cover'
+        image.save()
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['images'][1]['alt_text'], 'Back cover')
+
+
+class KeysetPaginationTests(CatalogTestCase):
+    def paginate(self, queryset):
+        request = Request(APIRequestFactory().get(reverse('products:product-list')))
+        return KeysetPagination().paginate_queryset(queryset, request)
+
+    def test_pages_in_ordering(self):
+        self.create_product('Atlas')
+
+        rows = self.paginate(Product.objects.order_by('name'))
+
+        self.assertEqual([product.name for product in rows], ['Atlas', 'Book'])
+
+    def test_ordering_through_a_relation_is_rejected(self):
+        with self.assertRaises(ParseError):
+            self.paginate(Product.objects.order_by('category__name'))
+
+
+class PopularProductsTests(CatalogTestCase):
+    def test_invalid_category(self):
+        response = self.client.get(reverse('products:product-popular') + '?category=abc')
+
+        self.assertEqual(response.status_code, 400)
+
+
+class ProductFilterTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.child = Category.objects.create(name='Novels', slug='novels', parent=self.category)
+        self.grandchild = Category.objects.create(name='Classics', slug='classics', parent=self.child)
+        self.create_product('Classic', category=self.grandchild, price=Decimal('8.00'))
+        self.create_product('Lamp', category=Category.objects.create(name='Lighting', slug='lighting'))
+
+    def test_category_tree_and_price(self):
+        for name in ('products:product-list', 'products:async-product-list'):
+            with self.subTest(name):
+                response = self.client.get(reverse(name), {'category_tree': self.category.pk, 'max_price': '10'})
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual([product['name'] for product in response.json()['results']], ['Classic'])
+
+    def test_malformed_filters(self):
+        for params in ({'category_tree': 'abc'}, {'min_price': 'abc'}, {'max_price': 'NaN'}, {'category': 'x'}):
+            for name in ('products:product-list', 'products:async-product-list'):
+                with self.subTest(name, **params):
+                    response = self.client.get(reverse(name), params)
+
+                    self.assertEqual(response.status_code, 400)
+
+
+class CategoryClosureTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.child = Category.objects.create(name='Novels', slug='novels', parent=self.category)
+        self.grandchild = Category.objects.create(name='Classics', slug='classics', parent=self.child)
+
+    def links(self, category):
+        return set(CategoryClosure.objects.filter(descendant=category).values_list('ancestor__slug', 'depth'))
+
+    def test_insert_adds_a_row_per_ancestor(self):
+        self.assertEqual(self.links(self.grandchild), {('classics', 0), ('novels', 1), ('books', 2)})
+        self.assertEqual(
+            list(self.category.get_descendants().order_by('name')), [self.grandchild, self.child]
+        )
+
+    def test_move_rebuilds_the_subtree(self):
+        other = Category.objects.create(name='Fiction', slug='fiction')
+
+        self.child.parent = other
+        self.child.save()
+
+        self.assertEqual(self.links(self.child), {('novels', 0), ('fiction', 1)})
+        self.assertEqual(self.links(self.grandchild), {('classics', 0), ('novels', 1), ('fiction', 2)})
+        self.assertFalse(self.category.get_descendants().exists())
+
+    def test_move_under_own_subtree_is_rejected(self):
+        self.category.parent = self.grandchild
+
+        with self.assertRaises(ValidationError):
+            self.category.save()
+
+        self.assertEqual(self.links(self.category), {('books', 0)})
+
+
+class RatingAggregateTests(CatalogTestCase):
+    """Review saves and deletes shift the product's rating columns in place"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.readers = [User.objects.create_user(email=f'reader{n}@example.com', password=None) for n in range(3)]
+
+    def review(self, reader, rating, product=None, **fields):
+        return Review.objects.create(
+            product=product or self.product, user=self.readers[reader], rating=rating, title='Review', comment='',
+            **fields
+        )
+
+    def aggregates(self, product=None):
+        product = Product.objects.get(pk=(product or self.product).pk)
+        return product.rating_count, product.rating_avg, product.rating_histogram
+
+    def assertRecomputable(self, product=None):
+        """The incremental columns match a recount of the active reviews"""
+        product = product or self.product
+        incremental = self.aggregates(product)
+        Product.objects.get(pk=product.pk).update_rating()
+        self.assertEqual(incremental, self.aggregates(product))
+
+    def test_create(self):
+        self.review(0, 5)
+        self.review(1, 4)
+        self.review(2, 1, is_active=False)
+
+        self.assertEqual(self.aggregates(), (2, Decimal('4.50'), {1: 0, 2: 0, 3: 0, 4: 1, 5: 1}))
+        self.assertRecomputable()
+
+    def test_update_moves_the_rating_between_buckets(self):
+        review = self.review(0, 5)
+        self.review(1, 4)
+
+        review.rating = 2
+        review.save()
+
+        self.assertEqual(self.aggregates(), (2, Decimal('3.00'), {1: 0, 2: 1, 3: 0, 4: 1, 5: 0}))
+        self.assertRecomputable()
+
+    def test_deactivating_and_reactivating(self):
+        review = self.review(0, 5)
+        self.review(1, 3)
+
+        review.is_active = False
+        review.save()
+        self.assertEqual(self.aggregates()[:2], (1, Decimal('3.00')))
+
+        review.is_active = True
+        review.save()
+        self.assertEqual(self.aggregates()[:2], (2, Decimal('4.00')))
+        self.assertRecomputable()
+
+    def test_unrelated_save_leaves_the_aggregates_alone(self):
+        review = self.review(0, 5)
+
+        review.helpful_votes = 3
+        with self.assertNumQueries(1):
+            review.save(update_fields=['helpful_votes'])
+
+        self.assertEqual(self.aggregates()[:2], (1, Decimal('5.00')))
+
+    def test_moving_a_review_to_another_product(self):
+        other = self.create_product('Pamphlet')
+        review = self.review(0, 2)
+        self.review(1, 4)
+
+        review.product = other
+        review.save()
+
+        self.assertEqual(self.aggregates()[:2], (1, Decimal('4.00')))
+        self.assertEqual(self.aggregates(other)[:2], (1, Decimal('2.00')))
+        self.assertRecomputable()
+        self.assertRecomputable(other)
+
+    def test_delete(self):
+        review = self.review(0, 5)
+        self.review(1, 2)
+        self.review(2, 1, is_active=False).delete()
+
+        review.delete()
+
+        self.assertEqual(self.aggregates(), (1, Decimal('2.00'), {1: 0, 2: 1, 3: 0, 4: 0, 5: 0}))
+        Review.objects.all().delete()
+        self.assertEqual(self.aggregates()[:2], (0, Decimal('0.00')))
+
+    def test_deferred_rating_falls_back_to_a_recount(self):
+        self.review(0, 5)
+        review = Review.objects.only('id', 'title').get(user=self.readers[0])
+
+        Review.objects.filter(pk=review.pk).update(rating=1)
+        review.title = 'Changed'
+        review.save()
+
+        self.assertEqual(self.aggregates()[:2], (1, Decimal('1.00')))
+
+
+class ViewCountBufferTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = self.create_product('Pamphlet')
+        self.buffer = tracking.ViewCountBuffer(flush_interval=3600, max_pending=5)
+        self.hour = tracking.truncate_hour(timezone.now())
+
+    def view_counts(self):
+        return dict(Product.objects.filter(pk__in=[self.product.pk, self.other.pk]).values_list('pk', 'view_count'))
+
+    def hourly(self):
+        return set(ProductViewStat.objects.values_list('product_id', 'hour', 'views'))
+
+    def test_flush_writes_totals_and_hourly_counts(self):
+        earlier = self.hour - timedelta(hours=1)
+        self.buffer.record(self.product.pk, when=earlier)
+        self.buffer.record(self.product.pk, views=2)
+        self.buffer.record(self.other.pk)
+
+        self.assertEqual(self.buffer.flush(), 4)
+
+        self.assertEqual(self.view_counts(), {self.product.pk: 3, self.other.pk: 1})
+        self.assertEqual(self.hourly(), {
+            (self.product.pk, earlier, 1), (self.product.pk, self.hour, 2), (self.other.pk, self.hour, 1)
+        })
+        self.assertEqual(self.buffer.pending, 0)
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_later_flushes_add_to_the_hour(self):
+        self.buffer.record(self.product.pk)
+        self.buffer.flush()
+        self.buffer.record(self.product.pk, views=2)
+
+        self.buffer.flush()
+
+        self.assertEqual(self.hourly(), {(self.product.pk, self.hour, 3)})
+        self.assertEqual(ViewFlushBatch.objects.count(), 2)
+
+    def test_due_after_max_pending_or_interval(self):
+        self.assertFalse(self.buffer.due)
+        self.buffer.record(self.product.pk, views=4)
+        self.assertFalse(self.buffer.due)
+
+        self.buffer.record(self.product.pk)
+        self.assertTrue(self.buffer.due)
+
+        self.buffer.flush()
+        self.buffer.record(self.product.pk)
+        with mock.patch.object(tracking.time, 'monotonic', return_value=tracking.time.monotonic() + 3600):
+            self.assertTrue(self.buffer.due)
+
+    def test_failed_flush_is_retried_under_the_same_batch(self):
+        self.buffer.record(self.product.pk, views=2)
+
+        with mock.patch.object(tracking, '_upsert_hourly', side_effect=OSError('connection lost')):
+            with self.assertLogs('products.tracking', 'ERROR'):
+                self.assertEqual(self.buffer.flush(), 0)
+
+        self.assertEqual(self.view_counts()[self.product.pk], 0)
+        self.assertEqual(self.buffer.pending, 2)
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(self.view_counts()[self.product.pk], 2)
+
+    def test_retry_after_a_commit_that_went_through_is_a_no_op(self):
+        self.buffer.record(self.product.pk, views=2)
+        apply_view_counts = tracking.apply_view_counts
+
+        def commit_then_time_out(batch_id, counts):
+            apply_view_counts(batch_id, counts)
+            raise OSError('timed out')
+
+        with mock.patch.object(tracking, 'apply_view_counts', side_effect=commit_then_time_out):
+            with self.assertLogs('products.tracking', 'ERROR'):
+                self.buffer.flush()
+
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(self.buffer.pending, 0)
+        self.assertEqual(self.view_counts()[self.product.pk], 2)
+        self.assertEqual(self.hourly(), {(self.product.pk, self.hour, 2)})
+
+    def test_views_of_deleted_products_are_dropped(self):
+        self.buffer.record(self.product.pk)
+        self.buffer.record(self.other.pk)
+        self.other.delete()
+
+        self.buffer.flush()
+
+        self.assertEqual(self.hourly(), {(self.product.pk, self.hour, 1)})
+
+    def test_detail_views_are_buffered(self):
+        with mock.patch.object(tracking, 'view_buffer', self.buffer):
+            for _ in range(4):
+                self.client.get(reverse('products:product-detail', args=[self.product.pk]))
+            self.assertEqual(self.view_counts()[self.product.pk], 0)
+
+            # The fifth view makes a flush due once its response is out
+            self.client.get(reverse('products:product-detail', args=[self.product.pk]))
+
+        self.assertEqual(self.view_counts()[self.product.pk], 5)
+
+    def test_hourly_views_fills_empty_hours(self):
+        self.buffer.record(self.product.pk, views=3, when=self.hour - timedelta(hours=2))
+        self.buffer.flush()
+
+        series = tracking.hourly_views(self.product.pk, since=self.hour - timedelta(hours=3), until=self.hour)
+
+        self.assertEqual([views for _hour, views in series], [0, 3, 0, 0])
+        self.assertEqual(
+            tracking.hourly_views(self.product.pk, fill=False), [(self.hour - timedelta(hours=2), 3)]
+        )
+
+
+class AsyncParityTests(CatalogTestCase):
+    """The async catalog views answer with the same bytes as the sync ones"""
+
+    def setUp(self):
+        super().setUp()
+        child = Category.objects.create(name='Novels', slug='novels', parent=self.category)
+        self.create_product('Novel', category=child, is_featured=True)
+        ProductVariant.objects.create(product=self.product, name='Hardcover', sku='BOOK-HC', price=Decimal('30.00'))
+
+    def assertSameResponse(self, sync_url, async_url):
+        get_cache().clear()
+        sync_response = self.client.get(sync_url)
+        get_cache().clear()
+        async_response = self.client.get(async_url)
+        self.assertEqual(sync_response.status_code, 200)
+        self.assertEqual(async_response.status_code, 200)
+        self.assertEqual(async_response.content, sync_response.content)
+
+    def test_product_list(self):
+        self.assertSameResponse(reverse('products:product-list'), reverse('products:async-product-list'))
+
+    def test_product_detail(self):
+        self.assertSameResponse(
+            reverse('products:product-detail', args=[self.product.pk]),
+            reverse('products:async-product-detail', args=[self.product.pk]),
+        )
+
+    def test_featured(self):
+        self.assertSameResponse(reverse('products:product-featured'), reverse('products:async-product-featured'))
+
+    def test_search(self):
+        self.assertSameResponse(
+            reverse('products:product-search') + '?q=book', reverse('products:async-product-search') + '?q=book'
+        )
+
+    def test_category_list(self):
+        self.assertSameResponse(reverse('products:category-list'), reverse('products:async-category-list'))
+
+    def test_brand_list(self):
+        self.assertSameResponse(reverse('products:brand-list'), reverse('products:async-brand-list'))
+
+    def test_filtered_lists(self):
+        Brand.objects.create(name='Zeta', slug='zeta')
+        for name, query in (('brand', '?search=zeta&ordering=-name'), ('category', '?search=nov')):
+            with self.subTest(name):
+                self.assertSameResponse(
+                    reverse(f'products:{name}-list') + query, reverse(f'products:async-{name}-list') + query
+                )
+
+    def test_search_shares_the_cache_entry(self):
+        Brand.objects.create(name='Zeta', slug='zeta')
+        self.client.get(reverse('products:async-brand-list') + '?search=Zeta')
+
+        response = self.client.get(reverse('products:brand-list') + '?search=Zeta')
+
+        self.assertEqual([brand['name'] for brand in response.data['results']], ['Zeta'])
+
+
+class QueryBudgetTests(QueryBudgetTestMixin, CatalogTestCase):
+    """Catalog endpoints stay within settings.QUERY_BUDGETS as rows grow"""
+
+    def setUp(self):
+        super().setUp()
+        for number in range(6):
+            shelf = Category.objects.create(name=f'Shelf {number}', slug=f'shelf-{number}', parent=self.category)
+            Brand.objects.create(name=f'Imprint {number}', slug=f'imprint-{number}')
+            product = self.create_product(f'Title {number}', category=shelf, brand=self.brand, is_featured=True)
+            ProductImage.objects.create(product=product, image='products/cover.jpg')
+        # Steady state: the family versions exist (their first lookup creates them)
+        get_versions(FAMILIES)
+
+    def test_category_list(self):
+        self.client.get(reverse('products:category-list'))
+
+    def test_brand_list(self):
+        response = self.client.get(reverse('products:brand-list'))
+
+        counts = {brand['name']: brand['product_count'] for brand in response.data['results']}
+        self.assertEqual(counts['Press'], 7)
+        self.assertEqual(counts['Imprint 0'], 0)
+
+    def test_async_brand_list(self):
+        response = self.client.get(reverse('products:async-brand-list'))
+
+        self.assertEqual(response.json()['count'], 7)
+
+    def test_brand_products(self):
+        response = self.client.get(reverse('products:brand-products', args=[self.brand.pk]))
+
+        self.assertEqual(len(response.data), 7)
+
+    def test_category_products(self):
+        response = self.client.get(reverse('products:category-products', args=[self.category.pk]))
+
+        self.assertEqual(len(response.data), 7)
+
+    def test_featured(self):
+        response = self.client.get(reverse('products:product-featured'))
+
+        self.assertEqual(len(response.data), 6)
+
+    def test_popular(self):
+        response = self.client.get(reverse('products:product-popular'))
+
+        self.assertEqual(len(response.data), 7)
+
+    def test_popular_from_rankings(self):
+        rebuild_rankings()
+
+        response = self.client.get(reverse('products:product-popular') + f'?category={self.category.pk}')
+
+        self.assertEqual(len(response.data), 7)
+
+
+class CompiledSerializerTests(CatalogTestCase):
+    """Compiled list serializers render exactly what DRF renders"""
+
+    def assertSameRender(self, serializer_class, instances):
+        with override_settings(COMPILED_SERIALIZERS=False):
+            expected = JSONRenderer().render(serializer_class(instances, many=True).data)
+        self.assertEqual(JSONRenderer().render(serializer_class(instances, many=True).data), expected)
+
+    def test_products(self):
+        self.create_product('Unbranded', compare_price=Decimal('25.00'), stock_quantity=0)
+        self.create_product('Plain Book', brand=self.brand, is_featured=True)
+
+        products = Product.objects.select_related('category', 'brand').prefetch_related('images')
+
+        self.assertSameRender(ProductListSerializer, list(products))
+
+    def test_reviews(self):
+        user = User.objects.create_user(email='reader@example.com', password='secret', first_name='Ada')
+        Review.objects.create(product=self.product, user=user, rating=4, title='Good', comment='Solid.')
+        Review.objects.create(
+            product=self.create_product('Pamphlet'), user=user, rating=2, title='Torn', comment='',
+            is_active=False, helpful_votes=3,
+        )
+
+        reviews = Review.objects.select_related('user', 'product')
+
+        self.assertSameRender(ReviewSerializer, list(reviews))
+
+
+class CatalogCacheTests(CatalogTestCase):
+    def test_bumped_version_orphans_entries(self):
+        computed = []
+
+        def compute():
+            computed.append(1)
+            return len(computed)
+
+        self.assertEqual(get_or_compute('test.entry', compute, ('product',)), 1)
+        self.assertEqual(get_or_compute('test.entry', compute, ('product',)), 1)
+        bump_version('product')
+
+        self.assertEqual(get_or_compute('test.entry', compute, ('product',)), 2)
+
+    def test_per_process_cache_keeps_versions_in_the_database(self):
+        get_or_compute('test.entry', lambda: 'first', ('product', 'brand'))
+        # Another worker saved a product
+        CatalogVersion.objects.filter(family='product').update(version=1)
+
+        self.assertEqual(get_or_compute('test.entry', lambda: 'second', ('product', 'brand')), 'second')
@@ -0,0 +1,226 @@
+"""
+Buffered product view counting.
+
+``record_view`` only increments an in-process counter keyed by
+``(product_id, hour)``. Once the buffer holds ``VIEW_COUNT_MAX_PENDING``
+views or ``VIEW_COUNT_FLUSH_INTERVAL`` seconds have passed since the last
+flush, it is flushed after the current response has been sent (the
+``request_finished`` receiver in signals.py), and once more when the worker
+exits. A flush writes every product's delta with one ``UPDATE ... SET
+view_count = view_count + CASE ... END`` and adds the hourly counts to
+``ProductViewStat`` with one ``INSERT ... ON CONFLICT DO UPDATE``.
+
+Each flush is a batch with its own id, recorded in ``ViewFlushBatch`` in the
+same transaction as the counts. A batch whose commit failed or timed out is
+kept and retried under the same id, so a retry after a commit that did go
+through is a no-op instead of counting the views twice. Views still in
+memory when a worker is killed without a clean exit are lost (undercounted),
+never double counted.
+"""
+
+import atexit
+import logging
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Case, F, Sum, Value, When
+from django.utils import timezone
+
+from .models import Product, ProductViewStat, ViewFlushBatch
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 30
+DEFAULT_MAX_PENDING = 1000
+UPSERT_BATCH_SIZE = 500
+
+
+def truncate_hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+
+def _upsert_hourly(counts):
+    """Add ``{(product_id, hour): views}`` to ProductViewStat"""
+    qn = connection.ops.quote_name
+    table = qn(ProductViewStat._meta.db_table)
+    adapt = connection.ops.adapt_datetimefield_value
+    rows = list(counts.items())
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+            chunk = rows[start:start + UPSERT_BATCH_SIZE]
+            sql = (
+                f'INSERT INTO {table} ({qn("product_id")}, {qn("hour")}, {qn("views")}) '
+                f'VALUES {", ".join(["(%s, %s, %s)"] * len(chunk))} '
+                f'ON CONFLICT ({qn("product_id")}, {qn("hour")}) '
+                f'DO UPDATE SET {qn("views")} = {table}.{qn("views")} + EXCLUDED.{qn("views")}'
+            )
+            params = []
+            for (product_id, hour), views in chunk:
+                params.extend([product_id, adapt(hour), views])
+            cursor.execute(sql, params)
+
+
+def apply_view_counts(batch_id, counts):
+    """Write one batch of ``{(product_id, hour): views}``; returns False if already applied"""
+    per_product = Counter()
+    for (product_id, _hour), views in counts.items():
+        per_product[product_id] += views
+    try:
+        with transaction.atomic():
+            ViewFlushBatch.objects.create(batch_id=batch_id, views=sum(per_product.values()))
+            Product.objects.filter(pk__in=list(per_product)).update(
+                view_count=F('view_count') + Case(
+                    *[When(pk=product_id, then=Value(views)) for product_id, views in per_product.items()],
+                    default=Value(0),
+                )
+            )
+            # Views of products deleted since they were recorded are dropped
+            existing = set(Product.objects.filter(pk__in=list(per_product)).values_list('pk', flat=True))
+            _upsert_hourly({key: views for key, views in counts.items() if key[0] in existing})
+    except IntegrityError:
+        if ViewFlushBatch.objects.filter(batch_id=batch_id).exists():
+            return False
+        raise
+    return True
+
+
+class ViewCountBuffer:
+    """Thread-safe per-process view counter with batched, idempotent flushes"""
+
+    def __init__(self, flush_interval=None, max_pending=None):
+        self.flush_interval = flush_interval if flush_interval is not None else getattr(
+            settings, 'VIEW_COUNT_FLUSH_INTERVAL', DEFAULT_FLUSH_INTERVAL
+        )
+        self.max_pending = max_pending if max_pending is not None else getattr(
+            settings, 'VIEW_COUNT_MAX_PENDING', DEFAULT_MAX_PENDING
+        )
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._counts = Counter()
+        self._pending = 0
+        # [(batch_id, counts)] taken from the buffer but not known to be committed
+        self._unconfirmed = []
+        self._last_flush = time.monotonic()
+
+    def record(self, product_id, views=1, when=None):
+        hour = truncate_hour(when or timezone.now())
+        with self._lock:
+            self._counts[(product_id, hour)] += views
+            self._pending += views
+
+    @property
+    def due(self):
+        with self._lock:
+            if not self._counts and not self._unconfirmed:
+                return False
+            return (
+                self._pending >= self.max_pending
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+
+    @property
+    def pending(self):
+        with self._lock:
+            return self._pending + sum(sum(counts.values()) for _id, counts in self._unconfirmed)
+
+    def flush(self):
+        """Write buffered views to the database; returns the number of views written"""
+        if not self._flush_lock.acquire(blocking=False):
+            # Another thread is flushing; our views go out with the next batch
+            return 0
+        try:
+            with self._lock:
+                if self._counts:
+                    self._unconfirmed.append((uuid.uuid4(), self._counts))
+                    self._counts = Counter()
+                    self._pending = 0
+                self._last_flush = time.monotonic()
+                batches = list(self._unconfirmed)
+
+            written = 0
+            for batch_id, counts in batches:
+                try:
+                    if apply_view_counts(batch_id, counts):
+                        written += sum(counts.values())
+                except Exception:
+                    # Keep the batch (and its id) for the next flush
+                    logger.exception('View count flush %s failed; will retry', batch_id)
+                    break
+                with self._lock:
+                    self._unconfirmed.remove((batch_id, counts))
+            return written
+        finally:
+            self._flush_lock.release()
+
+
+view_buffer = ViewCountBuffer()
+
+
+def record_view(product_id, views=1):
+    """Count a product detail view"""
+    view_buffer.record(product_id, views)
+
+
+def flush_views():
+    return view_buffer.flush()
+
+
+def flush_views_if_due():
+    if view_buffer.due:
+        return view_buffer.flush()
+    return 0
+
+
+atexit.register(flush_views)
+
+
+def hourly_views(product_id, since=None, until=None, fill=True):
+    """``[(hour, views)]`` for one product, oldest first
+
+    Defaults to the last 24 hours. With ``fill`` hours without views are
+    included as zeros so series line up across products.
+    """
+    until = truncate_hour(until or timezone.now())
+    since = truncate_hour(since or until - timedelta(hours=23))
+    found = dict(
+        ProductViewStat.objects.filter(
+            product_id=product_id, hour__gte=since, hour__lte=until
+        ).values_list('hour', 'views')
+    )
+    if not fill:
+        return sorted(found.items())
+    series = []
+    hour = since
+    while hour <= until:
+        series.append((hour, found.get(hour, 0)))
+        hour += timedelta(hours=1)
+    return series
+
+
+def views_since(since, product_ids=None):
+    """{product_id: views} recorded since ``since``, for trend-aware ranking"""
+    queryset = ProductViewStat.objects.filter(hour__gte=truncate_hour(since))
+    if product_ids is not None:
+        queryset = queryset.filter(product_id__in=product_ids)
+    return dict(
+        queryset.values('product_id').annotate(total=Sum('views')).values_list('product_id', 'total')
+    )
+
+
+def prune_view_stats(before, batch_size=10000):
+    """Delete hourly stats and flush markers older than ``before``; returns rows deleted"""
+    deleted = 0
+    for model, field in ((ProductViewStat, 'hour'), (ViewFlushBatch, 'flushed_at')):
+        while True:
+            ids = list(
+                model.objects.filter(**{f'{field}__lt': before}).values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            deleted += model.objects.filter(pk__in=ids).delete()[0]
+    return deleted
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from . import views
+from . import async_views, views
 
 app_name = 'products'
 
@@ -14,4 +14,13 @@ router.register(r'variants', views.VariantViewSet)
 urlpatterns = [
     path('', include(router.urls)),
     path('search/', views.ProductSearchView.as_view(), name='product-search'),
+    path('cache/stats/', views.CatalogCacheStatsView.as_view(), name='catalog-cache-stats'),
+
+    # Async read path (see products/async_views.py); run under shop_backend.asgi
+    path('async/products/', async_views.product_list, name='async-product-list'),
+    path('async/products/featured/', async_views.featured_products, name='async-product-featured'),
+    path('async/products/<int:pk>/', async_views.product_detail, name='async-product-detail'),
+    path('async/search/', async_views.product_search, name='async-product-search'),
+    path('async/categories/', async_views.category_list, name='async-category-list'),
+    path('async/brands/', async_views.brand_list, name='async-brand-list'),
 ]
@@ -1,37 +1,133 @@
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
 from rest_framework import viewsets, status, generics
 from rest_framework.decorators import action
+from rest_framework.exceptions import ParseError
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated
+from rest_framework.permissions import IsAuthenticatedOrReadOnly, IsAuthenticated, IsAdminUser
 from rest_framework.filters import SearchFilter, OrderingFilter
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Q, Avg, Count
+from django.db.models import Q, Count, Prefetch
 from django.shortcuts import get_object_or_404
-from .models import Category, Brand, Product, Review, ProductVariant as Variant
+from django.utils import timezone
+from shop_backend.conditional import ConditionalGetMixin
+from shop_backend.pagination import KeysetPagination
+from .models import Category, Brand, PopularityRank, Product, Review, ProductVariant as Variant
+from . import cache as catalog_cache
 from . import serializers
+from .ranking import popular_products
+from .search import get_search_backend, search_facets
+from .tracking import hourly_views, record_view
+
+# Families whose changes alter a product listing (names are denormalized in)
+PRODUCT_LIST_FAMILIES = ('product', 'category', 'brand')
+
+
+def _number(value):
+    number = Decimal(value)
+    if not number.is_finite():
+        raise ValueError(value)
+    return number
+
+
+# Query parameter -> lookup and type of the product list filters that
+# DjangoFilterBackend does not cover
+PRODUCT_FILTERS = {
+    'min_price': ('price__gte', _number),
+    'max_price': ('price__lte', _number),
+    'min_rating': ('rating_avg__gte', _number),
+    'category_tree': ('category__ancestor_links__ancestor_id', int),
+}
 
 
-class CategoryViewSet(viewsets.ModelViewSet):
+def product_filters(params, filters=PRODUCT_FILTERS):
+    """``{lookup: value}`` of the ``filters`` given in ``params``
+
+    Raises ``ParseError`` (400) for a malformed value instead of letting it
+    reach the query.
+    """
+    lookups = {}
+    for param, (lookup, convert) in filters.items():
+        value = params.get(param)
+        if value:
+            try:
+                lookups[lookup] = convert(value)
+            except (ValueError, InvalidOperation):
+                raise ParseError(f'{param} must be a number')
+    return lookups
+
+
+class CategoryViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """Category management"""
     queryset = Category.objects.all()
     serializer_class = serializers.CategorySerializer
     permission_classes = [IsAuthenticatedOrReadOnly]
     filter_backends = [SearchFilter, OrderingFilter]
     search_fields = ['name', 'description']
-    ordering_fields = ['name', 'created_at', 'order']
-    ordering = ['order', 'name']
+    ordering_fields = ['name', 'created_at', 'display_order']
+    ordering = ['display_order', 'name']
+    validator_relations = {'list': ('products',), 'retrieve': ('products', 'children')}
+    # Served from a read replica (see shop_backend/replicas.py)
+    replica_actions = ('list', 'retrieve', 'products', 'tree')
+    cache_policies = {
+        'list': {'public': True, 'max_age': 300, 'stale_while_revalidate': 3600},
+        'retrieve': {'public': True, 'max_age': 300, 'stale_while_revalidate': 3600},
+    }
+
+    def list(self, request, *args, **kwargs):
+        data = catalog_cache.get_or_compute(
+            'category.list',
+            lambda: super(CategoryViewSet, self).list(request, *args, **kwargs).data,
+            depends_on=('category', 'product'),
+            params=catalog_cache.request_params(request),
+        )
+        return Response(data)
+
+    def get_queryset(self):
+        return Category.objects.annotate(
+            product_count=Count('products')
+        ).prefetch_related(
+            Prefetch(
+                'children',
+                queryset=Category.objects.annotate(product_count=Count('products'))
+            )
+        )
 
     @action(detail=True, methods=['get'])
     def products(self, request, pk=None):
-        """Get products in category"""
+        """Get products in category and all of its subcategories"""
         category = self.get_object()
-        products = Product.objects.filter(
-            Q(category=category) | Q(category__parent=category)
-        ).distinct()
+        products = Product.objects.select_related(
+            'category', 'brand'
+        ).prefetch_related('images').filter(category__ancestor_links__ancestor=category)
         serializer = serializers.ProductListSerializer(products, many=True)
         return Response(serializer.data)
 
+    @action(detail=False, methods=['get'])
+    def tree(self, request):
+        """Get the full active category tree with subtree product counts"""
+        rows = Category.objects.filter(is_active=True).annotate(
+            product_count=Count(
+                'descendant_links__descendant__products',
+                filter=Q(descendant_links__descendant__products__is_active=True)
+            )
+        ).values(
+            'id', 'name', 'slug', 'parent_id', 'display_order', 'product_count'
+        ).order_by('display_order', 'name')
 
-class BrandViewSet(viewsets.ModelViewSet):
+        nodes = {row['id']: dict(row, children=[]) for row in rows}
+        roots = []
+        for node in nodes.values():
+            parent_id = node.pop('parent_id')
+            if parent_id is None:
+                roots.append(node)
+            elif parent_id in nodes:
+                nodes[parent_id]['children'].append(node)
+        return Response(roots)
+
+
+class BrandViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """Brand management"""
     queryset = Brand.objects.all()
     serializer_class = serializers.BrandSerializer
@@ -40,17 +136,37 @@ class BrandViewSet(viewsets.ModelViewSet):
     search_fields = ['name', 'description']
     ordering_fields = ['name', 'created_at']
     ordering = ['name']
+    validator_relations = {'list': ('products',), 'retrieve': ('products',)}
+    replica_actions = ('list', 'retrieve', 'products')
+    cache_policies = {
+        'list': {'public': True, 'max_age': 300, 'stale_while_revalidate': 3600},
+        'retrieve': {'public': True, 'max_age': 300, 'stale_while_revalidate': 3600},
+    }
+
+    def list(self, request, *args, **kwargs):
+        data = catalog_cache.get_or_compute(
+            'brand.list',
+            lambda: super(BrandViewSet, self).list(request, *args, **kwargs).data,
+            depends_on=('brand', 'product'),
+            params=catalog_cache.request_params(request),
+        )
+        return Response(data)
+
+    def get_queryset(self):
+        return Brand.objects.annotate(product_count=Count('products'))
 
     @action(detail=True, methods=['get'])
     def products(self, request, pk=None):
         """Get products by brand"""
         brand = self.get_object()
-        products = Product.objects.filter(brand=brand)
+        products = Product.objects.select_related(
+            'category', 'brand'
+        ).prefetch_related('images').filter(brand=brand)
         serializer = serializers.ProductListSerializer(products, many=True)
         return Response(serializer.data)
 
 
-class ProductViewSet(viewsets.ModelViewSet):
+class ProductViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """Product management"""
     queryset = Product.objects.all()
     serializer_class = serializers.ProductSerializer
@@ -58,8 +174,18 @@ class ProductViewSet(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
     filterset_fields = ['category', 'brand', 'is_active', 'is_featured']
     search_fields = ['name', 'description', 'sku']
-    ordering_fields = ['name', 'price', 'created_at', 'rating']
+    ordering_fields = ['name', 'price', 'created_at', 'rating_avg', 'rating_count']
     ordering = ['-created_at']
+    pagination_class = KeysetPagination
+    validator_relations = {
+        'list': ('category', 'brand', 'images'),
+        'retrieve': ('category', 'brand', 'images', 'variants', 'reviews'),
+    }
+    replica_actions = ('list', 'retrieve', 'featured', 'popular', 'reviews', 'variants')
+    cache_policies = {
+        'list': {'public': True, 'max_age': 30, 'stale_while_revalidate': 120},
+        'retrieve': {'public': True, 'max_age': 60, 'stale_while_revalidate': 300},
+    }
 
     def get_serializer_class(self):
         if self.action == 'list':
@@ -70,23 +196,36 @@ class ProductViewSet(viewsets.ModelViewSet):
         queryset = Product.objects.select_related(
             'category', 'brand'
         ).prefetch_related(
-            'images', 'variants', 'reviews'
+            'images', 'variants'
         ).filter(is_active=True)
 
-        # Price range filter
-        min_price = self.request.query_params.get('min_price')
-        max_price = self.request.query_params.get('max_price')
-        if min_price:
-            queryset = queryset.filter(price__gte=min_price)
-        if max_price:
-            queryset = queryset.filter(price__lte=max_price)
+        # Price range, rating and category subtree (any depth, via the closure table)
+        return queryset.filter(**product_filters(self.request.query_params))
 
-        # Rating filter
-        min_rating = self.request.query_params.get('min_rating')
-        if min_rating:
-            queryset = queryset.filter(rating__gte=min_rating)
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        # Revalidated (304) detail pages count as views too
+        if self.action == 'retrieve' and response.status_code in (200, 304):
+            try:
+                record_view(int(kwargs.get('pk')))
+            except (TypeError, ValueError):
+                pass
+        return response
 
-        return queryset
+    @action(detail=True, methods=['get'], url_path='views', permission_classes=[IsAdminUser])
+    def view_stats(self, request, pk=None):
+        """Hourly view counts (?hours=, default 24, max 720) (staff only)"""
+        product = get_object_or_404(Product, pk=pk)
+        try:
+            hours = max(1, min(int(request.query_params.get('hours', 24)), 720))
+        except ValueError:
+            hours = 24
+        series = hourly_views(product.pk, since=timezone.now() - timedelta(hours=hours - 1))
+        return Response({
+            'product': product.pk,
+            'view_count': product.view_count,
+            'series': [{'hour': hour, 'views': views} for hour, views in series],
+        })
 
     @action(detail=True, methods=['get'])
     def reviews(self, request, pk=None):
@@ -102,9 +241,8 @@ class ProductViewSet(viewsets.ModelViewSet):
         product = self.get_object()
         serializer = serializers.ReviewSerializer(data=request.data)
         if serializer.is_valid():
+            # Product rating aggregates are updated by the Review post_save signal
             serializer.save(user=request.user, product=product)
-            # Update product rating
-            product.update_rating()
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
@@ -119,20 +257,44 @@ class ProductViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'])
     def featured(self, request):
         """Get featured products"""
-        products = Product.objects.filter(is_featured=True, is_active=True)
-        serializer = serializers.ProductListSerializer(products, many=True)
-        return Response(serializer.data)
+        def compute():
+            products = Product.objects.select_related('category', 'brand').prefetch_related('images').filter(
+                is_featured=True, is_active=True
+            )
+            return serializers.ProductListSerializer(products, many=True).data
+
+        return Response(catalog_cache.get_or_compute('product.featured', compute, PRODUCT_LIST_FAMILIES))
 
     @action(detail=False, methods=['get'])
     def popular(self, request):
-        """Get popular products"""
-        products = Product.objects.filter(
-            is_active=True
-        ).annotate(
-            review_count=Count('reviews')
-        ).order_by('-review_count', '-rating')[:20]
-        serializer = serializers.ProductListSerializer(products, many=True)
-        return Response(serializer.data)
+        """Get popular products, globally or for a category subtree (?category=)"""
+        category_id = request.query_params.get('category') or None
+        if category_id is not None:
+            try:
+                category_id = int(category_id)
+            except ValueError:
+                return Response(
+                    {'error': 'category must be a category id'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+        try:
+            limit = min(int(request.query_params.get('limit', 20)), 100)
+        except ValueError:
+            limit = 20
+
+        def compute():
+            # Precomputed by the rebuild_popularity job
+            products = list(popular_products(category_id, limit).prefetch_related('images'))
+            if not products and not PopularityRank.objects.exists():
+                products = Product.objects.select_related('category', 'brand').prefetch_related(
+                    'images'
+                ).filter(is_active=True).order_by('-rating_count', '-rating_avg')[:limit]
+            return serializers.ProductListSerializer(products, many=True).data
+
+        return Response(catalog_cache.get_or_compute(
+            'product.popular', compute, PRODUCT_LIST_FAMILIES,
+            params=[('category', category_id), ('limit', limit)],
+        ))
 
 
 class ReviewViewSet(viewsets.ModelViewSet):
@@ -144,13 +306,15 @@ class ReviewViewSet(viewsets.ModelViewSet):
     filterset_fields = ['product', 'user', 'rating']
     ordering_fields = ['created_at', 'rating']
     ordering = ['-created_at']
+    replica_actions = ('list', 'retrieve')
 
     def get_queryset(self):
+        queryset = Review.objects.select_related('user', 'product')
         if self.request.user.is_authenticated:
-            return Review.objects.filter(
-                Q(is_approved=True) | Q(user=self.request.user)
+            return queryset.filter(
+                Q(is_active=True) | Q(user=self.request.user)
             )
-        return Review.objects.filter(is_approved=True)
+        return queryset.filter(is_active=True)
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -164,7 +328,7 @@ class ReviewViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
         review = self.get_object()
-        review.is_approved = True
+        review.is_active = True
         review.save()
         return Response({'message': 'Review approved'})
 
@@ -178,33 +342,67 @@ class VariantViewSet(viewsets.ModelViewSet):
     filterset_fields = ['product', 'size', 'color', 'is_active']
     ordering_fields = ['price', 'stock_quantity']
     ordering = ['price']
+    replica_actions = ('list', 'retrieve')
 
     def get_queryset(self):
         return Variant.objects.filter(is_active=True)
 
 
 class ProductSearchView(generics.ListAPIView):
-    """Advanced product search"""
+    """Ranked product search with highlights and facets"""
     serializer_class = serializers.ProductListSerializer
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
-    search_fields = ['name', 'description', 'sku', 'tags__name']
-    ordering_fields = ['name', 'price', 'created_at', 'rating']
-    ordering = ['-rating', '-created_at']
+    permission_classes = [IsAuthenticatedOrReadOnly]
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filterset_fields = ['category', 'brand']
+    ordering_fields = ['name', 'price', 'created_at', 'rating_avg']
+    ordering = None
+    replica_read = True
+
+    def get_search_query(self):
+        return self.request.query_params.get('q', '').strip()
 
     def get_queryset(self):
         queryset = Product.objects.select_related(
             'category', 'brand'
         ).prefetch_related(
-            'images', 'variants', 'reviews'
+            'images', 'variants'
         ).filter(is_active=True)
 
-        query = self.request.query_params.get('q')
+        query = self.get_search_query()
         if query:
-            queryset = queryset.filter(
-                Q(name__icontains=query) |
-                Q(description__icontains=query) |
-                Q(sku__icontains=query) |
-                Q(tags__name__icontains=query)
-            ).distinct()
-
-        return queryset
+            # Relevance first unless the client passes ?ordering=
+            return get_search_backend().search(queryset, query).order_by(
+                '-search_rank', '-rating_avg', '-created_at'
+            )
+        return queryset.order_by('-rating_avg', '-created_at')
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        facets = search_facets(queryset)
+
+        page = self.paginate_queryset(queryset)
+        products = list(page if page is not None else queryset)
+        data = self.get_serializer(products, many=True).data
+
+        query = self.get_search_query()
+        if query:
+            highlights = get_search_backend().highlight(products, query)
+            for item, product in zip(data, products):
+                item['search_rank'] = round(float(product.search_rank), 6)
+                item['highlight'] = highlights.get(product.pk, {})
+
+        if page is not None:
+            response = self.get_paginated_response(data)
+        else:
+            response = Response({'results': data})
+        response.data['query'] = query
+        response.data['facets'] = facets
+        return response
+
+
+class CatalogCacheStatsView(generics.GenericAPIView):
+    """Catalog cache hit/miss/latency counters for this worker (staff only)"""
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, *args, **kwargs):
+        return Response(catalog_cache.metrics.snapshot())
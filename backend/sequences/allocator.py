@@ -0,0 +1,158 @@
+"""
+Human-readable IDs from block-allocated sequences.
+
+Order numbers, payment and refund IDs and product and variant SKUs are
+numbered from one sequence per prefix (``ORD-20261018-00012345``,
+``PAY-00012345``, ...). Numbers never repeat, so inserts need no
+collision retries, and they only grow, so IDs sort by creation time and new
+rows land at the right edge of the unique indexes instead of at random
+positions.
+
+Each process leases a block of numbers at a time and hands them out from
+memory; only the first insert of a block touches the database. On
+PostgreSQL a lease is one ``nextval()`` of a sequence whose ``INCREMENT BY``
+is the block size (``ID_SEQUENCE_BLOCK_SIZE`` when the sequence was created,
+see the ``id_sequences`` command). Sequences are not transactional, so a
+lease never waits on other transactions, is never rolled back and works
+behind the transaction-mode pooler. Other databases lease from an
+``IdSequence`` row instead.
+
+IDs are unique but not gapless: numbers of a block left unused when a
+process exits are skipped, and IDs from concurrently running processes
+interleave within the span of one block. A forked child process drops the
+block it inherited from its parent.
+"""
+
+import os
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, router, transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+DEFAULT_BLOCK_SIZE = 100
+
+# Prefix -> (ID format, IDs of the existing format that a sequence number could match)
+SEQUENCES = {
+    'ORD': ('ORD-{date:%Y%m%d}-{value:08d}', r'^ORD-[0-9]{8}-[0-9]+$'),
+    'PAY': ('PAY-{value:08d}', r'^PAY-[0-9]+$'),
+    'REF': ('REF-{value:08d}', r'^REF-[0-9]+$'),
+    'PRD': ('PRD-{value:08d}', r'^PRD-[0-9]+$'),
+    'VAR': ('VAR-{value:08d}', r'^VAR-[0-9]+$'),
+}
+
+_lock = threading.Lock()
+_blocks = {}
+
+
+class _Block:
+    """Numbers leased by this process: ``next`` to ``end`` inclusive"""
+
+    __slots__ = ('next', 'end', 'pid')
+
+    def __init__(self, start, end):
+        self.next = start
+        self.end = end
+        self.pid = os.getpid()
+
+
+def block_size():
+    return getattr(settings, 'ID_SEQUENCE_BLOCK_SIZE', DEFAULT_BLOCK_SIZE)
+
+
+def sequence_name(prefix):
+    return f'id_sequence_{prefix.lower()}'
+
+
+def sequence_database():
+    from .models import IdSequence
+    return router.db_for_write(IdSequence)
+
+
+def next_values(prefix, count=1):
+    """The next ``count`` numbers of the ``prefix`` sequence, in increasing order"""
+    if prefix not in SEQUENCES:
+        raise ValueError(f'Unknown ID sequence {prefix!r}')
+    values = []
+    with _lock:
+        block = _blocks.get(prefix)
+        while len(values) < count:
+            if block is None or block.pid != os.getpid() or block.next > block.end:
+                floor = block.end if block is not None else 0
+                block = _blocks[prefix] = _Block(*_lease(prefix, floor))
+            taken = min(count - len(values), block.end - block.next + 1)
+            values.extend(range(block.next, block.next + taken))
+            block.next += taken
+    return values
+
+
+def format_id(prefix, value, date=None):
+    return SEQUENCES[prefix][0].format(value=value, date=date or timezone.now())
+
+
+def next_id(prefix):
+    """A new ID such as ``ORD-20261018-00012345``"""
+    return format_id(prefix, next_values(prefix)[0])
+
+
+def next_ids(prefix, count):
+    """``count`` new IDs, e.g. for ``bulk_create``"""
+    now = timezone.now()
+    return [format_id(prefix, value, now) for value in next_values(prefix, count)]
+
+
+def reset():
+    """Forget the leased blocks; the next allocation leases a new one"""
+    with _lock:
+        _blocks.clear()
+
+
+def _lease(prefix, floor):
+    """First and last number of a new block of the ``prefix`` sequence"""
+    using = sequence_database()
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        name = sequence_name(prefix)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT nextval(%s), increment_by FROM pg_sequences '
+                'WHERE schemaname = current_schema() AND sequencename = %s',
+                [name, name]
+            )
+            row = cursor.fetchone()
+        if row is None:
+            raise ImproperlyConfigured(f'Sequence {name} does not exist; run migrate')
+        start, size = row
+        return start, start + size - 1
+
+    from .models import IdSequence
+    size = block_size()
+    sequences = IdSequence.objects.using(using)
+    # A lease rolled back with the caller's transaction is still in use by
+    # this process, so never go below the end of the previous block
+    advance = {'last_value': Greatest(F('last_value'), floor) + size}
+    with transaction.atomic(using=using):
+        # The row only needs creating on the first lease of the prefix
+        if not sequences.filter(prefix=prefix).update(**advance):
+            sequences.get_or_create(prefix=prefix)
+            sequences.filter(prefix=prefix).update(**advance)
+        end = sequences.values_list('last_value', flat=True).get(prefix=prefix)
+    return end - size + 1, end
+
+
+def highest_number(queryset, field, prefix):
+    """Highest sequence number already used by ``field`` values of ``queryset``"""
+    values = queryset.filter(**{f'{field}__regex': SEQUENCES[prefix][1]}).values_list(field, flat=True)
+    return max((int(value.rsplit('-', 1)[1]) for value in values.iterator()), default=0)
+
+
+def create_sequence(prefix, start=1, using=None):
+    """Create the PostgreSQL sequence of ``prefix`` with ``start`` as its first number"""
+    with connections[using or sequence_database()].cursor() as cursor:
+        cursor.execute(
+            f'CREATE SEQUENCE IF NOT EXISTS {sequence_name(prefix)} '
+            f'AS bigint START WITH {int(start)} INCREMENT BY {int(block_size())}'
+        )
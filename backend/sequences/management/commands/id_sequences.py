@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from sequences.allocator import SEQUENCES, block_size, sequence_database, sequence_name
+from sequences.models import IdSequence
+
+
+class Command(BaseCommand):
+    """Show the ID sequences and change their block size"""
+
+    help = (
+        'Per-prefix ID sequence state: the first number of the next block to be leased and the block '
+        'size. --block-size changes the size of the blocks leased from now on (PostgreSQL)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--block-size', type=int, help='Numbers leased per block from now on')
+
+    def handle(self, *args, **options):
+        using = sequence_database()
+        connection = connections[using]
+        if options['block_size'] is not None:
+            if options['block_size'] < 1:
+                raise CommandError('--block-size must be at least 1')
+            if connection.vendor != 'postgresql':
+                raise CommandError('Without PostgreSQL sequences the block size is ID_SEQUENCE_BLOCK_SIZE')
+            with connection.cursor() as cursor:
+                for prefix in SEQUENCES:
+                    cursor.execute(
+                        f'ALTER SEQUENCE {sequence_name(prefix)} INCREMENT BY {options["block_size"]}'
+                    )
+            self.stdout.write(
+                f'Block size set to {options["block_size"]}; processes keep their current blocks until used up'
+            )
+
+        self.stdout.write(f"{'prefix':<8}{'sequence':<20}{'next block':>14}{'block size':>12}")
+        for prefix, next_block, size in self.sequences(connection, using):
+            self.stdout.write(f'{prefix:<8}{sequence_name(prefix):<20}{next_block:>14}{size:>12}')
+
+    def sequences(self, connection, using):
+        if connection.vendor != 'postgresql':
+            last_values = dict(IdSequence.objects.using(using).values_list('prefix', 'last_value'))
+            return [(prefix, last_values.get(prefix, 0) + 1, block_size()) for prefix in SEQUENCES]
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT sequencename, start_value, last_value, increment_by FROM pg_sequences '
+                'WHERE schemaname = current_schema() AND sequencename = ANY(%s)',
+                [[sequence_name(prefix) for prefix in SEQUENCES]]
+            )
+            rows = {name: (start, last, size) for name, start, last, size in cursor.fetchall()}
+        states = []
+        for prefix in SEQUENCES:
+            if sequence_name(prefix) not in rows:
+                raise CommandError(f'Sequence {sequence_name(prefix)} does not exist; run migrate')
+            start, last, size = rows[sequence_name(prefix)]
+            states.append((prefix, start if last is None else last + size, size))
+        return states
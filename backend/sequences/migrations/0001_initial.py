@@ -0,0 +1,63 @@
+# Generated by Django 5.2.5 on 2026-10-18 06:50
+
+from django.db import migrations, models
+
+from sequences.allocator import create_sequence, highest_number, sequence_name
+
+# Prefix -> model and field holding its IDs
+ID_FIELDS = {
+    'ORD': ('orders', 'Order', 'order_number'),
+    'PAY': ('payments', 'Payment', 'payment_id'),
+    'REF': ('payments', 'Refund', 'refund_id'),
+    'PRD': ('products', 'Product', 'sku'),
+    'VAR': ('products', 'ProductVariant', 'sku'),
+}
+
+
+def create_sequences(apps, schema_editor):
+    """Start every sequence above the existing IDs that look like its numbers"""
+    connection = schema_editor.connection
+    IdSequence = apps.get_model('sequences', 'IdSequence')
+    for prefix, (app_label, model_name, field) in ID_FIELDS.items():
+        model = apps.get_model(app_label, model_name)
+        start = highest_number(model.objects.using(connection.alias), field, prefix) + 1
+        if connection.vendor == 'postgresql':
+            create_sequence(prefix, start, using=connection.alias)
+        else:
+            IdSequence.objects.using(connection.alias).update_or_create(
+                prefix=prefix, defaults={'last_value': start - 1}
+            )
+
+
+def drop_sequences(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for prefix in ID_FIELDS:
+            cursor.execute(f'DROP SEQUENCE IF EXISTS {sequence_name(prefix)}')
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('orders', '0005_order_number_length'),
+        ('payments', '0001_initial'),
+        ('products', '0008_product_view_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdSequence',
+            fields=[
+                ('prefix', models.CharField(max_length=10, primary_key=True, serialize=False, verbose_name='Prefix')),
+                ('last_value', models.BigIntegerField(default=0, verbose_name='Last Value')),
+            ],
+            options={
+                'verbose_name': 'ID Sequence',
+                'verbose_name_plural': 'ID Sequences',
+            },
+        ),
+        migrations.RunPython(create_sequences, drop_sequences),
+    ]
@@ -0,0 +1,21 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class IdSequence(models.Model):
+    """Counter of an ID sequence on databases without native sequences
+
+    PostgreSQL leases blocks from a real sequence (see sequences.allocator);
+    this table only backs SQLite and other development databases.
+    """
+
+    prefix = models.CharField(max_length=10, primary_key=True, verbose_name=_('Prefix'))
+    last_value = models.BigIntegerField(default=0, verbose_name=_('Last Value'))
+
+    class Meta:
+        app_label = 'sequences'
+        verbose_name = _('ID Sequence')
+        verbose_name_plural = _('ID Sequences')
+
+    def __str__(self):
+        return f'{self.prefix}: {self.last_value}'
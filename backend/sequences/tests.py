@@ -0,0 +1,89 @@
+import re
+from unittest import mock, skipIf
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from . import allocator
+from .models import IdSequence
+
+ON_POSTGRES = connection.vendor == 'postgresql'
+
+
+class AllocatorTestCase(TestCase):
+    def setUp(self):
+        allocator.reset()
+        self.addCleanup(allocator.reset)
+
+    def count_leases(self):
+        return mock.patch.object(allocator, '_lease', wraps=allocator._lease)
+
+
+class AllocatorTests(AllocatorTestCase):
+    def test_unknown_prefix(self):
+        with self.assertRaises(ValueError):
+            allocator.next_values('XYZ')
+
+    def test_formats(self):
+        self.assertRegex(allocator.next_id('ORD'), r'^ORD-[0-9]{8}-[0-9]{8}$')
+        self.assertRegex(allocator.next_id('PAY'), r'^PAY-[0-9]{8}$')
+
+    def test_values_increase_across_blocks(self):
+        size = allocator.block_size()
+
+        with self.count_leases() as lease:
+            values = [allocator.next_values('REF')[0] for _ in range(2 * size + 1)]
+
+        self.assertEqual(lease.call_count, 3)
+        self.assertEqual(values, sorted(set(values)))
+
+    def test_next_ids_cross_a_block_boundary(self):
+        size = allocator.block_size()
+        first = allocator.next_values('VAR')[0]
+
+        with self.count_leases() as lease:
+            ids = allocator.next_ids('VAR', size)
+
+        self.assertEqual(lease.call_count, 1)
+        numbers = [int(re.match(r'^VAR-([0-9]+)$', sku).group(1)) for sku in ids]
+        self.assertEqual(len(numbers), size)
+        self.assertEqual(numbers, sorted(set(numbers)))
+        self.assertGreater(numbers[0], first)
+        self.assertGreater(numbers[-1], first + size - 1)
+
+    def test_forked_process_leases_a_new_block(self):
+        parent = allocator.next_values('PRD')[0]
+
+        with self.count_leases() as lease, mock.patch.object(allocator.os, 'getpid', return_value=-1):
+            child = allocator.next_values('PRD')[0]
+
+        self.assertEqual(lease.call_count, 1)
+        self.assertGreater(child, parent + allocator.block_size() - 1)
+
+
+@skipIf(ON_POSTGRES, 'PostgreSQL leases from a native sequence')
+@override_settings(ID_SEQUENCE_BLOCK_SIZE=10)
+class IdSequenceLeaseTests(AllocatorTestCase):
+    def test_lease_advances_the_row_by_one_block(self):
+        IdSequence.objects.update_or_create(prefix='PAY', defaults={'last_value': 41})
+
+        self.assertEqual(allocator.next_values('PAY', 3), [42, 43, 44])
+        self.assertEqual(IdSequence.objects.get(prefix='PAY').last_value, 51)
+        with self.assertNumQueries(0):
+            self.assertEqual(allocator.next_values('PAY'), [45])
+
+    def test_missing_row_is_created(self):
+        IdSequence.objects.filter(prefix='PAY').delete()
+
+        self.assertEqual(allocator.next_values('PAY'), [1])
+        self.assertEqual(IdSequence.objects.get(prefix='PAY').last_value, 10)
+
+    def test_rolled_back_lease_is_not_reused(self):
+        IdSequence.objects.update_or_create(prefix='PAY', defaults={'last_value': 0})
+        allocator.next_values('PAY', 10)
+        # As if the lease had been rolled back with the caller's transaction
+        IdSequence.objects.filter(prefix='PAY').update(last_value=0)
+
+        self.assertEqual(allocator.next_values('PAY'), [11])
+        self.assertEqual(IdSequence.objects.get(prefix='PAY').last_value, 20)
@@ -0,0 +1,441 @@
+"""
+Compiled list serialization.
+
+For every row and every field DRF calls ``field.get_attribute`` (which walks
+the source path with ``getattr`` and callable checks) and then
+``field.to_representation``; on large pages that dispatch dominates CPU time.
+
+``CompiledListSerializer``, set as a serializer's
+``Meta.list_serializer_class``, renders ``many=True`` output with a function
+generated once per serializer layout instead:
+
+* model columns, through foreign keys and one-to-one relations
+  (``category.name``, ``payment.status``), are read directly and
+  ``get_<field>_display`` looks labels up in a dict built once per page;
+* integer, string, boolean, decimal, ISO datetime, choice and primary key
+  values are converted inline;
+* ``SerializerMethodField`` calls its ``get_<name>`` method.
+
+Any other field, or a value of an unexpected type, goes through the field's
+own ``get_attribute``/``to_representation``, so the output is the same as
+DRF's; the ``CompiledSerializerTests`` of the products and orders apps check
+that parity and ``manage.py benchmark_serializers`` times both paths. Set
+``COMPILED_SERIALIZERS = False`` to render with DRF's code path.
+"""
+
+import datetime
+import decimal
+import functools
+import inspect
+import threading
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
+from django.db import models
+from django.utils.encoding import force_str
+from django.utils.hashable import make_hashable
+from rest_framework import fields as drf_fields
+from rest_framework import relations, serializers
+from rest_framework.fields import SkipField, empty
+from rest_framework.relations import PKOnlyObject
+from rest_framework.settings import api_settings
+
+# Generated render factories by (serializer class, field plans)
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+def compiled_serializers_enabled():
+    return getattr(settings, 'COMPILED_SERIALIZERS', True)
+
+
+def _model_field(model, name):
+    try:
+        return model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+
+
+def _relation_kind(model_field, attr):
+    """'forward' for a foreign key or one-to-one column, 'reverse' for the other side of a one-to-one
+
+    Following either reads at most one row (none with select_related).
+    """
+    if model_field is None:
+        return None
+    if model_field.concrete and (model_field.many_to_one or model_field.one_to_one):
+        return 'forward'
+    if model_field.one_to_one and not model_field.concrete and model_field.get_accessor_name() == attr:
+        return 'reverse'
+    return None
+
+
+def _is_plain_method(model, name):
+    """Whether ``model.name`` is a method DRF would call without arguments"""
+    method = getattr(model, name, None)
+    if not inspect.isfunction(method):
+        return False
+    parameters = list(inspect.signature(method).parameters.values())[1:]
+    return all(
+        parameter.default is not inspect.Parameter.empty
+        or parameter.kind in (parameter.VAR_POSITIONAL, parameter.VAR_KEYWORD)
+        for parameter in parameters
+    )
+
+
+def _display_field(model, name):
+    """The choices field whose Django-generated ``get_<field>_display`` is ``model.name``, or None"""
+    if not (name.startswith('get_') and name.endswith('_display')):
+        return None
+    model_field = _model_field(model, name[4:-8])
+    if model_field is None or not model_field.choices:
+        return None
+    for klass in model.__mro__:
+        if name in klass.__dict__:
+            method = klass.__dict__[name]
+            generated = (
+                isinstance(method, functools.partialmethod)
+                and method.func is models.Model._get_FIELD_display
+                and method.keywords.get('field') is model_field
+            )
+            return model_field if generated else None
+    return None
+
+
+def _access_plan(field, model):
+    """How to read the field's value from a row
+
+    ('method',), ('generic',) or ('value', relations, leaf, on_missing) where
+    ``relations`` is ((attr, 'forward' | 'reverse'), ...) and ``leaf`` one of
+    ('column', attname), ('call', name), ('display', model, field name),
+    ('attribute', property name).
+    """
+    if isinstance(field, serializers.SerializerMethodField):
+        return ('method',)
+    attrs = getattr(field, 'source_attrs', None)
+    if model is None or not attrs or field.default is not empty:
+        return ('generic',)
+
+    if isinstance(field, relations.PrimaryKeyRelatedField):
+        model_field = _model_field(model, attrs[0])
+        if len(attrs) == 1 and _relation_kind(model_field, attrs[0]) == 'forward' and not _overrides(
+            field, relations.RelatedField, 'get_attribute'
+        ):
+            return ('value', (), ('column', model_field.attname), None)
+        return ('generic',)
+    if _overrides(field, drf_fields.Field, 'get_attribute'):
+        return ('generic',)
+
+    path, current = [], model
+    for attr in attrs[:-1]:
+        model_field = _model_field(current, attr)
+        kind = _relation_kind(model_field, attr)
+        if kind is None:
+            return ('generic',)
+        path.append((attr, kind))
+        current = model_field.related_model
+
+    name = attrs[-1]
+    leaf_field = _model_field(current, name)
+    display_field = _display_field(current, name) if leaf_field is None else None
+    if leaf_field is not None:
+        if not leaf_field.concrete or leaf_field.is_relation:
+            return ('generic',)
+        leaf = ('column', leaf_field.attname)
+    elif display_field is not None:
+        leaf = ('display', current, display_field.name)
+    elif _is_plain_method(current, name):
+        leaf = ('call', name)
+    elif isinstance(getattr(current, name, None), (property, functools.cached_property)):
+        leaf = ('attribute', name)
+    else:
+        return ('generic',)
+
+    on_missing = None
+    if leaf[0] == 'attribute' or any(kind == 'forward' for _attr, kind in path):
+        # DRF turns the AttributeError of a missing (None) relation into None
+        # or an omitted key; a required field would raise, so leave that to DRF
+        if field.allow_null:
+            on_missing = 'null'
+        elif not field.required:
+            on_missing = 'skip'
+        else:
+            return ('generic',)
+    return ('value', tuple(path), leaf, on_missing)
+
+
+def _overrides(field, base, *methods):
+    return any(getattr(type(field), name) is not getattr(base, name) for name in methods)
+
+
+def _conversion_plan(field, access):
+    """How to turn a non-None value into its representation"""
+    if access[0] == 'method':
+        return ('none',)
+    if isinstance(field, relations.PrimaryKeyRelatedField):
+        if access[0] == 'value' and field.pk_field is None and not _overrides(
+            field, relations.PrimaryKeyRelatedField, 'to_representation'
+        ):
+            return ('raw',)
+        return ('field',)
+    representation = type(field).to_representation
+    if representation is drf_fields.ReadOnlyField.to_representation:
+        return ('raw',)
+    if representation is drf_fields.IntegerField.to_representation:
+        return ('int',)
+    if representation is drf_fields.BigIntegerField.to_representation:
+        coerce = getattr(field, 'coerce_to_string', api_settings.COERCE_BIGINT_TO_STRING)
+        return ('str',) if coerce else ('int',)
+    if representation is drf_fields.CharField.to_representation:
+        return ('str',)
+    if representation is drf_fields.BooleanField.to_representation:
+        return ('bool',)
+    if representation is drf_fields.ChoiceField.to_representation:
+        return ('choice',)
+    if representation is drf_fields.DecimalField.to_representation:
+        if field.decimal_places is None or field.localize or field.normalize_output or _overrides(
+            field, drf_fields.DecimalField, 'quantize'
+        ):
+            return ('field',)
+        coerce = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+        return ('decimal', bool(coerce))
+    if representation is drf_fields.DateTimeField.to_representation:
+        output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+        if not isinstance(output_format, str) or output_format.lower() != drf_fields.ISO_8601:
+            return ('field',)
+        if _overrides(field, drf_fields.DateTimeField, 'enforce_timezone', 'default_timezone'):
+            return ('field',)
+        aware = field.timezone is not None if hasattr(field, 'timezone') else settings.USE_TZ
+        if not aware:
+            # Naive output: leave the conversion to DRF
+            return ('field',)
+        return ('datetime',)
+    return ('field',)
+
+
+def field_plans(serializer):
+    """Plan of every readable field of ``serializer``: ((name, access, conversion), ...)"""
+    model = getattr(getattr(serializer, 'Meta', None), 'model', None)
+    plans = []
+    for field in serializer.fields.values():
+        if field.write_only:
+            continue
+        access = _access_plan(field, model)
+        plans.append((field.field_name, access, _conversion_plan(field, access)))
+    return tuple(plans)
+
+
+def _convert(index, conversion, value, target, indent):
+    """Source lines that store the representation of ``value`` into ``target``"""
+    kind = conversion[0]
+    pad = ' ' * indent
+    if kind == 'raw':
+        return [f'{pad}{target} = {value}']
+    if kind == 'int':
+        return [f'{pad}{target} = {value} if {value}.__class__ is int else int({value})']
+    if kind == 'str':
+        return [f'{pad}{target} = {value} if {value}.__class__ is str else str({value})']
+    if kind == 'bool':
+        return [f'{pad}{target} = {value} if {value}.__class__ is bool else r{index}({value})']
+    if kind == 'choice':
+        return [
+            f'{pad}if {value}.__class__ is str:',
+            f'{pad}    {target} = c{index}.get({value}, {value}) if {value} else {value}',
+            f'{pad}else:',
+            f'{pad}    {target} = r{index}({value})',
+        ]
+    if kind == 'decimal':
+        quantized = f'{value}.quantize(e{index}, rounding=q{index}, context=x{index})'
+        converted = f"format({quantized}, 'f')" if conversion[1] else quantized
+        return [
+            f'{pad}if {value}.__class__ is Decimal:',
+            f'{pad}    {target} = {converted}',
+            f'{pad}else:',
+            f'{pad}    {target} = r{index}({value})',
+        ]
+    if kind == 'datetime':
+        return [
+            f'{pad}if {value}.__class__ is datetime and {value}.tzinfo is not None:',
+            f'{pad}    {value} = {value}.astimezone(z{index}).isoformat()',
+            f"{pad}    {target} = {value}[:-6] + 'Z' if {value}.endswith('+00:00') else {value}",
+            f'{pad}else:',
+            f'{pad}    {target} = r{index}({value})',
+        ]
+    return [f'{pad}{target} = r{index}({value})']
+
+
+def _store(index, conversion, target, indent):
+    """Lines storing ``value`` (None passes through, as in DRF)"""
+    pad = ' ' * indent
+    return [
+        f'{pad}if value is None:',
+        f'{pad}    {target} = None',
+        f'{pad}else:',
+        *_convert(index, conversion, 'value', target, indent + 4),
+    ]
+
+
+def _render_source(plans):
+    setup = []
+    body = []
+    for index, (name, access, conversion) in enumerate(plans):
+        target = f'ret[{name!r}]'
+        setup.append(f'    f{index} = fields[{index}]')
+        setup.append(f'    r{index} = f{index}.to_representation')
+        kind = conversion[0]
+        if kind == 'choice':
+            setup.append(f'    c{index} = f{index}.choice_strings_to_values')
+        elif kind == 'decimal':
+            setup.append(f'    e{index}, q{index}, x{index} = decimal_args(f{index})')
+        elif kind == 'datetime':
+            setup.append(f'    z{index} = datetime_timezone(f{index})')
+
+        if access[0] == 'method':
+            setup.append(f'    m{index} = getattr(serializer, f{index}.method_name)')
+            body.append(f'        {target} = m{index}(obj)')
+        elif access[0] == 'value':
+            _kind, path, leaf, on_missing = access
+            if leaf[0] == 'display':
+                setup.append(f'    d{index} = display_labels(plans[{index}][1][2])')
+            if path:
+                body.append('        value = obj')
+            owner = 'value' if path else 'obj'
+            indent = 8
+            for relation, relation_kind in path:
+                pad = ' ' * indent
+                if relation_kind == 'forward':
+                    body.append(f'{pad}value = value.{relation}')
+                    body.append(f'{pad}if value is None:')
+                    body.append(f'{pad}    {target} = None' if on_missing == 'null' else f'{pad}    pass')
+                else:
+                    # DRF renders a missing reverse one-to-one as None
+                    body.append(f'{pad}try:')
+                    body.append(f'{pad}    value = value.{relation}')
+                    body.append(f'{pad}except ObjectDoesNotExist:')
+                    body.append(f'{pad}    {target} = None')
+                body.append(f'{pad}else:')
+                indent += 4
+            pad = ' ' * indent
+            if leaf[0] == 'column':
+                body.append(f'{pad}value = {owner}.{leaf[1]}')
+            elif leaf[0] == 'call':
+                body.append(f'{pad}value = {owner}.{leaf[1]}()')
+            elif leaf[0] == 'attribute':
+                body.extend([
+                    f'{pad}try:',
+                    f'{pad}    value = {owner}.{leaf[1]}',
+                    f'{pad}except AttributeError:',
+                    f'{pad}    {target} = None' if on_missing == 'null' else f'{pad}    pass',
+                    f'{pad}else:',
+                ])
+                indent += 4
+            else:
+                attname = leaf[1]._meta.get_field(leaf[2]).attname
+                body.extend([
+                    f'{pad}owner = {owner}',
+                    f'{pad}value = owner.{attname}',
+                    f'{pad}if value.__class__ is str or value.__class__ is int:',
+                    f'{pad}    value = d{index}.get(value, value)',
+                    f'{pad}else:',
+                    f'{pad}    value = owner.get_{leaf[2]}_display()',
+                ])
+            body.extend(_store(index, conversion, target, indent))
+        else:
+            body.extend([
+                '        try:',
+                f'            value = f{index}.get_attribute(obj)',
+                '        except SkipField:',
+                '            pass',
+                '        else:',
+                '            if (value.pk if isinstance(value, PKOnlyObject) else value) is None:',
+                f'                {target} = None',
+                '            else:',
+                *_convert(index, conversion, 'value', target, 16),
+            ])
+
+    return '\n'.join([
+        'def make_renderer(fields, serializer):',
+        *setup,
+        '',
+        '    def render(rows):',
+        '        out = []',
+        '        append = out.append',
+        '        for obj in rows:',
+        '            ret = {}',
+        *('    ' + line for line in body),
+        '            append(ret)',
+        '        return out',
+        '',
+        '    return render',
+        '',
+    ])
+
+
+def decimal_args(field):
+    """Quantize exponent, rounding and context, resolved once per page like DRF does per value"""
+    context = decimal.getcontext().copy()
+    if field.max_digits is not None:
+        context.prec = field.max_digits
+    return decimal.Decimal('.1') ** field.decimal_places, field.rounding, context
+
+
+def display_labels(leaf):
+    """{value: label} of a choices field as ``get_<field>_display`` returns them in the active language"""
+    _kind, model, name = leaf
+    return {
+        make_hashable(value): force_str(label, strings_only=True)
+        for value, label in model._meta.get_field(name).flatchoices
+    }
+
+
+def datetime_timezone(field):
+    return field.timezone if hasattr(field, 'timezone') else field.default_timezone()
+
+
+def _factory(serializer_class, plans):
+    key = (serializer_class, plans)
+    factory = _compiled.get(key)
+    if factory is None:
+        source = _render_source(plans)
+        namespace = {
+            'Decimal': decimal.Decimal,
+            'datetime': datetime.datetime,
+            'PKOnlyObject': PKOnlyObject,
+            'SkipField': SkipField,
+            'ObjectDoesNotExist': ObjectDoesNotExist,
+            'plans': plans,
+            'decimal_args': decimal_args,
+            'display_labels': display_labels,
+            'datetime_timezone': datetime_timezone,
+        }
+        exec(compile(source, f'<compiled {serializer_class.__qualname__}>', 'exec'), namespace)
+        factory = namespace['make_renderer']
+        factory.source = source
+        with _compiled_lock:
+            factory = _compiled.setdefault(key, factory)
+    return factory
+
+
+def compile_serializer(serializer):
+    """A function rendering a list of rows like ``serializer.to_representation`` each, or None
+
+    Serializers that override ``to_representation`` are not compiled.
+    """
+    if type(serializer).to_representation is not serializers.Serializer.to_representation:
+        return None
+    readable = [field for field in serializer.fields.values() if not field.write_only]
+    return _factory(type(serializer), field_plans(serializer))(readable, serializer)
+
+
+class CompiledListSerializer(serializers.ListSerializer):
+    """``many=True`` serializer rendering rows with a compiled function"""
+
+    def to_representation(self, data):
+        if not compiled_serializers_enabled():
+            return super().to_representation(data)
+        if not hasattr(self, '_renderer'):
+            self._renderer = compile_serializer(self.child)
+        if self._renderer is None:
+            return super().to_representation(data)
+        iterable = data.all() if isinstance(data, models.manager.BaseManager) else data
+        return self._renderer(iterable)
@@ -0,0 +1,143 @@
+"""
+HTTP conditional GET for catalog viewsets.
+
+``ConditionalGetMixin`` derives an ETag for list and detail actions from
+``COUNT`` and ``MAX(updated_at)`` over the filtered queryset (plus selected
+relations), evaluated after authentication and permission checks but before
+the action runs. A matching ``If-None-Match``/``If-Modified-Since`` returns
+304 without serializing anything.
+
+Last-Modified is sent only for a single row without to-many relations:
+deleting a row of a collection that is not its newest leaves
+``MAX(updated_at)`` where it was, so a client revalidating with the date
+alone would get a 304 for a changed body. Collections carry the ETag only,
+which the count moves. ``Cache-Control`` comes from ``HTTP_CACHE_POLICIES`` in settings,
+keyed by namespaced URL name like ``QUERY_BUDGETS``, falling back to the
+viewset's ``cache_policies``.
+"""
+
+import hashlib
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+
+class _ConditionalResponse(Exception):
+    """Carries a 304/412 response out of ``initial()``"""
+
+    def __init__(self, response):
+        self.response = response
+
+
+def get_cache_policy(view_name, default=None):
+    """Cache-Control options for a namespaced view name such as 'products:product-list'"""
+    policies = getattr(settings, 'HTTP_CACHE_POLICIES', {})
+    if view_name:
+        if view_name in policies:
+            return policies[view_name]
+        namespace, _, url_name = view_name.rpartition(':')
+        basename = url_name.split('-')[0]
+        key = f'{namespace}:{basename}' if namespace else basename
+        if key in policies:
+            return policies[key]
+    return default
+
+
+def compute_validators(queryset, relations=()):
+    """Return ``(etag_source, last_modified)`` for a queryset in one aggregate query
+
+    ``relations`` are related names whose row count and ``updated_at`` also
+    feed the validators (e.g. a brand rename changes product listings).
+    """
+    model = queryset.model
+    base = model._default_manager.filter(pk__in=queryset.order_by().values('pk'))
+    aggregates = {'count': Count('pk', distinct=True), 'modified': Max('updated_at')}
+    for relation in relations:
+        aggregates[f'{relation}_count'] = Count(f'{relation}__pk', distinct=True)
+        aggregates[f'{relation}_modified'] = Max(f'{relation}__updated_at')
+    values = base.aggregate(**aggregates)
+
+    modified = [value for key, value in values.items() if key.endswith('modified') and value]
+    source = '|'.join(f'{key}={values[key]}' for key in sorted(values))
+    return source, max(modified) if modified else None
+
+
+def has_to_many(model, relations):
+    """Whether any of ``relations`` holds several rows per ``model`` row"""
+    return any(
+        field.one_to_many or field.many_to_many
+        for field in (model._meta.get_field(relation) for relation in relations)
+    )
+
+
+class ConditionalGetMixin:
+    """ETag/Last-Modified validators and Cache-Control for list and retrieve"""
+
+    conditional_actions = ('list', 'retrieve')
+
+    # {action: (related names)} folded into that action's validators
+    validator_relations = {}
+
+    # {action: patch_cache_control() kwargs}, overridden by HTTP_CACHE_POLICIES
+    cache_policies = {}
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.etag = self.last_modified = None
+        if request.method not in ('GET', 'HEAD') or self.action not in self.conditional_actions:
+            return
+
+        queryset = self.get_validator_queryset()
+        if queryset is None:
+            return
+        relations = self.validator_relations.get(self.action, ())
+        source, last_modified = compute_validators(queryset, relations)
+        if last_modified is None:
+            return
+
+        source = '|'.join([source, request.get_full_path(), request.accepted_media_type or ''])
+        self.etag = quote_etag('W/"%s"' % hashlib.md5(source.encode('utf-8')).hexdigest())
+        if self.action == 'retrieve' and not has_to_many(queryset.model, relations):
+            self.last_modified = last_modified
+        response = get_conditional_response(
+            request,
+            etag=self.etag,
+            last_modified=int(self.last_modified.timestamp()) if self.last_modified else None,
+        )
+        if response is not None:
+            raise _ConditionalResponse(response)
+
+    def get_validator_queryset(self):
+        """Rows whose state determines the response body; None to skip"""
+        queryset = self.filter_queryset(self.get_queryset())
+        if self.action == 'retrieve':
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            if lookup_url_kwarg not in self.kwargs:
+                return None
+            queryset = queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        return queryset
+
+    def get_cache_policy(self):
+        match = getattr(self.request, 'resolver_match', None)
+        return get_cache_policy(
+            match.view_name if match else None,
+            default=self.cache_policies.get(self.action),
+        )
+
+    def handle_exception(self, exc):
+        if isinstance(exc, _ConditionalResponse):
+            return exc.response
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if getattr(self, 'etag', None) and response.status_code in (200, 304):
+            response['ETag'] = self.etag
+            if self.last_modified:
+                response['Last-Modified'] = http_date(self.last_modified.timestamp())
+            policy = self.get_cache_policy()
+            if policy:
+                patch_cache_control(response, **policy)
+        return response
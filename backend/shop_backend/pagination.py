@@ -0,0 +1,269 @@
+"""
+Keyset (seek) pagination for large, append-mostly listings.
+
+``KeysetPagination`` pages on the queryset's ordering fields plus the primary
+key as a tie breaker, so every page is an index range scan instead of
+``OFFSET n``. Cursors are opaque base64 tokens. Totals come from planner
+estimates on PostgreSQL instead of ``COUNT(*)``. Viewsets opt in with
+``pagination_class = KeysetPagination``; requests that still send ``?page=``
+are served by the regular page-number paginator. Async views use
+``apaginate_queryset``.
+"""
+
+import asyncio
+import base64
+import json
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db import connections
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ParseError
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def _encode_value(value):
+    # Full precision: DjangoJSONEncoder truncates microseconds, which would
+    # make the seek predicate skip rows created within the same millisecond
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value)
+
+
+def approximate_count(queryset, exact_threshold=1000):
+    """Row count from the query planner, exact when the estimate is small
+
+    Returns ``(count, is_approximate)``.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return queryset.count(), False
+
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    estimate = int(plan[0]['Plan']['Plan Rows'])
+    if estimate < exact_threshold:
+        return queryset.count(), False
+    return estimate, True
+
+
+class KeysetPagination(BasePagination):
+    """Cursor pagination keyed on the queryset ordering plus the primary key"""
+
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    default_ordering = ('-created_at',)
+
+    # 'approximate' (planner estimate), 'exact' (COUNT(*)) or None (no total)
+    count_mode = 'approximate'
+    exact_count_threshold = 1000
+
+    legacy_pagination_class = PageNumberPagination
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.legacy = None
+        if self.legacy_pagination_class and self.legacy_pagination_class.page_query_param in request.query_params:
+            self.legacy = self.legacy_pagination_class()
+            return self.legacy.paginate_queryset(queryset, request, view)
+
+        page_queryset, values, reverse = self.get_page_queryset(queryset, request)
+        rows = self.set_page_bounds(list(page_queryset[:self.page_size + 1]), values, reverse)
+
+        self.count = None
+        self.count_is_approximate = False
+        if self.count_mode == 'exact':
+            self.count = queryset.count()
+        elif self.count_mode == 'approximate':
+            self.count, self.count_is_approximate = approximate_count(
+                queryset, exact_threshold=self.exact_count_threshold
+            )
+        return rows
+
+    async def apaginate_queryset(self, queryset, request):
+        """``paginate_queryset`` for async views, fetching the page and the total concurrently
+
+        ``request`` is a DRF ``Request`` wrapping the ``HttpRequest``. Legacy
+        ``?page=`` requests are not supported here.
+        """
+        self.request = request
+        self.legacy = None
+        page_queryset, values, reverse = self.get_page_queryset(queryset, request)
+
+        async def fetch_rows():
+            return [row async for row in page_queryset[:self.page_size + 1]]
+
+        async def fetch_count():
+            if self.count_mode == 'exact':
+                return await queryset.acount(), False
+            if self.count_mode == 'approximate':
+                return await sync_to_async(approximate_count)(
+                    queryset, exact_threshold=self.exact_count_threshold
+                )
+            return None, False
+
+        rows, (self.count, self.count_is_approximate) = await asyncio.gather(fetch_rows(), fetch_count())
+        return self.set_page_bounds(rows, values, reverse)
+
+    def get_page_queryset(self, queryset, request):
+        """Return ``(page_queryset, cursor_values, reverse)``; fetch ``page_size + 1`` rows from it"""
+        self.page_size = self.get_page_size(request)
+        try:
+            self.ordering = self.get_ordering(queryset)
+            self.fields = [self._get_field(queryset.model, name.lstrip('-')) for name in self.ordering]
+        except ValueError as exc:
+            # Orderings through relations, on nullable or unknown fields
+            raise ParseError(str(exc))
+
+        values, reverse = self.decode_cursor(request)
+        ordering = self.ordering
+        if reverse:
+            ordering = [self._invert(name) for name in ordering]
+        page_queryset = queryset.order_by(*ordering)
+        if values is not None:
+            page_queryset = page_queryset.filter(self._seek_condition(ordering, values))
+        return page_queryset, values, reverse
+
+    def set_page_bounds(self, rows, values, reverse):
+        """Trim the look-ahead row and record next/previous state; returns the page"""
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        self.has_next = has_more if not reverse else values is not None
+        self.has_previous = (values is not None) if not reverse else has_more
+        self.first_row = rows[0] if rows else None
+        self.last_row = rows[-1] if rows else None
+        return rows
+
+    def get_paginated_response(self, data):
+        if self.legacy is not None:
+            return self.legacy.get_paginated_response(data)
+        return Response(self.get_paginated_data(data))
+
+    def get_paginated_data(self, data):
+        payload = OrderedDict()
+        if self.count is not None:
+            payload['count'] = self.count
+            payload['count_is_approximate'] = self.count_is_approximate
+        payload['next'] = self.get_next_link()
+        payload['previous'] = self.get_previous_link()
+        payload['results'] = data
+        return payload
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'required': ['results'],
+            'properties': {
+                'count': {'type': 'integer', 'example': 123},
+                'count_is_approximate': {'type': 'boolean'},
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        if self.page_size_query_param:
+            try:
+                size = int(request.query_params[self.page_size_query_param])
+                if size > 0:
+                    return min(size, self.max_page_size)
+            except (KeyError, ValueError):
+                pass
+        return self.page_size
+
+    def get_ordering(self, queryset):
+        """Ordering fields of the queryset with the primary key appended"""
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering or self.default_ordering)
+        for name in ordering:
+            if not isinstance(name, str) or '__' in name or name.lstrip('-') == '?':
+                raise ValueError(f'KeysetPagination cannot order by {name!r}')
+        pk_names = {'pk', 'id', queryset.model._meta.pk.name}
+        if not any(name.lstrip('-') in pk_names for name in ordering):
+            descending = ordering[-1].startswith('-') if ordering else False
+            ordering.append('-pk' if descending else 'pk')
+        return ordering
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')).decode('utf-8'))
+            raw_values, reverse = payload['v'], bool(payload.get('r'))
+            if len(raw_values) != len(self.fields):
+                raise ValueError('cursor does not match ordering')
+            values = [
+                None if raw is None else field.to_python(raw)
+                for field, raw in zip(self.fields, raw_values)
+            ]
+        except (TypeError, ValueError, KeyError, ValidationError, UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+        return values, reverse
+
+    def encode_cursor(self, row, reverse):
+        values = [getattr(row, field.attname) for field in self.fields]
+        payload = json.dumps({'v': values, 'r': int(reverse)}, default=_encode_value, separators=(',', ':'))
+        encoded = base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if not self.has_next or self.last_row is None:
+            return None
+        return self.encode_cursor(self.last_row, reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.first_row is None:
+            return remove_query_param(self.request.build_absolute_uri(), self.cursor_query_param)
+        return self.encode_cursor(self.first_row, reverse=True)
+
+    def _get_field(self, model, name):
+        if name == 'pk':
+            return model._meta.pk
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            raise ValueError(f'KeysetPagination cannot order by {name!r}')
+        if field.null or not field.concrete:
+            raise ValueError(f'KeysetPagination needs non-null columns, {name!r} is nullable')
+        return field
+
+    @staticmethod
+    def _invert(name):
+        return name[1:] if name.startswith('-') else f'-{name}'
+
+    def _seek_condition(self, ordering, values):
+        """Rows strictly after ``values`` in ``ordering``
+
+        Expanded as ``a >= x AND (a > x OR (a = x AND (b > y OR ...)))`` so
+        the leading column bounds an index range scan.
+        """
+        condition = None
+        for name, value in reversed(list(zip(ordering, values))):
+            field = name.lstrip('-')
+            lookup = 'lt' if name.startswith('-') else 'gt'
+            after = Q(**{f'{field}__{lookup}': value})
+            if condition is None:
+                condition = after
+            else:
+                condition = after | (Q(**{field: value}) & condition)
+        first_name, first_value = ordering[0], values[0]
+        bound = 'lte' if first_name.startswith('-') else 'gte'
+        return Q(**{f"{first_name.lstrip('-')}__{bound}": first_value}) & condition
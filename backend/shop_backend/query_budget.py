@@ -0,0 +1,299 @@
+"""
+Per-request SQL query budgets and N+1 detection.
+
+``QueryBudgetMiddleware`` records every query executed while a request is
+handled, groups them by normalized SQL fingerprint and the project call site
+that issued them, and compares the total against ``QUERY_BUDGETS``. Overruns
+and repeated fingerprints are logged and sent through the
+``query_budget_exceeded`` signal; with ``QUERY_BUDGET_RAISE`` enabled (as the
+test runner and test helpers do) they raise ``QueryBudgetExceeded`` instead.
+"""
+
+import logging
+import os
+import re
+import sys
+import time
+from collections import defaultdict
+from contextlib import ExitStack, asynccontextmanager, contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connections
+from django.dispatch import Signal
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+logger = logging.getLogger(__name__)
+
+# Sent with sender=QueryBudgetMiddleware, view_name, budget and report
+query_budget_exceeded = Signal()
+
+DEFAULT_BUDGET = 50
+DEFAULT_REPEAT_THRESHOLD = 5
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\bIN\s*\((?:\s*\?\s*,?)+\)', re.IGNORECASE)
+_PLACEHOLDER = re.compile(r'%s|\$\d+')
+_WHITESPACE = re.compile(r'\s+')
+
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SKIP_PATHS = (
+    os.path.abspath(__file__),
+    os.path.join(_PROJECT_ROOT, 'manage.py'),
+    os.path.join(_PROJECT_ROOT, 'shop_backend', 'wsgi.py'),
+    os.path.join(_PROJECT_ROOT, 'shop_backend', 'asgi.py'),
+    os.sep + 'site-packages' + os.sep,
+    os.sep + 'dist-packages' + os.sep,
+)
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised when a request exceeds its query budget or repeats a query"""
+
+
+def fingerprint_sql(sql):
+    """Normalize SQL so queries differing only in literals share a fingerprint"""
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _PLACEHOLDER.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    sql = _IN_LIST.sub('IN (...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def _call_site():
+    """Return 'path:line in function' for the innermost project frame"""
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(_PROJECT_ROOT) and not any(skip in filename for skip in _SKIP_PATHS):
+            return '%s:%d in %s' % (
+                os.path.relpath(filename, _PROJECT_ROOT), frame.f_lineno, frame.f_code.co_name
+            )
+        frame = frame.f_back
+    return 'unknown'
+
+
+class QueryReport:
+    """Queries recorded for one request or block, grouped by fingerprint"""
+
+    def __init__(self, repeat_threshold=DEFAULT_REPEAT_THRESHOLD):
+        self.repeat_threshold = repeat_threshold
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = defaultdict(lambda: {'count': 0, 'duration': 0.0, 'call_sites': defaultdict(int)})
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            entry = self.fingerprints[fingerprint_sql(sql)]
+            entry['count'] += 1
+            entry['duration'] += elapsed
+            entry['call_sites'][_call_site()] += 1
+            self.count += 1
+            self.duration += elapsed
+
+    @contextmanager
+    def capture(self):
+        """Record queries on every configured database for the block"""
+        with ExitStack() as stack:
+            self._install(stack)
+            yield self
+
+    @asynccontextmanager
+    async def acapture(self):
+        """``capture`` for async code
+
+        Connections are thread local and the async ORM runs queries on the
+        thread that ``sync_to_async`` uses for this request, so the wrappers
+        are installed on that thread's connections.
+        """
+        stack = ExitStack()
+        await sync_to_async(self._install)(stack)
+        try:
+            yield self
+        finally:
+            await sync_to_async(stack.close)()
+
+    def _install(self, stack):
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(self))
+
+    @property
+    def repeated(self):
+        """Fingerprints executed at least ``repeat_threshold`` times (likely N+1)"""
+        return {
+            fingerprint: entry
+            for fingerprint, entry in self.fingerprints.items()
+            if entry['count'] >= self.repeat_threshold
+        }
+
+    def summary(self, limit=5):
+        lines = [f'{self.count} queries in {self.duration * 1000:.1f}ms']
+        ordered = sorted(self.fingerprints.items(), key=lambda item: -item[1]['count'])
+        for fingerprint, entry in ordered[:limit]:
+            sites = ', '.join(
+                f'{site} (x{count})' for site, count in
+                sorted(entry['call_sites'].items(), key=lambda item: -item[1])[:3]
+            )
+            lines.append(f"  x{entry['count']} {fingerprint[:200]}\n      from {sites}")
+        return '\n'.join(lines)
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'duration_ms': round(self.duration * 1000, 2),
+            'repeated': {
+                fingerprint: {
+                    'count': entry['count'],
+                    'call_sites': dict(entry['call_sites']),
+                }
+                for fingerprint, entry in self.repeated.items()
+            },
+        }
+
+
+def get_query_budget(view_name):
+    """Look up the budget for a namespaced view name such as 'products:product-list'
+
+    Falls back to the route's basename entry ('products:product') and then to
+    ``QUERY_BUDGET_DEFAULT``.
+    """
+    budgets = getattr(settings, 'QUERY_BUDGETS', {})
+    if view_name:
+        if view_name in budgets:
+            return budgets[view_name]
+        namespace, _, url_name = view_name.rpartition(':')
+        basename = url_name.split('-')[0]
+        key = f'{namespace}:{basename}' if namespace else basename
+        if key in budgets:
+            return budgets[key]
+    return getattr(settings, 'QUERY_BUDGET_DEFAULT', DEFAULT_BUDGET)
+
+
+def check_report(report, budget, view_name=None, sender=None):
+    """Log, signal and optionally raise for budget overruns and N+1 patterns"""
+    problems = []
+    if budget is not None and report.count > budget:
+        problems.append(f'{report.count} queries exceeds budget of {budget}')
+    if report.repeated:
+        problems.append(
+            f'{len(report.repeated)} query fingerprint(s) repeated '
+            f'{report.repeat_threshold}+ times (possible N+1)'
+        )
+    if not problems:
+        return
+
+    message = f"{view_name or 'block'}: {'; '.join(problems)}\n{report.summary()}"
+    logger.warning(message, extra={
+        'view_name': view_name,
+        'query_budget': budget,
+        'query_report': report.as_dict(),
+    })
+    query_budget_exceeded.send(
+        sender=sender or QueryBudgetMiddleware,
+        view_name=view_name,
+        budget=budget,
+        report=report,
+    )
+    if getattr(settings, 'QUERY_BUDGET_RAISE', False):
+        raise QueryBudgetExceeded(message)
+
+
+class QueryBudgetMiddleware:
+    """Count SQL queries per request and enforce per-endpoint budgets
+
+    Works under WSGI and ASGI; as an async middleware it keeps async views
+    off the sync thread pool.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not getattr(settings, 'QUERY_BUDGET_ENABLED', True):
+            return self.get_response(request)
+
+        report = self.start_report(request)
+        with report.capture():
+            response = self.get_response(request)
+        return self.finish_report(request, response, report)
+
+    async def __acall__(self, request):
+        if not getattr(settings, 'QUERY_BUDGET_ENABLED', True):
+            return await self.get_response(request)
+
+        report = self.start_report(request)
+        async with report.acapture():
+            response = await self.get_response(request)
+        return self.finish_report(request, response, report)
+
+    def start_report(self, request):
+        report = QueryReport(
+            repeat_threshold=getattr(settings, 'QUERY_BUDGET_REPEAT_THRESHOLD', DEFAULT_REPEAT_THRESHOLD)
+        )
+        request.query_report = report
+        return report
+
+    def finish_report(self, request, response, report):
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else None
+        if settings.DEBUG:
+            response['X-Query-Count'] = str(report.count)
+        check_report(report, get_query_budget(view_name), view_name=view_name, sender=self.__class__)
+        return response
+
+
+@contextmanager
+def assert_query_budget(budget, repeat_threshold=DEFAULT_REPEAT_THRESHOLD):
+    """Fail the block if it runs more than ``budget`` queries or repeats one
+
+    Usable around any code, including test client calls::
+
+        with assert_query_budget(6):
+            self.client.get('/api/v1/products/products/')
+    """
+    report = QueryReport(repeat_threshold=repeat_threshold)
+    with override_settings(QUERY_BUDGET_RAISE=True), report.capture():
+        yield report
+    with override_settings(QUERY_BUDGET_RAISE=True):
+        check_report(report, budget, sender=assert_query_budget)
+
+
+class QueryBudgetTestMixin:
+    """TestCase mixin that makes the middleware fail tests on budget overruns"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        override = override_settings(QUERY_BUDGET_ENABLED=True, QUERY_BUDGET_RAISE=True)
+        override.enable()
+        cls.addClassCleanup(override.disable)
+
+    def assertQueryBudget(self, budget, repeat_threshold=DEFAULT_REPEAT_THRESHOLD):
+        return assert_query_budget(budget, repeat_threshold=repeat_threshold)
+
+
+class QueryBudgetTestRunner(DiscoverRunner):
+    """Test runner that fails any test whose requests exceed their query budget (``TEST_RUNNER``)"""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.query_budget_settings = override_settings(QUERY_BUDGET_ENABLED=True, QUERY_BUDGET_RAISE=True)
+        self.query_budget_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.query_budget_settings.disable()
+        super().teardown_test_environment(**kwargs)
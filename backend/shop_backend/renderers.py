@@ -0,0 +1,116 @@
+"""
+Response renderers.
+
+``FastJSONRenderer`` is the default renderer. It encodes with orjson, several
+times faster than the stdlib encoder behind DRF's ``JSONRenderer``, and hands
+everything orjson doesn't encode natively (``Decimal``, datetimes, lazy
+translations, querysets, ...) to DRF's ``JSONEncoder``, so responses keep the
+same bytes. Indented output (``Accept: application/json; indent=4``), the
+non-compact/ASCII ``REST_FRAMEWORK`` options, integers beyond 64 bits and
+installs without orjson fall back to ``JSONRenderer``. Floats are written in
+orjson's shortest form (``1e16`` rather than ``1e+16``).
+
+``NDJSONRenderer`` and ``CSVRenderer`` back the streaming exports of
+``shop_backend.exports.StreamingExportMixin``; as regular renderers they
+render error responses and other non-streamed data in the same format.
+"""
+
+import csv
+import io
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_encoder = JSONEncoder()
+# Same escaping as JSONRenderer, for JSON embedded in <script> tags
+_LINE_SEPARATORS = ((b'\xe2\x80\xa8', b'\\u2028'), (b'\xe2\x80\xa9', b'\\u2029'))
+
+
+def dumps(value):
+    """Compact UTF-8 JSON bytes of ``value``, encoded like DRF's JSONRenderer"""
+    if orjson is None:
+        return JSONRenderer().render(value)
+    try:
+        ret = orjson.dumps(
+            value,
+            default=_encoder.default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+        )
+    except orjson.JSONEncodeError:
+        # e.g. integers beyond 64 bits
+        return JSONRenderer().render(value)
+    for separator, escaped in _LINE_SEPARATORS:
+        if separator in ret:
+            ret = ret.replace(separator, escaped)
+    return ret
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer encoding with orjson"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent is not None or not self.compact or self.ensure_ascii or orjson is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """Newline-delimited JSON: one line per row of a list, or a single line"""
+
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        rows = data if isinstance(data, list) else [data]
+        return b''.join(dumps(row) + b'\n' for row in rows)
+
+
+def csv_value(value):
+    """Cell text of a serialized value: nested data as JSON, None as an empty cell"""
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return dumps(value).decode()
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return value
+
+
+def csv_text(rows, columns, header=True):
+    """CSV text of ``rows`` (serialized dicts) in ``columns`` order"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(columns)
+    for row in rows:
+        writer.writerow([csv_value(row.get(column)) for column in columns])
+    return buffer.getvalue()
+
+
+class CSVRenderer(BaseRenderer):
+    """CSV with a header row; a paginated response renders its results"""
+
+    media_type = 'text/csv'
+    format = 'csv'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, dict) and isinstance(data.get('results'), list):
+            data = data['results']
+        rows = data if isinstance(data, list) else [data]
+        rows = [row if isinstance(row, dict) else {'value': row} for row in rows]
+        columns = list(dict.fromkeys(column for row in rows for column in row))
+        return csv_text(rows, columns).encode()
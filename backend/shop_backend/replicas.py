@@ -0,0 +1,341 @@
+"""
+Read-replica routing.
+
+``ReplicaRouter`` sends reads to a replica only inside requests that
+``ReplicaRoutingMiddleware`` marked as replica-safe: GET/HEAD requests to a
+viewset action listed in the viewset's ``replica_actions``, or to a view
+decorated with ``replica_read`` (or whose class sets ``replica_read = True``).
+Everything else reads from and writes to the primary: unsafe requests,
+management commands, tasks, and any read inside a transaction on the primary
+or after the request wrote something.
+
+After a successful write request the user is pinned to the primary for
+``REPLICA_STICKY_SECONDS``: a cookie for browser clients plus a key in the
+``REPLICA_PIN_CACHE`` cache for authenticated API clients (share that cache
+between workers, e.g. Redis, for the pin to hold across them).
+
+Each process checks its replicas every ``REPLICA_HEALTH_CHECK_INTERVAL``
+seconds from a background thread. A replica that fails the check or lags more
+than ``REPLICA_MAX_LAG_SECONDS`` behind is ejected until a later check passes;
+with no healthy replica reads go to the primary.
+
+Replicas are the aliases in ``REPLICA_DATABASES``. With none configured the
+router leaves every query on ``default``.
+"""
+
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.functional import SimpleLazyObject
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STICKY_SECONDS = 10
+DEFAULT_MAX_LAG_SECONDS = 5
+DEFAULT_HEALTH_CHECK_INTERVAL = 5
+DEFAULT_LAG_PROBE = 'shop_backend.replicas.replication_lag'
+PIN_COOKIE = 'primary_pin'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# ReadPolicy of the current request, if any
+_policy = contextvars.ContextVar('replica_read_policy', default=None)
+# Forces primary reads for a block (see primary_reads)
+_force_primary = contextvars.ContextVar('replica_force_primary', default=False)
+
+
+def replication_lag(connection):
+    """Seconds the database behind ``connection`` is behind its primary (0 for a primary)"""
+    with connection.cursor() as cursor:
+        if connection.vendor != 'postgresql':
+            cursor.execute('SELECT 1')
+            return 0.0
+        # Caught up when everything received has been replayed; the replay
+        # timestamp alone grows while the primary is idle
+        cursor.execute(
+            'SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 '
+            'WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+            'ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END'
+        )
+        return float(cursor.fetchone()[0])
+
+
+class ReplicaPool:
+    """Health and lag state of the replicas, refreshed in the background"""
+
+    def __init__(self, aliases=None, max_lag=None, check_interval=None, lag_probe=None):
+        self.aliases = list(aliases if aliases is not None else getattr(settings, 'REPLICA_DATABASES', []))
+        self.max_lag = max_lag if max_lag is not None else getattr(
+            settings, 'REPLICA_MAX_LAG_SECONDS', DEFAULT_MAX_LAG_SECONDS
+        )
+        self.check_interval = check_interval if check_interval is not None else getattr(
+            settings, 'REPLICA_HEALTH_CHECK_INTERVAL', DEFAULT_HEALTH_CHECK_INTERVAL
+        )
+        self.lag_probe = lag_probe or import_string(getattr(settings, 'REPLICA_LAG_PROBE', DEFAULT_LAG_PROBE))
+        self._lock = threading.Lock()
+        # Unknown replicas are not used until their first check passes
+        self._state = {
+            alias: {'healthy': False, 'lag': None, 'error': None, 'checked_at': None}
+            for alias in self.aliases
+        }
+        self._thread = None
+        self._stop = threading.Event()
+
+    def check(self, alias):
+        """Probe one replica and update its state; returns whether it is usable"""
+        try:
+            lag = self.lag_probe(connections[alias])
+            error = None
+        except Exception as exc:
+            lag, error = None, str(exc)
+            # Drop the broken connection so the next check reconnects
+            connections[alias].close()
+        healthy = error is None and lag <= self.max_lag
+        with self._lock:
+            state = self._state[alias]
+            if state['healthy'] != healthy:
+                if healthy:
+                    logger.info('Replica %s back in rotation (lag %.2fs)', alias, lag)
+                elif state['checked_at'] is not None:
+                    logger.warning(
+                        'Replica %s ejected: %s', alias,
+                        error or f'lag {lag:.2f}s exceeds {self.max_lag}s'
+                    )
+            state.update(healthy=healthy, lag=lag, error=error, checked_at=time.time())
+        return healthy
+
+    def check_all(self):
+        for alias in self.aliases:
+            self.check(alias)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check_all()
+            self._stop.wait(self.check_interval)
+
+    def start(self):
+        """Start the background health checks once per process"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='replica-health', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def healthy(self):
+        with self._lock:
+            return [alias for alias in self.aliases if self._state[alias]['healthy']]
+
+    def choose(self):
+        """A healthy replica alias, or None to use the primary"""
+        if not self.aliases:
+            return None
+        self.start()
+        healthy = self.healthy()
+        return random.choice(healthy) if healthy else None
+
+    def status(self):
+        """{alias: {'healthy', 'lag', 'error', 'checked_at'}}"""
+        with self._lock:
+            return {alias: dict(state) for alias, state in self._state.items()}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ReplicaPool()
+    return _pool
+
+
+def _request_user_id(request):
+    """Id of the authenticated user if already resolved, without triggering a lookup"""
+    user = request.__dict__.get('user')
+    if user is None or isinstance(user, SimpleLazyObject):
+        # DRF replaces the lazy session user once it has authenticated
+        user = request.__dict__.get('_cached_user')
+    if user is None or not getattr(user, 'is_authenticated', False):
+        return None
+    return user.pk
+
+
+def _pin_key(user_id):
+    return f'replica-pin:{user_id}'
+
+
+def _pin_cache():
+    return caches[getattr(settings, 'REPLICA_PIN_CACHE', 'default')]
+
+
+def pin_to_primary(request, response):
+    """Send the requesting user's reads to the primary for REPLICA_STICKY_SECONDS"""
+    seconds = getattr(settings, 'REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+    if not seconds:
+        return
+    user_id = _request_user_id(request)
+    if user_id is not None:
+        _pin_cache().set(_pin_key(user_id), True, timeout=seconds)
+    response.set_cookie(PIN_COOKIE, '1', max_age=seconds, httponly=True, samesite='Lax')
+
+
+class ReadPolicy:
+    """Replica eligibility of one request (or ``replica_reads`` block)"""
+
+    def __init__(self, request=None, allow_replica=False):
+        self.request = request
+        self.allow_replica = allow_replica
+        self.wrote = False
+        self.alias = None
+        if request is None:
+            self._pinned = False
+        else:
+            self._pinned = True if request.COOKIES.get(PIN_COOKIE) else None
+
+    def pinned(self):
+        if self._pinned is None:
+            user_id = _request_user_id(self.request)
+            if user_id is None:
+                # Not authenticated (yet); decide again on the next query
+                return False
+            self._pinned = bool(_pin_cache().get(_pin_key(user_id)))
+        return self._pinned
+
+    def read_alias(self):
+        if not self.allow_replica or self.wrote or self.pinned():
+            return None
+        if self.alias is None:
+            # One replica per request, so its reads see a consistent snapshot
+            self.alias = get_pool().choose()
+        return self.alias
+
+
+class ReplicaRouter:
+    """Route reads of replica-safe requests to a healthy replica"""
+
+    def db_for_read(self, model, **hints):
+        if _force_primary.get():
+            return DEFAULT_DB_ALIAS
+        policy = _policy.get()
+        if policy is None or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return policy.read_alias() or DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        policy = _policy.get()
+        if policy is not None:
+            # Reads after a write in the same request must see it
+            policy.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *getattr(settings, 'REPLICA_DATABASES', [])}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive the schema through replication
+        if db in getattr(settings, 'REPLICA_DATABASES', []):
+            return False
+        return None
+
+
+@contextmanager
+def primary_reads():
+    """Read from the primary inside the block, e.g. to fill a shared cache"""
+    token = _force_primary.set(True)
+    try:
+        yield
+    finally:
+        _force_primary.reset(token)
+
+
+@contextmanager
+def replica_reads():
+    """Allow replica reads outside a request, e.g. in reporting commands"""
+    policy = ReadPolicy(allow_replica=True)
+    token = _policy.set(policy)
+    try:
+        yield
+    finally:
+        _policy.reset(token)
+
+
+def replica_read(view):
+    """Mark a function view as safe to serve from a replica"""
+    view.replica_read = True
+    return view
+
+
+def view_allows_replica(view_func, method):
+    """Whether ``view_func`` serves ``method`` requests from replicas"""
+    if getattr(view_func, 'replica_read', False):
+        return True
+    view_class = getattr(view_func, 'cls', None)
+    if view_class is None:
+        return False
+    actions = getattr(view_func, 'actions', None)
+    if actions is None:
+        return getattr(view_class, 'replica_read', False)
+    # HEAD is served by the GET action
+    action = actions.get(method.lower()) or (actions.get('get') if method == 'HEAD' else None)
+    return action in getattr(view_class, 'replica_actions', ())
+
+
+class ReplicaRoutingMiddleware:
+    """Mark replica-safe requests and pin users to the primary after writes"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = _policy.set(ReadPolicy(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            _policy.reset(token)
+        return self.finish(request, response)
+
+    async def __acall__(self, request):
+        token = _policy.set(ReadPolicy(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            _policy.reset(token)
+        return self.finish(request, response)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        policy = _policy.get()
+        if policy is not None and request.method in SAFE_METHODS:
+            policy.allow_replica = view_allows_replica(view_func, request.method)
+
+    def finish(self, request, response):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            pin_to_primary(request, response)
+        return response
+
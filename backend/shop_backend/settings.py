@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -37,6 +38,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     
     # Third party apps
     'rest_framework',
@@ -48,6 +50,8 @@ INSTALLED_APPS = [
     'products',
     'orders',
     'payments',
+    'taskqueue',
+    'sequences',
 ]
 
 MIDDLEWARE = [
@@ -59,6 +63,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'shop_backend.replicas.ReplicaRoutingMiddleware',
+    'shop_backend.query_budget.QueryBudgetMiddleware',
 ]
 
 ROOT_URLCONF = 'shop_backend.urls'
@@ -100,6 +106,23 @@ DATABASES = {
     }
 }
 
+# Read replicas (see shop_backend/replicas.py): each host in the
+# comma-separated DATABASE_REPLICA_HOSTS becomes an alias replica_1,
+# replica_2, ... with the primary's credentials. Replica-safe catalog reads
+# go to a healthy replica lagging at most REPLICA_MAX_LAG_SECONDS; a user who
+# just wrote reads from the primary for REPLICA_STICKY_SECONDS.
+DATABASE_REPLICA_HOSTS = [
+    host.strip() for host in os.environ.get('DATABASE_REPLICA_HOSTS', '').split(',') if host.strip()
+]
+for _index, _host in enumerate(DATABASE_REPLICA_HOSTS, 1):
+    DATABASES[f'replica_{_index}'] = {**DATABASES['default'], 'HOST': _host, 'TEST': {'MIRROR': 'default'}}
+REPLICA_DATABASES = [alias for alias in DATABASES if alias.startswith('replica_')]
+DATABASE_ROUTERS = ['shop_backend.replicas.ReplicaRouter']
+REPLICA_STICKY_SECONDS = 10
+REPLICA_MAX_LAG_SECONDS = 5
+REPLICA_HEALTH_CHECK_INTERVAL = 5
+REPLICA_PIN_CACHE = 'default'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -152,12 +175,62 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'shop_backend.renderers.FastJSONRenderer',
     ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20,
 }
 
+# Compiled list serialization (see shop_backend/compiled_serializers.py):
+# serializers whose Meta.list_serializer_class is CompiledListSerializer
+# render many=True output with a generated function. False renders with DRF.
+COMPILED_SERIALIZERS = True
+
+# ID sequences (see sequences/allocator.py): order numbers, payment and
+# refund IDs and SKUs are numbered from per-prefix sequences, leased this
+# many numbers at a time per process. On PostgreSQL the size is fixed when
+# the sequence is created; change it with `manage.py id_sequences --block-size`
+ID_SEQUENCE_BLOCK_SIZE = 100
+
+# Streaming exports (see shop_backend/exports.py): ?format=ndjson / ?format=csv
+# on order, payment and activity listings stream every matching row, read
+# through a server-side cursor this many rows at a time
+EXPORT_CHUNK_SIZE = 2000
+
+# Payment webhooks (see payments/webhooks.py): deliveries are verified with
+# the active PaymentGateway of their type (Stripe: settings['webhook_secret'],
+# PayPal: settings['webhook_id']), stored in WebhookEvent and applied by the
+# payments task queue. Stripe signatures older than this many seconds are
+# rejected as replays.
+WEBHOOK_SIGNATURE_TOLERANCE = 300
+
+# Payment gateway clients (see payments/clients.py): per-gateway keep-alive
+# connection pools, a deadline per call covering its retries, retries capped
+# at PAYMENT_GATEWAY_RETRY_RATIO of the calls, and a circuit breaker that
+# fails calls fast for BREAKER_COOLDOWN seconds once BREAKER_THRESHOLD of the
+# last BREAKER_WINDOW calls (at least BREAKER_MIN_CALLS) failed
+PAYMENT_GATEWAY_POOL_SIZE = 10
+PAYMENT_GATEWAY_CONNECT_TIMEOUT = 3.05
+PAYMENT_GATEWAY_DEADLINE = 15
+PAYMENT_GATEWAY_MAX_ATTEMPTS = 3
+PAYMENT_GATEWAY_RETRY_RATIO = 0.2
+PAYMENT_GATEWAY_BREAKER_WINDOW = 50
+PAYMENT_GATEWAY_BREAKER_MIN_CALLS = 20
+PAYMENT_GATEWAY_BREAKER_THRESHOLD = 0.5
+PAYMENT_GATEWAY_BREAKER_COOLDOWN = 30
+
+# Payment routing (see payments/routing.py): eligible gateways are ranked by
+# fees plus, once a gateway made ROUTING_MIN_CALLS calls in the last
+# GATEWAY_STATS_WINDOW seconds, amount * (FAILURE_COST * failure rate +
+# LATENCY_COST * mean seconds per call) in this process. Gateway
+# configurations are reloaded when one is saved or deleted, and at least
+# every GATEWAY_CACHE_SECONDS
+PAYMENT_GATEWAY_CACHE_SECONDS = 60
+PAYMENT_GATEWAY_STATS_WINDOW = 300
+PAYMENT_ROUTING_MIN_CALLS = 20
+PAYMENT_ROUTING_FAILURE_COST = 0.05
+PAYMENT_ROUTING_LATENCY_COST = 0.001
+
 # CORS settings for Flutter web
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
@@ -174,3 +247,141 @@ AUTH_USER_MODEL = 'accounts.User'
 SECURE_BROWSER_XSS_FILTER = True
 SECURE_CONTENT_TYPE_NOSNIFF = True
 X_FRAME_OPTIONS = 'DENY'
+
+# Caches. The 'catalog' alias backs products/cache.py: an in-process LRU
+# bounded by MAX_ENTRIES/TIMEOUT, or Redis when CATALOG_CACHE_URL is set
+# (e.g. redis://127.0.0.1:6379/1 for a local stand-in). With the in-process
+# LRU each worker has its own entries and the invalidation versions are kept
+# in the database (products.CatalogVersion).
+CATALOG_CACHE_URL = os.environ.get('CATALOG_CACHE_URL')
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'catalog': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+            'CULL_FREQUENCY': 10,
+        },
+    },
+}
+if CATALOG_CACHE_URL:
+    CACHES['catalog'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': CATALOG_CACHE_URL,
+        'TIMEOUT': 300,
+        'KEY_PREFIX': 'shop',
+    }
+
+# HTTP caching (see shop_backend/conditional.py): patch_cache_control()
+# options per namespaced URL name, overriding the viewsets' cache_policies,
+# e.g. 'products:product-list': {'public': True, 'max_age': 30, 'stale_while_revalidate': 120}
+HTTP_CACHE_POLICIES = {}
+
+# Popular products (see products/ranking.py), rebuilt by rebuild_popularity
+POPULARITY_SCORER = 'products.ranking.WeightedPopularityScorer'
+POPULARITY_TOP_N = 50
+POPULARITY_WEIGHTS = {}
+
+# Product view counting (see products/tracking.py): each worker flushes its
+# buffered views after this many seconds or views; hourly stats older than
+# VIEW_STATS_RETENTION_DAYS are removed by prune_view_stats
+VIEW_COUNT_FLUSH_INTERVAL = 30
+VIEW_COUNT_MAX_PENDING = 1000
+VIEW_STATS_RETENTION_DAYS = 90
+
+# User activity log (see accounts/activity.py and accounts/partitions.py):
+# each worker writes its buffered events in bulk after this many seconds or
+# events. On PostgreSQL the table is partitioned by month;
+# manage_activity_partitions creates partitions ahead and drops months past
+# the retention period. The activity API lists at most
+# USER_ACTIVITY_MAX_RANGE_DAYS per request (default window: the last
+# USER_ACTIVITY_DEFAULT_DAYS).
+USER_ACTIVITY_FLUSH_INTERVAL = 10
+USER_ACTIVITY_MAX_PENDING = 500
+USER_ACTIVITY_PARTITIONS_AHEAD = 2
+USER_ACTIVITY_RETENTION_MONTHS = 12
+USER_ACTIVITY_DEFAULT_DAYS = 30
+USER_ACTIVITY_MAX_RANGE_DAYS = 366
+
+# Stock reservations (see products/inventory.py): seconds a checkout holds
+# stock before expire_stock_reservations returns it
+STOCK_RESERVATION_TTL = 15 * 60
+
+# Coupon rules (see orders/coupons.py) compiled per process are rebuilt when
+# the coupon or the category tree changes, and at least this often
+COUPON_RULE_CACHE_SECONDS = 300
+
+# Background tasks (see taskqueue/): run_task_worker processes them. Failed
+# tasks are retried after TASK_RETRY_BACKOFF * 2**attempt seconds (jittered,
+# capped at TASK_RETRY_BACKOFF_MAX); a task held by a worker for longer than
+# TASK_VISIBILITY_TIMEOUT is assumed lost and released. Use
+# 'taskqueue.brokers.EagerBroker' to run tasks in-process during development.
+TASK_BROKER = 'taskqueue.brokers.DatabaseBroker'
+TASK_DEFAULT_MAX_ATTEMPTS = 5
+TASK_RETRY_BACKOFF = 10
+TASK_RETRY_BACKOFF_MAX = 60 * 60
+TASK_VISIBILITY_TIMEOUT = 5 * 60
+TASK_RESULT_TTL_DAYS = 7
+
+# Password reset emails link here with ?uid=...&token=...
+PASSWORD_RESET_URL = os.environ.get('PASSWORD_RESET_URL', 'http://localhost:3000/reset-password')
+
+# Query budgets (see shop_backend/query_budget.py)
+# Keys are namespaced URL names; a bare router basename ('products:product')
+# covers every action of that viewset that has no explicit entry.
+QUERY_BUDGET_ENABLED = True
+QUERY_BUDGET_RAISE = False
+# Tests run with QUERY_BUDGET_RAISE on, so any overrun fails the suite
+TEST_RUNNER = 'shop_backend.query_budget.QueryBudgetTestRunner'
+QUERY_BUDGET_DEFAULT = 30
+QUERY_BUDGET_REPEAT_THRESHOLD = 5
+QUERY_BUDGETS = {
+    # products/urls.py
+    'products:category': 6,
+    'products:category-list': 6,
+    'products:category-products': 8,
+    'products:brand': 6,
+    'products:brand-products': 8,
+    'products:product': 10,
+    'products:product-list': 8,
+    'products:product-detail': 10,
+    'products:product-featured': 8,
+    'products:product-popular': 8,
+    'products:product-add-review': 10,
+    'products:review': 6,
+    'products:productvariant': 6,
+    'products:product-search': 12,
+    'products:async': 6,
+    'products:async-product-detail': 8,
+    'products:async-product-search': 10,
+
+    # orders/urls.py
+    'orders:order': 8,
+    'orders:order-list': 6,
+    'orders:order-detail': 10,
+    'orders:orderitem': 6,
+    'orders:cart': 12,
+    'orders:cartitem': 8,
+    'orders:coupon': 6,
+    'orders:checkout': 20,
+
+    # payments/urls.py
+    'payments:payment': 10,
+    'payments:paymentgateway': 6,
+    'payments:refund': 8,
+    'payments:payment-intent': 10,
+    'payments:payment-webhook': 10,
+    'payments:payment-methods': 6,
+
+    # accounts/urls.py
+    'accounts:user': 6,
+    'accounts:address': 6,
+    'accounts:userprofile': 6,
+    'accounts:useractivity': 6,
+    'accounts:login': 8,
+    'accounts:register': 10,
+}
@@ -0,0 +1,176 @@
+import datetime
+import uuid
+from decimal import Decimal
+from unittest import mock, skipIf
+
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase
+from django.utils.translation import gettext_lazy
+from products.models import Product
+from products.views import ProductViewSet
+from rest_framework.renderers import JSONRenderer
+
+from . import renderers, replicas
+
+
+class StaticPool:
+    """A pool whose replica is always healthy"""
+
+    def choose(self):
+        return 'replica_1'
+
+
+class ReplicaRouterTests(SimpleTestCase):
+    databases = {DEFAULT_DB_ALIAS}
+
+    def setUp(self):
+        patcher = mock.patch.object(replicas, '_pool', StaticPool())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = replicas.ReplicaRouter()
+
+    def read_alias(self):
+        return self.router.db_for_read(Product)
+
+    def test_reads_outside_requests_use_the_primary(self):
+        self.assertEqual(self.read_alias(), DEFAULT_DB_ALIAS)
+
+    def test_replica_safe_reads_use_a_replica(self):
+        with replicas.replica_reads():
+            self.assertEqual(self.read_alias(), 'replica_1')
+            with replicas.primary_reads():
+                self.assertEqual(self.read_alias(), DEFAULT_DB_ALIAS)
+
+    def test_writes_go_to_the_primary_and_pin_later_reads(self):
+        with replicas.replica_reads():
+            self.assertEqual(self.router.db_for_write(Product), DEFAULT_DB_ALIAS)
+            self.assertEqual(self.read_alias(), DEFAULT_DB_ALIAS)
+
+    def test_reads_in_a_transaction_use_the_primary(self):
+        with replicas.replica_reads(), transaction.atomic():
+            self.assertEqual(self.read_alias(), DEFAULT_DB_ALIAS)
+
+    def test_pinned_client_reads_from_the_primary(self):
+        request = RequestFactory().get('/', HTTP_COOKIE=f'{replicas.PIN_COOKIE}=1')
+        policy = replicas.ReadPolicy(request, allow_replica=True)
+
+        self.assertIsNone(policy.read_alias())
+
+    def test_successful_write_request_sets_the_pin(self):
+        middleware = replicas.ReplicaRoutingMiddleware(lambda request: HttpResponse())
+
+        write = middleware(RequestFactory().post('/'))
+        read = middleware(RequestFactory().get('/'))
+
+        self.assertIn(replicas.PIN_COOKIE, write.cookies)
+        self.assertNotIn(replicas.PIN_COOKIE, read.cookies)
+
+    def test_replica_actions(self):
+        self.assertTrue(replicas.view_allows_replica(ProductViewSet.as_view({'get': 'list'}), 'GET'))
+        self.assertTrue(replicas.view_allows_replica(ProductViewSet.as_view({'get': 'list'}), 'HEAD'))
+        self.assertFalse(replicas.view_allows_replica(ProductViewSet.as_view({'post': 'create'}), 'POST'))
+
+
+class ReplicaPoolTests(SimpleTestCase):
+    databases = {DEFAULT_DB_ALIAS}
+
+    def setUp(self):
+        self.lag = 0.0
+        self.pool = replicas.ReplicaPool(
+            aliases=[DEFAULT_DB_ALIAS], max_lag=5, check_interval=60, lag_probe=self.probe
+        )
+        # Checks are driven by the tests, not the background thread
+        patcher = mock.patch.object(self.pool, 'start')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def probe(self, connection):
+        if isinstance(self.lag, Exception):
+            raise self.lag
+        return self.lag
+
+    def test_unchecked_replica_is_not_used(self):
+        self.assertIsNone(self.pool.choose())
+
+    def test_lagging_replica_is_ejected_until_it_catches_up(self):
+        self.assertTrue(self.pool.check(DEFAULT_DB_ALIAS))
+        self.assertEqual(self.pool.choose(), DEFAULT_DB_ALIAS)
+
+        self.lag = 6.0
+        with self.assertLogs('shop_backend.replicas', 'WARNING'):
+            self.assertFalse(self.pool.check(DEFAULT_DB_ALIAS))
+        self.assertIsNone(self.pool.choose())
+        self.assertEqual(self.pool.status()[DEFAULT_DB_ALIAS]['lag'], 6.0)
+
+        self.lag = 1.0
+        self.pool.check(DEFAULT_DB_ALIAS)
+        self.assertEqual(self.pool.choose(), DEFAULT_DB_ALIAS)
+
+    def test_failing_replica_is_ejected(self):
+        self.pool.check(DEFAULT_DB_ALIAS)
+        self.lag = OSError('connection refused')
+
+        with self.assertLogs('shop_backend.replicas', 'WARNING'):
+            self.pool.check(DEFAULT_DB_ALIAS)
+
+        self.assertEqual(self.pool.status()[DEFAULT_DB_ALIAS]['error'], 'connection refused')
+        self.assertIsNone(self.pool.choose())
+
+    def test_primary_reports_no_lag(self):
+        self.assertEqual(replicas.replication_lag(connections[DEFAULT_DB_ALIAS]), 0.0)
+
+
+@skipIf(renderers.orjson is None, 'orjson is not installed')
+class FastJSONRendererTests(SimpleTestCase):
+    data = {
+        'price': Decimal('19.90'),
+        'created_at': datetime.datetime(2024, 5, 1, 12, 30, 15, 123456, tzinfo=datetime.timezone.utc),
+        'day': datetime.date(2024, 5, 1),
+        'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        'label': gettext_lazy('Price'),
+        'text': 'caf\u00e9 \u2028 <b>',
+        'nested': [{'n': 1, 'ok': True, 'none': None}],
+        1: 'integer key',
+    }
+
+    def test_same_bytes_as_drf(self):
+        self.assertEqual(renderers.FastJSONRenderer().render(self.data), JSONRenderer().render(self.data))
+
+    def test_falls_back_for_what_orjson_cannot_encode(self):
+        self.assertEqual(renderers.dumps({'big': 2 ** 70}), b'{"big":1180591620717411303424}')
+
+    def test_indented_output_uses_drf(self):
+        rendered = renderers.FastJSONRenderer().render(self.data, 'application/json; indent=2')
+
+        self.assertEqual(rendered, JSONRenderer().render(self.data, 'application/json; indent=2'))
+        self.assertIn(b'\n  ', rendered)
+
+    def test_ascii_output_uses_drf(self):
+        renderer = type('AsciiRenderer', (renderers.FastJSONRenderer,), {'ensure_ascii': True})()
+
+        self.assertEqual(renderer.render(self.data), JSONRenderer.render(renderer, self.data))
+        self.assertIn(b'\\u00e9', renderer.render(self.data))
+
+    def test_no_data(self):
+        self.assertEqual(renderers.FastJSONRenderer().render(None), b'')
+
+
+class ExportRendererTests(SimpleTestCase):
+    def test_ndjson_writes_a_line_per_row(self):
+        rendered = renderers.NDJSONRenderer().render([{'id': 1}, {'id': 2}])
+
+        self.assertEqual(rendered, b'{"id":1}\n{"id":2}\n')
+        self.assertEqual(renderers.NDJSONRenderer().render({'error': 'Not found'}), b'{"error":"Not found"}\n')
+
+    def test_csv_renders_the_results_of_a_page(self):
+        page = {'next': None, 'results': [
+            {'id': 1, 'paid': True, 'note': None, 'tags': ['a', 'b']},
+            {'id': 2, 'paid': False, 'extra': 'x'},
+        ]}
+
+        rendered = renderers.CSVRenderer().render(page).decode()
+
+        self.assertEqual(rendered.splitlines(), [
+            'id,paid,note,tags,extra', '1,true,,"[""a"",""b""]",', '2,false,,,x',
+        ])
@@ -0,0 +1,21 @@
+from django.contrib import admin
+from django.utils import timezone
+from .models import Task
+
+
+@admin.register(Task)
+class TaskAdmin(admin.ModelAdmin):
+    """Background task admin"""
+    list_display = ('id', 'name', 'queue', 'status', 'attempts', 'max_attempts', 'run_at', 'finished_at')
+    list_filter = ('status', 'queue', 'name')
+    search_fields = ('name', 'dedup_key', 'last_error')
+    ordering = ('-created_at',)
+    readonly_fields = ('locked_by', 'locked_at', 'started_at', 'finished_at', 'created_at', 'updated_at')
+    actions = ['retry_tasks']
+
+    @admin.action(description='Retry selected failed tasks now')
+    def retry_tasks(self, request, queryset):
+        updated = queryset.filter(status__in=['failed', 'cancelled']).update(
+            status='queued', attempts=0, run_at=timezone.now(), finished_at=None, locked_by='', locked_at=None
+        )
+        self.message_user(request, f'{updated} task(s) queued again')
@@ -0,0 +1,344 @@
+"""
+Task brokers.
+
+A broker stores queued messages and hands them to workers. ``Broker``
+defines the interface; the worker only talks to it. Select one with
+``TASK_BROKER`` (a dotted path):
+
+* ``DatabaseBroker`` (default) keeps messages in the ``Task`` table. Enqueue
+  is an ``INSERT`` in the caller's transaction, so a task is only visible to
+  workers once the request's writes commit, and rolled back with them.
+  Workers claim batches with ``SELECT ... FOR UPDATE SKIP LOCKED``.
+* ``InMemoryBroker`` keeps messages in process memory, for tests and
+  scripts that drive ``Worker.run_once`` themselves.
+* ``EagerBroker`` runs each task in-process right after the enqueueing
+  transaction commits, for local development without a worker.
+"""
+
+import itertools
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Count, DurationField, ExpressionWrapper, F, Max, Sum
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BROKER = 'taskqueue.brokers.DatabaseBroker'
+
+
+class Message:
+    """One queued task call as seen by brokers and workers"""
+
+    __slots__ = ('id', 'name', 'args', 'kwargs', 'queue', 'dedup_key', 'attempts', 'max_attempts', 'run_at')
+
+    def __init__(self, name, args=(), kwargs=None, queue='default', dedup_key=None, attempts=0,
+                 max_attempts=5, run_at=None, id=None):
+        self.id = id
+        self.name = name
+        self.args = list(args)
+        self.kwargs = dict(kwargs or {})
+        self.queue = queue
+        self.dedup_key = dedup_key
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+        self.run_at = run_at or timezone.now()
+
+    def __repr__(self):
+        return f'<Message {self.name} #{self.id} attempt {self.attempts}>'
+
+
+class Broker:
+    """Interface between enqueueing code and workers"""
+
+    def enqueue(self, message):
+        """Store ``message``; returns its id (an existing id for a deduplicated key)"""
+        raise NotImplementedError
+
+    def reserve(self, queues, worker_id, limit=1):
+        """Claim up to ``limit`` due messages, incrementing their ``attempts``"""
+        raise NotImplementedError
+
+    def ack(self, message):
+        """Mark a claimed message done"""
+        raise NotImplementedError
+
+    def retry(self, message, error, run_at):
+        """Return a claimed message to the queue to run again at ``run_at``"""
+        raise NotImplementedError
+
+    def fail(self, message, error):
+        """Give up on a claimed message"""
+        raise NotImplementedError
+
+    def requeue_stale(self, older_than):
+        """Release messages claimed before ``older_than`` by workers that died; returns the count"""
+        return 0
+
+    def prune(self, before):
+        """Delete finished messages older than ``before``; returns the count"""
+        return 0
+
+    def stats(self, since=None):
+        """{task name: {status counts, retries, avg_run_ms, avg_wait_ms, ...}}"""
+        return {}
+
+
+class DatabaseBroker(Broker):
+    """Messages stored in the ``Task`` table"""
+
+    def enqueue(self, message):
+        from .models import Task
+
+        task = Task(
+            name=message.name,
+            queue=message.queue,
+            args=message.args,
+            kwargs=message.kwargs,
+            dedup_key=message.dedup_key,
+            max_attempts=message.max_attempts,
+            run_at=message.run_at,
+        )
+        if not message.dedup_key:
+            task.save(force_insert=True)
+            return task.pk
+        try:
+            with transaction.atomic():
+                task.save(force_insert=True)
+        except IntegrityError:
+            existing = Task.objects.filter(dedup_key=message.dedup_key, status='queued').values_list(
+                'pk', flat=True
+            ).first()
+            if existing is None:
+                raise
+            return existing
+        return task.pk
+
+    def reserve(self, queues, worker_id, limit=1):
+        from .models import Task
+
+        now = timezone.now()
+        with transaction.atomic():
+            ids = list(
+                Task.objects.select_for_update(skip_locked=True).filter(
+                    status='queued', queue__in=list(queues), run_at__lte=now
+                ).order_by('run_at', 'pk').values_list('pk', flat=True)[:limit]
+            )
+            if not ids:
+                return []
+            # Conditional so two workers on a database without row locks
+            # (SQLite) can never claim the same row
+            Task.objects.filter(pk__in=ids, status='queued').update(
+                status='running',
+                locked_by=worker_id,
+                locked_at=now,
+                started_at=now,
+                attempts=F('attempts') + 1,
+            )
+            rows = Task.objects.filter(pk__in=ids, status='running', locked_by=worker_id, locked_at=now)
+            return [
+                Message(
+                    id=row.pk,
+                    name=row.name,
+                    args=row.args,
+                    kwargs=row.kwargs,
+                    queue=row.queue,
+                    dedup_key=row.dedup_key,
+                    attempts=row.attempts,
+                    max_attempts=row.max_attempts,
+                    run_at=row.run_at,
+                )
+                for row in rows.order_by('run_at', 'pk')
+            ]
+
+    def _finish(self, message, status, error=''):
+        from .models import Task
+
+        Task.objects.filter(pk=message.id).update(
+            status=status, finished_at=timezone.now(), last_error=error, locked_by='', locked_at=None
+        )
+
+    def ack(self, message):
+        self._finish(message, 'succeeded')
+
+    def fail(self, message, error):
+        self._finish(message, 'failed', error)
+
+    def retry(self, message, error, run_at):
+        from .models import Task
+
+        try:
+            with transaction.atomic():
+                Task.objects.filter(pk=message.id).update(
+                    status='queued', run_at=run_at, last_error=error, locked_by='', locked_at=None
+                )
+        except IntegrityError:
+            # A newer call with the same dedup key is queued and will do the work
+            self._finish(message, 'cancelled', error)
+
+    def requeue_stale(self, older_than):
+        from .models import Task
+
+        released = 0
+        stale = Task.objects.filter(status='running', locked_at__lt=older_than).only(
+            'pk', 'attempts', 'max_attempts'
+        )
+        for row in stale:
+            message = Message(name='', id=row.pk, attempts=row.attempts, max_attempts=row.max_attempts)
+            error = 'Worker lost while running the task'
+            if row.attempts >= row.max_attempts:
+                self.fail(message, error)
+            else:
+                self.retry(message, error, timezone.now())
+            released += 1
+        return released
+
+    def prune(self, before, batch_size=10000):
+        from .models import Task
+
+        deleted = 0
+        while True:
+            ids = list(
+                Task.objects.filter(
+                    status__in=['succeeded', 'cancelled'], finished_at__lt=before
+                ).values_list('pk', flat=True)[:batch_size]
+            )
+            if not ids:
+                return deleted
+            deleted += Task.objects.filter(pk__in=ids).delete()[0]
+
+    def stats(self, since=None):
+        from .models import Task
+
+        queryset = Task.objects.all()
+        if since is not None:
+            queryset = queryset.filter(created_at__gte=since)
+        finished = queryset.filter(status__in=['succeeded', 'failed'], started_at__isnull=False)
+        run_time = ExpressionWrapper(F('finished_at') - F('started_at'), output_field=DurationField())
+        wait_time = ExpressionWrapper(F('started_at') - F('run_at'), output_field=DurationField())
+
+        stats = {}
+        for row in queryset.order_by().values('name', 'status').annotate(count=Count('pk')):
+            stats.setdefault(row['name'], {})[row['status']] = row['count']
+        timings = finished.order_by().values('name').annotate(
+            retries=Sum(F('attempts') - 1),
+            avg_run=Avg(run_time),
+            max_run=Max(run_time),
+            avg_wait=Avg(wait_time),
+        )
+        for row in timings:
+            entry = stats.setdefault(row['name'], {})
+            entry['retries'] = row['retries'] or 0
+            entry['avg_run_ms'] = _milliseconds(row['avg_run'])
+            entry['max_run_ms'] = _milliseconds(row['max_run'])
+            entry['avg_wait_ms'] = _milliseconds(row['avg_wait'])
+        for entry in stats.values():
+            done = entry.get('succeeded', 0) + entry.get('failed', 0)
+            entry['failure_rate'] = round(entry.get('failed', 0) / done, 4) if done else 0.0
+        return stats
+
+
+def _milliseconds(value):
+    if value is None:
+        return None
+    if isinstance(value, timedelta):
+        return round(value.total_seconds() * 1000, 2)
+    # Some backends return microseconds
+    return round(value / 1000, 2)
+
+
+class InMemoryBroker(Broker):
+    """Process-local broker with the same semantics as the database broker"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.messages = {}
+        self.status = {}
+        self.errors = {}
+
+    def enqueue(self, message):
+        with self._lock:
+            if message.dedup_key:
+                for message_id, queued in self.messages.items():
+                    if queued.dedup_key == message.dedup_key and self.status[message_id] == 'queued':
+                        return message_id
+            message.id = next(self._ids)
+            self.messages[message.id] = message
+            self.status[message.id] = 'queued'
+            return message.id
+
+    def reserve(self, queues, worker_id, limit=1):
+        now = timezone.now()
+        with self._lock:
+            due = sorted(
+                (
+                    message for message_id, message in self.messages.items()
+                    if self.status[message_id] == 'queued' and message.queue in queues and message.run_at <= now
+                ),
+                key=lambda message: (message.run_at, message.id),
+            )[:limit]
+            for message in due:
+                self.status[message.id] = 'running'
+                message.attempts += 1
+            return due
+
+    def ack(self, message):
+        with self._lock:
+            self.status[message.id] = 'succeeded'
+
+    def fail(self, message, error):
+        with self._lock:
+            self.status[message.id] = 'failed'
+            self.errors[message.id] = error
+
+    def retry(self, message, error, run_at):
+        with self._lock:
+            message.run_at = run_at
+            self.status[message.id] = 'queued'
+            self.errors[message.id] = error
+
+    def pending(self):
+        with self._lock:
+            return sum(1 for status in self.status.values() if status in ('queued', 'running'))
+
+
+class EagerBroker(InMemoryBroker):
+    """Run tasks in-process once the enqueueing transaction commits"""
+
+    def enqueue(self, message):
+        message_id = super().enqueue(message)
+        transaction.on_commit(self._drain)
+        return message_id
+
+    def _drain(self):
+        from .worker import Worker
+
+        with self._lock:
+            queues = {message.queue for message in self.messages.values()}
+        Worker(queues=queues, broker=self).drain()
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """The broker named by ``TASK_BROKER``, created once per process"""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'TASK_BROKER', DEFAULT_BROKER))()
+    return _broker
+
+
+def set_broker(broker):
+    """Replace the process broker (tests); returns the previous one"""
+    global _broker
+    previous, _broker = _broker, broker
+    return previous
@@ -0,0 +1,71 @@
+import json
+import logging
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from taskqueue.registry import registered_tasks
+from taskqueue.worker import Worker, default_worker_id, metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    """Run background task workers"""
+
+    help = (
+        'Process queued background tasks until stopped (SIGTERM/SIGINT finish the running '
+        'task, then exit). Run one or more of these next to the web servers.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queues', nargs='+', default=['default'], help='Queues to consume')
+        parser.add_argument('--concurrency', type=int, default=1, help='Worker threads in this process')
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to sleep when idle')
+        parser.add_argument('--batch-size', type=int, default=10, help='Tasks claimed per poll and thread')
+        parser.add_argument('--once', action='store_true', help='Run everything that is due, then exit')
+        parser.add_argument('--max-tasks', type=int, help='Exit after roughly this many tasks per thread')
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+
+        def stop(signum, frame):
+            logger.info('Received signal %s; stopping after the running tasks', signum)
+            stop_event.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        self.stdout.write(
+            f"Task worker: queues {', '.join(options['queues'])}, "
+            f"{options['concurrency']} thread(s), {len(registered_tasks())} registered task(s)"
+        )
+        worker_id = default_worker_id()
+        workers = [
+            Worker(queues=options['queues'], batch_size=options['batch_size'], worker_id=f'{worker_id}:{index}')
+            for index in range(options['concurrency'])
+        ]
+        processed = [0] * len(workers)
+
+        def work(index):
+            worker = workers[index]
+            if options['once']:
+                worker.maintenance(force=True)
+                processed[index] = worker.drain()
+            else:
+                processed[index] = worker.run(
+                    stop_event=stop_event,
+                    poll_interval=options['poll_interval'],
+                    max_tasks=options['max_tasks'],
+                )
+
+        threads = [threading.Thread(target=work, args=(index,), daemon=True) for index in range(len(workers))]
+        for thread in threads:
+            thread.start()
+        # Join with a timeout so the main thread keeps handling signals
+        while any(thread.is_alive() for thread in threads):
+            for thread in threads:
+                thread.join(timeout=0.5)
+
+        self.stdout.write(json.dumps(metrics.snapshot(), indent=2, sort_keys=True))
+        self.stdout.write(self.style.SUCCESS(f'Processed {sum(processed)} task(s)'))
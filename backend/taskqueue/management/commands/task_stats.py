@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from taskqueue.brokers import get_broker
+
+
+class Command(BaseCommand):
+    """Report background task throughput, failures and latency"""
+
+    help = 'Per-task counts by status, failure rate, retries and average run/queue-wait time'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24, help='Only tasks created in the last N hours (0 for all)')
+
+    def handle(self, *args, **options):
+        since = timezone.now() - timedelta(hours=options['hours']) if options['hours'] else None
+        stats = get_broker().stats(since=since)
+        if not stats:
+            self.stdout.write('No tasks')
+            return
+
+        self.stdout.write(
+            f"{'task':<48}{'queued':>8}{'running':>8}{'ok':>8}{'failed':>8}{'retries':>8}"
+            f"{'fail %':>8}{'avg ms':>10}{'max ms':>10}{'wait ms':>10}"
+        )
+        for name, entry in sorted(stats.items()):
+            self.stdout.write(
+                f"{name:<48}{entry.get('queued', 0):>8}{entry.get('running', 0):>8}"
+                f"{entry.get('succeeded', 0):>8}{entry.get('failed', 0):>8}{entry.get('retries', 0):>8}"
+                f"{entry['failure_rate'] * 100:>8.1f}{_ms(entry.get('avg_run_ms')):>10}"
+                f"{_ms(entry.get('max_run_ms')):>10}{_ms(entry.get('avg_wait_ms')):>10}"
+            )
+
+
+def _ms(value):
+    return '-' if value is None else f'{value:.1f}'
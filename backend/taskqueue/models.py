@@ -0,0 +1,65 @@
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+
+
+class Task(models.Model):
+    """A queued call of a registered background task (database broker)"""
+
+    STATUS_CHOICES = [
+        ('queued', _('Queued')),
+        ('running', _('Running')),
+        ('succeeded', _('Succeeded')),
+        ('failed', _('Failed')),
+        ('cancelled', _('Cancelled')),
+    ]
+
+    name = models.CharField(max_length=200, verbose_name=_('Task Name'))
+    queue = models.CharField(max_length=50, default='default', verbose_name=_('Queue'))
+    args = models.JSONField(default=list, blank=True, verbose_name=_('Arguments'))
+    kwargs = models.JSONField(default=dict, blank=True, verbose_name=_('Keyword Arguments'))
+
+    status = models.CharField(
+        max_length=20,
+        choices=STATUS_CHOICES,
+        default='queued',
+        verbose_name=_('Status')
+    )
+    # At most one queued task per key; enqueueing a duplicate is a no-op
+    dedup_key = models.CharField(max_length=200, null=True, blank=True, verbose_name=_('Dedup Key'))
+
+    attempts = models.PositiveIntegerField(default=0, verbose_name=_('Attempts'))
+    max_attempts = models.PositiveIntegerField(default=5, verbose_name=_('Max Attempts'))
+    run_at = models.DateTimeField(default=timezone.now, verbose_name=_('Run At'))
+
+    locked_by = models.CharField(max_length=100, blank=True, verbose_name=_('Locked By'))
+    locked_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Locked At'))
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Started At'))
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Finished At'))
+    last_error = models.TextField(blank=True, verbose_name=_('Last Error'))
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'taskqueue'
+        verbose_name = _('Task')
+        verbose_name_plural = _('Tasks')
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dedup_key'],
+                condition=models.Q(status='queued'),
+                name='unique_queued_task_dedup_key',
+            ),
+        ]
+        indexes = [
+            # Workers poll only queued rows, so keep that index small
+            models.Index(fields=['queue', 'run_at'], condition=models.Q(status='queued'), name='task_queued_idx'),
+            models.Index(fields=['locked_at'], condition=models.Q(status='running'), name='task_running_idx'),
+            models.Index(fields=['status', 'finished_at']),
+            models.Index(fields=['name', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.status})"
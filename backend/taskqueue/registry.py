@@ -0,0 +1,96 @@
+"""
+Task registration and enqueueing.
+
+Functions decorated with ``@task`` in an app's ``tasks.py`` are registered
+by name when the app registry loads. Calling the function runs it inline;
+``.delay(*args, **kwargs)`` or ``.enqueue(...)`` hands it to the configured
+broker for a worker to run. Arguments must be JSON serializable, and tasks
+must be idempotent: delivery is at least once.
+"""
+
+import random
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from .brokers import Message, get_broker
+
+DEFAULT_QUEUE = 'default'
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_BACKOFF = 10
+DEFAULT_RETRY_BACKOFF_MAX = 3600
+
+_registry = {}
+
+
+class TaskDefinition:
+    """A registered task function and its retry policy"""
+
+    def __init__(self, func, name=None, queue=DEFAULT_QUEUE, max_attempts=None,
+                 retry_backoff=None, retry_backoff_max=None):
+        self.func = func
+        self.name = name or f'{func.__module__}.{func.__name__}'
+        self.queue = queue
+        self.max_attempts = max_attempts or getattr(settings, 'TASK_DEFAULT_MAX_ATTEMPTS', DEFAULT_MAX_ATTEMPTS)
+        self.retry_backoff = retry_backoff if retry_backoff is not None else getattr(
+            settings, 'TASK_RETRY_BACKOFF', DEFAULT_RETRY_BACKOFF
+        )
+        self.retry_backoff_max = retry_backoff_max if retry_backoff_max is not None else getattr(
+            settings, 'TASK_RETRY_BACKOFF_MAX', DEFAULT_RETRY_BACKOFF_MAX
+        )
+        self.__doc__ = func.__doc__
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def __repr__(self):
+        return f'<TaskDefinition {self.name}>'
+
+    def delay(self, *args, **kwargs):
+        return self.enqueue(args=args, kwargs=kwargs)
+
+    def enqueue(self, args=(), kwargs=None, dedup_key=None, countdown=None, queue=None):
+        """Queue a call; returns the broker's message id
+
+        With ``dedup_key``, enqueueing while an identical key is still
+        queued returns the queued message instead of adding another.
+        """
+        now = timezone.now()
+        message = Message(
+            name=self.name,
+            args=list(args),
+            kwargs=dict(kwargs or {}),
+            queue=queue or self.queue,
+            dedup_key=dedup_key,
+            max_attempts=self.max_attempts,
+            run_at=now + timedelta(seconds=countdown) if countdown else now,
+        )
+        return get_broker().enqueue(message)
+
+    def backoff(self, attempt):
+        """Seconds before retry number ``attempt`` (1-based): exponential with jitter"""
+        delay = min(self.retry_backoff * 2 ** (attempt - 1), self.retry_backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+
+def task(func=None, **options):
+    """Register a background task; usable as ``@task`` or ``@task(queue=..., max_attempts=...)``"""
+    def register(func):
+        definition = TaskDefinition(func, **options)
+        if definition.name in _registry and _registry[definition.name].func is not func:
+            raise ValueError(f'Task {definition.name!r} is already registered')
+        _registry[definition.name] = definition
+        return definition
+
+    if func is not None:
+        return register(func)
+    return register
+
+
+def get_task(name):
+    return _registry.get(name)
+
+
+def registered_tasks():
+    return dict(_registry)
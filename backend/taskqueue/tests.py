@@ -0,0 +1,137 @@
+from datetime import timedelta
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+
+from .brokers import DatabaseBroker, set_broker
+from .models import Task
+from .registry import task
+from .worker import Worker
+
+calls = []
+
+
+@task(name='taskqueue.tests.record', queue='tests')
+def record(value):
+    calls.append(value)
+
+
+@task(name='taskqueue.tests.explode', queue='tests', max_attempts=2, retry_backoff=10)
+def explode():
+    raise RuntimeError('boom')
+
+
+class DatabaseBrokerTestCase(TestCase):
+    def setUp(self):
+        calls.clear()
+        self.broker = DatabaseBroker()
+        previous = set_broker(self.broker)
+        self.addCleanup(set_broker, previous)
+        self.worker = Worker(queues=['tests'], broker=self.broker, worker_id='test-worker')
+        # The worker closes connections between tasks, which would end the test's transaction
+        patcher = mock.patch('taskqueue.worker.close_old_connections')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_due(self, task_id):
+        Task.objects.filter(pk=task_id).update(run_at=timezone.now() - timedelta(seconds=1))
+
+
+class EnqueueTests(DatabaseBrokerTestCase):
+    def test_enqueue_stores_the_call(self):
+        task_id = record.delay(1)
+
+        row = Task.objects.get(pk=task_id)
+        self.assertEqual(
+            (row.name, row.queue, row.args, row.status), ('taskqueue.tests.record', 'tests', [1], 'queued')
+        )
+
+        self.assertEqual(self.worker.run_once(), 1)
+        self.assertEqual(calls, [1])
+        self.assertEqual(Task.objects.get(pk=task_id).status, 'succeeded')
+
+    def test_dedup_key_while_queued(self):
+        first = record.enqueue(args=[1], dedup_key='record')
+        duplicate = record.enqueue(args=[2], dedup_key='record')
+
+        self.assertEqual(duplicate, first)
+        self.assertEqual(Task.objects.count(), 1)
+
+        self.worker.run_once()
+        again = record.enqueue(args=[3], dedup_key='record')
+
+        self.assertNotEqual(again, first)
+        self.assertEqual(Task.objects.filter(status='queued').count(), 1)
+
+    def test_countdown(self):
+        task_id = record.enqueue(args=[1], countdown=60)
+
+        self.assertEqual(self.worker.run_once(), 0)
+        self.make_due(task_id)
+        self.assertEqual(self.worker.run_once(), 1)
+
+
+class RetryTests(DatabaseBrokerTestCase):
+    def test_failure_is_retried_with_backoff(self):
+        task_id = explode.delay()
+
+        before = timezone.now()
+        with self.assertLogs('taskqueue.worker', 'WARNING'):
+            self.assertEqual(self.worker.run_once(), 1)
+
+        row = Task.objects.get(pk=task_id)
+        self.assertEqual((row.status, row.attempts, row.locked_by), ('queued', 1, ''))
+        self.assertIn('RuntimeError: boom', row.last_error)
+        # First retry waits between half and all of retry_backoff
+        self.assertGreaterEqual(row.run_at, before + timedelta(seconds=5))
+        self.assertLessEqual(row.run_at, timezone.now() + timedelta(seconds=10))
+        self.assertEqual(self.worker.run_once(), 0)
+
+    def test_backoff_grows_up_to_the_maximum(self):
+        self.assertLessEqual(explode.backoff(1), 10)
+        self.assertGreaterEqual(explode.backoff(3), 20)
+        self.assertLessEqual(explode.backoff(30), explode.retry_backoff_max)
+
+    def test_fails_after_max_attempts(self):
+        task_id = explode.delay()
+        with self.assertLogs('taskqueue.worker', 'WARNING'):
+            self.worker.run_once()
+        self.make_due(task_id)
+
+        with self.assertLogs('taskqueue.worker', 'ERROR'):
+            self.assertEqual(self.worker.run_once(), 1)
+
+        row = Task.objects.get(pk=task_id)
+        self.assertEqual((row.status, row.attempts), ('failed', 2))
+        self.assertIsNotNone(row.finished_at)
+
+    def test_unknown_task_fails(self):
+        task_id = Task.objects.create(name='taskqueue.tests.missing', queue='tests').pk
+
+        with self.assertLogs('taskqueue.worker', 'ERROR'):
+            self.worker.run_once()
+
+        self.assertEqual(Task.objects.get(pk=task_id).status, 'failed')
+
+
+class RequeueStaleTests(DatabaseBrokerTestCase):
+    def running(self, locked_at, attempts=1, max_attempts=5):
+        return Task.objects.create(
+            name='taskqueue.tests.record', queue='tests', args=[1], status='running', locked_by='lost-worker',
+            locked_at=locked_at, attempts=attempts, max_attempts=max_attempts,
+        ).pk
+
+    def test_releases_tasks_of_lost_workers(self):
+        now = timezone.now()
+        stale = self.running(now - timedelta(minutes=10))
+        exhausted = self.running(now - timedelta(minutes=10), attempts=5)
+        fresh = self.running(now)
+
+        released = self.broker.requeue_stale(now - timedelta(minutes=5))
+
+        self.assertEqual(released, 2)
+        statuses = dict(Task.objects.values_list('pk', 'status'))
+        self.assertEqual((statuses[stale], statuses[exhausted], statuses[fresh]), ('queued', 'failed', 'running'))
+        self.assertEqual(self.worker.run_once(), 1)
+        self.assertEqual(calls, [1])
@@ -0,0 +1,182 @@
+"""
+Task worker.
+
+``Worker.run`` polls the broker for due messages on its queues and runs them
+in the worker's thread. A task that raises is retried after an exponential
+backoff (``TaskDefinition.backoff``) until ``max_attempts`` is reached, then
+marked failed. Messages claimed by a worker that died are released after
+``TASK_VISIBILITY_TIMEOUT`` seconds, and finished messages are pruned after
+``TASK_RESULT_TTL_DAYS``. Per-task run time, queue wait and outcomes are
+collected in ``metrics``.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .brokers import get_broker
+from .registry import get_task
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_VISIBILITY_TIMEOUT = 300
+DEFAULT_RESULT_TTL_DAYS = 7
+MAINTENANCE_INTERVAL = 60
+
+
+class TaskMetrics:
+    """Thread-safe outcome/latency counters per task name"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._stats = defaultdict(lambda: {
+                'succeeded': 0, 'failed': 0, 'retried': 0,
+                'run_time': 0.0, 'max_run_time': 0.0, 'wait_time': 0.0,
+            })
+
+    def record(self, name, outcome, run_time, wait_time):
+        with self._lock:
+            stats = self._stats[name]
+            stats[outcome] += 1
+            stats['run_time'] += run_time
+            stats['max_run_time'] = max(stats['max_run_time'], run_time)
+            stats['wait_time'] += wait_time
+
+    def snapshot(self):
+        """{name: {'succeeded', 'failed', 'retried', 'failure_rate', 'avg_run_ms', 'avg_wait_ms', ...}}"""
+        with self._lock:
+            result = {}
+            for name, stats in self._stats.items():
+                runs = stats['succeeded'] + stats['failed'] + stats['retried']
+                result[name] = {
+                    'succeeded': stats['succeeded'],
+                    'failed': stats['failed'],
+                    'retried': stats['retried'],
+                    'failure_rate': round((stats['failed'] + stats['retried']) / runs, 4) if runs else 0.0,
+                    'avg_run_ms': round(stats['run_time'] * 1000 / runs, 3) if runs else 0.0,
+                    'max_run_ms': round(stats['max_run_time'] * 1000, 3),
+                    'avg_wait_ms': round(stats['wait_time'] * 1000 / runs, 3) if runs else 0.0,
+                }
+            return result
+
+
+metrics = TaskMetrics()
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+
+class Worker:
+    """Claims messages from a broker and runs them"""
+
+    def __init__(self, queues=None, broker=None, batch_size=1, worker_id=None):
+        self.queues = list(queues or ['default'])
+        self.broker = broker or get_broker()
+        self.batch_size = batch_size
+        self.worker_id = worker_id or default_worker_id()
+        self.visibility_timeout = getattr(settings, 'TASK_VISIBILITY_TIMEOUT', DEFAULT_VISIBILITY_TIMEOUT)
+        self.result_ttl = timedelta(days=getattr(settings, 'TASK_RESULT_TTL_DAYS', DEFAULT_RESULT_TTL_DAYS))
+        self._last_maintenance = None
+
+    def process(self, message):
+        """Run one claimed message and report the outcome to the broker"""
+        definition = get_task(message.name)
+        wait_time = max((timezone.now() - message.run_at).total_seconds(), 0.0)
+        if definition is None:
+            logger.error('Unknown task %s (#%s)', message.name, message.id)
+            self.broker.fail(message, f'Unknown task {message.name!r}')
+            metrics.record(message.name, 'failed', 0.0, wait_time)
+            return 'failed'
+
+        close_old_connections()
+        started = time.perf_counter()
+        try:
+            definition.func(*message.args, **message.kwargs)
+        except Exception:
+            run_time = time.perf_counter() - started
+            error = traceback.format_exc()
+            if message.attempts < message.max_attempts:
+                delay = definition.backoff(message.attempts)
+                logger.warning(
+                    'Task %s #%s failed (attempt %s/%s); retrying in %.0fs',
+                    message.name, message.id, message.attempts, message.max_attempts, delay
+                )
+                self.broker.retry(message, error, timezone.now() + timedelta(seconds=delay))
+                outcome = 'retried'
+            else:
+                logger.error(
+                    'Task %s #%s failed after %s attempts', message.name, message.id, message.attempts,
+                    exc_info=True
+                )
+                self.broker.fail(message, error)
+                outcome = 'failed'
+        else:
+            run_time = time.perf_counter() - started
+            self.broker.ack(message)
+            outcome = 'succeeded'
+        finally:
+            close_old_connections()
+        metrics.record(message.name, outcome, run_time, wait_time)
+        return outcome
+
+    def maintenance(self, force=False):
+        """Release messages of dead workers and prune old results, at most once a minute"""
+        now = time.monotonic()
+        if not force and self._last_maintenance is not None and now - self._last_maintenance < MAINTENANCE_INTERVAL:
+            return
+        self._last_maintenance = now
+        released = self.broker.requeue_stale(timezone.now() - timedelta(seconds=self.visibility_timeout))
+        if released:
+            logger.warning('Released %s task(s) held by lost workers', released)
+        self.broker.prune(timezone.now() - self.result_ttl)
+
+    def run_once(self):
+        """Claim and run one batch; returns the number of messages processed"""
+        messages = self.broker.reserve(self.queues, self.worker_id, limit=self.batch_size)
+        for message in messages:
+            self.process(message)
+        return len(messages)
+
+    def drain(self):
+        """Run until nothing on the worker's queues is due"""
+        processed = 0
+        while True:
+            count = self.run_once()
+            if not count:
+                return processed
+            processed += count
+
+    def run(self, stop_event=None, poll_interval=1.0, max_tasks=None):
+        """Poll until ``stop_event`` is set or ``max_tasks`` messages were processed"""
+        stop_event = stop_event or threading.Event()
+        processed = 0
+        while not stop_event.is_set():
+            try:
+                self.maintenance()
+                count = self.run_once()
+            except Exception:
+                # Typically the database being unreachable; back off and retry
+                logger.exception('Task worker %s poll failed', self.worker_id)
+                close_old_connections()
+                count = 0
+            processed += count
+            if max_tasks is not None and processed >= max_tasks:
+                break
+            if not count:
+                stop_event.wait(poll_interval)
+        return processed